@@ -0,0 +1,565 @@
+import contextlib
+import dataclasses
+import logging
+import subprocess
+import tempfile
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from importlib.resources import files
+from pathlib import Path
+
+from meds import held_out_split
+
+from ..datasets import DATASETS
+from ..models import MODELS
+from ..tasks import TASKS
+from ..utils import stream_subprocess
+
+logger = logging.getLogger(__name__)
+
+CFG_YAML = files("MEDS_DEV.configs") / "_run_benchmark.yaml"
+
+
+@dataclasses.dataclass(frozen=True)
+class Stage:
+    """A single node in the benchmark graph.
+
+    Attributes:
+        name: The unique name of the stage within the graph, e.g., `"task/MIMIC-IV/mortality/in_icu"`.
+        cmd: The command to run, as a list of arguments. This is always a call to one of the MEDS-DEV CLI
+            helpers (e.g., `meds-dev-task`), so each stage runs in its own process.
+        depends_on: The names of the stages that must complete successfully before this stage can run.
+
+    Examples:
+        >>> Stage("foo", ["echo", "foo"])
+        Stage(name='foo', cmd=['echo', 'foo'], depends_on=())
+        >>> Stage("bar", ["echo", "bar"], depends_on=("foo",))
+        Stage(name='bar', cmd=['echo', 'bar'], depends_on=('foo',))
+    """
+
+    name: str
+    cmd: list[str]
+    depends_on: tuple[str, ...] = ()
+
+
+def _kwargs_to_args(**kwargs) -> list[str]:
+    """Converts keyword arguments into a list of Hydra CLI overrides, dropping `None` values.
+
+    Examples:
+        >>> _kwargs_to_args(a=1, b="foo", c=None, d=True)
+        ['a=1', 'b=foo', 'd=True']
+    """
+    return [f"{k}={v}" for k, v in kwargs.items() if v is not None]
+
+
+def _has_unsupervised_train(model: str) -> bool:
+    unsupervised_commands = MODELS[model]["commands"].get("unsupervised", None)
+    return bool(unsupervised_commands) and bool(unsupervised_commands.get("train", None))
+
+
+def supported_pairs(datasets: list[str], tasks: list[str]) -> list[tuple[str, str]]:
+    """Returns the (dataset, task) pairs for which the task declares support for the dataset.
+
+    Args:
+        datasets: The datasets to consider.
+        tasks: The tasks to consider.
+
+    Returns:
+        The list of (dataset, task) pairs, in dataset-major order, for which the task's metadata lists the
+        dataset among its `supported_datasets`.
+
+    Examples:
+        >>> supported_pairs(["MIMIC-IV"], ["mortality/in_icu/first_24h"])
+        [('MIMIC-IV', 'mortality/in_icu/first_24h')]
+        >>> supported_pairs(["_not_a_dataset"], ["mortality/in_icu/first_24h"])
+        []
+    """
+    out = []
+    for dataset in datasets:
+        for task in tasks:
+            task_metadata = TASKS[task]["metadata"]
+            if task_metadata is None or not task_metadata.supported_datasets:
+                continue
+            if dataset in task_metadata.supported_datasets:
+                out.append((dataset, task))
+    return out
+
+
+def build_benchmark_graph(
+    root_dir: Path | str,
+    datasets: list[str] | None = None,
+    tasks: list[str] | None = None,
+    models: list[str] | None = None,
+    dataset_dirs: dict[str, str] | None = None,
+    demo: bool = False,
+    stage_cache_dir: Path | str | None = None,
+    venv_store_dir: Path | str | None = None,
+) -> dict[str, Stage]:
+    """Expands the dataset x task x model matrix into a dependency graph of MEDS-DEV CLI stages.
+
+    The graph contains, per dataset, a build stage (unless a pre-built dataset directory is given); per
+    supported (dataset, task) pair, a label extraction stage; per (dataset, model), an unsupervised
+    pre-training stage if the model supports it; and per (dataset, task, model), a supervised `mode=full`
+    model stage, an evaluation stage, and a result packaging stage. All outputs are stored under `root_dir`:
+
+      - `datasets/$DATASET`: The built MEDS dataset.
+      - `labels/$DATASET/$TASK`: The extracted task labels.
+      - `models/$MODEL/$DATASET/...`: The model outputs, in the layout used by `meds-dev-model mode=full`.
+      - `evaluations/$DATASET/$TASK/$MODEL`: The evaluation outputs.
+      - `results/$DATASET/$TASK/$MODEL.json`: The packaged result.
+
+    Args:
+        root_dir: The root directory for all benchmark outputs.
+        datasets: The datasets to include. Defaults to all configured datasets.
+        tasks: The tasks to include. Defaults to all configured tasks. Only tasks that list a dataset in their
+            `supported_datasets` metadata will be run on that dataset.
+        models: The models to include. Defaults to all configured models.
+        dataset_dirs: An optional mapping from dataset name to the directory of an already built copy of that
+            dataset. Datasets listed here will not be built.
+        demo: Whether to build the demo versions of datasets and run models in demo mode.
+        stage_cache_dir: If given, all dataset, task, model, and evaluation stages run through this shared
+            content-addressed stage cache (see `MEDS_DEV.stage_cache`).
+        venv_store_dir: If given, all dataset and model stages share the virtual environments in this store
+            (see `MEDS_DEV.utils.venv_from_store`) instead of each building their own.
+
+    Returns:
+        A dictionary mapping stage names to stages, in a valid topological order.
+
+    Raises:
+        ValueError: If any dataset, task, or model is not configured.
+
+    Examples:
+        >>> graph = build_benchmark_graph(
+        ...     "bench", datasets=["MIMIC-IV"], tasks=["mortality/in_icu/first_24h"],
+        ...     models=["random_predictor"], demo=True,
+        ... )
+        >>> for name, stage in graph.items():
+        ...     print(name, "<-", list(stage.depends_on))
+        dataset/MIMIC-IV <- []
+        task/MIMIC-IV/mortality/in_icu/first_24h <- ['dataset/MIMIC-IV']
+        model/MIMIC-IV/mortality/in_icu/first_24h/random_predictor <- ['task/MIMIC-IV/mortality/in_icu/first_24h']
+        evaluation/MIMIC-IV/mortality/in_icu/first_24h/random_predictor <- ['model/MIMIC-IV/mortality/in_icu/first_24h/random_predictor']
+        result/MIMIC-IV/mortality/in_icu/first_24h/random_predictor <- ['evaluation/MIMIC-IV/mortality/in_icu/first_24h/random_predictor']
+        >>> print(" ".join(graph["task/MIMIC-IV/mortality/in_icu/first_24h"].cmd))  # doctest: +NORMALIZE_WHITESPACE
+        meds-dev-task task=mortality/in_icu/first_24h dataset=MIMIC-IV dataset_dir=bench/datasets/MIMIC-IV
+            output_dir=bench/labels/MIMIC-IV/mortality/in_icu/first_24h
+
+    Pre-built datasets are not re-built, and models that support unsupervised training get a pre-training
+    stage shared across all tasks on a dataset:
+
+        >>> graph = build_benchmark_graph(
+        ...     "bench", datasets=["MIMIC-IV"], tasks=["mortality/in_icu/first_24h"], models=["cehrbert"],
+        ...     dataset_dirs={"MIMIC-IV": "/data/MIMIC-IV"},
+        ... )
+        >>> for name, stage in graph.items():
+        ...     print(name, "<-", list(stage.depends_on))
+        task/MIMIC-IV/mortality/in_icu/first_24h <- []
+        pretrain/MIMIC-IV/cehrbert <- []
+        model/MIMIC-IV/mortality/in_icu/first_24h/cehrbert <- ['task/MIMIC-IV/mortality/in_icu/first_24h', 'pretrain/MIMIC-IV/cehrbert']
+        evaluation/MIMIC-IV/mortality/in_icu/first_24h/cehrbert <- ['model/MIMIC-IV/mortality/in_icu/first_24h/cehrbert']
+        result/MIMIC-IV/mortality/in_icu/first_24h/cehrbert <- ['evaluation/MIMIC-IV/mortality/in_icu/first_24h/cehrbert']
+        >>> print(" ".join(graph["pretrain/MIMIC-IV/cehrbert"].cmd))  # doctest: +NORMALIZE_WHITESPACE
+        meds-dev-model model=cehrbert dataset_type=unsupervised mode=train dataset_dir=/data/MIMIC-IV
+            dataset_name=MIMIC-IV output_dir=bench/models/cehrbert/MIMIC-IV/unsupervised/train demo=False
+            venv_dir=bench/models/cehrbert/MIMIC-IV/unsupervised/.venv
+
+    Unknown names raise errors:
+
+        >>> build_benchmark_graph("bench", datasets=["_not_a_dataset"])
+        Traceback (most recent call last):
+            ...
+        ValueError: Dataset _not_a_dataset not currently configured! Available datasets: ...
+        >>> build_benchmark_graph("bench", tasks=["_not_a_task"])
+        Traceback (most recent call last):
+            ...
+        ValueError: Task _not_a_task not currently configured. Configured tasks: ...
+        >>> build_benchmark_graph("bench", models=["_not_a_model"])
+        Traceback (most recent call last):
+            ...
+        ValueError: Model _not_a_model not currently configured. Available models: ...
+    """  # noqa: E501
+
+    root_dir = Path(root_dir)
+    datasets = list(DATASETS) if datasets is None else list(datasets)
+    tasks = list(TASKS) if tasks is None else list(tasks)
+    models = list(MODELS) if models is None else list(models)
+    dataset_dirs = dict(dataset_dirs) if dataset_dirs else {}
+
+    for dataset in datasets:
+        if dataset not in DATASETS and dataset not in dataset_dirs:
+            raise ValueError(
+                f"Dataset {dataset} not currently configured! Available datasets: {DATASETS.keys()}"
+            )
+    for task in tasks:
+        if task not in TASKS:
+            raise ValueError(f"Task {task} not currently configured. Configured tasks: {TASKS.keys()}")
+    for model in models:
+        if model not in MODELS:
+            raise ValueError(f"Model {model} not currently configured. Available models: {MODELS.keys()}")
+
+    graph = {}
+
+    def add(stage: Stage):
+        graph[stage.name] = stage
+
+    for dataset in datasets:
+        if dataset in dataset_dirs:
+            continue
+        add(
+            Stage(
+                name=f"dataset/{dataset}",
+                cmd=[
+                    "meds-dev-dataset",
+                    *_kwargs_to_args(
+                        dataset=dataset,
+                        output_dir=root_dir / "datasets" / dataset,
+                        demo=demo,
+                        stage_cache_dir=stage_cache_dir,
+                        venv_store_dir=venv_store_dir,
+                    ),
+                ],
+            )
+        )
+
+    def dataset_deps(dataset: str) -> tuple[str, ...]:
+        return () if dataset in dataset_dirs else (f"dataset/{dataset}",)
+
+    def dataset_dir(dataset: str) -> Path:
+        return Path(dataset_dirs[dataset]) if dataset in dataset_dirs else root_dir / "datasets" / dataset
+
+    pairs = supported_pairs(datasets, tasks)
+    for dataset, task in pairs:
+        add(
+            Stage(
+                name=f"task/{dataset}/{task}",
+                cmd=[
+                    "meds-dev-task",
+                    *_kwargs_to_args(
+                        task=task,
+                        dataset=dataset,
+                        dataset_dir=dataset_dir(dataset),
+                        output_dir=root_dir / "labels" / dataset / task,
+                        stage_cache_dir=stage_cache_dir,
+                    ),
+                ],
+                depends_on=dataset_deps(dataset),
+            )
+        )
+
+    for dataset in dict.fromkeys(d for d, _ in pairs):
+        for model in models:
+            if not _has_unsupervised_train(model):
+                continue
+            unsupervised_dir = root_dir / "models" / model / dataset / "unsupervised"
+            add(
+                Stage(
+                    name=f"pretrain/{dataset}/{model}",
+                    cmd=[
+                        "meds-dev-model",
+                        *_kwargs_to_args(
+                            model=model,
+                            dataset_type="unsupervised",
+                            mode="train",
+                            dataset_dir=dataset_dir(dataset),
+                            dataset_name=dataset,
+                            output_dir=unsupervised_dir / "train",
+                            demo=demo,
+                            venv_dir=unsupervised_dir / ".venv",
+                            stage_cache_dir=stage_cache_dir,
+                            venv_store_dir=venv_store_dir,
+                        ),
+                    ],
+                    depends_on=dataset_deps(dataset),
+                )
+            )
+
+    for dataset, task in pairs:
+        for model in models:
+            model_dir = root_dir / "models" / model
+            depends_on = [f"task/{dataset}/{task}"]
+            model_initialization_dir = None
+            if _has_unsupervised_train(model):
+                depends_on.append(f"pretrain/{dataset}/{model}")
+                model_initialization_dir = model_dir / dataset / "unsupervised" / "train"
+
+            # Each (dataset, task, model) run gets its own virtual environment, so that concurrently running
+            # stages for the same model never write into the same environment. With a `venv_store_dir`, the
+            # store's locking makes sharing one environment across these stages safe instead.
+            model_stage = Stage(
+                name=f"model/{dataset}/{task}/{model}",
+                cmd=[
+                    "meds-dev-model",
+                    *_kwargs_to_args(
+                        model=model,
+                        dataset_type="supervised",
+                        mode="full",
+                        dataset_dir=dataset_dir(dataset),
+                        labels_dir=root_dir / "labels" / dataset / task,
+                        dataset_name=dataset,
+                        task_name=task,
+                        output_dir=model_dir,
+                        model_initialization_dir=model_initialization_dir,
+                        demo=demo,
+                        venv_dir=model_dir / dataset / task / ".venv",
+                        stage_cache_dir=stage_cache_dir,
+                        venv_store_dir=venv_store_dir,
+                    ),
+                ],
+                depends_on=tuple(depends_on),
+            )
+            add(model_stage)
+
+            evaluation_dir = root_dir / "evaluations" / dataset / task / model
+            evaluation_stage = Stage(
+                name=f"evaluation/{dataset}/{task}/{model}",
+                cmd=[
+                    "meds-dev-evaluation",
+                    *_kwargs_to_args(
+                        predictions_dir=model_dir / dataset / task / "predict",
+                        labels_path=root_dir
+                        / "labels"
+                        / dataset
+                        / task
+                        / held_out_split
+                        / "**"
+                        / "*.parquet",
+                        output_dir=evaluation_dir,
+                        stage_cache_dir=stage_cache_dir,
+                    ),
+                ],
+                depends_on=(model_stage.name,),
+            )
+            add(evaluation_stage)
+
+            add(
+                Stage(
+                    name=f"result/{dataset}/{task}/{model}",
+                    cmd=[
+                        "meds-dev-pack-result",
+                        *_kwargs_to_args(
+                            dataset=dataset,
+                            task=task,
+                            model=model,
+                            evaluation_fp=evaluation_dir / "results.json",
+                            result_fp=root_dir / "results" / dataset / task / f"{model}.json",
+                            do_overwrite=True,
+                        ),
+                    ],
+                    depends_on=(evaluation_stage.name,),
+                )
+            )
+
+    return graph
+
+
+def run_stage(stage: Stage, log_dir: Path | str | None = None) -> subprocess.CompletedProcess:
+    """Runs a single stage's command, raising an error if it fails.
+
+    The stage's output is streamed to `stdout.log` and `stderr.log` in `log_dir/$STAGE_NAME` (or in a
+    temporary directory, if `log_dir` is not given) rather than held in memory, as several stages, with
+    possibly very large logs, can run at once. Only the last lines of each stream are kept, to report on
+    failure.
+
+    Args:
+        stage: The stage to run.
+        log_dir: The directory to write the logs of each stage in.
+
+    Returns:
+        The completed process, whose `stdout` and `stderr` hold only the tails of the output streams.
+
+    Examples:
+        >>> run_stage(Stage("ok", ["python", "-c", "print('hi')"])).stdout
+        b'hi\\n'
+        >>> run_stage(Stage("bad", ["python", "-c", "import sys; sys.exit('oh no')"]))
+        Traceback (most recent call last):
+            ...
+        RuntimeError: Stage bad failed with exit code 1:
+        COMMAND:
+        python -c import sys; sys.exit('oh no')
+        STDERR:
+        oh no
+        ...
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     code = "[print(i) for i in range(10_000)]"
+        ...     out = run_stage(Stage("task/foo", ["python", "-c", code]), log_dir=d)
+        ...     n_logged = len((Path(d) / "task" / "foo" / "stdout.log").read_text().splitlines())
+        >>> n_logged, out.stdout.splitlines()[-1]
+        (10000, b'9999')
+    """
+    logger.info(f"Running stage {stage.name}: {' '.join(stage.cmd)}")
+    with contextlib.ExitStack() as stack:
+        if log_dir is None:
+            stage_log_dir = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        else:
+            stage_log_dir = Path(log_dir) / stage.name
+        out = stream_subprocess(stage.cmd, stage_log_dir)
+    if out.returncode != 0:
+        logs = "" if log_dir is None else f" (full logs in {stage_log_dir})"
+        raise RuntimeError(
+            f"Stage {stage.name} failed with exit code {out.returncode}{logs}:\n"
+            f"COMMAND:\n{' '.join(stage.cmd)}\n"
+            f"STDERR:\n{out.stderr.decode(errors='replace')}\n"
+            f"STDOUT:\n{out.stdout.decode(errors='replace')}"
+        )
+    return out
+
+
+def check_graph(graph: dict[str, Stage]) -> tuple[dict[str, int], dict[str, list[str]]]:
+    """Checks that all dependencies of a benchmark graph exist and that it has no cycles.
+
+    Returns:
+        The number of dependencies of each stage and the stages that directly depend on each stage.
+
+    Raises:
+        ValueError: If the graph has a dependency on a stage that does not exist or has a cycle.
+
+    Examples:
+        >>> check_graph({"a": Stage("a", ["true"]), "b": Stage("b", ["true"], depends_on=("a",))})
+        ({'a': 0, 'b': 1}, {'a': ['b'], 'b': []})
+    """
+
+    for stage in graph.values():
+        for dep in stage.depends_on:
+            if dep not in graph:
+                raise ValueError(f"Stage {stage.name} depends on unknown stage {dep}.")
+
+    # Kahn's algorithm, to reject cycles up front.
+    n_deps = {name: len(stage.depends_on) for name, stage in graph.items()}
+    dependents = {name: [] for name in graph}
+    for stage in graph.values():
+        for dep in stage.depends_on:
+            dependents[dep].append(stage.name)
+
+    frontier = [name for name, n in n_deps.items() if n == 0]
+    remaining = dict(n_deps)
+    n_visited = 0
+    while frontier:
+        name = frontier.pop()
+        n_visited += 1
+        for child in dependents[name]:
+            remaining[child] -= 1
+            if remaining[child] == 0:
+                frontier.append(child)
+    if n_visited != len(graph):
+        cycle = sorted(name for name, n in remaining.items() if n > 0)
+        raise ValueError(f"Benchmark graph has a cycle among stages: {', '.join(cycle)}")
+
+    return n_deps, dependents
+
+
+def run_benchmark_graph(
+    graph: dict[str, Stage],
+    n_workers: int = 1,
+    runner: Callable[[Stage], object] = run_stage,
+) -> dict[str, str]:
+    """Runs the stages of a benchmark graph, running independent stages concurrently.
+
+    Each stage is a separate MEDS-DEV CLI process, so the pool here only dispatches and waits on those
+    subprocesses; at most `n_workers` stages run at any one time. A stage is started as soon as all of its
+    dependencies have finished successfully. If a stage fails, all stages that (transitively) depend on it
+    are skipped, but all other stages continue to run.
+
+    Args:
+        graph: The benchmark graph, as returned by `build_benchmark_graph`.
+        n_workers: The maximum number of stages to run concurrently.
+        runner: The function used to run a single stage. Defaults to `run_stage`.
+
+    Returns:
+        A dictionary mapping each stage name to its status: one of `"done"`, `"failed"`, or `"skipped"`.
+
+    Raises:
+        ValueError: If the graph has a dependency on a stage that does not exist or has a cycle.
+
+    Examples:
+        >>> import threading
+        >>> order, lock = [], threading.Lock()
+        >>> def record(stage):
+        ...     with lock:
+        ...         order.append(stage.name)
+        >>> graph = {
+        ...     "a": Stage("a", ["a"]),
+        ...     "b": Stage("b", ["b"], depends_on=("a",)),
+        ...     "c": Stage("c", ["c"], depends_on=("a",)),
+        ...     "d": Stage("d", ["d"], depends_on=("b", "c")),
+        ... }
+        >>> run_benchmark_graph(graph, n_workers=2, runner=record)
+        {'a': 'done', 'b': 'done', 'c': 'done', 'd': 'done'}
+        >>> order[0], sorted(order[1:3]), order[3]
+        ('a', ['b', 'c'], 'd')
+
+    Failures propagate to dependents only:
+
+        >>> graph = {
+        ...     "a": Stage("a", ["python", "-c", "raise SystemExit(1)"]),
+        ...     "b": Stage("b", ["python", "-c", "pass"], depends_on=("a",)),
+        ...     "c": Stage("c", ["python", "-c", "pass"], depends_on=("b",)),
+        ...     "d": Stage("d", ["python", "-c", "pass"]),
+        ... }
+        >>> run_benchmark_graph(graph, n_workers=2)
+        {'a': 'failed', 'b': 'skipped', 'c': 'skipped', 'd': 'done'}
+
+    Malformed graphs raise errors before anything runs:
+
+        >>> run_benchmark_graph({"a": Stage("a", ["true"], depends_on=("z",))})
+        Traceback (most recent call last):
+            ...
+        ValueError: Stage a depends on unknown stage z.
+        >>> run_benchmark_graph({
+        ...     "a": Stage("a", ["true"], depends_on=("b",)), "b": Stage("b", ["true"], depends_on=("a",))
+        ... })
+        Traceback (most recent call last):
+            ...
+        ValueError: Benchmark graph has a cycle among stages: a, b
+    """
+
+    n_deps, dependents = check_graph(graph)
+
+    status = {}
+    waiting_on = dict(n_deps)
+
+    def skip_dependents(name: str):
+        for child in dependents[name]:
+            if child not in status:
+                status[child] = "skipped"
+                logger.warning(f"Skipping stage {child} as its dependency {name} did not succeed.")
+                skip_dependents(child)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        running: dict[Future, str] = {}
+
+        def submit_ready():
+            for name, n in waiting_on.items():
+                if n == 0 and name not in status and name not in running.values():
+                    running[pool.submit(runner, graph[name])] = name
+
+        submit_ready()
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Stage {name} failed: {e}")
+                    status[name] = "failed"
+                    skip_dependents(name)
+                    continue
+
+                logger.info(f"Stage {name} finished successfully.")
+                status[name] = "done"
+                for child in dependents[name]:
+                    waiting_on[child] -= 1
+            submit_ready()
+
+    return {name: status[name] for name in graph}
+
+
+__all__ = [
+    "CFG_YAML",
+    "Stage",
+    "build_benchmark_graph",
+    "check_graph",
+    "run_benchmark_graph",
+    "supported_pairs",
+]
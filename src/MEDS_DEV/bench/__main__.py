@@ -0,0 +1,55 @@
+import functools
+import json
+import logging
+from pathlib import Path
+
+import hydra
+from omegaconf import DictConfig, OmegaConf
+
+from . import CFG_YAML, build_benchmark_graph, run_benchmark_graph, run_stage
+from .job_queue import queue_status, run_queue_workers, submit_graph
+
+logger = logging.getLogger(__name__)
+
+
+@hydra.main(version_base=None, config_path=str(CFG_YAML.parent), config_name=CFG_YAML.stem)
+def main(cfg: DictConfig):
+    output_dir = Path(cfg.output_dir)
+
+    dataset_dirs = OmegaConf.to_container(cfg.dataset_dirs) if cfg.get("dataset_dirs", None) else None
+
+    graph = build_benchmark_graph(
+        root_dir=output_dir,
+        datasets=cfg.get("datasets", None),
+        tasks=cfg.get("tasks", None),
+        models=cfg.get("models", None),
+        dataset_dirs=dataset_dirs,
+        demo=cfg.demo,
+        stage_cache_dir=cfg.get("stage_cache_dir", None),
+        venv_store_dir=cfg.get("venv_store_dir", None),
+    )
+    queue_dir = cfg.get("queue_dir", None)
+    if queue_dir:
+        # The queue is shared with any other machines running the same benchmark, so the status is only read
+        # back once it is drained.
+        submit_graph(queue_dir, graph)
+        logger.info(f"Running the jobs of {queue_dir} with {cfg.n_workers} workers.")
+        run_queue_workers(queue_dir, n_workers=cfg.n_workers, stale_after_s=cfg.queue_stale_after_s)
+        queue = queue_status(queue_dir)
+        status = {name: queue[name] for name in graph}
+    else:
+        logger.info(f"Running benchmark graph of {len(graph)} stages with {cfg.n_workers} workers.")
+        runner = functools.partial(run_stage, log_dir=output_dir / ".logs" / "stages")
+        status = run_benchmark_graph(graph, n_workers=cfg.n_workers, runner=runner)
+
+    status_fp = output_dir / "status.json"
+    status_fp.parent.mkdir(parents=True, exist_ok=True)
+    status_fp.write_text(json.dumps(status, indent=2))
+
+    failed = [name for name, s in status.items() if s == "failed"]
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} benchmark stage(s) failed: {', '.join(failed)}. See {status_fp} for details."
+        )
+
+    logger.info(f"Benchmark finished successfully. Stage statuses written to {status_fp}.")
@@ -0,0 +1,421 @@
+"""A file-based job queue, to run a benchmark graph cooperatively from several machines sharing a filesystem.
+
+There is no scheduler service: the queue is a directory (e.g., on an NFS mount) that any number of worker
+processes, on any number of machines, poll for jobs. Every state change is a single atomic `rename` (or an
+exclusive `link`), so exactly one worker wins any race, and no locks (which are unreliable over NFS) are
+needed. The queue directory is laid out as:
+
+    jobs/$STAGE/job.json    The stage's name, command, and dependencies, written once when it is submitted.
+    jobs/$STAGE/            Also the stage's run directory (see `MEDS_DEV.utils.run_in_env`), holding its
+                            `cmd.sh`, logs, and the `.done` marker that records that the stage has finished.
+    pending/$KEY            Jobs that are waiting to be claimed.
+    running/$KEY@$WORKER    Jobs claimed by a worker, whose heartbeat keeps updating their modification time.
+    failed/$KEY             Jobs whose command failed, holding the error.
+    skipped/$KEY            Jobs that were not run because a dependency failed.
+    workers/$WORKER         Each live worker's own heartbeat.
+
+A worker claims a job by renaming it from `pending/` to `running/` under its own name, once all of the job's
+dependencies are done. If a worker dies, its claims stop being refreshed; once a claim is older than
+`stale_after_s`, any other worker renames it back to `pending/` and the job is run again. As claims are named
+after the worker holding them, a stale claim can never be confused with a newer claim of the same job. Ages
+are measured against the modification time of the worker's own heartbeat file, so that they only depend on
+the shared filesystem's clock and not on those of the machines.
+
+Re-running a job is safe: a stage whose `.done` marker exists is never re-run, and the MEDS-DEV commands run
+by the stages themselves skip the work they have already completed in their output directories.
+"""
+
+import json
+import logging
+import os
+import platform
+import shlex
+import threading
+import time
+import uuid
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import quote, unquote
+
+from ..utils import run_in_env
+from . import Stage, check_graph
+
+logger = logging.getLogger(__name__)
+
+JOB_FILE = "job.json"
+STATE_DIRS = ("pending", "running", "failed", "skipped", "workers")
+
+
+def _key(name: str) -> str:
+    return quote(name, safe="")
+
+
+def _job_dir(queue_dir: Path, name: str) -> Path:
+    return queue_dir / "jobs" / name
+
+
+def _touch(fp: Path) -> float:
+    """Creates or updates a file and returns its new modification time, as set by its filesystem."""
+    fp.touch()
+    return fp.stat().st_mtime
+
+
+def submit_graph(queue_dir: Path | str, graph: dict[str, Stage]) -> list[str]:
+    """Submits the stages of a benchmark graph to a queue as jobs.
+
+    Submission is idempotent, and safe to run concurrently from several machines: a stage that is already in
+    the queue, in whatever state, is not submitted again.
+
+    Args:
+        queue_dir: The queue directory. It is created if it does not exist.
+        graph: The benchmark graph, as returned by `MEDS_DEV.bench.build_benchmark_graph`.
+
+    Returns:
+        The names of the newly submitted stages.
+
+    Raises:
+        ValueError: If the graph is malformed (see `MEDS_DEV.bench.check_graph`), or if one of its stages is
+            already in the queue with a different command or dependencies.
+
+    Examples:
+        >>> import tempfile
+        >>> graph = {"a": Stage("a", ["echo", "a"]), "b/c": Stage("b/c", ["echo", "b"], depends_on=("a",))}
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     print(submit_graph(d, graph))
+        ...     print(submit_graph(d, graph))
+        ...     print(queue_status(d))
+        ...     try:
+        ...         submit_graph(d, {"a": Stage("a", ["echo", "other"])})
+        ...     except ValueError as e:
+        ...         print(e)
+        ['a', 'b/c']
+        []
+        {'a': 'pending', 'b/c': 'pending'}
+        Stage a is already in the queue with a different command or dependencies. Use a new queue directory.
+    """
+    queue_dir = Path(queue_dir)
+    check_graph(graph)
+
+    specs = {
+        name: {"name": name, "cmd": list(stage.cmd), "depends_on": list(stage.depends_on), "order": order}
+        for order, (name, stage) in enumerate(graph.items())
+    }
+    for name, spec in specs.items():
+        job_fp = _job_dir(queue_dir, name) / JOB_FILE
+        if job_fp.is_file():
+            existing = json.loads(job_fp.read_text())
+            if (existing["cmd"], existing["depends_on"]) != (spec["cmd"], spec["depends_on"]):
+                raise ValueError(
+                    f"Stage {name} is already in the queue with a different command or dependencies. "
+                    "Use a new queue directory."
+                )
+
+    for state_dir in STATE_DIRS:
+        (queue_dir / state_dir).mkdir(parents=True, exist_ok=True)
+
+    submitted = []
+    for name, spec in specs.items():
+        job_dir = _job_dir(queue_dir, name)
+        job_dir.mkdir(parents=True, exist_ok=True)
+
+        # Linking a complete file into place fails if the job exists, so only one submitter ever queues it.
+        tmp_fp = job_dir / f".{JOB_FILE}.{uuid.uuid4().hex}"
+        tmp_fp.write_text(json.dumps(spec, indent=2))
+        try:
+            os.link(tmp_fp, job_dir / JOB_FILE)
+        except FileExistsError:
+            continue
+        finally:
+            tmp_fp.unlink()
+
+        (queue_dir / "pending" / _key(name)).touch()
+        submitted.append(name)
+
+    logger.info(f"Submitted {len(submitted)}/{len(graph)} stages to the queue in {queue_dir}.")
+    return submitted
+
+
+def _load_jobs(queue_dir: Path) -> dict[str, Stage]:
+    specs = [json.loads(fp.read_text()) for fp in (queue_dir / "jobs").glob(f"**/{JOB_FILE}")]
+    return {
+        spec["name"]: Stage(spec["name"], spec["cmd"], tuple(spec["depends_on"]))
+        for spec in sorted(specs, key=lambda spec: (spec["order"], spec["name"]))
+    }
+
+
+def _keys(queue_dir: Path, state_dir: str) -> list[str]:
+    if not (queue_dir / state_dir).is_dir():
+        return []
+    return [fp.name for fp in (queue_dir / state_dir).iterdir() if not fp.name.startswith(".")]
+
+
+def queue_status(queue_dir: Path | str) -> dict[str, str]:
+    """Returns the status of each job in the queue.
+
+    Returns:
+        A dictionary mapping the name of each job's stage, in submission order, to its status: one of
+        `"pending"`, `"running"`, `"done"`, `"failed"`, or `"skipped"`.
+    """
+    queue_dir = Path(queue_dir)
+    status = {}
+    for state_dir in ("pending", "failed", "skipped"):
+        status.update({unquote(key): state_dir for key in _keys(queue_dir, state_dir)})
+    status.update({unquote(claim.split("@", 1)[0]): "running" for claim in _keys(queue_dir, "running")})
+
+    out = {}
+    for name in _load_jobs(queue_dir):
+        # A job's `.done` marker is authoritative: a worker may have died after finishing it but before
+        # releasing its claim.
+        if (_job_dir(queue_dir, name) / ".done").is_file():
+            out[name] = "done"
+        else:
+            out[name] = status.get(name, "pending")
+    return out
+
+
+def reclaim_stale_claims(queue_dir: Path | str, now: float, stale_after_s: float) -> list[str]:
+    """Returns the jobs claimed by workers whose last heartbeat is older than `stale_after_s` to the queue.
+
+    Args:
+        queue_dir: The queue directory.
+        now: The current time, as a modification time on the queue's filesystem.
+        stale_after_s: How long, in seconds, a claim may go without a heartbeat before it is reclaimed.
+
+    Returns:
+        The names of the reclaimed jobs.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     _ = submit_graph(d, {"a": Stage("a", ["true"]), "b": Stage("b", ["true"])})
+        ...     for name in ("a", "b"):
+        ...         _ = (Path(d) / "pending" / name).rename(Path(d) / "running" / f"{name}@worker-{name}")
+        ...     os.utime(Path(d) / "running" / "a@worker-a", (0, 0))
+        ...     print(queue_status(d))
+        ...     print(reclaim_stale_claims(d, now=time.time(), stale_after_s=60))
+        ...     print(queue_status(d))
+        {'a': 'running', 'b': 'running'}
+        ['a']
+        {'a': 'pending', 'b': 'running'}
+    """
+    queue_dir = Path(queue_dir)
+    reclaimed = []
+    for claim in _keys(queue_dir, "running"):
+        claim_fp = queue_dir / "running" / claim
+        key, worker = claim.split("@", 1)
+        try:
+            age = now - claim_fp.stat().st_mtime
+            if age <= stale_after_s:
+                continue
+            # The claim is named after its worker, so this can only move this (stale) claim of the job.
+            claim_fp.rename(queue_dir / "pending" / key)
+        except FileNotFoundError:
+            continue  # The job finished or was reclaimed by another worker in the meantime.
+        logger.warning(f"Reclaimed job {unquote(key)} from worker {worker}, last seen {age:.0f}s ago.")
+        reclaimed.append(unquote(key))
+
+    for worker in _keys(queue_dir, "workers"):
+        worker_fp = queue_dir / "workers" / worker
+        try:
+            if now - worker_fp.stat().st_mtime > stale_after_s:
+                worker_fp.unlink()
+        except FileNotFoundError:
+            pass
+    return reclaimed
+
+
+def run_job(stage: Stage, job_dir: Path):
+    """Runs a job's command with `MEDS_DEV.utils.run_in_env`, using the job's directory as its run directory.
+
+    The command's script, logs, and resource usage are stored in `job_dir`, and `run_in_env` writes the
+    job's `.done` marker there once the command succeeds.
+    """
+    run_in_env(shlex.join(stage.cmd), job_dir)
+
+
+def _run_claimed(
+    queue_dir: Path,
+    stage: Stage,
+    claim_fp: Path,
+    runner: Callable[[Stage, Path], object],
+    heartbeat_s: float,
+) -> str:
+    job_dir = _job_dir(queue_dir, stage.name)
+    done_fp = job_dir / ".done"
+    if done_fp.is_file():
+        logger.info(f"Skipping job {stage.name} because {done_fp} exists.")
+        claim_fp.unlink(missing_ok=True)
+        return "done"
+
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(heartbeat_s):
+            try:
+                os.utime(claim_fp)
+            except FileNotFoundError:
+                logger.warning(f"Lost the claim on job {stage.name}; another worker may re-run it.")
+                return
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    logger.info(f"Running job {stage.name}: {shlex.join(stage.cmd)}")
+    try:
+        runner(stage, job_dir)
+    except Exception as e:
+        logger.error(f"Job {stage.name} failed: {e}")
+        failed_fp = queue_dir / "failed" / claim_fp.name.split("@", 1)[0]
+        try:
+            claim_fp.rename(failed_fp)
+            failed_fp.write_text(str(e))
+        except FileNotFoundError:
+            pass
+        return "failed"
+    finally:
+        stop.set()
+        heartbeat_thread.join()
+
+    done_fp.touch()
+    claim_fp.unlink(missing_ok=True)
+    logger.info(f"Job {stage.name} finished successfully.")
+    return "done"
+
+
+def run_queue_worker(
+    queue_dir: Path | str,
+    runner: Callable[[Stage, Path], object] = run_job,
+    stale_after_s: float = 600.0,
+    heartbeat_s: float | None = None,
+    poll_s: float = 5.0,
+) -> dict[str, str]:
+    """Claims and runs jobs from a queue until none are left pending or running.
+
+    Jobs are claimed in submission order once all of their dependencies are done; jobs that depend on a job
+    that failed (or was skipped) are skipped. When no job can be claimed but others are still running, the
+    worker waits for them, reclaiming any claims that go stale in the meantime.
+
+    Args:
+        queue_dir: The queue directory, to which jobs were submitted with `submit_graph`.
+        runner: The function used to run a single job, given its stage and its job directory. It must raise
+            an error if the job fails. Defaults to `run_job`.
+        stale_after_s: How long, in seconds, a claim may go without a heartbeat before it is reclaimed.
+        heartbeat_s: How often, in seconds, to refresh the claim on the running job; by default, a tenth of
+            `stale_after_s`.
+        poll_s: How long, in seconds, to wait between checks of the queue when no job can be claimed.
+
+    Returns:
+        A dictionary mapping the name of each job this worker ran to its outcome, `"done"` or `"failed"`.
+
+    Raises:
+        ValueError: If `heartbeat_s` is not shorter than `stale_after_s`.
+
+    Examples:
+        >>> import tempfile
+        >>> graph = {
+        ...     "a": Stage("a", ["python", "-c", "print('a')"]),
+        ...     "b": Stage("b", ["python", "-c", "raise SystemExit(1)"], depends_on=("a",)),
+        ...     "c": Stage("c", ["python", "-c", "print('c')"], depends_on=("b",)),
+        ...     "d": Stage("d", ["python", "-c", "print('d')"], depends_on=("a",)),
+        ... }
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     _ = submit_graph(d, graph)
+        ...     print(run_queue_worker(d, poll_s=0.1))
+        ...     print(queue_status(d))
+        ...     print((Path(d) / "jobs" / "a" / ".logs" / "stdout.log").read_text().strip())
+        ...     print(run_queue_worker(d, poll_s=0.1))
+        {'a': 'done', 'b': 'failed', 'd': 'done'}
+        {'a': 'done', 'b': 'failed', 'c': 'skipped', 'd': 'done'}
+        a
+        {}
+        >>> run_queue_worker("queue", stale_after_s=10, heartbeat_s=10)
+        Traceback (most recent call last):
+            ...
+        ValueError: heartbeat_s (10) must be shorter than stale_after_s (10).
+    """
+    queue_dir = Path(queue_dir)
+    if heartbeat_s is None:
+        heartbeat_s = stale_after_s / 10
+    if heartbeat_s >= stale_after_s:
+        raise ValueError(f"heartbeat_s ({heartbeat_s}) must be shorter than stale_after_s ({stale_after_s}).")
+
+    for state_dir in STATE_DIRS:
+        (queue_dir / state_dir).mkdir(parents=True, exist_ok=True)
+
+    worker = f"{platform.node()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    worker_fp = queue_dir / "workers" / worker
+    logger.info(f"Worker {worker} polling the queue in {queue_dir}.")
+
+    ran = {}
+    try:
+        while True:
+            now = _touch(worker_fp)
+            reclaim_stale_claims(queue_dir, now, stale_after_s)
+
+            jobs = _load_jobs(queue_dir)
+            status = queue_status(queue_dir)
+            pending = set(_keys(queue_dir, "pending"))
+            claimed = None
+            for name, stage in jobs.items():
+                # A pending job may already be done, if it was reclaimed from a worker that died just after
+                # finishing it; claiming it then only releases it.
+                if _key(name) not in pending:
+                    continue
+                dep_status = [status[dep] for dep in stage.depends_on]
+                if any(s in ("failed", "skipped") for s in dep_status):
+                    try:
+                        (queue_dir / "pending" / _key(name)).rename(queue_dir / "skipped" / _key(name))
+                        logger.warning(f"Skipping job {name} as one of its dependencies did not succeed.")
+                    except FileNotFoundError:
+                        pass
+                    continue
+                if any(s != "done" for s in dep_status):
+                    continue
+
+                claim_fp = queue_dir / "running" / f"{_key(name)}@{worker}"
+                try:
+                    (queue_dir / "pending" / _key(name)).rename(claim_fp)
+                except FileNotFoundError:
+                    continue  # Another worker claimed it first.
+                claimed = (stage, claim_fp)
+                break
+
+            if claimed is not None:
+                stage, claim_fp = claimed
+                ran[stage.name] = _run_claimed(queue_dir, stage, claim_fp, runner, heartbeat_s)
+            elif not _keys(queue_dir, "pending") and not _keys(queue_dir, "running"):
+                break
+            else:
+                time.sleep(poll_s)
+    finally:
+        worker_fp.unlink(missing_ok=True)
+
+    logger.info(f"Worker {worker} found no more jobs after running {len(ran)}.")
+    return ran
+
+
+def run_queue_workers(queue_dir: Path | str, n_workers: int = 1, **kwargs) -> dict[str, str]:
+    """Runs `n_workers` queue workers concurrently in this process, until the queue is drained.
+
+    Each worker claims and runs one job at a time (each job being a separate MEDS-DEV CLI process), so the
+    workers only need threads. Keyword arguments are passed to `run_queue_worker`.
+
+    Returns:
+        A dictionary mapping the name of each job these workers ran to its outcome.
+    """
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(run_queue_worker, queue_dir, **kwargs) for _ in range(n_workers)]
+        ran = {}
+        for future in futures:
+            ran.update(future.result())
+    return ran
+
+
+__all__ = [
+    "queue_status",
+    "reclaim_stale_claims",
+    "run_job",
+    "run_queue_worker",
+    "run_queue_workers",
+    "submit_graph",
+]
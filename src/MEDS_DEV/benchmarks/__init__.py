@@ -0,0 +1,295 @@
+"""Performance benchmarks of the MEDS-DEV harness itself.
+
+Unlike `MEDS_DEV.bench`, which runs the dataset x task x model matrix to produce results, this suite measures
+how long the harness takes to produce them. It runs the full pipeline (dataset build, task extraction,
+prediction with the `random_predictor` model, evaluation, and result packaging) over synthetic datasets of
+several sizes, records the resources each stage used, and compares the timings against a stored baseline
+report.
+"""
+
+import dataclasses
+import json
+import logging
+import math
+import platform
+import shutil
+from importlib.resources import files
+from pathlib import Path
+
+from ..stage_cache import package_versions
+from ..utils import ResourceUsage, stream_subprocess
+
+logger = logging.getLogger(__name__)
+
+CFG_YAML = files("MEDS_DEV.configs") / "_run_perf_benchmarks.yaml"
+
+DATASET = "synthetic"
+MODEL = "random_predictor"
+STAGES = ("dataset", "task", "predict", "evaluation", "result")
+
+
+def pipeline_commands(
+    root_dir: Path | str,
+    n_subjects: int,
+    task: str,
+    subjects_per_shard: int = 50_000,
+    events_per_subject: int = 50,
+    n_workers: int = 1,
+) -> dict[str, list[str]]:
+    """Returns the command of each pipeline stage for one synthetic dataset size, in the order they run.
+
+    Args:
+        root_dir: The directory to store all of the pipeline's outputs in.
+        n_subjects: The number of subjects in the synthetic dataset.
+        task: The task to extract and predict.
+        subjects_per_shard: The number of subjects per shard (per split) of the synthetic dataset.
+        events_per_subject: The mean number of measurements per subject in the synthetic dataset.
+        n_workers: The number of workers to extract task shards with.
+
+    Returns:
+        A dictionary mapping each stage in `STAGES` to its command.
+
+    Examples:
+        >>> cmds = pipeline_commands("perf", 1000, "mortality/in_icu/first_24h", subjects_per_shard=400)
+        >>> list(cmds) == list(STAGES)
+        True
+        >>> print(" ".join(cmds["dataset"]))  # doctest: +NORMALIZE_WHITESPACE
+        meds-dev-dataset dataset=synthetic output_dir=perf/dataset n_subjects=1000 n_shards=3
+            events_per_subject=50
+        >>> print(" ".join(cmds["task"]))  # doctest: +NORMALIZE_WHITESPACE
+        meds-dev-task task=mortality/in_icu/first_24h dataset=synthetic dataset_dir=perf/dataset
+            output_dir=perf/labels n_workers=1
+    """
+    root_dir = Path(root_dir)
+    dataset_dir = root_dir / "dataset"
+    labels_dir = root_dir / "labels"
+    predictions_dir = root_dir / "predictions"
+    evaluation_dir = root_dir / "evaluation"
+    n_shards = max(1, math.ceil(n_subjects / subjects_per_shard))
+
+    return {
+        "dataset": [
+            "meds-dev-dataset",
+            f"dataset={DATASET}",
+            f"output_dir={dataset_dir}",
+            f"n_subjects={n_subjects}",
+            f"n_shards={n_shards}",
+            f"events_per_subject={events_per_subject}",
+        ],
+        "task": [
+            "meds-dev-task",
+            f"task={task}",
+            f"dataset={DATASET}",
+            f"dataset_dir={dataset_dir}",
+            f"output_dir={labels_dir}",
+            f"n_workers={n_workers}",
+        ],
+        "predict": [
+            "meds-dev-model",
+            f"model={MODEL}",
+            "dataset_type=supervised",
+            "mode=predict",
+            "split=held_out",
+            f"dataset_dir={dataset_dir}",
+            f"labels_dir={labels_dir}",
+            f"output_dir={predictions_dir}",
+        ],
+        "evaluation": [
+            "meds-dev-evaluation",
+            f"predictions_dir={predictions_dir}",
+            f"output_dir={evaluation_dir}",
+        ],
+        "result": [
+            "meds-dev-pack-result",
+            f"dataset={DATASET}",
+            f"task={task}",
+            f"model={MODEL}",
+            f"evaluation_fp={evaluation_dir / 'results.json'}",
+            f"result_fp={root_dir / 'result.json'}",
+            "do_overwrite=True",
+        ],
+    }
+
+
+def run_timed(name: str, cmd: list[str], log_dir: Path) -> ResourceUsage:
+    """Runs a command, returning the resources it used and raising an error if it fails.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     usage = run_timed("ok", ["python", "-c", "print('hi')"], Path(d))
+        ...     run_timed("bad", ["python", "-c", "raise SystemExit('oh no')"], Path(d))
+        Traceback (most recent call last):
+            ...
+        RuntimeError: Benchmark stage bad failed with exit code 1:
+        COMMAND:
+        python -c raise SystemExit('oh no')
+        STDERR:
+        oh no
+        ...
+        >>> usage.wall_time_s > 0
+        True
+    """
+    resources_fp = log_dir / f"{name}.resources.json"
+    out = stream_subprocess(cmd, log_dir / name, resources_fp=resources_fp)
+    if out.returncode != 0:
+        raise RuntimeError(
+            f"Benchmark stage {name} failed with exit code {out.returncode}:\n"
+            f"COMMAND:\n{' '.join(cmd)}\n"
+            f"STDERR:\n{out.stderr.decode(errors='replace')}\n"
+            f"STDOUT:\n{out.stdout.decode(errors='replace')}"
+        )
+    return ResourceUsage(**json.loads(resources_fp.read_text()))
+
+
+def run_suite(
+    root_dir: Path | str,
+    n_subjects: list[int],
+    task: str,
+    repeats: int = 1,
+    subjects_per_shard: int = 50_000,
+    events_per_subject: int = 50,
+    n_workers: int = 1,
+    keep_outputs: bool = False,
+) -> dict:
+    """Runs the pipeline at each dataset size, `repeats` times, and returns the benchmark report.
+
+    Each repetition runs the whole pipeline from scratch in its own directory. A stage's reported wall time is
+    the minimum over repetitions, which is the least noisy estimate of its cost; all runs are kept in the
+    report as well.
+
+    Args:
+        root_dir: The directory to run the pipelines in.
+        n_subjects: The synthetic dataset sizes to benchmark.
+        task: The task to extract and predict.
+        repeats: How many times to run the pipeline at each size.
+        subjects_per_shard: The number of subjects per shard (per split) of the synthetic datasets.
+        events_per_subject: The mean number of measurements per subject in the synthetic datasets.
+        n_workers: The number of workers to extract task shards with.
+        keep_outputs: Whether to keep each pipeline's outputs. If false, they are deleted after each run, as
+            large synthetic datasets take up significant disk space.
+
+    Returns:
+        The report, with the environment the suite ran in and, per dataset size and stage, the minimum wall
+        time and the resources used by each run.
+    """
+    root_dir = Path(root_dir)
+    report = {
+        "environment": {
+            "packages": package_versions(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "task": task,
+        "repeats": repeats,
+        "scales": {},
+    }
+
+    for n in n_subjects:
+        scale = f"{n}_subjects"
+        runs = {stage: [] for stage in STAGES}
+        for i in range(repeats):
+            run_dir = root_dir / scale / f"run_{i}"
+            if run_dir.exists():
+                shutil.rmtree(run_dir)
+            cmds = pipeline_commands(
+                run_dir,
+                n,
+                task,
+                subjects_per_shard=subjects_per_shard,
+                events_per_subject=events_per_subject,
+                n_workers=n_workers,
+            )
+            for stage, cmd in cmds.items():
+                logger.info(f"Running {stage} at {scale} (run {i + 1}/{repeats}).")
+                usage = run_timed(stage, cmd, run_dir / ".logs")
+                logger.info(f"{stage} at {scale} took {usage.wall_time_s:.2f}s.")
+                runs[stage].append(dataclasses.asdict(usage))
+            if not keep_outputs:
+                shutil.rmtree(run_dir)
+
+        report["scales"][scale] = {
+            stage: {"wall_time_s": min(r["wall_time_s"] for r in stage_runs), "runs": stage_runs}
+            for stage, stage_runs in runs.items()
+        }
+
+    return report
+
+
+@dataclasses.dataclass
+class Regression:
+    """A pipeline stage that got slower than in the baseline report.
+
+    Attributes:
+        scale: The dataset size, e.g., `"1000_subjects"`.
+        stage: The pipeline stage.
+        baseline_s: The stage's wall time in the baseline report, in seconds.
+        current_s: The stage's wall time in the current report, in seconds.
+
+    Examples:
+        >>> print(Regression("1000_subjects", "task", 10.0, 12.5))
+        task at 1000_subjects: 10.00s -> 12.50s (+25%)
+    """
+
+    scale: str
+    stage: str
+    baseline_s: float
+    current_s: float
+
+    def __str__(self) -> str:
+        slowdown = self.current_s / self.baseline_s - 1 if self.baseline_s > 0 else math.inf
+        return (
+            f"{self.stage} at {self.scale}: {self.baseline_s:.2f}s -> {self.current_s:.2f}s ({slowdown:+.0%})"
+        )
+
+
+def compare_reports(
+    report: dict, baseline: dict, threshold: float = 0.2, min_delta_s: float = 1.0
+) -> list[Regression]:
+    """Compares a benchmark report against a baseline report, returning the stages that regressed.
+
+    A stage regressed if its wall time grew by more than `threshold` (as a fraction of the baseline time) and
+    by more than `min_delta_s` seconds, so that noise on very short stages is not flagged. Scales and stages
+    that are not in both reports are ignored.
+
+    Args:
+        report: The current report, from `run_suite`.
+        baseline: The baseline report to compare against.
+        threshold: The fractional slowdown above which a stage is flagged.
+        min_delta_s: The minimum absolute slowdown, in seconds, for a stage to be flagged.
+
+    Returns:
+        The regressions, in report order.
+
+    Examples:
+        >>> def make_report(task_s):
+        ...     return {"scales": {"1000_subjects": {
+        ...         "dataset": {"wall_time_s": 5.0}, "task": {"wall_time_s": task_s}
+        ...     }}}
+        >>> compare_reports(make_report(11.0), make_report(10.0))
+        []
+        >>> for regression in compare_reports(make_report(15.0), make_report(10.0)):
+        ...     print(regression)
+        task at 1000_subjects: 10.00s -> 15.00s (+50%)
+        >>> compare_reports(make_report(15.0), make_report(10.0), min_delta_s=10)
+        []
+        >>> compare_reports(make_report(15.0), {"scales": {"10_subjects": {}}})
+        []
+    """
+    regressions = []
+    for scale, stages in report["scales"].items():
+        baseline_stages = baseline.get("scales", {}).get(scale, None)
+        if baseline_stages is None:
+            logger.warning(f"Scale {scale} is not in the baseline report; not comparing it.")
+            continue
+        for stage, timing in stages.items():
+            if stage not in baseline_stages:
+                continue
+            baseline_s = baseline_stages[stage]["wall_time_s"]
+            current_s = timing["wall_time_s"]
+            if current_s - baseline_s > max(threshold * baseline_s, min_delta_s):
+                regressions.append(Regression(scale, stage, baseline_s, current_s))
+    return regressions
+
+
+__all__ = ["CFG_YAML", "STAGES", "Regression", "compare_reports", "pipeline_commands", "run_suite"]
@@ -0,0 +1,56 @@
+import dataclasses
+import json
+import logging
+from pathlib import Path
+
+import hydra
+from omegaconf import DictConfig
+
+from . import CFG_YAML, compare_reports, run_suite
+
+logger = logging.getLogger(__name__)
+
+
+@hydra.main(version_base=None, config_path=str(CFG_YAML.parent), config_name=CFG_YAML.stem)
+def main(cfg: DictConfig):
+    output_dir = Path(cfg.output_dir)
+    n_subjects = [cfg.n_subjects] if isinstance(cfg.n_subjects, int) else list(cfg.n_subjects)
+
+    baseline_fp = Path(cfg.baseline_fp) if cfg.get("baseline_fp", None) else None
+    if baseline_fp is not None and not baseline_fp.is_file() and not cfg.save_baseline:
+        raise FileNotFoundError(
+            f"Baseline report {baseline_fp} not found. Run with save_baseline=true first."
+        )
+
+    report = run_suite(
+        output_dir,
+        n_subjects,
+        cfg.task,
+        repeats=cfg.repeats,
+        subjects_per_shard=cfg.subjects_per_shard,
+        events_per_subject=cfg.events_per_subject,
+        n_workers=cfg.n_workers,
+        keep_outputs=cfg.keep_outputs,
+    )
+
+    regressions = []
+    if baseline_fp is not None and baseline_fp.is_file():
+        baseline = json.loads(baseline_fp.read_text())
+        regressions = compare_reports(report, baseline, threshold=cfg.threshold, min_delta_s=cfg.min_delta_s)
+        report["baseline_fp"] = str(baseline_fp)
+        report["regressions"] = [dataclasses.asdict(r) for r in regressions]
+
+    report_fp = output_dir / "report.json"
+    report_fp.write_text(json.dumps(report, indent=2))
+    logger.info(f"Benchmark report written to {report_fp}.")
+
+    if baseline_fp is not None and cfg.save_baseline:
+        baseline_fp.parent.mkdir(parents=True, exist_ok=True)
+        baseline_fp.write_text(json.dumps(report, indent=2))
+        logger.info(f"Saved the report as the new baseline in {baseline_fp}.")
+
+    if regressions:
+        raise RuntimeError(
+            f"{len(regressions)} stage(s) regressed by more than {cfg.threshold:.0%} against {baseline_fp}:\n"
+            + "\n".join(f"  - {r}" for r in regressions)
+        )
@@ -1,9 +1,12 @@
 import dataclasses
 from enum import StrEnum, auto
 from importlib.resources import files
+from pathlib import Path
+from typing import Any
 
 from omegaconf import OmegaConf
 
+from ..registry import LazyRegistry
 from ..utils import Metadata
 
 
@@ -97,21 +100,58 @@ class DatasetMetadata(Metadata):
             raise ValueError("access_details must be provided if access_policy is set to AccessPolicy.OTHER")
 
 
-dataset_files = files("MEDS_DEV.datasets")
 CFG_YAML = files("MEDS_DEV.configs") / "_build_dataset.yaml"
+MATERIALIZE_CFG_YAML = files("MEDS_DEV.configs") / "_materialize_dataset.yaml"
+PROFILE_CFG_YAML = files("MEDS_DEV.configs") / "_profile_dataset.yaml"
+RESHARD_CFG_YAML = files("MEDS_DEV.configs") / "_reshard_dataset.yaml"
+SUBSAMPLE_CFG_YAML = files("MEDS_DEV.configs") / "_subsample_dataset.yaml"
 
-DATASETS = {}
-for path in dataset_files.rglob("*/dataset.yaml"):
-    dataset_name = path.relative_to(dataset_files).parent.with_suffix("").as_posix()
 
+def load_dataset(path: Path) -> dict[str, Any]:
+    """Loads and validates the specification of the dataset whose `dataset.yaml` is at `path`.
+
+    A dataset that uses the same codes as another can share its predicates, rather than keeping a copy of
+    them that could drift, by naming it under the `predicates_from` key of its `dataset.yaml`.
+
+    Examples:
+        >>> spec = load_dataset(DATASETS.root / "datasets" / "synthetic" / "dataset.yaml")
+        >>> spec["metadata"].access_policy
+        <AccessPolicy.PUBLIC_UNRESTRICTED: 'public_unrestricted'>
+        >>> spec["predicates"].relative_to(DATASETS.root).as_posix(), spec["requirements"]
+        ('datasets/MIMIC-IV/predicates.yaml', None)
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     fp = Path(d) / "foo" / "dataset.yaml"
+        ...     fp.parent.mkdir()
+        ...     _ = fp.write_text("predicates_from: bar")
+        ...     load_dataset(fp)
+        Traceback (most recent call last):
+            ...
+        ValueError: .../foo/dataset.yaml takes its predicates from unknown dataset bar
+    """
     spec = OmegaConf.to_object(OmegaConf.load(path))
     requirements_path = path.parent / "requirements.txt"
-    predicates_path = path.parent / "predicates.yaml"
-    DATASETS[dataset_name] = {
+    predicates_dir = path.parent
+    if spec.get("predicates_from", None) is not None:
+        predicates_dir = path.parent.parent / spec["predicates_from"]
+        if not (predicates_dir / "dataset.yaml").is_file():
+            raise ValueError(f"{path} takes its predicates from unknown dataset {spec['predicates_from']}")
+    predicates_path = predicates_dir / "predicates.yaml"
+    return {
         "metadata": DatasetMetadata(**spec["metadata"]),
         "commands": spec.get("commands", None),
         "predicates": predicates_path if predicates_path.exists() else None,
         "requirements": requirements_path if requirements_path.exists() else None,
     }
 
-__all__ = ["CFG_YAML", "DATASETS"]
+
+DATASETS = LazyRegistry("datasets", load_dataset)
+
+__all__ = [
+    "CFG_YAML",
+    "DATASETS",
+    "MATERIALIZE_CFG_YAML",
+    "PROFILE_CFG_YAML",
+    "RESHARD_CFG_YAML",
+    "SUBSAMPLE_CFG_YAML",
+]
@@ -1,3 +1,4 @@
+import json
 import logging
 import shutil
 from pathlib import Path
@@ -6,7 +7,18 @@ import hydra
 from omegaconf import DictConfig
 
 from ..utils import run_in_env, temp_env
-from . import CFG_YAML, DATASETS
+from . import (
+    CFG_YAML,
+    DATASETS,
+    MATERIALIZE_CFG_YAML,
+    PROFILE_CFG_YAML,
+    RESHARD_CFG_YAML,
+    SUBSAMPLE_CFG_YAML,
+)
+from .materialize import materialize_dataset
+from .profiling import profile_dataset
+from .reshard import reshard_dataset
+from .subsample import subsample_dataset
 
 logger = logging.getLogger(__name__)
 
@@ -29,14 +41,18 @@ def main(cfg: DictConfig):
         output_dir.mkdir(parents=True, exist_ok=False)
 
     done_fp = output_dir / ".done"
-    if done_fp.is_file():  # pragma: no cover
+    if done_fp.is_file() and not cfg.get("stage_cache_dir", None):  # pragma: no cover
         logger.info(f"Output directory {output_dir} already exists and is marked as done.")
         return
 
     build_cmd = commands["build_demo"] if cfg.demo else commands["build_full"]
+    default_size = cfg.default_size["demo" if cfg.demo else "full"]
+    size = {k: default_size[k] if cfg.get(k, None) is None else cfg[k] for k in default_size}
 
     with temp_env(cfg, requirements) as (build_temp_dir, env):
-        build_cmd = build_cmd.format(output_dir=cfg.output_dir, temp_dir=str(build_temp_dir.resolve()))
+        build_cmd = build_cmd.format(
+            output_dir=cfg.output_dir, temp_dir=str(build_temp_dir.resolve()), **size
+        )
 
         logger.info(f"Considering running build command: {build_cmd}")
         run_in_env(
@@ -45,5 +61,103 @@ def main(cfg: DictConfig):
             env=env,
             do_overwrite=cfg.do_overwrite,
             cwd=build_temp_dir,
+            cache_dir=cfg.get("stage_cache_dir", None),
+            live_tail=cfg.get("live_tail", False),
+            cache_inputs={"requirements": requirements},
         )
         logger.info(f"Build {cfg.dataset} command {build_cmd} completed successfully.")
+
+
+def _derived_dataset_dirs(cfg: DictConfig) -> tuple[Path, Path]:
+    """Resolves the input and output directories of a stage that derives a new dataset from a built one.
+
+    The output directory must not be within the input directory. If `do_overwrite` is set, everything in an
+    existing output directory except its logs is removed.
+    """
+    input_dir = Path(cfg.input_dir).resolve()
+    output_dir = Path(cfg.output_dir).resolve()
+    if input_dir == output_dir or input_dir in output_dir.parents:
+        raise ValueError(f"Output directory {output_dir} must not be within the input directory {input_dir}")
+
+    if cfg.do_overwrite and (output_dir / "data").exists():
+        logger.info(f"Removing existing data in {output_dir}")
+        for fp in output_dir.iterdir():
+            if fp.name == ".logs":
+                continue
+            if fp.is_dir():
+                shutil.rmtree(fp)
+            else:
+                fp.unlink()
+
+    return input_dir, output_dir
+
+
+@hydra.main(version_base=None, config_path=str(RESHARD_CFG_YAML.parent), config_name=RESHARD_CFG_YAML.stem)
+def reshard(cfg: DictConfig):
+    """Rewrites a MEDS dataset into `n_shards` shards balanced by event count."""
+
+    input_dir, output_dir = _derived_dataset_dirs(cfg)
+    done_fp = output_dir / ".done"
+    if done_fp.is_file():
+        logger.info(f"Output directory {output_dir} already exists and is marked as done.")
+        return
+
+    report = reshard_dataset(
+        input_dir,
+        output_dir,
+        n_shards=int(cfg.n_shards),
+        row_group_size=cfg.row_group_size,
+        n_workers=int(cfg.n_workers),
+    )
+    for split, stats in report["splits"].items():
+        logger.info(
+            f"{split}: {stats['n_input_shards']} shards (largest {stats['max_input_shard_events']} events)"
+            f" -> {stats['n_shards']} shards (largest {stats['max_shard_events']} events)"
+        )
+    done_fp.touch()
+
+
+@hydra.main(
+    version_base=None, config_path=str(SUBSAMPLE_CFG_YAML.parent), config_name=SUBSAMPLE_CFG_YAML.stem
+)
+def subsample(cfg: DictConfig):
+    """Writes a subset of a fraction of the subjects of a MEDS dataset, stratified by split (and label)."""
+
+    input_dir, output_dir = _derived_dataset_dirs(cfg)
+    done_fp = output_dir / ".done"
+    if done_fp.is_file():
+        logger.info(f"Output directory {output_dir} already exists and is marked as done.")
+        return
+
+    report = subsample_dataset(
+        input_dir,
+        output_dir,
+        fraction=float(cfg.fraction),
+        seed=int(cfg.seed),
+        labels_dir=cfg.labels_dir,
+        n_workers=int(cfg.n_workers),
+    )
+    for stratum, counts in report["strata"].items():
+        logger.info(f"{stratum}: kept {counts['n_sampled_subjects']} of {counts['n_subjects']} subjects")
+    logger.info(
+        f"Wrote {report['n_sampled_subjects']} subjects ({report['n_events']} events) to {output_dir}"
+    )
+    done_fp.touch()
+
+
+@hydra.main(version_base=None, config_path=str(PROFILE_CFG_YAML.parent), config_name=PROFILE_CFG_YAML.stem)
+def profile(cfg: DictConfig):
+    """Computes (or reuses) the cached profile of a MEDS dataset and prints its summary."""
+
+    dataset_profile = profile_dataset(cfg.dataset_dir, cfg.profile_dir, n_workers=int(cfg.n_workers))
+    print(json.dumps({"profile_dir": str(dataset_profile.profile_dir), **dataset_profile.summary}, indent=2))
+
+
+@hydra.main(
+    version_base=None, config_path=str(MATERIALIZE_CFG_YAML.parent), config_name=MATERIALIZE_CFG_YAML.stem
+)
+def materialize(cfg: DictConfig):
+    """Materializes (or reuses) the Arrow IPC copies of a MEDS dataset's shards and prints where they are."""
+
+    shards = materialize_dataset(cfg.dataset_dir, cfg.materialized_dir, n_workers=int(cfg.n_workers))
+    print(json.dumps({"shards": {shard: str(fp) for shard, fp in shards.items()}}, indent=2))
@@ -0,0 +1,320 @@
+"""Uncompressed, memory-mappable Arrow IPC copies of the data shards of MEDS datasets.
+
+Every consumer of a MEDS dataset re-decodes (and decompresses) the same parquet shards. This module converts a
+dataset's `data/` shards, once, into uncompressed Arrow IPC files with a dictionary-encoded `code` column, and
+reads them back by memory-mapping them: the columns of a materialized shard are then views over the page
+cache, so processes reading the same shards on a node share one in-memory copy of them rather than each
+decompressing its own.
+
+Each shard is materialized into `$SHARD.arrow` under the materialized directory (by default, the dataset's
+hidden `.arrow` directory), next to a `$SHARD.json` sidecar recording the path, size, and modification time
+of the parquet shard it was built from. A materialized shard is only read while its shard is unchanged, and
+materializing a dataset again only converts the shards that were added or changed since. Materialized shards
+whose parquet shards have been removed are deleted (only files with this module's sidecar are ever removed),
+as they are several times larger than the parquet shards.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from meds import code_field, data_subdirectory
+
+from ..utils import list_shards
+
+logger = logging.getLogger(__name__)
+
+MATERIALIZED_SUBDIR = ".arrow"
+MATERIALIZE_VERSION = 1
+RECORD_BATCH_SIZE = 65536
+
+
+def _materialized_dir(dataset_dir: Path, materialized_dir: Path | str | None) -> Path:
+    return dataset_dir / MATERIALIZED_SUBDIR if materialized_dir is None else Path(materialized_dir)
+
+
+def _source_stat(shard_fp: Path) -> dict[str, Any]:
+    stat = shard_fp.stat()
+    return {
+        "source": str(shard_fp.resolve()),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "version": MATERIALIZE_VERSION,
+    }
+
+
+def _read_sidecar(out_fp: Path) -> dict[str, Any] | None:
+    try:
+        sidecar = json.loads(out_fp.with_suffix(".json").read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if not isinstance(sidecar, dict) or set(sidecar) != {"source", "size", "mtime_ns", "version"}:
+        return None
+    return sidecar
+
+
+def is_materialized(shard_fp: Path | str, out_fp: Path | str) -> bool:
+    """Returns whether `out_fp` is an up-to-date materialization of the parquet shard `shard_fp`.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     shard_fp, out_fp = Path(d) / "0.parquet", Path(d) / "arrow" / "0.arrow"
+        ...     pl.DataFrame({"code": ["A", "B"]}).write_parquet(shard_fp)
+        ...     print(is_materialized(shard_fp, out_fp))
+        ...     materialize_shard(shard_fp, out_fp)
+        ...     print(is_materialized(shard_fp, out_fp))
+        ...     pl.DataFrame({"code": ["A", "B", "C"]}).write_parquet(shard_fp)
+        ...     print(is_materialized(shard_fp, out_fp))
+        False
+        True
+        False
+    """
+    out_fp = Path(out_fp)
+    return out_fp.is_file() and _read_sidecar(out_fp) == _source_stat(Path(shard_fp))
+
+
+def materialize_shard(shard_fp: Path | str, out_fp: Path | str):
+    """Converts a parquet shard into an uncompressed Arrow IPC file with a dictionary-encoded `code` column.
+
+    The file is written to a temporary path and renamed into place, and its sidecar, which marks it as an
+    up-to-date materialization of the shard, is written last. Readers that have mapped an older version of the
+    file keep their view of it.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     shard_fp, out_fp = Path(d) / "0.parquet", Path(d) / "arrow" / "0.arrow"
+        ...     shard = pl.DataFrame({"subject_id": [1, 1, 2], "code": ["A", "B", "A"]})
+        ...     shard.write_parquet(shard_fp)
+        ...     materialize_shard(shard_fp, out_fp)
+        ...     table = read_shard_table(out_fp)
+        ...     print(table.schema)
+        ...     print(read_shard(out_fp).with_columns(pl.col("code").cast(pl.String)).equals(shard))
+        ...     print(sorted(fp.name for fp in out_fp.parent.iterdir()))
+        subject_id: int64
+        code: dictionary<values=large_string, indices=int32, ordered=0>
+        True
+        ['0.arrow', '0.json']
+    """
+    shard_fp, out_fp = Path(shard_fp), Path(out_fp)
+    source_stat = _source_stat(shard_fp)
+    table = pq.read_table(shard_fp)
+    if code_field in table.column_names:
+        code = table.column(code_field).combine_chunks()
+        if not pa.types.is_dictionary(code.type):
+            code = code.dictionary_encode()
+        table = table.set_column(table.schema.get_field_index(code_field), code_field, code)
+
+    out_fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fp = out_fp.with_name(f".{out_fp.name}.tmp.{os.getpid()}")
+    options = ipc.IpcWriteOptions(compression=None)
+    with pa.OSFile(str(tmp_fp), "wb") as sink, ipc.new_file(sink, table.schema, options=options) as writer:
+        writer.write_table(table, max_chunksize=RECORD_BATCH_SIZE)
+    tmp_fp.rename(out_fp)
+
+    sidecar_fp = out_fp.with_suffix(".json")
+    tmp_sidecar_fp = sidecar_fp.with_name(f".{sidecar_fp.name}.tmp.{os.getpid()}")
+    tmp_sidecar_fp.write_text(json.dumps(source_stat))
+    tmp_sidecar_fp.rename(sidecar_fp)
+
+
+def read_shard_table(fp: Path | str) -> pa.Table:
+    """Memory-maps a materialized shard as a pyarrow table, without copying (or decoding) any of its data."""
+    return ipc.open_file(pa.memory_map(str(fp))).read_all()
+
+
+def read_shard(fp: Path | str, columns: list[str] | None = None) -> pl.DataFrame:
+    """Reads (the given columns of) a materialized shard into polars by memory-mapping it.
+
+    The `code` column is read as a polars `Categorical`.
+    """
+    return pl.read_ipc(fp, columns=columns, memory_map=True)
+
+
+def _shard_files(dataset_dir: Path, materialized_dir: Path) -> dict[str, tuple[Path, Path]]:
+    data_dir = dataset_dir / data_subdirectory
+    shards = list_shards(data_dir)
+    if not shards:
+        raise FileNotFoundError(f"No shards found in {data_dir}")
+    return {
+        shard: (data_dir / f"{shard}.parquet", materialized_dir / f"{shard}.arrow")
+        for shard in sorted(shards)
+    }
+
+
+def load_materialized(dataset_dir: Path | str, materialized_dir: Path | str | None = None) -> dict[str, Path]:
+    """Returns the materialized shards of the dataset as it is now.
+
+    Args:
+        dataset_dir: The root directory of the MEDS dataset.
+        materialized_dir: The directory the shards are materialized in; by default, `$DATASET_DIR/.arrow`.
+
+    Returns:
+        A dictionary mapping the name of each shard (its path relative to `data/`, without suffix) to its
+        materialized Arrow IPC file.
+
+    Raises:
+        FileNotFoundError: If the dataset has no shards, or if any of its shards has not been materialized
+            since it last changed.
+    """
+    dataset_dir = Path(dataset_dir)
+    materialized_dir = _materialized_dir(dataset_dir, materialized_dir)
+    files = _shard_files(dataset_dir, materialized_dir)
+    stale = [shard for shard, (shard_fp, out_fp) in files.items() if not is_materialized(shard_fp, out_fp)]
+    if stale:
+        raise FileNotFoundError(
+            f"{len(stale)}/{len(files)} shards of {dataset_dir} have no up-to-date materialization in "
+            f"{materialized_dir} (e.g., {stale[0]}). "
+            f"Run `meds-dev-materialize dataset_dir={dataset_dir}` to create them."
+        )
+    return {shard: out_fp for shard, (_, out_fp) in files.items()}
+
+
+def _remove_stale(dataset_dir: Path, materialized_dir: Path, shards: set[str]) -> list[str]:
+    """Removes the materialized shards of the dataset whose parquet shards no longer exist.
+
+    Only files with this module's sidecar, recording a source shard in this dataset's `data/` directory, are
+    removed, so that nothing else that happens to be in the materialized directory is touched.
+    """
+    data_dir = (dataset_dir / data_subdirectory).resolve()
+    removed = []
+    for sidecar_fp in sorted(materialized_dir.rglob("*.json")):
+        out_fp = sidecar_fp.with_suffix(".arrow")
+        sidecar = _read_sidecar(out_fp)
+        if sidecar is None or sidecar_fp.name.startswith("."):
+            continue
+        source = Path(sidecar["source"])
+        if not source.is_relative_to(data_dir):
+            continue
+        shard = source.relative_to(data_dir).with_suffix("").as_posix()
+        if shard in shards:
+            continue
+        logger.info(f"Removing {out_fp}, as its shard {shard} no longer exists.")
+        out_fp.unlink(missing_ok=True)
+        sidecar_fp.unlink(missing_ok=True)
+        removed.append(shard)
+    return removed
+
+
+def materialize_dataset(
+    dataset_dir: Path | str, materialized_dir: Path | str | None = None, n_workers: int = 1
+) -> dict[str, Path]:
+    """Materializes the data shards of a MEDS dataset that are missing or out of date, and returns them all.
+
+    Args:
+        dataset_dir: The root directory of the MEDS dataset.
+        materialized_dir: The directory to materialize shards in; by default, `$DATASET_DIR/.arrow`. Being
+            hidden, the default does not change the dataset's fingerprint. Shards of different datasets
+            with the same names overwrite each other, so give each dataset its own directory.
+        n_workers: The number of processes to convert shards with.
+
+    Returns:
+        A dictionary mapping the name of each shard to its materialized Arrow IPC file, as in
+        `load_materialized`.
+
+    Raises:
+        FileNotFoundError: If the dataset has no shards.
+
+    Examples:
+        >>> import tempfile
+        >>> def write_shard(d, shard, subject):
+        ...     (Path(d) / "data" / shard).parent.mkdir(parents=True, exist_ok=True)
+        ...     pl.DataFrame({
+        ...         "subject_id": [subject, subject], "code": ["A", "B"], "numeric_value": [1.0, None]
+        ...     }).write_parquet(Path(d) / "data" / f"{shard}.parquet")
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     write_shard(d, "train/0", 1)
+        ...     write_shard(d, "held_out/0", 2)
+        ...     shards = materialize_dataset(d)
+        ...     print(list(shards))
+        ...     print(shards == materialize_dataset(d) == load_materialized(d))
+        ...     print(read_shard(shards["train/0"], columns=["subject_id", "numeric_value"]))
+        ['held_out/0', 'train/0']
+        True
+        shape: (2, 2)
+        ┌────────────┬───────────────┐
+        │ subject_id ┆ numeric_value │
+        │ ---        ┆ ---           │
+        │ i64        ┆ f64           │
+        ╞════════════╪═══════════════╡
+        │ 1          ┆ 1.0           │
+        │ 1          ┆ null          │
+        └────────────┴───────────────┘
+
+    Adding, changing, or removing a shard only re-materializes (or removes) that shard:
+
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     write_shard(d, "train/0", 1)
+        ...     write_shard(d, "held_out/0", 2)
+        ...     shards = materialize_dataset(d)
+        ...     mtimes = {shard: fp.stat().st_mtime_ns for shard, fp in shards.items()}
+        ...     write_shard(d, "train/1", 3)
+        ...     (Path(d) / "data" / "held_out" / "0.parquet").unlink()
+        ...     try:
+        ...         load_materialized(d)
+        ...     except FileNotFoundError:
+        ...         print("stale")
+        ...     shards = materialize_dataset(d)
+        ...     print(list(shards), shards["train/0"].stat().st_mtime_ns == mtimes["train/0"])
+        ...     print(sorted(fp.relative_to(d).as_posix() for fp in (Path(d) / ".arrow").rglob("*.arrow")))
+        stale
+        ['train/0', 'train/1'] True
+        ['.arrow/train/0.arrow', '.arrow/train/1.arrow']
+
+    Only this module's files are ever removed from the materialized directory, so it may hold other data:
+
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     write_shard(d, "train/0", 1)
+        ...     shared = Path(d) / "shared"
+        ...     (shared / "other_dataset_stuff").mkdir(parents=True)
+        ...     _ = (shared / "other_dataset_stuff" / "notes.json").write_text("{}")
+        ...     _ = materialize_dataset(d, shared)
+        ...     write_shard(d, "train/1", 2)
+        ...     (Path(d) / "data" / "train" / "0.parquet").unlink()
+        ...     print(list(materialize_dataset(d, shared)))
+        ...     print(sorted(fp.relative_to(shared).as_posix() for fp in shared.rglob("*")))
+        ['train/1']
+        ['other_dataset_stuff', 'other_dataset_stuff/notes.json', 'train', 'train/1.arrow', 'train/1.json']
+    """
+    dataset_dir = Path(dataset_dir)
+    materialized_dir = _materialized_dir(dataset_dir, materialized_dir)
+    files = _shard_files(dataset_dir, materialized_dir)
+
+    todo = [
+        (shard_fp, out_fp) for shard_fp, out_fp in files.values() if not is_materialized(shard_fp, out_fp)
+    ]
+    logger.info(
+        f"Materializing {len(todo)}/{len(files)} shards of {dataset_dir} in {materialized_dir} "
+        f"with {n_workers} workers."
+    )
+    if n_workers > 1 and len(todo) > 1:
+        # Spawn rather than fork, as forking a process that has used polars' thread pool can deadlock.
+        with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            list(pool.map(materialize_shard, *zip(*todo, strict=True)))
+    else:
+        for shard_fp, out_fp in todo:
+            materialize_shard(shard_fp, out_fp)
+
+    # Readers that still have a removed shard mapped keep their view of it until they unmap it.
+    _remove_stale(dataset_dir, materialized_dir, set(files))
+    return {shard: out_fp for shard, (_, out_fp) in files.items()}
+
+
+__all__ = [
+    "MATERIALIZED_SUBDIR",
+    "is_materialized",
+    "load_materialized",
+    "materialize_dataset",
+    "materialize_shard",
+    "read_shard",
+    "read_shard_table",
+]
@@ -0,0 +1,408 @@
+"""Cached profiles of MEDS datasets: code counts and value statistics, and per-subject and per-split sizes.
+
+Model preprocessing pipelines (and task authors) repeatedly need the same summary statistics of a dataset,
+such as how often each code occurs, the distribution of its numeric values, and how many events and how much
+time each subject spans. This module computes all of them in one (optionally parallel) pass over the shards
+and caches the result next to the dataset, keyed by the dataset's fingerprint (see
+`MEDS_DEV.stage_cache.fingerprint`), so later queries only read a few small parquet files.
+
+Numeric value quantiles are approximate: each shard contributes a sketch of `SKETCH_SIZE` evenly spaced order
+statistics of each code's values, weighted by its number of values, and the quantiles are taken over the
+merged, weighted sketches. Per-code subject counts are summed over shards, so they are exact when, as in
+MEDS datasets, each subject's events are all in one shard.
+"""
+
+import dataclasses
+import datetime
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import polars as pl
+from meds import code_field, numeric_value_field, subject_id_field, time_field
+
+from ..stage_cache import stage_key
+from .reshard import split_shards
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SUBDIR = ".profile"
+PROFILE_VERSION = 1
+QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+SKETCH_SIZE = 101
+
+CODES_FILE = "codes.parquet"
+SUBJECTS_FILE = "subjects.parquet"
+SPLITS_FILE = "splits.parquet"
+SUMMARY_FILE = "profile.json"
+
+
+def quantile_column(q: float) -> str:
+    """Returns the name of the profile column of the `q` quantile of numeric values.
+
+    Examples:
+        >>> [quantile_column(q) for q in (0.01, 0.5, 0.995)]
+        ['q1', 'q50', 'q99.5']
+    """
+    return f"q{q * 100:g}"
+
+
+def _valid_value() -> pl.Expr:
+    return pl.col(numeric_value_field).is_not_null() & pl.col(numeric_value_field).is_not_nan()
+
+
+def _profile_shard(fp: Path) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    """Computes the per-code statistics, per-code value sketches, and per-subject statistics of one shard."""
+    lf = pl.scan_parquet(fp).select(subject_id_field, time_field, code_field, numeric_value_field)
+    value = pl.col(numeric_value_field).cast(pl.Float64)
+
+    codes = lf.group_by(code_field).agg(
+        pl.len().cast(pl.Int64).alias("n_events"),
+        pl.col(subject_id_field).n_unique().cast(pl.Int64).alias("n_subjects"),
+        _valid_value().sum().cast(pl.Int64).alias("n_values"),
+        value.filter(_valid_value()).sum().alias("values_sum"),
+        (value**2).filter(_valid_value()).sum().alias("values_sum_sq"),
+        value.filter(_valid_value()).min().alias("min"),
+        value.filter(_valid_value()).max().alias("max"),
+    )
+    positions = (pl.int_range(SKETCH_SIZE, dtype=pl.Int64) * (pl.len() - 1) / (SKETCH_SIZE - 1)).round()
+    sketches = (
+        lf.filter(_valid_value())
+        .group_by(code_field)
+        .agg(value.sort().gather(positions.cast(pl.Int64)).alias("sketch"), pl.len().alias("n_values"))
+    )
+    subjects = lf.group_by(subject_id_field).agg(
+        pl.len().cast(pl.Int64).alias("n_events"),
+        pl.col(time_field).min().alias("first_time"),
+        pl.col(time_field).max().alias("last_time"),
+    )
+    return tuple(pl.collect_all([codes, sketches, subjects]))
+
+
+def _merge_codes(codes: list[pl.DataFrame], sketches: list[pl.DataFrame]) -> pl.DataFrame:
+    """Merges per-shard code statistics and value sketches into the profile's per-code table.
+
+    Examples:
+        >>> codes = [
+        ...     pl.DataFrame({
+        ...         "code": ["A", "B"], "n_events": [4, 1], "n_subjects": [2, 1], "n_values": [3, 0],
+        ...         "values_sum": [6.0, 0.0], "values_sum_sq": [14.0, 0.0], "min": [1.0, None],
+        ...         "max": [3.0, None],
+        ...     }),
+        ...     pl.DataFrame({
+        ...         "code": ["A"], "n_events": [1], "n_subjects": [1], "n_values": [1], "values_sum": [10.0],
+        ...         "values_sum_sq": [100.0], "min": [10.0], "max": [10.0],
+        ...     }),
+        ... ]
+        >>> sketches = [
+        ...     pl.DataFrame({"code": "A", "sketch": [[1.0] * 34 + [2.0] * 33 + [3.0] * 34], "n_values": 3}),
+        ...     pl.DataFrame({"code": ["A"], "sketch": [[10.0] * 101], "n_values": [1]}),
+        ... ]
+        >>> merged = _merge_codes(codes, sketches)
+        >>> merged.select("code", "n_events", "n_subjects", "n_values", "mean", "std", "min", "max")
+        shape: (2, 8)
+        ┌──────┬──────────┬────────────┬──────────┬──────┬──────────┬──────┬──────┐
+        │ code ┆ n_events ┆ n_subjects ┆ n_values ┆ mean ┆ std      ┆ min  ┆ max  │
+        │ ---  ┆ ---      ┆ ---        ┆ ---      ┆ ---  ┆ ---      ┆ ---  ┆ ---  │
+        │ str  ┆ i64      ┆ i64        ┆ i64      ┆ f64  ┆ f64      ┆ f64  ┆ f64  │
+        ╞══════╪══════════╪════════════╪══════════╪══════╪══════════╪══════╪══════╡
+        │ A    ┆ 5        ┆ 3          ┆ 4        ┆ 4.0  ┆ 4.082483 ┆ 1.0  ┆ 10.0 │
+        │ B    ┆ 1        ┆ 1          ┆ 0        ┆ null ┆ null     ┆ null ┆ null │
+        └──────┴──────────┴────────────┴──────────┴──────┴──────────┴──────┴──────┘
+        >>> merged.select("code", "q1", "q25", "q50", "q75", "q99").row(0)
+        ('A', 1.0, 1.0, 3.0, 3.0, 10.0)
+    """
+    sums = ["n_events", "n_subjects", "n_values", "values_sum", "values_sum_sq"]
+    n = pl.col("n_values")
+    mean = pl.col("values_sum") / n
+    variance = (pl.col("values_sum_sq") - n * mean**2) / (n - 1)
+    merged = (
+        pl.concat(codes, how="vertical_relaxed")
+        .group_by(code_field)
+        .agg(*(pl.sum(c) for c in sums), pl.min("min"), pl.max("max"))
+        .with_columns(
+            pl.when(n > 0).then(mean).alias("mean"),
+            pl.when(n > 1).then(variance.clip(lower_bound=0).sqrt()).alias("std"),
+        )
+    )
+
+    weighted = (
+        pl.concat(sketches, how="vertical_relaxed")
+        .with_columns((pl.col("n_values") / SKETCH_SIZE).alias("weight"))
+        .explode("sketch")
+        .sort(code_field, "sketch")
+        .with_columns(pl.col("weight").cum_sum().over(code_field).alias("cum_weight"))
+    )
+    quantiles = weighted.group_by(code_field).agg(
+        pl.col("sketch")
+        .filter(pl.col("cum_weight") >= q * pl.col("weight").sum())
+        .first()
+        .alias(quantile_column(q))
+        for q in QUANTILES
+    )
+
+    return (
+        merged.join(quantiles, on=code_field, how="left", join_nulls=True)
+        .select(
+            code_field,
+            "n_events",
+            "n_subjects",
+            "n_values",
+            "mean",
+            "std",
+            "min",
+            "max",
+            *(quantile_column(q) for q in QUANTILES),
+        )
+        .sort("n_events", code_field, descending=[True, False], nulls_last=True)
+    )
+
+
+@dataclasses.dataclass
+class DatasetProfile:
+    """A computed dataset profile, whose tables are read (once) on first access.
+
+    Attributes:
+        profile_dir: The directory holding the profile's files.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     _ = (Path(d) / SUMMARY_FILE).write_text(json.dumps({"n_subjects": 2}))
+        ...     pl.DataFrame({"code": ["A", "B"], "n_events": [3, 1]}).write_parquet(Path(d) / CODES_FILE)
+        ...     profile = DatasetProfile(Path(d))
+        ...     print(profile.summary, profile.code_stats("B"), profile.code_stats("C"))
+        {'n_subjects': 2} {'code': 'B', 'n_events': 1} None
+    """
+
+    profile_dir: Path
+
+    @functools.cached_property
+    def summary(self) -> dict[str, Any]:
+        """The dataset-level summary (totals, quantiles, and provenance) of the profile."""
+        return json.loads((self.profile_dir / SUMMARY_FILE).read_text())
+
+    @functools.cached_property
+    def codes(self) -> pl.DataFrame:
+        """Per-code event, subject, and value counts, and value mean, std, range, and quantiles."""
+        return pl.read_parquet(self.profile_dir / CODES_FILE)
+
+    @functools.cached_property
+    def subjects(self) -> pl.DataFrame:
+        """Per-subject split, number of events, first and last event times, and timespan."""
+        return pl.read_parquet(self.profile_dir / SUBJECTS_FILE)
+
+    @functools.cached_property
+    def splits(self) -> pl.DataFrame:
+        """Per-split numbers of shards, subjects, and events."""
+        return pl.read_parquet(self.profile_dir / SPLITS_FILE)
+
+    def code_stats(self, code: str) -> dict[str, Any] | None:
+        """Returns the statistics of one code, or `None` if it does not occur in the dataset."""
+        rows = self.codes.filter(pl.col(code_field) == code)
+        return rows.row(0, named=True) if len(rows) else None
+
+
+def profile_key(dataset_dir: Path | str) -> str:
+    """Returns the key of the profile of a dataset, from its fingerprint and the profiling code's version.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     _ = (Path(d) / "0.parquet").write_text("data")
+        ...     key = profile_key(d)
+        ...     (Path(d) / PROFILE_SUBDIR).mkdir()
+        ...     print(profile_key(d) == key)
+        ...     _ = (Path(d) / "1.parquet").write_text("more data")
+        ...     print(profile_key(d) == key)
+        True
+        False
+    """
+    cmd = f"meds-dev-profile version={PROFILE_VERSION} quantiles={QUANTILES} sketch_size={SKETCH_SIZE}"
+    return stage_key(cmd, PROFILE_SUBDIR, inputs={"dataset": dataset_dir})
+
+
+def _profile_path(dataset_dir: Path, profile_dir: Path | str | None) -> Path:
+    profile_dir = dataset_dir / PROFILE_SUBDIR if profile_dir is None else Path(profile_dir)
+    return profile_dir / profile_key(dataset_dir)
+
+
+def load_profile(dataset_dir: Path | str, profile_dir: Path | str | None = None) -> DatasetProfile:
+    """Returns the cached profile of the dataset as it is now.
+
+    Args:
+        dataset_dir: The root directory of the MEDS dataset.
+        profile_dir: The directory profiles are cached in; by default, `$DATASET_DIR/.profile`.
+
+    Raises:
+        FileNotFoundError: If the dataset has not been profiled since it last changed.
+    """
+    dataset_dir = Path(dataset_dir)
+    path = _profile_path(dataset_dir, profile_dir)
+    if not (path / SUMMARY_FILE).is_file():
+        raise FileNotFoundError(
+            f"No up-to-date profile of {dataset_dir} found in {path.parent}. "
+            f"Run `meds-dev-profile dataset_dir={dataset_dir}` to compute it."
+        )
+    return DatasetProfile(path)
+
+
+def profile_dataset(
+    dataset_dir: Path | str, profile_dir: Path | str | None = None, n_workers: int = 1
+) -> DatasetProfile:
+    """Profiles a MEDS dataset, or returns its cached profile if the dataset has not changed since.
+
+    Each shard is read once (in up to `n_workers` processes) for the columns `subject_id`, `time`, `code`,
+    and `numeric_value`. The profile holds:
+
+      - `codes`: per code, the number of events, subjects, and numeric values, and the mean, standard
+        deviation, minimum, maximum, and (approximate) `QUANTILES` of the numeric values.
+      - `subjects`: per subject, its split, number of events, first and last event times, and timespan.
+      - `splits`: per split (the directory of its shards), the number of shards, subjects, and events.
+      - `summary`: the dataset totals, the quantiles and sketch size used, and when it was computed.
+
+    Args:
+        dataset_dir: The root directory of the MEDS dataset.
+        profile_dir: The directory to cache profiles in; by default, `$DATASET_DIR/.profile`. Being hidden,
+            the default does not change the dataset's fingerprint.
+        n_workers: The number of processes to profile shards with.
+
+    Raises:
+        FileNotFoundError: If the dataset has no shards.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     shards = (("train/0", 1, "AAB"), ("train/1", 2, "AC"), ("held_out/0", 3, "A"))
+        ...     for shard, subject, codes in shards:
+        ...         (Path(d) / "data" / shard).parent.mkdir(parents=True, exist_ok=True)
+        ...         pl.DataFrame({
+        ...             "subject_id": [subject] * len(codes),
+        ...             "time": [datetime(2020, 1, 1 + i) if i else None for i in range(len(codes))],
+        ...             "code": list(codes),
+        ...             "numeric_value": [i + subject if c == "A" else None for i, c in enumerate(codes)],
+        ...         }).write_parquet(Path(d) / "data" / f"{shard}.parquet")
+        ...     profile = profile_dataset(d)
+        ...     cached = profile_dataset(d)
+        ...     loaded = load_profile(d)
+        ...     codes, subjects, splits = profile.codes, profile.subjects, profile.splits
+        ...     summary = profile.summary
+        ...     print(cached.profile_dir == profile.profile_dir == loaded.profile_dir)
+        ...     print(profile.profile_dir.parent == Path(d) / PROFILE_SUBDIR)
+        True
+        True
+        >>> codes.select("code", "n_events", "n_subjects", "n_values", "mean", "min", "max", "q50")
+        shape: (3, 8)
+        ┌──────┬──────────┬────────────┬──────────┬──────┬──────┬──────┬──────┐
+        │ code ┆ n_events ┆ n_subjects ┆ n_values ┆ mean ┆ min  ┆ max  ┆ q50  │
+        │ ---  ┆ ---      ┆ ---        ┆ ---      ┆ ---  ┆ ---  ┆ ---  ┆ ---  │
+        │ str  ┆ i64      ┆ i64        ┆ i64      ┆ f64  ┆ f64  ┆ f64  ┆ f64  │
+        ╞══════╪══════════╪════════════╪══════════╪══════╪══════╪══════╪══════╡
+        │ A    ┆ 4        ┆ 3          ┆ 4        ┆ 2.0  ┆ 1.0  ┆ 3.0  ┆ 2.0  │
+        │ B    ┆ 1        ┆ 1          ┆ 0        ┆ null ┆ null ┆ null ┆ null │
+        │ C    ┆ 1        ┆ 1          ┆ 0        ┆ null ┆ null ┆ null ┆ null │
+        └──────┴──────────┴────────────┴──────────┴──────┴──────┴──────┴──────┘
+        >>> subjects
+        shape: (3, 6)
+        ┌────────────┬──────────┬──────────┬─────────────────────┬─────────────────────┬──────────────┐
+        │ subject_id ┆ split    ┆ n_events ┆ first_time          ┆ last_time           ┆ timespan     │
+        │ ---        ┆ ---      ┆ ---      ┆ ---                 ┆ ---                 ┆ ---          │
+        │ i64        ┆ str      ┆ i64      ┆ datetime[μs]        ┆ datetime[μs]        ┆ duration[μs] │
+        ╞════════════╪══════════╪══════════╪═════════════════════╪═════════════════════╪══════════════╡
+        │ 1          ┆ train    ┆ 3        ┆ 2020-01-02 00:00:00 ┆ 2020-01-03 00:00:00 ┆ 1d           │
+        │ 2          ┆ train    ┆ 2        ┆ 2020-01-02 00:00:00 ┆ 2020-01-02 00:00:00 ┆ 0µs          │
+        │ 3          ┆ held_out ┆ 1        ┆ null                ┆ null                ┆ null         │
+        └────────────┴──────────┴──────────┴─────────────────────┴─────────────────────┴──────────────┘
+        >>> splits
+        shape: (2, 4)
+        ┌──────────┬──────────┬────────────┬──────────┐
+        │ split    ┆ n_shards ┆ n_subjects ┆ n_events │
+        │ ---      ┆ ---      ┆ ---        ┆ ---      │
+        │ str      ┆ i64      ┆ i64        ┆ i64      │
+        ╞══════════╪══════════╪════════════╪══════════╡
+        │ held_out ┆ 1        ┆ 1          ┆ 1        │
+        │ train    ┆ 2        ┆ 2          ┆ 5        │
+        └──────────┴──────────┴────────────┴──────────┘
+        >>> {k: summary[k] for k in ("n_shards", "n_subjects", "n_events", "n_codes")}
+        {'n_shards': 3, 'n_subjects': 3, 'n_events': 6, 'n_codes': 3}
+    """
+    dataset_dir = Path(dataset_dir)
+    path = _profile_path(dataset_dir, profile_dir)
+    if (path / SUMMARY_FILE).is_file():
+        logger.info(f"Using the cached profile of {dataset_dir} in {path}.")
+        return DatasetProfile(path)
+
+    shards = split_shards(dataset_dir / "data")
+    fps = [fp for split_fps in shards.values() for fp in split_fps]
+    if not fps:
+        raise FileNotFoundError(f"No shards found in {dataset_dir / 'data'}")
+    split_of = {fp: split for split, split_fps in shards.items() for fp in split_fps}
+
+    logger.info(f"Profiling {len(fps)} shards of {dataset_dir} with {n_workers} workers.")
+    if n_workers > 1 and len(fps) > 1:
+        # Spawn rather than fork, as forking a process that has used polars' thread pool can deadlock.
+        with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            shard_profiles = list(pool.map(_profile_shard, fps))
+    else:
+        shard_profiles = [_profile_shard(fp) for fp in fps]
+
+    codes = _merge_codes([p[0] for p in shard_profiles], [p[1] for p in shard_profiles])
+    subjects = (
+        pl.concat(
+            [
+                p[2].with_columns(pl.lit(split_of[fp]).alias("split"))
+                for fp, p in zip(fps, shard_profiles, strict=True)
+            ],
+            how="vertical_relaxed",
+        )
+        .group_by(subject_id_field, "split")
+        .agg(pl.sum("n_events"), pl.min("first_time"), pl.max("last_time"))
+        .with_columns((pl.col("last_time") - pl.col("first_time")).alias("timespan"))
+        .select(subject_id_field, "split", "n_events", "first_time", "last_time", "timespan")
+        .sort(subject_id_field)
+    )
+    splits = (
+        subjects.group_by("split")
+        .agg(pl.len().cast(pl.Int64).alias("n_subjects"), pl.sum("n_events"))
+        .join(
+            pl.DataFrame({"split": list(shards), "n_shards": [len(v) for v in shards.values()]}),
+            on="split",
+        )
+        .select("split", "n_shards", "n_subjects", "n_events")
+        .sort("split")
+    )
+    summary = {
+        "dataset_dir": str(dataset_dir.resolve()),
+        "n_shards": len(fps),
+        "n_subjects": len(subjects),
+        "n_events": int(subjects["n_events"].sum()),
+        "n_codes": len(codes),
+        "quantiles": list(QUANTILES),
+        "sketch_size": SKETCH_SIZE,
+        "created_at": datetime.datetime.now(tz=datetime.UTC).isoformat(),
+    }
+
+    # Write to a temporary directory and rename it into place, so concurrent runs never see a partial profile.
+    tmp_path = path.parent / f".tmp.{path.name}.{os.getpid()}"
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    codes.write_parquet(tmp_path / CODES_FILE)
+    subjects.write_parquet(tmp_path / SUBJECTS_FILE)
+    splits.write_parquet(tmp_path / SPLITS_FILE)
+    (tmp_path / SUMMARY_FILE).write_text(json.dumps(summary, indent=2))
+    try:
+        tmp_path.rename(path)
+        logger.info(f"Wrote the profile of {dataset_dir} to {path}.")
+    except OSError:  # pragma: no cover
+        # Another process profiled the same dataset concurrently; its profile is equivalent.
+        shutil.rmtree(tmp_path)
+    return DatasetProfile(path)
+
+
+__all__ = ["QUANTILES", "DatasetProfile", "load_profile", "profile_dataset", "profile_key", "quantile_column"]
@@ -0,0 +1,376 @@
+"""Re-sharding of MEDS datasets into shards balanced by event count.
+
+Task extraction and model preprocessing parallelize over the shards of a dataset, so a few outsized shards
+dominate their wall time. This module rewrites the data of a MEDS dataset into a given number of shards with
+(near) equal numbers of events, keeping each subject whole and in its original split, and copying the
+`metadata/` directory unchanged.
+
+The rewrite runs in two passes so that memory use is bounded by the largest input or output shard, rather
+than the whole dataset: each input shard is first partitioned into per-output-shard parts, and then the parts
+of each output shard are sorted and written with the requested row group size.
+"""
+
+import heapq
+import logging
+import multiprocessing
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import polars as pl
+from meds import data_subdirectory, subject_id_field, time_field
+
+from ..utils import list_shards
+
+logger = logging.getLogger(__name__)
+
+SHARD = "shard"
+TMP_DIR = ".reshard"
+
+
+def split_shards(data_dir: Path | str) -> dict[str, list[Path]]:
+    """Groups the shards of a MEDS data directory by split (their parent directory), largest first.
+
+    Shards directly in the data directory are grouped under the split `"."`.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     for name, size in (("train/0", 10), ("train/1", 30), ("held_out/0", 20), ("extra", 5)):
+        ...         (Path(d) / name).parent.mkdir(parents=True, exist_ok=True)
+        ...         _ = (Path(d) / f"{name}.parquet").write_bytes(b"0" * size)
+        ...     shards = split_shards(d)
+        ...     for split, fps in shards.items():
+        ...         print(split, [fp.relative_to(d).as_posix() for fp in fps])
+        train ['train/1.parquet', 'train/0.parquet']
+        held_out ['held_out/0.parquet']
+        . ['extra.parquet']
+    """
+    data_dir = Path(data_dir)
+    shards = {}
+    for shard in list_shards(data_dir):
+        shards.setdefault(Path(shard).parent.as_posix(), []).append(data_dir / f"{shard}.parquet")
+    return shards
+
+
+def count_events(shards: dict[str, list[Path]]) -> pl.DataFrame:
+    """Counts the events of each subject, reading only the subject ID column of each shard.
+
+    Returns:
+        A dataframe with the `split`, `subject_id`, and `n_events` of each subject.
+
+    Raises:
+        ValueError: If any subject has events in more than one split.
+
+    Examples:
+        >>> import tempfile
+        >>> d = tempfile.TemporaryDirectory()
+        >>> for split, subjects in (("train", [1, 1, 2]), ("tuning", [3, 3, 3]), ("held_out", [2])):
+        ...     pl.DataFrame({"subject_id": subjects}).write_parquet(Path(d.name) / f"{split}.parquet")
+        >>> fps = {split: [Path(d.name) / f"{split}.parquet"] for split in ("train", "tuning")}
+        >>> count_events(fps).sort("subject_id")
+        shape: (3, 3)
+        ┌────────┬────────────┬──────────┐
+        │ split  ┆ subject_id ┆ n_events │
+        │ ---    ┆ ---        ┆ ---      │
+        │ str    ┆ i64        ┆ u32      │
+        ╞════════╪════════════╪══════════╡
+        │ train  ┆ 1          ┆ 2        │
+        │ train  ┆ 2          ┆ 1        │
+        │ tuning ┆ 3          ┆ 3        │
+        └────────┴────────────┴──────────┘
+        >>> fps["held_out"] = [Path(d.name) / "held_out.parquet"]
+        >>> count_events(fps)
+        Traceback (most recent call last):
+            ...
+        ValueError: 1 subjects have events in more than one split, e.g. 2.
+        >>> d.cleanup()
+    """
+    counts = pl.concat(
+        [
+            pl.scan_parquet(fps)
+            .group_by(subject_id_field)
+            .agg(pl.len().alias("n_events"))
+            .select(pl.lit(split).alias("split"), subject_id_field, "n_events")
+            for split, fps in shards.items()
+        ]
+    ).collect()
+
+    in_many_splits = counts.filter(pl.col(subject_id_field).is_duplicated())[subject_id_field].unique().sort()
+    if len(in_many_splits):
+        raise ValueError(
+            f"{len(in_many_splits)} subjects have events in more than one split, e.g. {in_many_splits[0]}."
+        )
+    return counts
+
+
+def allocate_shards(n_events: dict[str, int], n_subjects: dict[str, int], n_shards: int) -> dict[str, int]:
+    """Divides `n_shards` among the splits in proportion to their numbers of events.
+
+    Each split gets one shard, and each remaining shard goes to the split whose shards currently have the most
+    events each, so that the largest shard is as small as possible. No split gets more shards than subjects.
+
+    Raises:
+        ValueError: If there are fewer shards than splits.
+
+    Examples:
+        >>> allocate_shards({"train": 800, "tuning": 100, "held_out": 100}, {"train": 80, "tuning": 10,
+        ...     "held_out": 10}, 10)
+        {'train': 8, 'tuning': 1, 'held_out': 1}
+        >>> allocate_shards({"train": 800, "tuning": 100, "held_out": 100}, {"train": 80, "tuning": 10,
+        ...     "held_out": 10}, 4)
+        {'train': 2, 'tuning': 1, 'held_out': 1}
+        >>> allocate_shards({"train": 700, "tuning": 150, "held_out": 150}, {"train": 70, "tuning": 15,
+        ...     "held_out": 15}, 7)
+        {'train': 5, 'tuning': 1, 'held_out': 1}
+        >>> allocate_shards({"train": 900, "held_out": 100}, {"train": 2, "held_out": 1}, 8)
+        {'train': 2, 'held_out': 1}
+        >>> allocate_shards({"train": 900, "held_out": 100}, {"train": 90, "held_out": 10}, 1)
+        Traceback (most recent call last):
+            ...
+        ValueError: Cannot split 2 splits into 1 shards; each split needs at least one shard.
+    """
+    if n_shards < len(n_events):
+        raise ValueError(
+            f"Cannot split {len(n_events)} splits into {n_shards} shards; "
+            "each split needs at least one shard."
+        )
+
+    allocation = dict.fromkeys(n_events, 1)
+    loads = [(-n, split) for split, n in n_events.items() if n_subjects[split] > 1]
+    heapq.heapify(loads)
+    for _ in range(n_shards - len(n_events)):
+        if not loads:
+            break
+        _, split = heapq.heappop(loads)
+        allocation[split] += 1
+        if allocation[split] < n_subjects[split]:
+            heapq.heappush(loads, (-n_events[split] / allocation[split], split))
+    return allocation
+
+
+def assign_subjects(counts: pl.DataFrame, n_shards: int) -> pl.DataFrame:
+    """Assigns subjects to `n_shards` shards so that the shards have near equal numbers of events.
+
+    Subjects are placed largest first, each into the shard with the fewest events so far (the longest
+    processing time first heuristic, which is within 4/3 of the optimal maximum shard size).
+
+    Args:
+        counts: A dataframe with the `subject_id` and `n_events` of each subject.
+        n_shards: The number of shards.
+
+    Returns:
+        A dataframe with the `subject_id` and assigned `shard` of each subject.
+
+    Examples:
+        >>> counts = pl.DataFrame({"subject_id": [1, 2, 3, 4, 5, 6], "n_events": [9, 1, 5, 4, 3, 2]})
+        >>> shards = assign_subjects(counts, 2)
+        >>> shards.sort("subject_id")["shard"].to_list()
+        [0, 1, 1, 1, 0, 1]
+        >>> counts.join(shards, on="subject_id").group_by("shard").agg(pl.sum("n_events")).sort("shard")
+        shape: (2, 2)
+        ┌───────┬──────────┐
+        │ shard ┆ n_events │
+        │ ---   ┆ ---      │
+        │ u32   ┆ i64      │
+        ╞═══════╪══════════╡
+        │ 0     ┆ 12       │
+        │ 1     ┆ 12       │
+        └───────┴──────────┘
+    """
+    counts = counts.sort(["n_events", subject_id_field], descending=[True, False])
+
+    loads = [(0, shard) for shard in range(n_shards)]
+    assignment = []
+    for n in counts["n_events"]:
+        load, shard = heapq.heappop(loads)
+        assignment.append(shard)
+        heapq.heappush(loads, (load + n, shard))
+
+    return counts.select(subject_id_field, pl.Series(SHARD, assignment, dtype=pl.UInt32))
+
+
+def _partition_shard(args: tuple[Path, pl.DataFrame, Path]) -> None:
+    """Splits one input shard into a part per output shard, at `parts_dir/$SHARD/$INPUT_NAME.parquet`."""
+    fp, assignment, parts_dir = args
+    df = pl.read_parquet(fp).join(assignment, on=subject_id_field, how="left")
+    for (shard,), part in df.partition_by(SHARD, as_dict=True, include_key=False).items():
+        part_fp = parts_dir / str(shard) / f"{fp.stem}.parquet"
+        part_fp.parent.mkdir(parents=True, exist_ok=True)
+        part.write_parquet(part_fp)
+
+
+def _write_shard(args: tuple[Path, Path, int]) -> int:
+    """Sorts the parts of an output shard by subject and time and writes them; returns the number of events.
+
+    The sort is stable, so events of a subject at the same time keep their original order.
+    """
+    shard_parts_dir, out_fp, row_group_size = args
+    df = pl.read_parquet(sorted(shard_parts_dir.glob("*.parquet")))
+    df = df.sort([subject_id_field, time_field], maintain_order=True, nulls_last=False)
+    out_fp.parent.mkdir(parents=True, exist_ok=True)
+    df.write_parquet(out_fp, row_group_size=row_group_size)
+    return len(df)
+
+
+def _map(fn, tasks: list, n_workers: int) -> list:
+    if n_workers > 1 and len(tasks) > 1:
+        # Spawn rather than fork, as forking a process that has used polars' thread pool can deadlock.
+        with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            return list(pool.map(fn, tasks))
+    return [fn(task) for task in tasks]
+
+
+def reshard_dataset(
+    input_dir: Path | str,
+    output_dir: Path | str,
+    n_shards: int,
+    row_group_size: int | None = None,
+    n_workers: int = 1,
+) -> dict[str, Any]:
+    """Rewrites a MEDS dataset into `n_shards` shards balanced by event count.
+
+    The shards are divided among the splits in proportion to their numbers of events, and the subjects of
+    each split are then assigned to its shards with `assign_subjects`. The output shards are written to
+    `output_dir/data/$SPLIT/$I.parquet`, sorted by subject and time, and the `metadata/` directory (and any
+    other non-hidden files outside of `data/`) is copied unchanged.
+
+    Args:
+        input_dir: The root directory of the MEDS dataset to re-shard.
+        output_dir: The root directory to write the re-sharded dataset to. It must not exist or must hold only
+            hidden files (such as logs).
+        n_shards: The total number of output shards.
+        row_group_size: The number of rows per parquet row group of the output shards, or `None` for the
+            Polars default.
+        n_workers: The number of processes to partition and write shards with.
+
+    Returns:
+        A report with the number of input and output shards, subjects, and events of each split, and the
+        largest input and output shard (in events).
+
+    Raises:
+        FileNotFoundError: If the input dataset has no shards.
+        FileExistsError: If the output directory is not empty.
+        ValueError: If a subject has events in more than one split, or there are fewer shards than splits.
+        RuntimeError: If the output shards do not hold exactly the input events.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> def events(subjects: list[int]) -> pl.DataFrame:
+        ...     return pl.DataFrame({
+        ...         "subject_id": subjects,
+        ...         "time": [None if i % 3 == 0 else datetime(2020, 1, 1 + i) for i in range(len(subjects))],
+        ...         "code": [f"C{i}" for i in range(len(subjects))],
+        ...     })
+        >>> import pyarrow.parquet as pq
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     input_dir, output_dir = Path(d) / "input", Path(d) / "output"
+        ...     for name, subjects in (
+        ...         ("train/0", [1] * 12 + [2] * 2 + [3] * 2),
+        ...         ("train/1", [4] * 2 + [5] * 2),
+        ...         ("train/2", [6] * 4),
+        ...         ("held_out/0", [7] * 2 + [8]),
+        ...     ):
+        ...         (input_dir / "data" / name).parent.mkdir(parents=True, exist_ok=True)
+        ...         events(subjects).write_parquet(input_dir / "data" / f"{name}.parquet")
+        ...     (input_dir / "metadata").mkdir()
+        ...     _ = (input_dir / "metadata" / "dataset.json").write_text("{}")
+        ...     report = reshard_dataset(input_dir, output_dir, n_shards=3, row_group_size=2)
+        ...     shards = {
+        ...         fp.relative_to(output_dir).as_posix(): pl.read_parquet(fp)
+        ...         for fp in sorted(output_dir.rglob("*.parquet"))
+        ...     }
+        ...     metadata = (output_dir / "metadata" / "dataset.json").read_text()
+        ...     n_row_groups = pq.ParquetFile(output_dir / "data" / "train" / "1.parquet").num_row_groups
+        ...     try:
+        ...         reshard_dataset(input_dir, output_dir, n_shards=3)
+        ...     except FileExistsError as e:
+        ...         print(str(e).replace(str(output_dir), "$OUTPUT_DIR"))
+        Output directory $OUTPUT_DIR is not empty.
+        >>> for name, df in shards.items():
+        ...     print(name, df["subject_id"].to_list())
+        data/held_out/0.parquet [7, 7, 8]
+        data/train/0.parquet [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
+        data/train/1.parquet [2, 2, 3, 3, 4, 4, 5, 5, 6, 6, 6, 6]
+        >>> metadata, n_row_groups
+        ('{}', 6)
+        >>> shards["data/train/0.parquet"]["code"].to_list()[:5]
+        ['C0', 'C3', 'C6', 'C9', 'C1']
+        >>> report["n_shards"], report["n_events"]
+        (3, 27)
+        >>> for key, value in report["splits"]["train"].items():
+        ...     print(f"{key}: {value}")
+        n_input_shards: 3
+        n_shards: 2
+        n_subjects: 6
+        n_events: 24
+        max_input_shard_events: 16
+        max_shard_events: 12
+    """
+    input_dir, output_dir = Path(input_dir), Path(output_dir)
+
+    shards = split_shards(input_dir / data_subdirectory)
+    if not shards:
+        raise FileNotFoundError(f"No shards found in {input_dir / data_subdirectory}")
+    if output_dir.exists() and any(not fp.name.startswith(".") for fp in output_dir.iterdir()):
+        raise FileExistsError(f"Output directory {output_dir} is not empty.")
+
+    counts = count_events(shards)
+    split_totals = counts.group_by("split").agg(pl.sum("n_events"), pl.len().alias("n_subjects"))
+    n_events = dict(split_totals.select("split", "n_events").iter_rows())
+    allocation = allocate_shards(
+        {split: n_events[split] for split in shards},
+        dict(split_totals.select("split", "n_subjects").iter_rows()),
+        n_shards,
+    )
+    logger.info(f"Re-sharding {sum(len(fps) for fps in shards.values())} shards into {allocation}.")
+
+    parts_dir = output_dir / TMP_DIR
+    partition_tasks, write_tasks, write_splits = [], [], []
+    for split, fps in shards.items():
+        assignment = assign_subjects(counts.filter(pl.col("split") == split), allocation[split])
+        split_parts_dir = parts_dir / split
+        partition_tasks.extend((fp, assignment, split_parts_dir) for fp in fps)
+        for shard in range(allocation[split]):
+            out_fp = output_dir / data_subdirectory / split / f"{shard}.parquet"
+            write_tasks.append((split_parts_dir / str(shard), out_fp, row_group_size))
+            write_splits.append(split)
+
+    try:
+        _map(_partition_shard, partition_tasks, n_workers)
+        written = _map(_write_shard, write_tasks, n_workers)
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+    for fp in input_dir.iterdir():
+        if fp.name == data_subdirectory or fp.name.startswith("."):
+            continue
+        if fp.is_dir():
+            shutil.copytree(fp, output_dir / fp.name)
+        else:
+            shutil.copy2(fp, output_dir / fp.name)
+
+    report = {"n_shards": len(write_tasks), "n_subjects": len(counts), "n_events": sum(n_events.values())}
+    report["splits"] = {}
+    for split, fps in shards.items():
+        split_written = [n for s, n in zip(write_splits, written, strict=True) if s == split]
+        if sum(split_written) != n_events[split]:
+            raise RuntimeError(
+                f"Re-sharded {split} has {sum(split_written)} events, but the input has {n_events[split]}."
+            )
+        report["splits"][split] = {
+            "n_input_shards": len(fps),
+            "n_shards": allocation[split],
+            "n_subjects": counts.filter(pl.col("split") == split).height,
+            "n_events": n_events[split],
+            "max_input_shard_events": max(
+                pl.scan_parquet(fp).select(pl.len()).collect().item() for fp in fps
+            ),
+            "max_shard_events": max(split_written),
+        }
+    return report
+
+
+__all__ = ["allocate_shards", "assign_subjects", "count_events", "reshard_dataset", "split_shards"]
@@ -0,0 +1,310 @@
+"""Subsampling of MEDS datasets to a fraction of their subjects, for fast development loops.
+
+Subjects are sampled within strata of their split (and, optionally, of whether they have a positive label
+for a task), so that the subset keeps the split proportions (and label prevalence) of the full dataset. The
+shards are then streamed one at a time through a filter on the sampled subjects, and the
+metadata is copied with the subject splits restricted to the subset, so the subset is a MEDS dataset of its
+own that tasks can be extracted from.
+"""
+
+import json
+import logging
+import multiprocessing
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+from meds import (
+    data_subdirectory,
+    dataset_metadata_filepath,
+    subject_id_field,
+    subject_splits_filepath,
+)
+
+from ..tasks.label_checks import label_files
+from .reshard import count_events, split_shards
+
+logger = logging.getLogger(__name__)
+
+STRATUM = "stratum"
+
+
+def subject_strata(dataset_dir: Path | str, labels_dir: Path | str | None = None) -> pl.DataFrame:
+    """Returns the split (and label stratum, if `labels_dir` is given) of each subject of a MEDS dataset.
+
+    Splits are read from the dataset's `metadata/subject_splits.parquet`, or, if it does not exist, from the
+    directories of the shards each subject is in. With `labels_dir`, each subject is further stratified as
+    `positive` (if any of its labels has a true `boolean_value`), `negative`, or `unlabeled`.
+
+    Returns:
+        A dataframe with the `subject_id`, `split`, and `stratum` of each subject.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     (Path(d) / "metadata").mkdir()
+        ...     pl.DataFrame(
+        ...         {"subject_id": [1, 2, 3, 4], "split": ["train", "train", "train", "held_out"]}
+        ...     ).write_parquet(Path(d) / subject_splits_filepath)
+        ...     (Path(d) / "labels").mkdir()
+        ...     pl.DataFrame(
+        ...         {"subject_id": [1, 1, 2], "boolean_value": [False, True, False]}
+        ...     ).write_parquet(Path(d) / "labels" / "0.parquet")
+        ...     subject_strata(d, Path(d) / "labels")
+        shape: (4, 3)
+        ┌────────────┬──────────┬────────────────────┐
+        │ subject_id ┆ split    ┆ stratum            │
+        │ ---        ┆ ---      ┆ ---                │
+        │ i64        ┆ str      ┆ str                │
+        ╞════════════╪══════════╪════════════════════╡
+        │ 1          ┆ train    ┆ train/positive     │
+        │ 2          ┆ train    ┆ train/negative     │
+        │ 3          ┆ train    ┆ train/unlabeled    │
+        │ 4          ┆ held_out ┆ held_out/unlabeled │
+        └────────────┴──────────┴────────────────────┘
+
+    Without labels or a subject splits file, the strata are just the shard directories:
+
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     for split, subjects in (("train", [1, 1, 2]), ("held_out", [3])):
+        ...         shard_fp = Path(d) / "data" / split / "0.parquet"
+        ...         shard_fp.parent.mkdir(parents=True)
+        ...         pl.DataFrame({"subject_id": subjects}).write_parquet(shard_fp)
+        ...     subject_strata(d).sort("subject_id")
+        shape: (3, 3)
+        ┌────────────┬──────────┬──────────┐
+        │ subject_id ┆ split    ┆ stratum  │
+        │ ---        ┆ ---      ┆ ---      │
+        │ i64        ┆ str      ┆ str      │
+        ╞════════════╪══════════╪══════════╡
+        │ 1          ┆ train    ┆ train    │
+        │ 2          ┆ train    ┆ train    │
+        │ 3          ┆ held_out ┆ held_out │
+        └────────────┴──────────┴──────────┘
+    """
+    dataset_dir = Path(dataset_dir)
+    splits_fp = dataset_dir / subject_splits_filepath
+    if splits_fp.is_file():
+        splits = pl.read_parquet(splits_fp, columns=[subject_id_field, "split"])
+    else:
+        logger.info(f"No subject splits found at {splits_fp}; using the shard directories instead.")
+        splits = count_events(split_shards(dataset_dir / data_subdirectory)).select(subject_id_field, "split")
+
+    if labels_dir is None:
+        return splits.with_columns(pl.col("split").alias(STRATUM))
+
+    positive = (
+        pl.scan_parquet(label_files(labels_dir))
+        .group_by(subject_id_field)
+        .agg(pl.col("boolean_value").any().alias("positive"))
+        .collect()
+    )
+    label_stratum = (
+        pl.when(pl.col("positive"))
+        .then(pl.lit("positive"))
+        .when(pl.col("positive").not_())
+        .then(pl.lit("negative"))
+        .otherwise(pl.lit("unlabeled"))
+    )
+    return splits.join(positive, on=subject_id_field, how="left").select(
+        subject_id_field, "split", pl.concat_str("split", label_stratum, separator="/").alias(STRATUM)
+    )
+
+
+def sample_subjects(strata: pl.DataFrame, fraction: float, seed: int = 1) -> pl.DataFrame:
+    """Samples `fraction` of the subjects of each stratum, and at least one subject of every stratum.
+
+    The sample is deterministic given the subjects and the seed, regardless of the input order.
+
+    Raises:
+        ValueError: If `fraction` is not in (0, 1].
+
+    Examples:
+        >>> strata = pl.DataFrame({
+        ...     "subject_id": list(range(100)),
+        ...     "stratum": ["train/positive"] * 10 + ["train/negative"] * 80 + ["held_out/negative"] * 10,
+        ... })
+        >>> sample = sample_subjects(strata, 0.1, seed=3)
+        >>> sample.group_by("stratum").len().sort("stratum")
+        shape: (3, 2)
+        ┌───────────────────┬─────┐
+        │ stratum           ┆ len │
+        │ ---               ┆ --- │
+        │ str               ┆ u32 │
+        ╞═══════════════════╪═════╡
+        │ held_out/negative ┆ 1   │
+        │ train/negative    ┆ 8   │
+        │ train/positive    ┆ 1   │
+        └───────────────────┴─────┘
+        >>> sample.equals(sample_subjects(strata.reverse(), 0.1, seed=3))
+        True
+        >>> sample.equals(sample_subjects(strata, 0.1, seed=4))
+        False
+        >>> sample_subjects(strata, 0.001)["stratum"].n_unique()
+        3
+        >>> sample_subjects(strata, 1.5)
+        Traceback (most recent call last):
+            ...
+        ValueError: fraction must be in (0, 1], got 1.5
+    """
+    if not 0 < fraction <= 1:
+        raise ValueError(f"fraction must be in (0, 1], got {fraction}")
+
+    strata = strata.sort(subject_id_field)
+    rng = np.random.default_rng(seed)
+    n_sampled = (pl.len() * fraction).round().clip(lower_bound=1).over(STRATUM)
+    return (
+        strata.with_columns(pl.Series("_key", rng.random(len(strata))))
+        .filter(pl.col("_key").rank("ordinal").over(STRATUM) <= n_sampled)
+        .drop("_key")
+    )
+
+
+def _subsample_shard(args: tuple[Path, Path, pl.Series]) -> int:
+    """Writes the events of the sampled subjects in one shard, if any; returns the number of events.
+
+    The shard is streamed through an `is_in` filter (a semi-join on the sampled subject IDs, which, unlike
+    `join(how="semi")`, the streaming engine can sink), so it is never fully loaded into memory.
+    """
+    in_fp, out_fp, subjects = args
+    out_fp.parent.mkdir(parents=True, exist_ok=True)
+    pl.scan_parquet(in_fp).filter(pl.col(subject_id_field).is_in(subjects)).sink_parquet(out_fp)
+    n_events = pq.ParquetFile(out_fp).metadata.num_rows
+    if n_events == 0:
+        out_fp.unlink()
+    return n_events
+
+
+def subsample_dataset(
+    input_dir: Path | str,
+    output_dir: Path | str,
+    fraction: float,
+    seed: int = 1,
+    labels_dir: Path | str | None = None,
+    n_workers: int = 1,
+) -> dict[str, Any]:
+    """Writes a subset of `fraction` of the subjects of a MEDS dataset, stratified by split (and label).
+
+    Each shard `data/$SHARD.parquet` of the input is filtered to the sampled subjects and written to the same
+    path under `output_dir`, unless it has none of them. The `metadata/` directory is copied, with the subject
+    splits restricted to the sampled subjects and the `dataset_version` in `dataset.json` marked with the
+    fraction and seed.
+
+    Args:
+        input_dir: The root directory of the MEDS dataset.
+        output_dir: The root directory to write the subset to. It must not exist or must hold only hidden
+            files (such as logs).
+        fraction: The fraction of subjects of each stratum to keep.
+        seed: The random seed for sampling.
+        labels_dir: If set, a task's labels, by which subjects are further stratified (see `subject_strata`).
+        n_workers: The number of processes to filter shards with.
+
+    Returns:
+        A report with the number of subjects of each stratum in the dataset and in the subset, and the number
+        of events in the subset.
+
+    Raises:
+        FileNotFoundError: If the input dataset has no shards.
+        FileExistsError: If the output directory is not empty.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     input_dir, output_dir = Path(d) / "input", Path(d) / "output"
+        ...     shards = {"train/0": range(0, 20), "train/1": range(20, 40), "tuning/0": [40]}
+        ...     for shard, subjects in shards.items():
+        ...         (input_dir / "data" / shard).parent.mkdir(parents=True, exist_ok=True)
+        ...         pl.DataFrame({"subject_id": [s for s in subjects for _ in range(3)]}).write_parquet(
+        ...             input_dir / "data" / f"{shard}.parquet"
+        ...         )
+        ...     (input_dir / "metadata").mkdir()
+        ...     pl.DataFrame({"subject_id": range(41), "split": ["train"] * 40 + ["tuning"]}).write_parquet(
+        ...         input_dir / subject_splits_filepath
+        ...     )
+        ...     dataset = {"dataset_name": "test", "dataset_version": "1.0"}
+        ...     _ = (input_dir / dataset_metadata_filepath).write_text(json.dumps(dataset))
+        ...     _ = (input_dir / "metadata" / "codes.parquet").write_bytes(b"codes")
+        ...     report = subsample_dataset(input_dir, output_dir, fraction=0.1)
+        ...     data = {
+        ...         fp.relative_to(output_dir).as_posix(): pl.read_parquet(fp)["subject_id"].to_list()
+        ...         for fp in sorted((output_dir / "data").rglob("*.parquet"))
+        ...     }
+        ...     splits = pl.read_parquet(output_dir / subject_splits_filepath)
+        ...     dataset = json.loads((output_dir / dataset_metadata_filepath).read_text())
+        ...     codes = (output_dir / "metadata" / "codes.parquet").read_bytes()
+        >>> for fp, subjects in data.items():
+        ...     print(fp, subjects)
+        data/train/0.parquet [9, 9, 9]
+        data/train/1.parquet [31, 31, 31, 36, 36, 36, 39, 39, 39]
+        data/tuning/0.parquet [40, 40, 40]
+        >>> splits["subject_id"].to_list(), splits["split"].to_list()
+        ([9, 31, 36, 39, 40], ['train', 'train', 'train', 'train', 'tuning'])
+        >>> dataset["dataset_version"], codes
+        ('1.0/subsample=0.1/seed=1', b'codes')
+        >>> report["n_subjects"], report["n_sampled_subjects"], report["n_events"]
+        (41, 5, 15)
+        >>> for stratum, counts in report["strata"].items():
+        ...     print(stratum, counts)
+        train {'n_subjects': 40, 'n_sampled_subjects': 4}
+        tuning {'n_subjects': 1, 'n_sampled_subjects': 1}
+    """
+    input_dir, output_dir = Path(input_dir), Path(output_dir)
+
+    shards = [fp for fps in split_shards(input_dir / data_subdirectory).values() for fp in fps]
+    if not shards:
+        raise FileNotFoundError(f"No shards found in {input_dir / data_subdirectory}")
+    if output_dir.exists() and any(not fp.name.startswith(".") for fp in output_dir.iterdir()):
+        raise FileExistsError(f"Output directory {output_dir} is not empty.")
+
+    strata = subject_strata(input_dir, labels_dir)
+    sampled = sample_subjects(strata, fraction, seed)
+    logger.info(f"Sampled {len(sampled)} of {len(strata)} subjects; filtering {len(shards)} shards.")
+
+    subjects = sampled[subject_id_field]
+    tasks = [(fp, output_dir / fp.relative_to(input_dir), subjects) for fp in shards]
+    if n_workers > 1 and len(tasks) > 1:
+        # Spawn rather than fork, as forking a process that has used polars' thread pool can deadlock.
+        with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            n_events = list(pool.map(_subsample_shard, tasks))
+    else:
+        n_events = [_subsample_shard(task) for task in tasks]
+
+    for fp in input_dir.iterdir():
+        if fp.name == data_subdirectory or fp.name.startswith("."):
+            continue
+        if fp.is_dir():
+            shutil.copytree(fp, output_dir / fp.name)
+        else:
+            shutil.copy2(fp, output_dir / fp.name)
+
+    splits_fp = output_dir / subject_splits_filepath
+    if splits_fp.is_file():
+        pl.read_parquet(splits_fp).filter(pl.col(subject_id_field).is_in(subjects)).write_parquet(splits_fp)
+
+    dataset_fp = output_dir / dataset_metadata_filepath
+    if dataset_fp.is_file():
+        dataset = json.loads(dataset_fp.read_text())
+        dataset["dataset_version"] = f"{dataset.get('dataset_version')}/subsample={fraction}/seed={seed}"
+        dataset_fp.write_text(json.dumps(dataset, indent=2))
+
+    counts = (
+        strata.group_by(STRATUM)
+        .agg(pl.len().alias("n_subjects"))
+        .join(sampled.group_by(STRATUM).agg(pl.len().alias("n_sampled_subjects")), on=STRATUM)
+        .sort(STRATUM)
+    )
+    return {
+        "fraction": fraction,
+        "seed": seed,
+        "n_subjects": len(strata),
+        "n_sampled_subjects": len(sampled),
+        "n_events": sum(n_events),
+        "strata": {row.pop(STRATUM): row for row in counts.iter_rows(named=True)},
+    }
+
+
+__all__ = ["sample_subjects", "subject_strata", "subsample_dataset"]
@@ -0,0 +1,352 @@
+import itertools
+import json
+import logging
+from datetime import UTC, datetime
+from importlib.metadata import version
+from importlib.resources import files
+from pathlib import Path
+
+import hydra
+import meds
+import numpy as np
+import polars as pl
+from omegaconf import DictConfig
+
+logger = logging.getLogger(__name__)
+
+CONFIG = files("MEDS_DEV") / "datasets" / "synthetic" / "_config.yaml"
+
+SPLIT_FRACTIONS = {meds.train_split: 0.8, meds.tuning_split: 0.1, meds.held_out_split: 0.1}
+
+START = np.datetime64("2110-01-01T00:00:00", "us")
+HOUR = np.timedelta64(3_600_000_000, "us")
+YEAR_HOURS = 365.25 * 24
+
+MAX_ADMISSIONS = 5
+ICU_RATE = 0.4
+ED_RATE = 0.5
+DEATH_RATE = 0.1
+
+ADMISSION_TYPES = ["EW EMER.", "URGENT", "ELECTIVE", "OBSERVATION ADMIT"]
+DISCHARGE_LOCATIONS = ["HOME", "HOME HEALTH CARE", "SKILLED NURSING FACILITY", "REHAB"]
+ED_ARRIVALS = ["WALK IN", "AMBULANCE"]
+ICU_UNITS = ["MICU", "SICU", "CVICU", "CCU"]
+
+# Each lab (or vital sign) maps to the codes it is recorded under and the mean and standard deviation of its
+# (normally distributed) values. Codes and units mirror the MIMIC-IV predicates, and the distributions are set
+# so that a sizable fraction of values falls beyond each task's abnormality threshold.
+LABS = {
+    "Creatinine": (["LAB//50912//mg/dL", "LAB//52546//mg/dL"], 1.0, 0.4),
+    "Sodium": (["LAB//220645//mEq/L", "LAB//50983//mEq/L", "LAB//52623//mEq/L"], 139.0, 4.0),
+    "Bicarbonate": (["LAB//227443//mEq/L", "LAB//50882//mEq/L"], 25.0, 3.0),
+    "Hemoglobin": (["LAB//220228//g/dl", "LAB//50811//g/dL"], 14.0, 2.0),
+    "White blood cells": (["LAB//220546//K/uL", "LAB//51300//K/uL"], 8.0, 3.0),
+    "Platelets": (["LAB//227457//K/uL", "LAB//51265//K/uL"], 230.0, 70.0),
+    "Mean arterial pressure": (["LAB//220052//mmHg", "LAB//220181//mmHg", "LAB//225312//mmHg"], 80.0, 12.0),
+}
+
+
+def code_metadata() -> pl.DataFrame:
+    """Returns the code metadata (vocabulary) of the synthetic dataset, in the MEDS code metadata schema.
+
+    The row index of each code is the integer code index used internally by `generate_shard`.
+
+    Examples:
+        >>> codes = code_metadata()
+        >>> codes.columns
+        ['code', 'description', 'parent_codes']
+        >>> codes["code"].head(4).to_list()
+        ['MEDS_BIRTH', 'MEDS_DEATH', 'HOSPITAL_ADMISSION//EW EMER.', 'HOSPITAL_ADMISSION//URGENT']
+        >>> codes.filter(pl.col("code") == "LAB//50912//mg/dL")["description"].item()
+        'Creatinine'
+    """
+    rows = [(meds.birth_code, "Birth"), (meds.death_code, "Death")]
+    rows.extend((f"HOSPITAL_ADMISSION//{t}", f"Hospital admission ({t})") for t in ADMISSION_TYPES)
+    rows.extend((f"HOSPITAL_DISCHARGE//{loc}", f"Hospital discharge ({loc})") for loc in DISCHARGE_LOCATIONS)
+    rows.append(("HOSPITAL_DISCHARGE//DIED", "Hospital discharge (died)"))
+    rows.extend((f"ED_REGISTRATION//{a}", f"ED registration ({a})") for a in ED_ARRIVALS)
+    rows.append(("ED_OUT//ADMITTED", "ED discharge (admitted)"))
+    rows.extend((f"ICU_ADMISSION//{u}", f"ICU admission ({u})") for u in ICU_UNITS)
+    rows.extend((f"ICU_DISCHARGE//{u}", f"ICU discharge ({u})") for u in ICU_UNITS)
+    rows.extend((code, name) for name, (codes, _, _) in LABS.items() for code in codes)
+
+    return pl.DataFrame(
+        {
+            meds.code_field: [code for code, _ in rows],
+            "description": [description for _, description in rows],
+            "parent_codes": pl.Series([None] * len(rows), dtype=pl.List(pl.String)),
+        }
+    )
+
+
+def _code_index(codes: pl.DataFrame, code: str) -> int:
+    return codes[meds.code_field].to_list().index(code)
+
+
+def _hours(x: np.ndarray) -> np.ndarray:
+    return (x * HOUR.astype(np.int64)).astype("timedelta64[us]")
+
+
+def generate_shard(
+    subject_ids: np.ndarray, events_per_subject: float, rng: np.random.Generator
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """Generates the events and splits of a set of synthetic subjects.
+
+    Each subject has a birth, between one and `MAX_ADMISSIONS` hospital admissions (some preceded by an ED
+    stay, some including an ICU stay, each ending in a discharge), and on average `events_per_subject` lab and
+    vital sign measurements taken during those admissions. Some subjects die at the end of their last
+    admission (in the ICU, if that admission had an ICU stay).
+
+    Args:
+        subject_ids: The IDs of the subjects to generate.
+        events_per_subject: The mean number of measurements per subject.
+        rng: The random number generator to use.
+
+    Returns:
+        The subjects' events, in the MEDS data schema and sorted by subject and time, and their splits, in the
+        MEDS subject splits schema.
+
+    Examples:
+        >>> data, splits = generate_shard(np.arange(100), 20, np.random.default_rng(1))
+        >>> data.schema == pl.Schema(pl.from_arrow(meds.data_schema().empty_table()).schema)
+        True
+        >>> sorted(splits["split"].unique())
+        ['held_out', 'train', 'tuning']
+        >>> per_subject = data.group_by("subject_id").agg(
+        ...     pl.col("code").eq("MEDS_BIRTH").sum().alias("births"),
+        ...     pl.col("code").str.starts_with("HOSPITAL_ADMISSION").sum().alias("admissions"),
+        ...     pl.col("code").str.starts_with("HOSPITAL_DISCHARGE").sum().alias("discharges"),
+        ...     pl.col("code").eq("MEDS_DEATH").sum().alias("deaths"),
+        ...     pl.col("time").first().alias("first_time"),
+        ...     pl.col("time").filter(pl.col("code") == "MEDS_BIRTH").first().alias("birth_time"),
+        ... )
+        >>> (per_subject["births"] == 1).all(), (per_subject["deaths"] <= 1).all()
+        (True, True)
+        >>> (per_subject["admissions"] == per_subject["discharges"]).all()
+        True
+        >>> (per_subject["first_time"] == per_subject["birth_time"]).all()
+        True
+        >>> data.equals(generate_shard(np.arange(100), 20, np.random.default_rng(1))[0])
+        True
+    """
+    codes = code_metadata()
+    n = len(subject_ids)
+
+    # Subjects
+    first_admission = START + _hours(rng.uniform(0, 40 * YEAR_HOURS, n))
+    birth = first_admission - _hours(rng.uniform(10 * YEAR_HOURS, 90 * YEAR_HOURS, n))
+    n_admissions = np.minimum(1 + rng.poisson(0.7, n), MAX_ADMISSIONS)
+    dies = rng.random(n) < DEATH_RATE
+
+    # Admissions, laid out back to back per subject with gaps of one month to a year between them.
+    adm_subject = np.repeat(np.arange(n), n_admissions)
+    n_adm = len(adm_subject)
+    subject_first_adm = np.cumsum(n_admissions) - n_admissions
+    is_last = np.arange(n_adm) - subject_first_adm[adm_subject] == n_admissions[adm_subject] - 1
+
+    los = np.maximum(rng.lognormal(np.log(96), 0.6, n_adm), 6)  # hours
+    step = los + rng.uniform(30 * 24, 365 * 24, n_adm)
+    offset = np.cumsum(step) - step
+    offset -= offset[subject_first_adm][adm_subject]
+    adm_start = first_admission[adm_subject] + _hours(offset)
+    adm_end = adm_start + _hours(los)
+    died = dies[adm_subject] & is_last
+
+    has_icu = rng.random(n_adm) < ICU_RATE
+    icu_start_offset = rng.uniform(0, 1, n_adm) * np.minimum(24, los / 2)
+    icu_los = rng.uniform(0.3, 0.9, n_adm) * (los - icu_start_offset)
+    icu_los = np.where(died, los - icu_start_offset, icu_los)
+    icu_start = adm_start + _hours(icu_start_offset)
+    icu_end = icu_start + _hours(icu_los)
+    icu_unit = rng.integers(len(ICU_UNITS), size=n_adm)
+
+    has_ed = rng.random(n_adm) < ED_RATE
+    ed_start = adm_start - _hours(rng.uniform(1, 12, n_adm))
+
+    discharge_code = np.where(
+        died,
+        _code_index(codes, "HOSPITAL_DISCHARGE//DIED"),
+        _code_index(codes, f"HOSPITAL_DISCHARGE//{DISCHARGE_LOCATIONS[0]}")
+        + rng.integers(len(DISCHARGE_LOCATIONS), size=n_adm),
+    )
+
+    # Measurements, each taken at a uniformly random time during a random admission of its subject.
+    n_labs = rng.poisson(events_per_subject, n)
+    lab_subject = np.repeat(np.arange(n), n_labs)
+    lab_adm = subject_first_adm[lab_subject] + (rng.random(len(lab_subject)) * n_admissions[lab_subject])
+    lab_adm = lab_adm.astype(np.int64)
+    lab_time = adm_start[lab_adm] + _hours(rng.random(len(lab_subject)) * los[lab_adm])
+
+    lab_sizes = np.array([len(c) for c, _, _ in LABS.values()])
+    lab_offsets = _code_index(codes, LABS["Creatinine"][0][0]) + np.cumsum(lab_sizes) - lab_sizes
+    lab = rng.integers(len(LABS), size=len(lab_subject))
+    lab_code = lab_offsets[lab] + (rng.random(len(lab_subject)) * lab_sizes[lab]).astype(np.int64)
+    lab_mean = np.array([m for _, m, _ in LABS.values()])[lab]
+    lab_std = np.array([s for _, _, s in LABS.values()])[lab]
+    lab_value = np.maximum(rng.normal(lab_mean, lab_std), 0.01)
+
+    def events(subject, time, code, value=None) -> dict[str, np.ndarray]:
+        code = np.broadcast_to(code, subject.shape)
+        value = np.full(subject.shape, np.nan) if value is None else value
+        return {"subject": subject, "time": time, "code": code, "value": value}
+
+    parts = [
+        events(np.arange(n), birth, _code_index(codes, meds.birth_code)),
+        events(
+            adm_subject[has_ed],
+            ed_start[has_ed],
+            _code_index(codes, f"ED_REGISTRATION//{ED_ARRIVALS[0]}")
+            + rng.integers(len(ED_ARRIVALS), size=has_ed.sum()),
+        ),
+        events(adm_subject[has_ed], adm_start[has_ed], _code_index(codes, "ED_OUT//ADMITTED")),
+        events(
+            adm_subject,
+            adm_start,
+            _code_index(codes, f"HOSPITAL_ADMISSION//{ADMISSION_TYPES[0]}")
+            + rng.integers(len(ADMISSION_TYPES), size=n_adm),
+        ),
+        events(
+            adm_subject[has_icu],
+            icu_start[has_icu],
+            _code_index(codes, f"ICU_ADMISSION//{ICU_UNITS[0]}") + icu_unit[has_icu],
+        ),
+        events(
+            adm_subject[has_icu],
+            icu_end[has_icu],
+            _code_index(codes, f"ICU_DISCHARGE//{ICU_UNITS[0]}") + icu_unit[has_icu],
+        ),
+        events(lab_subject, lab_time, lab_code, lab_value),
+        events(adm_subject, adm_end, discharge_code),
+        events(adm_subject[died], adm_end[died], _code_index(codes, meds.death_code)),
+    ]
+
+    def concat(key: str) -> np.ndarray:
+        return np.concatenate([part[key] for part in parts])
+
+    data = pl.DataFrame(
+        {
+            meds.subject_id_field: subject_ids[concat("subject")],
+            meds.time_field: concat("time"),
+            meds.code_field: codes[meds.code_field].gather(concat("code")),
+            meds.numeric_value_field: pl.Series(concat("value"), nan_to_null=True).cast(pl.Float32),
+        }
+    ).sort(meds.subject_id_field, meds.time_field, maintain_order=True)
+
+    splits = pl.DataFrame(
+        {
+            meds.subject_id_field: subject_ids,
+            "split": rng.choice(list(SPLIT_FRACTIONS), size=n, p=list(SPLIT_FRACTIONS.values())),
+        }
+    )
+    return data, splits
+
+
+@hydra.main(version_base=None, config_path=str(CONFIG.parent.resolve()), config_name=CONFIG.stem)
+def main(cfg: DictConfig) -> None:
+    """Generates a synthetic, MEDS-compliant dataset whose codes resolve all MIMIC-IV predicates.
+
+    Subjects are divided into `n_shards` contiguous blocks of subject IDs, each of which is generated
+    independently (with its own random state derived from `seed`), so datasets of millions of subjects can be
+    generated in bounded memory. Each block's subjects are assigned to the train, tuning, and held-out splits
+    at random, and each block is written as one shard per split, e.g., `data/train/0.parquet`.
+
+    Args:
+        cfg: The configuration object, controlled through Hydra command line arguments. Takes:
+          - output_dir: The root directory of the dataset to write.
+          - n_subjects: The number of subjects to generate.
+          - events_per_subject: The mean number of lab and vital sign measurements per subject.
+          - n_shards: The number of shards per split.
+          - seed: The random seed.
+
+    Raises:
+        ValueError: If `n_subjects` or `n_shards` is not positive, or there are more shards than subjects.
+
+    Examples:
+        >>> import tempfile
+        >>> from MEDS_DEV import DATASETS
+        >>> from MEDS_DEV.tasks.extraction import load_dataset_plain_predicates
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     cfg = DictConfig(
+        ...         {"output_dir": d, "n_subjects": 300, "events_per_subject": 30, "n_shards": 2, "seed": 1}
+        ...     )
+        ...     main(cfg)
+        ...     shards = sorted(fp.relative_to(d).as_posix() for fp in Path(d).rglob("*.parquet"))
+        ...     data = pl.read_parquet(Path(d) / "data")
+        ...     splits = pl.read_parquet(Path(d) / meds.subject_splits_filepath)
+        ...     dataset_metadata = json.loads((Path(d) / meds.dataset_metadata_filepath).read_text())
+        >>> for shard in shards:
+        ...     print(shard)
+        data/held_out/0.parquet
+        data/held_out/1.parquet
+        data/train/0.parquet
+        data/train/1.parquet
+        data/tuning/0.parquet
+        data/tuning/1.parquet
+        metadata/codes.parquet
+        metadata/subject_splits.parquet
+        >>> data["subject_id"].n_unique(), len(splits), dataset_metadata["dataset_name"]
+        (300, 300, 'synthetic')
+
+    Every plain predicate in the MIMIC-IV predicates file matches some events:
+
+        >>> predicates = load_dataset_plain_predicates(DATASETS["MIMIC-IV"]["predicates"])
+        >>> counts = data.select(
+        ...     [p.MEDS_eval_expr().sum().alias(name) for name, p in predicates.items() if not p.static]
+        ... )
+        >>> [name for name, count in counts.row(0, named=True).items() if count == 0]
+        []
+
+    Invalid sizes raise errors:
+
+        >>> main(DictConfig({"output_dir": "d", "n_subjects": 3, "events_per_subject": 3, "n_shards": 4}))
+        Traceback (most recent call last):
+            ...
+        ValueError: n_subjects (3) and n_shards (4) must be positive, with at least one subject per shard.
+    """
+
+    n_subjects = int(cfg.n_subjects)
+    n_shards = int(cfg.n_shards)
+    if n_subjects < 1 or n_shards < 1 or n_shards > n_subjects:
+        raise ValueError(
+            f"n_subjects ({n_subjects}) and n_shards ({n_shards}) must be positive, with at least one "
+            "subject per shard."
+        )
+
+    output_dir = Path(cfg.output_dir)
+    data_dir = output_dir / meds.data_subdirectory
+
+    all_splits = []
+    bounds = np.linspace(0, n_subjects, n_shards + 1).astype(np.int64)
+    for shard, (start, end) in enumerate(itertools.pairwise(bounds)):
+        rng = np.random.default_rng([cfg.get("seed", 1), shard])
+        data, splits = generate_shard(np.arange(start, end), cfg.events_per_subject, rng)
+        for split in SPLIT_FRACTIONS:
+            split_subjects = splits.filter(pl.col("split") == split)[meds.subject_id_field]
+            if split_subjects.is_empty():
+                continue
+            shard_fp = data_dir / split / f"{shard}.parquet"
+            shard_fp.parent.mkdir(parents=True, exist_ok=True)
+            data.filter(pl.col(meds.subject_id_field).is_in(split_subjects)).write_parquet(shard_fp)
+        all_splits.append(splits)
+        logger.info(f"Wrote shard {shard + 1}/{n_shards} ({end - start} subjects, {len(data)} events).")
+
+    metadata_dir = output_dir / "metadata"
+    metadata_dir.mkdir(parents=True, exist_ok=True)
+    pl.concat(all_splits).write_parquet(output_dir / meds.subject_splits_filepath)
+    code_metadata().write_parquet(output_dir / meds.code_metadata_filepath)
+    dataset_metadata = {
+        "dataset_name": "synthetic",
+        "dataset_version": (
+            f"n_subjects={n_subjects}/events_per_subject={cfg.events_per_subject}/n_shards={n_shards}/"
+            f"seed={cfg.get('seed', 1)}"
+        ),
+        "etl_name": "MEDS_DEV.datasets.synthetic",
+        "etl_version": version("MEDS_DEV"),
+        "meds_version": version("meds"),
+        "created_at": datetime.now(tz=UTC).isoformat(),
+    }
+    (output_dir / meds.dataset_metadata_filepath).write_text(json.dumps(dataset_metadata, indent=2))
+
+
+if __name__ == "__main__":
+    main()
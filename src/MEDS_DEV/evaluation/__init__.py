@@ -1,5 +1,399 @@
+import logging
+from collections.abc import Mapping
 from importlib.resources import files
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+from meds_evaluation.schema import (
+    BOOLEAN_VALUE_FIELD,
+    PREDICTED_BOOLEAN_PROBABILITY_FIELD,
+    PREDICTED_BOOLEAN_VALUE_FIELD,
+    PREDICTION_TIME_FIELD,
+    SUBJECT_ID_FIELD,
+    validate_binary_classification_schema,
+)
+
+from .metrics import BinaryPredictions, bootstrap_metrics, percentile_interval, resample_subjects
+
+logger = logging.getLogger(__name__)
 
 CFG_YAML = files("MEDS_DEV.configs") / "_evaluate_predictions.yaml"
 
-__all__ = ["CFG_YAML"]
+EVALUATION_COLUMNS = (
+    SUBJECT_ID_FIELD,
+    PREDICTION_TIME_FIELD,
+    BOOLEAN_VALUE_FIELD,
+    PREDICTED_BOOLEAN_VALUE_FIELD,
+    PREDICTED_BOOLEAN_PROBABILITY_FIELD,
+)
+KEY_COLUMNS = (SUBJECT_ID_FIELD, PREDICTION_TIME_FIELD)
+PREDICTED_COLUMNS = (PREDICTED_BOOLEAN_VALUE_FIELD, PREDICTED_BOOLEAN_PROBABILITY_FIELD)
+
+
+def read_predictions(predictions_path: Path | str) -> pl.DataFrame:
+    """Reads the columns needed for evaluation from the predictions parquet file(s) at a path or glob.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     for i in range(2):
+        ...         pl.DataFrame({
+        ...             "subject_id": [i], "prediction_time": [datetime(2021, 1, 1)], "boolean_value": [True],
+        ...             "predicted_boolean_probability": [0.5], "extra": ["ignored"],
+        ...         }).write_parquet(Path(d) / f"{i}.parquet")
+        ...     read_predictions(f"{d}/**/*.parquet").columns
+        ['subject_id', 'prediction_time', 'boolean_value', 'predicted_boolean_probability']
+    """
+    predictions = pl.scan_parquet(predictions_path)
+    available = predictions.collect_schema().names()
+    return predictions.select(c for c in EVALUATION_COLUMNS if c in available).collect()
+
+
+def read_prediction_sets(
+    predictions_paths: Mapping[str, Path | str],
+) -> tuple[pl.DataFrame, dict[str, pl.DataFrame]]:
+    """Reads several prediction sets for the same task, joined to one shared label frame.
+
+    The labels (the subject IDs, prediction times, and boolean values) are only read from the first
+    prediction set. From every other set, only the prediction keys and the predicted columns are read, and
+    they are joined to the shared labels on `(subject_id, prediction_time)`, all in one query. Every set must
+    predict exactly the rows of the first set, and the prediction keys must be unique.
+
+    Args:
+        predictions_paths: A mapping from the name of each prediction set to its parquet file(s) path or glob.
+
+    Returns:
+        The shared label frame and, for each prediction set, a frame of its predicted columns, with rows
+        aligned to the label frame.
+
+    Raises:
+        ValueError: If there are no prediction sets, a set is missing columns, the prediction keys are not
+            unique, or the sets do not predict the same rows.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> keys = {"subject_id": [1, 1, 2], "prediction_time": [datetime(2021, 1, d) for d in (1, 2, 1)]}
+        >>> y = {**keys, "boolean_value": [True, False, True]}
+        >>> y_pred = {**keys, "predicted_boolean_value": [True, True, False]}
+        >>> y_prob = {**y, "predicted_boolean_probability": [0.9, 0.2, 0.4]}
+        >>> def write(fp, df):
+        ...     fp.parent.mkdir(parents=True, exist_ok=True)
+        ...     df.write_parquet(fp)
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     write(Path(d) / "a/0.parquet", pl.DataFrame(y_prob))
+        ...     write(Path(d) / "b/0.parquet", pl.DataFrame(y_pred)[[2, 0, 1]])
+        ...     labels, predictions = read_prediction_sets({"a": f"{d}/a/*.parquet", "b": f"{d}/b/*.parquet"})
+        >>> labels
+        shape: (3, 3)
+        ┌────────────┬─────────────────────┬───────────────┐
+        │ subject_id ┆ prediction_time     ┆ boolean_value │
+        │ ---        ┆ ---                 ┆ ---           │
+        │ i64        ┆ datetime[μs]        ┆ bool          │
+        ╞════════════╪═════════════════════╪═══════════════╡
+        │ 1          ┆ 2021-01-01 00:00:00 ┆ true          │
+        │ 1          ┆ 2021-01-02 00:00:00 ┆ false         │
+        │ 2          ┆ 2021-01-01 00:00:00 ┆ true          │
+        └────────────┴─────────────────────┴───────────────┘
+        >>> for name, df in predictions.items():
+        ...     print(name, df.to_dict(as_series=False))
+        a {'predicted_boolean_probability': [0.9, 0.2, 0.4]}
+        b {'predicted_boolean_value': [True, True, False]}
+
+    Sets must predict the same rows, with unique keys:
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     write(Path(d) / "a.parquet", pl.DataFrame(y))
+        ...     write(Path(d) / "b.parquet", pl.DataFrame(y_pred)[1:])
+        ...     read_prediction_sets({"a": Path(d) / "a.parquet", "b": Path(d) / "b.parquet"})
+        Traceback (most recent call last):
+            ...
+        ValueError: Prediction set b has 2 rows, but prediction set a has 3 (of which b is missing 1).
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     write(Path(d) / "a.parquet", pl.DataFrame(y))
+        ...     write(Path(d) / "b.parquet", pl.DataFrame(y_pred)[[0, 0, 1]])
+        ...     read_prediction_sets({"a": Path(d) / "a.parquet", "b": Path(d) / "b.parquet"})
+        Traceback (most recent call last):
+            ...
+        ValueError: Prediction keys (subject_id, prediction_time) must be unique within each prediction set.
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     write(Path(d) / "a.parquet", pl.DataFrame(y_pred))
+        ...     read_prediction_sets({"a": Path(d) / "a.parquet"})
+        Traceback (most recent call last):
+            ...
+        ValueError: Prediction set a is missing columns: boolean_value
+        >>> read_prediction_sets({})
+        Traceback (most recent call last):
+            ...
+        ValueError: No prediction sets to read.
+    """
+    if not predictions_paths:
+        raise ValueError("No prediction sets to read.")
+
+    scans = {name: pl.scan_parquet(path) for name, path in predictions_paths.items()}
+    labels_name = next(iter(scans))
+
+    predicted_columns = {}
+    for name, scan in scans.items():
+        available = scan.collect_schema().names()
+        required = [*KEY_COLUMNS, BOOLEAN_VALUE_FIELD] if name == labels_name else list(KEY_COLUMNS)
+        if missing := [c for c in required if c not in available]:
+            raise ValueError(f"Prediction set {name} is missing columns: {', '.join(missing)}")
+        predicted_columns[name] = [c for c in PREDICTED_COLUMNS if c in available]
+
+    # Columns are renamed by the index of their set, as set names need not be valid or distinct column names.
+    def renamed(i: int, name: str) -> list[pl.Expr]:
+        return [pl.col(c).alias(f"{i}/{c}") for c in predicted_columns[name]]
+
+    joined = scans[labels_name].select(*KEY_COLUMNS, BOOLEAN_VALUE_FIELD, *renamed(0, labels_name))
+    for i, (name, scan) in enumerate(scans.items()):
+        if i == 0:
+            continue
+        set_columns = scan.select(*KEY_COLUMNS, *renamed(i, name), pl.lit(True).alias(f"{i}/matched"))
+        joined = joined.join(set_columns, on=KEY_COLUMNS, how="left", validate="1:1", join_nulls=True)
+
+    try:
+        df, *heights = pl.collect_all([joined, *(scan.select(pl.len()) for scan in scans.values())])
+    except pl.exceptions.ComputeError as e:
+        raise ValueError(
+            f"Prediction keys ({', '.join(KEY_COLUMNS)}) must be unique within each prediction set."
+        ) from e
+
+    predictions = {}
+    for i, (name, height) in enumerate(zip(scans, heights, strict=True)):
+        height = height.item()
+        n_missing = 0 if i == 0 else df[f"{i}/matched"].null_count()
+        if height != df.height or n_missing:
+            raise ValueError(
+                f"Prediction set {name} has {height} rows, but prediction set {labels_name} has {df.height} "
+                f"(of which {name} is missing {n_missing})."
+            )
+        predictions[name] = df.select(pl.col(f"{i}/{c}").alias(c) for c in predicted_columns[name])
+
+    return df.select(*KEY_COLUMNS, BOOLEAN_VALUE_FIELD), predictions
+
+
+def _as_json_value(value: float) -> float | None:
+    return None if np.isnan(value) else float(value)
+
+
+def _binary_predictions(df: pl.DataFrame) -> BinaryPredictions:
+    kwargs = {}
+    for field, arg in [
+        (PREDICTED_BOOLEAN_VALUE_FIELD, "y_pred"),
+        (PREDICTED_BOOLEAN_PROBABILITY_FIELD, "y_prob"),
+    ]:
+        if field in df.columns and not df[field].is_null().all():
+            kwargs[arg] = df[field].to_numpy()
+    return BinaryPredictions.from_arrays(df[BOOLEAN_VALUE_FIELD].to_numpy(), **kwargs)
+
+
+def _evaluate_weightings(
+    weightings: dict[str, BinaryPredictions],
+    n_bootstrap: int,
+    confidence_level: float,
+    seed: int,
+    n_workers: int,
+) -> dict:
+    results = {}
+    for weighting, preds in weightings.items():
+        results[weighting] = {name: _as_json_value(v[0]) for name, v in preds.metrics().items()}
+
+    if n_bootstrap > 0:
+        intervals = {"n_bootstrap": n_bootstrap, "confidence_level": confidence_level}
+        for weighting, preds in weightings.items():
+            logger.info(f"Computing {n_bootstrap} bootstrap replicates of the {weighting} metrics.")
+            replicates = bootstrap_metrics(preds, n_bootstrap, seed=seed, n_workers=n_workers)
+            intervals[weighting] = {
+                name: percentile_interval(values, confidence_level) for name, values in replicates.items()
+            }
+        results["confidence_intervals"] = intervals
+
+    return results
+
+
+def evaluate_predictions(
+    predictions: pl.DataFrame,
+    samples_per_subject: int = 4,
+    n_bootstrap: int = 1000,
+    confidence_level: float = 0.95,
+    seed: int = 0,
+    n_workers: int = 1,
+) -> dict:
+    """Evaluates binary classification predictions, with bootstrap confidence intervals.
+
+    This computes the same metrics as `meds-evaluation`, in the same output format, both with all samples
+    equally weighted and with all subjects equally weighted (via a resample of `samples_per_subject` samples
+    per subject, the same one `meds-evaluation` draws with the same `seed`), plus the Brier score. Undefined
+    metrics (e.g., AUROC with only one label class) are `None`.
+
+    If `n_bootstrap` is positive, percentile bootstrap confidence intervals of every metric, from
+    `n_bootstrap` resamples of the rows evaluated under each weighting, are added under the
+    `"confidence_intervals"` key.
+
+    Args:
+        predictions: The predictions, following the MEDS binary classification prediction schema.
+        samples_per_subject: The number of samples to draw per subject for the subject-weighted metrics.
+        n_bootstrap: The number of bootstrap replicates. If 0, no confidence intervals are computed.
+        confidence_level: The confidence level of the intervals.
+        seed: The random seed of the subject resampling and the bootstrap.
+        n_workers: The number of processes to compute bootstrap replicates in.
+
+    Returns:
+        The evaluation results.
+
+    Raises:
+        ValueError: If the predictions do not follow the schema.
+
+    Examples:
+        >>> rng = np.random.default_rng(0)
+        >>> labels = rng.random(500) < 0.4
+        >>> predictions = pl.DataFrame({
+        ...     "subject_id": rng.integers(0, 100, 500),
+        ...     "boolean_value": labels,
+        ...     "predicted_boolean_probability": np.clip(0.3 * labels + 0.7 * rng.random(500), 0, 1),
+        ... }).with_columns(
+        ...     pl.col("predicted_boolean_probability").gt(0.5).alias("predicted_boolean_value"),
+        ...     pl.lit(None, dtype=pl.Datetime("us")).alias("prediction_time"),
+        ... )
+        >>> out = evaluate_predictions(predictions, n_bootstrap=200)
+        >>> list(out)
+        ['samples_equally_weighted', 'subjects_equally_weighted', 'confidence_intervals']
+        >>> for name, value in out["samples_equally_weighted"].items():
+        ...     low, high = out["confidence_intervals"]["samples_equally_weighted"][name]
+        ...     print(f"{name}: {value:.3f} ({low:.3f}, {high:.3f})")
+        binary_accuracy: 0.720 (0.684, 0.758)
+        f1_score: 0.652 (0.598, 0.698)
+        roc_auc_score: 0.834 (0.794, 0.866)
+        average_precision_score: 0.782 (0.726, 0.831)
+        calibration_error: 0.147 (0.130, 0.169)
+        brier_score: 0.165 (0.153, 0.177)
+        >>> {k: v for k, v in out["confidence_intervals"].items() if not k.endswith("weighted")}
+        {'n_bootstrap': 200, 'confidence_level': 0.95}
+
+    The point estimates match `meds-evaluation` with the same seed, under both weightings:
+        >>> from meds_evaluation.evaluate import evaluate_binary_classification
+        >>> reference = evaluate_binary_classification(predictions, resampling_seed=0)
+        >>> def matches(weighting):
+        ...     return all(np.isclose(out[weighting][k], v) for k, v in reference[weighting].items())
+        >>> matches("samples_equally_weighted")
+        True
+        >>> for name, value in out["subjects_equally_weighted"].items():
+        ...     print(f"{name}: {value:.4f}")
+        binary_accuracy: 0.7325
+        f1_score: 0.6469
+        roc_auc_score: 0.8613
+        average_precision_score: 0.8050
+        calibration_error: 0.1516
+        brier_score: 0.1526
+        >>> matches("subjects_equally_weighted")
+        True
+
+    Confidence intervals can be skipped, and undefined metrics are `None`:
+        >>> out = evaluate_predictions(predictions.with_columns(boolean_value=True), n_bootstrap=0)
+        >>> list(out), out["samples_equally_weighted"]["roc_auc_score"]
+        (['samples_equally_weighted', 'subjects_equally_weighted'], None)
+        >>> evaluate_predictions(predictions.drop("boolean_value"))
+        Traceback (most recent call last):
+            ...
+        ValueError: Missing required fields: {'boolean_value'}
+    """
+    validate_binary_classification_schema(predictions)
+
+    subject_rows = resample_subjects(predictions[SUBJECT_ID_FIELD].to_numpy(), samples_per_subject, seed)
+    weightings = {
+        "samples_equally_weighted": _binary_predictions(predictions),
+        "subjects_equally_weighted": _binary_predictions(predictions[subject_rows]),
+    }
+    return _evaluate_weightings(weightings, n_bootstrap, confidence_level, seed, n_workers)
+
+
+def evaluate_prediction_sets(
+    labels: pl.DataFrame,
+    predictions: Mapping[str, pl.DataFrame],
+    samples_per_subject: int = 4,
+    n_bootstrap: int = 1000,
+    confidence_level: float = 0.95,
+    seed: int = 0,
+    n_workers: int = 1,
+) -> dict[str, dict]:
+    """Evaluates several prediction sets for the same task against one shared label frame.
+
+    This is equivalent to calling `evaluate_predictions` on each prediction set joined to the labels, but the
+    labels are only read, converted, and resampled (for the subject-weighted metrics) once. Each prediction
+    set is thus evaluated on exactly the same rows and resampled subjects, with the same bootstrap replicates.
+
+    Args:
+        labels: The shared label frame, with the prediction keys and boolean values, e.g., from
+            `read_prediction_sets`.
+        predictions: A mapping from the name of each prediction set to a frame of its predicted columns, with
+            rows aligned to `labels`.
+        samples_per_subject: The number of samples to draw per subject for the subject-weighted metrics.
+        n_bootstrap: The number of bootstrap replicates. If 0, no confidence intervals are computed.
+        confidence_level: The confidence level of the intervals.
+        seed: The random seed of the subject resampling and the bootstrap.
+        n_workers: The number of processes to compute bootstrap replicates in.
+
+    Returns:
+        A mapping from the name of each prediction set to its evaluation results, in the format of
+        `evaluate_predictions`.
+
+    Raises:
+        ValueError: If a prediction set is not aligned to the labels or does not follow the schema.
+
+    Examples:
+        >>> rng = np.random.default_rng(0)
+        >>> labels = pl.DataFrame({
+        ...     "subject_id": rng.integers(0, 100, 500), "boolean_value": rng.random(500) < 0.4,
+        ... }).with_columns(pl.lit(None, dtype=pl.Datetime("us")).alias("prediction_time"))
+        >>> predictions = {
+        ...     f"model_{i}": pl.DataFrame({"predicted_boolean_probability": rng.random(500)})
+        ...     for i in range(3)
+        ... }
+        >>> out = evaluate_prediction_sets(labels, predictions, n_bootstrap=100)
+        >>> list(out)
+        ['model_0', 'model_1', 'model_2']
+        >>> all(
+        ...     out[name] == evaluate_predictions(labels.hstack(df), n_bootstrap=100)
+        ...     for name, df in predictions.items()
+        ... )
+        True
+        >>> evaluate_prediction_sets(labels, {"short": predictions["model_0"][:10]})
+        Traceback (most recent call last):
+            ...
+        ValueError: Prediction set short has 10 rows, but there are 500 labels.
+        >>> evaluate_prediction_sets(labels, {"empty": pl.DataFrame({"foo": range(500)})})
+        Traceback (most recent call last):
+            ...
+        ValueError: Missing all prediction fields: ...
+    """
+    subject_rows = resample_subjects(labels[SUBJECT_ID_FIELD].to_numpy(), samples_per_subject, seed)
+
+    results = {}
+    for name, set_predictions in predictions.items():
+        if set_predictions.height != labels.height:
+            raise ValueError(
+                f"Prediction set {name} has {set_predictions.height} rows, but there are {labels.height} "
+                "labels."
+            )
+        df = labels.hstack(set_predictions)
+        validate_binary_classification_schema(df)
+
+        logger.info(f"Evaluating prediction set {name}.")
+        weightings = {
+            "samples_equally_weighted": _binary_predictions(df),
+            "subjects_equally_weighted": _binary_predictions(df[subject_rows]),
+        }
+        results[name] = _evaluate_weightings(weightings, n_bootstrap, confidence_level, seed, n_workers)
+
+    return results
+
+
+__all__ = [
+    "CFG_YAML",
+    "evaluate_prediction_sets",
+    "evaluate_predictions",
+    "read_prediction_sets",
+    "read_predictions",
+]
@@ -1,16 +1,178 @@
+import json
 import logging
+import os
+from pathlib import Path
 
 import hydra
 from omegaconf import DictConfig
 
+from ..stage_cache import run_cached, stage_key
 from ..utils import run_in_env
-from . import CFG_YAML
+from . import (
+    CFG_YAML,
+    evaluate_prediction_sets,
+    evaluate_predictions,
+    read_prediction_sets,
+    read_predictions,
+)
+from .streaming import count_predictions, evaluate_streaming, prediction_files
+from .validation import label_digest, validate_predictions
 
 logger = logging.getLogger(__name__)
 
 
+def _settings(cfg: DictConfig) -> dict:
+    return {
+        "samples_per_subject": cfg.samples_per_subject,
+        "n_bootstrap": cfg.n_bootstrap,
+        "confidence_level": cfg.confidence_level,
+        "seed": cfg.seed,
+    }
+
+
+def _validate(cfg: DictConfig, predictions_path: Path | str, labels_digest: tuple[int, int] | None = None):
+    if cfg.get("validate", True):
+        validate_predictions(
+            predictions_path, labels_path=cfg.get("labels_path", None), labels_digest=labels_digest
+        )
+
+
+def _cache_inputs(predictions_path: Path | str) -> dict[str, Path]:
+    """Returns the stage cache inputs of an evaluation: the files the predictions path or glob resolves to.
+
+    The files are named by their path relative to their common directory, so the cache key does not depend on
+    where the predictions are stored (the predictions path itself is masked in the command).
+    """
+    fps = prediction_files(predictions_path)
+    if not fps:
+        return {}
+    root = Path(os.path.commonpath([fp.parent for fp in fps]))
+    return {f"predictions/{fp.relative_to(root).as_posix()}": fp for fp in fps}
+
+
+def _write_results(results: dict, output_dir: Path):
+    output_dir.mkdir(parents=True, exist_ok=True)
+    (output_dir / "results.json").write_text(json.dumps(results, indent=4))
+    (output_dir / ".done").touch()
+
+
+def evaluate_in_process(cfg: DictConfig):
+    """Evaluates the predictions in this process, writing `results.json` to the output directory.
+
+    If `streaming` is set and there are more than `max_rows_in_memory` predictions, they are evaluated in
+    bounded memory from their score histograms (see `MEDS_DEV.evaluation.streaming`); otherwise, they are read
+    into memory and evaluated exactly.
+
+    Like `run_in_env`, this skips evaluations whose output directory is already marked done (unless
+    `do_overwrite` is set), and goes through the stage cache if `stage_cache_dir` is set.
+    """
+    output_dir = Path(cfg.output_dir)
+    settings = _settings(cfg)
+    streaming = cfg.get("streaming", False)
+    key_settings = {**settings, "streaming_bins": cfg.streaming_bins} if streaming else settings
+
+    def run():
+        _validate(cfg, cfg.predictions_path)
+        n_rows = count_predictions(cfg.predictions_path) if streaming else None
+        if streaming and n_rows > cfg.max_rows_in_memory:
+            logger.info(
+                f"Evaluating {n_rows} predictions in {cfg.predictions_path} by streaming them into "
+                f"{cfg.streaming_bins}-bin score histograms."
+            )
+            results = evaluate_streaming(cfg.predictions_path, n_bins=cfg.streaming_bins)
+        else:
+            logger.info(f"Evaluating predictions in {cfg.predictions_path} in-process with {settings}.")
+            results = evaluate_predictions(
+                read_predictions(cfg.predictions_path), n_workers=cfg.get("n_workers", 1), **settings
+            )
+        _write_results(results, output_dir)
+
+    if cfg.do_overwrite and (output_dir / ".done").is_file():
+        logger.info(f"Removing existing results in {output_dir}")
+        (output_dir / ".done").unlink()
+        (output_dir / "results.json").unlink(missing_ok=True)
+
+    cache_dir = cfg.get("stage_cache_dir", None)
+    if cache_dir is not None:
+        cmd = (
+            f"in-process evaluation of {cfg.predictions_path} with {json.dumps(key_settings, sort_keys=True)}"
+        )
+        inputs = _cache_inputs(cfg.predictions_path)
+        key = stage_key(cmd, output_dir, inputs=inputs, masks={"predictions_path": cfg.predictions_path})
+        run_cached(run, output_dir, key, cache_dir)
+    elif (output_dir / ".done").is_file():
+        logger.info(f"Skipping evaluation because {output_dir / '.done'} exists.")
+    else:
+        run()
+
+
+def evaluate_sets_in_process(cfg: DictConfig):
+    """Evaluates several prediction sets for the same task together, writing `<name>/results.json` for each.
+
+    The labels are read once, from the first prediction set, and every set is joined to them (see
+    `read_prediction_sets`). Without a stage cache, sets whose output directory is already marked done are
+    skipped (unless `do_overwrite` is set), so that adding a set to the batch only evaluates the new one. With
+    a stage cache, the whole batch is one cached stage, keyed on all of its prediction sets.
+    """
+    output_dir = Path(cfg.output_dir)
+    predictions_dirs = {name: Path(d) for name, d in cfg.prediction_sets.items()}
+    settings = _settings(cfg)
+
+    if cfg.do_overwrite:
+        for name in predictions_dirs:
+            (output_dir / name / ".done").unlink(missing_ok=True)
+            (output_dir / name / "results.json").unlink(missing_ok=True)
+        (output_dir / ".done").unlink(missing_ok=True)
+
+    def run(names: list[str]):
+        logger.info(f"Evaluating prediction sets {', '.join(names)} in-process with {settings}.")
+        predictions_paths = {name: predictions_dirs[name] / "**" / "*.parquet" for name in names}
+        # Every set is checked against the same labels, so they are only read (and hashed) once.
+        labels_path = cfg.get("labels_path", None)
+        digest = label_digest(labels_path) if cfg.get("validate", True) and labels_path is not None else None
+        for predictions_path in predictions_paths.values():
+            _validate(cfg, predictions_path, labels_digest=digest)
+        labels, predictions = read_prediction_sets(predictions_paths)
+        results = evaluate_prediction_sets(labels, predictions, n_workers=cfg.get("n_workers", 1), **settings)
+        for name, set_results in results.items():
+            _write_results(set_results, output_dir / name)
+
+    cache_dir = cfg.get("stage_cache_dir", None)
+    if cache_dir is not None:
+
+        def run_all():
+            run(list(predictions_dirs))
+            (output_dir / ".done").touch()
+
+        cmd = (
+            f"in-process evaluation of {sorted(predictions_dirs)} with {json.dumps(settings, sort_keys=True)}"
+        )
+        inputs = {f"predictions_dir/{name}": d for name, d in predictions_dirs.items()}
+        run_cached(run_all, output_dir, stage_key(cmd, output_dir, inputs=inputs), cache_dir)
+        return
+
+    pending = [name for name in predictions_dirs if not (output_dir / name / ".done").is_file()]
+    if skipped := [name for name in predictions_dirs if name not in pending]:
+        logger.info(f"Skipping prediction sets {', '.join(skipped)}, which are already evaluated.")
+    if pending:
+        run(pending)
+
+
 @hydra.main(version_base=None, config_path=str(CFG_YAML.parent), config_name=CFG_YAML.stem)
 def main(cfg: DictConfig):
+    if cfg.get("prediction_sets", None):
+        evaluate_sets_in_process(cfg)
+        logger.info(f"Evaluation of prediction sets {', '.join(cfg.prediction_sets)} finished successfully.")
+        return
+
+    if cfg.get("in_process", False) or cfg.get("streaming", False):
+        evaluate_in_process(cfg)
+        logger.info(f"Evaluation of {cfg.predictions_path} finished successfully.")
+        return
+
+    if cfg.do_overwrite or not (Path(cfg.output_dir) / ".done").is_file():
+        _validate(cfg, cfg.predictions_path)
+
     cmd_parts = [
         "meds-evaluation-cli",
         f'predictions_path="{cfg.predictions_path}"',
@@ -20,11 +182,15 @@ def main(cfg: DictConfig):
 
     logger.info(f"Running MEDS-Evaluation: {cmd}")
 
+    cache_dir = cfg.get("stage_cache_dir", None)
     run_in_env(
         cmd=cmd,
         output_dir=cfg.output_dir,
         do_overwrite=cfg.do_overwrite,
         run_as_script=False,
+        cache_dir=cache_dir,
+        cache_inputs=_cache_inputs(cfg.predictions_path) if cache_dir is not None else None,
+        cache_masks={"predictions_path": cfg.predictions_path},
     )
 
     logger.info(f"Evaluation command {cmd} finished successfully.")
@@ -0,0 +1,371 @@
+"""Sort-based binary classification metrics, vectorized over bootstrap replicates.
+
+The metrics match those of `meds-evaluation` (which uses `sklearn.metrics`), but are computed for a whole
+batch of row weightings at once: each bootstrap replicate is a vector of per-row resampling counts, and every
+metric is a weighted sum over rows, or over rows sorted by predicted probability, so a batch of replicates
+reduces to a few matrix products and cumulative sums. Predictions are sorted once, so AUROC and AUPRC take
+O(n log n) time for the sort plus O(n) per replicate, rather than a fresh sort per replicate.
+"""
+
+import dataclasses
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# The maximum number of (replicate, row) cells in one batch of bootstrap weights. Each float64 matrix of this
+# many cells takes 32 MiB, and a batch needs a few of them at a time.
+MAX_BATCH_CELLS = 2**22
+
+CALIBRATION_BINS = 10
+INTERVAL_DECIMALS = 4
+
+
+@dataclasses.dataclass
+class BinaryPredictions:
+    """Labels and predictions of a binary classification task, sorted by predicted probability.
+
+    Use `BinaryPredictions.from_arrays` to build this, as the sort order and tie groups are precomputed there.
+
+    Attributes:
+        y_true: The boolean labels.
+        y_pred: The boolean predicted values, if any.
+        y_prob: The predicted probabilities, if any, in ascending order.
+        tie_starts: The index of the first row of each group of tied probabilities.
+        calibration_bins: The index of the calibration bin of each row, following
+            `sklearn.calibration.calibration_curve` with uniform bins.
+    """
+
+    y_true: np.ndarray
+    y_pred: np.ndarray | None = None
+    y_prob: np.ndarray | None = None
+    tie_starts: np.ndarray | None = None
+    calibration_bins: np.ndarray | None = None
+
+    @classmethod
+    def from_arrays(
+        cls, y_true: np.ndarray, y_pred: np.ndarray | None = None, y_prob: np.ndarray | None = None
+    ) -> "BinaryPredictions":
+        """Builds the sorted predictions from unsorted label and prediction arrays.
+
+        Examples:
+            >>> preds = BinaryPredictions.from_arrays(
+            ...     np.array([True, False, True]), y_prob=np.array([0.9, 0.3, 0.3])
+            ... )
+            >>> preds.y_true, preds.y_prob, preds.tie_starts, preds.calibration_bins
+            (array([False,  True,  True]), array([0.3, 0.3, 0.9]), array([0, 2]), array([2, 2, 8]))
+            >>> BinaryPredictions.from_arrays(np.array([True]), y_prob=np.array([1.5]))
+            Traceback (most recent call last):
+                ...
+            ValueError: Predicted probabilities must be in [0, 1]; got values in [1.5, 1.5].
+            >>> BinaryPredictions.from_arrays(np.array([True, False]), y_pred=np.array([True]))
+            Traceback (most recent call last):
+                ...
+            ValueError: Got 2 labels but 1 predicted values.
+        """
+        y_true = np.asarray(y_true, dtype=bool)
+        if y_pred is not None:
+            y_pred = np.asarray(y_pred, dtype=bool)
+            if len(y_pred) != len(y_true):
+                raise ValueError(f"Got {len(y_true)} labels but {len(y_pred)} predicted values.")
+        if y_prob is None:
+            return cls(y_true=y_true, y_pred=y_pred)
+
+        y_prob = np.asarray(y_prob, dtype=np.float64)
+        if len(y_prob) != len(y_true):
+            raise ValueError(f"Got {len(y_true)} labels but {len(y_prob)} predicted probabilities.")
+        if len(y_prob) and (y_prob.min() < 0 or y_prob.max() > 1):
+            raise ValueError(
+                f"Predicted probabilities must be in [0, 1]; got values in [{y_prob.min()}, {y_prob.max()}]."
+            )
+
+        order = np.argsort(y_prob, kind="stable")
+        y_prob = y_prob[order]
+        is_new_value = np.ones(len(y_prob), dtype=bool)
+        is_new_value[1:] = y_prob[1:] != y_prob[:-1]
+
+        bin_edges = np.linspace(0.0, 1.0, CALIBRATION_BINS + 1)
+        return cls(
+            y_true=y_true[order],
+            y_pred=None if y_pred is None else y_pred[order],
+            y_prob=y_prob,
+            tie_starts=np.flatnonzero(is_new_value),
+            calibration_bins=np.searchsorted(bin_edges[1:-1], y_prob),
+        )
+
+    def __len__(self) -> int:
+        return len(self.y_true)
+
+    def metrics(self, weights: np.ndarray | None = None) -> dict[str, np.ndarray]:
+        """Computes the metrics under each row weighting.
+
+        Metrics that are undefined under a weighting (e.g., AUROC without both positive and negative labels)
+        are NaN.
+
+        Args:
+            weights: A `(n_weightings, n_rows)` array of non-negative row weights (e.g., bootstrap resampling
+                counts). Defaults to a single, uniform weighting.
+
+        Returns:
+            A dictionary mapping each metric name to a `(n_weightings,)` array of its values. Accuracy and F1
+            are computed if there are predicted values; AUROC, AUPRC, calibration error, and the Brier score
+            if there are predicted probabilities.
+
+        Examples:
+            >>> preds = BinaryPredictions.from_arrays(
+            ...     y_true=np.array([True, False, True, False, True]),
+            ...     y_pred=np.array([True, True, False, False, True]),
+            ...     y_prob=np.array([0.9, 0.6, 0.4, 0.1, 0.6]),
+            ... )
+            >>> for name, values in preds.metrics().items():
+            ...     print(f"{name}: {values.round(4)}")
+            binary_accuracy: [0.6]
+            f1_score: [0.6667]
+            roc_auc_score: [0.75]
+            average_precision_score: [0.8056]
+            calibration_error: [0.225]
+            brier_score: [0.18]
+
+        Weights act as row multiplicities (in sorted order), so duplicating a row is the same as giving it
+        weight 2:
+            >>> preds.y_true, preds.y_prob
+            (array([False,  True, False,  True,  True]), array([0.1, 0.4, 0.6, 0.6, 0.9]))
+            >>> doubled = BinaryPredictions.from_arrays(
+            ...     y_true=np.array([False, True, True, False, True, True]),
+            ...     y_prob=np.array([0.1, 0.4, 0.4, 0.6, 0.6, 0.9]),
+            ... )
+            >>> weighted = preds.metrics(np.array([[1, 2, 1, 1, 1], [1, 1, 1, 1, 1]]))
+            >>> unweighted = doubled.metrics()
+            >>> for name in ["roc_auc_score", "average_precision_score", "brier_score"]:
+            ...     print(name, weighted[name].round(4), unweighted[name].round(4))
+            roc_auc_score [0.6875 0.75  ] [0.6875]
+            average_precision_score [0.8167 0.8056] [0.8167]
+            brier_score [0.21 0.18] [0.21]
+
+        The results match `sklearn.metrics` (and hence `meds-evaluation`), including with tied probabilities:
+            >>> from sklearn.calibration import calibration_curve
+            >>> from sklearn.metrics import average_precision_score, roc_auc_score
+            >>> rng = np.random.default_rng(0)
+            >>> y_true = rng.random(1000) < 0.3
+            >>> y_prob = np.round(np.clip(0.3 * y_true + rng.random(1000) * 0.7, 0, 1), 2)
+            >>> out = BinaryPredictions.from_arrays(y_true, y_prob=y_prob).metrics()
+            >>> bool(np.isclose(out["roc_auc_score"][0], roc_auc_score(y_true, y_prob)))
+            True
+            >>> bool(np.isclose(out["average_precision_score"][0], average_precision_score(y_true, y_prob)))
+            True
+            >>> prob_true, prob_pred = calibration_curve(y_true, y_prob, n_bins=10)
+            >>> bool(np.isclose(out["calibration_error"][0], np.abs(prob_true - prob_pred).mean()))
+            True
+
+        Undefined metrics are NaN:
+            >>> BinaryPredictions.from_arrays(np.array([True, True]), y_prob=np.array([0.1, 0.2])).metrics()
+            {'roc_auc_score': array([nan]), 'average_precision_score': array([1.]), ...}
+        """
+        if weights is None:
+            weights = np.ones((1, len(self)))
+        weights = np.asarray(weights, dtype=np.float64)
+
+        y_true = self.y_true.astype(np.float64)
+        total = weights.sum(axis=1)
+        n_pos = weights @ y_true
+        n_neg = total - n_pos
+
+        out = {}
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if self.y_pred is not None:
+                y_pred = self.y_pred.astype(np.float64)
+                tp = weights @ (y_true * y_pred)
+                fp = weights @ ((1 - y_true) * y_pred)
+                tn = n_neg - fp
+                out["binary_accuracy"] = (tp + tn) / total
+                # As in sklearn, F1 is 0 if there are neither positive labels nor positive predictions.
+                f1_denominator = tp + fp + n_pos
+                out["f1_score"] = np.where(f1_denominator > 0, 2 * tp / f1_denominator, 0.0)
+
+            if self.y_prob is not None:
+                pos_weights = weights * y_true
+                # Per-tie-group positive and negative weights, in ascending order of probability.
+                if len(self.tie_starts) == len(self):
+                    group_pos = pos_weights
+                    group_neg = weights - pos_weights
+                else:
+                    group_pos = np.add.reduceat(pos_weights, self.tie_starts, axis=1)
+                    group_neg = np.add.reduceat(weights, self.tie_starts, axis=1) - group_pos
+
+                # AUROC is the probability a positive outranks a negative, counting ties as half.
+                neg_below = np.cumsum(group_neg, axis=1) - group_neg
+                concordant = (group_pos * (neg_below + 0.5 * group_neg)).sum(axis=1)
+                out["roc_auc_score"] = concordant / (n_pos * n_neg)
+
+                # Average precision sums the precision at each threshold, from the highest probability down,
+                # weighted by the recall gained there.
+                tp_at = np.cumsum(group_pos[:, ::-1], axis=1)
+                fp_at = np.cumsum(group_neg[:, ::-1], axis=1)
+                precision = np.where(tp_at > 0, tp_at / (tp_at + fp_at), 0.0)
+                out["average_precision_score"] = (group_pos[:, ::-1] * precision).sum(axis=1) / n_pos
+
+                bins = np.zeros((len(self), CALIBRATION_BINS))
+                bins[np.arange(len(self)), self.calibration_bins] = 1
+                bin_total = weights @ bins
+                bin_true = pos_weights @ bins
+                bin_prob = (weights * self.y_prob) @ bins
+                nonzero = bin_total > 0
+                bin_errors = np.where(nonzero, np.abs(bin_true - bin_prob) / bin_total, 0.0)
+                out["calibration_error"] = bin_errors.sum(axis=1) / nonzero.sum(axis=1)
+
+                out["brier_score"] = (weights @ (self.y_prob - y_true) ** 2) / total
+
+        return out
+
+
+def bootstrap_weights(n_rows: int, n_replicates: int, rng: np.random.Generator) -> np.ndarray:
+    """Draws the row resampling counts of bootstrap replicates.
+
+    Examples:
+        >>> w = bootstrap_weights(5, 3, np.random.default_rng(0))
+        >>> w.shape, w.sum(axis=1)
+        ((3, 5), array([5, 5, 5]))
+    """
+    rows = rng.integers(0, n_rows, size=(n_replicates, n_rows))
+    rows += np.arange(n_replicates)[:, None] * n_rows
+    return np.bincount(rows.ravel(), minlength=n_replicates * n_rows).reshape(n_replicates, n_rows)
+
+
+_worker_predictions: BinaryPredictions | None = None
+
+
+def _init_worker(predictions: BinaryPredictions):
+    global _worker_predictions
+    _worker_predictions = predictions
+
+
+def _bootstrap_batch(seed: np.random.SeedSequence, n_replicates: int) -> dict[str, np.ndarray]:
+    weights = bootstrap_weights(len(_worker_predictions), n_replicates, np.random.default_rng(seed))
+    return _worker_predictions.metrics(weights)
+
+
+def bootstrap_metrics(
+    predictions: BinaryPredictions, n_replicates: int, seed: int = 0, n_workers: int = 1
+) -> dict[str, np.ndarray]:
+    """Computes the metrics on bootstrap resamples of the predictions.
+
+    Replicates are computed in batches of at most `MAX_BATCH_CELLS` (replicate, row) cells, so memory use is
+    bounded however many replicates there are. Each batch draws from its own random stream, spawned from
+    `seed`, so for a fixed batch layout (i.e., the same `MAX_BATCH_CELLS` and number of rows) the results are
+    identical whatever the number of workers. Changing the batch layout changes the replicates drawn.
+
+    Args:
+        predictions: The predictions to resample.
+        n_replicates: The number of bootstrap replicates.
+        seed: The random seed.
+        n_workers: The number of processes to compute batches in.
+
+    Returns:
+        A dictionary mapping each metric name to a `(n_replicates,)` array of its values.
+
+    Examples:
+        >>> rng = np.random.default_rng(1)
+        >>> y_true = rng.random(200) < 0.5
+        >>> y_prob = np.clip(0.4 * y_true + rng.random(200), 0, 1)
+        >>> preds = BinaryPredictions.from_arrays(y_true, y_prob=y_prob)
+        >>> reps = bootstrap_metrics(preds, 100, seed=1)
+        >>> reps["roc_auc_score"].shape
+        (100,)
+        >>> point = float(preds.metrics()["roc_auc_score"][0])
+        >>> bool(abs(reps["roc_auc_score"].mean() - point) < 0.02)
+        True
+
+    With several batches, the replicates are the same however many workers compute them:
+
+        >>> import MEDS_DEV.evaluation.metrics as metrics
+        >>> metrics.MAX_BATCH_CELLS = 2000  # Force several batches, as with large datasets.
+        >>> reps_1 = bootstrap_metrics(preds, 100, seed=1, n_workers=1)
+        >>> reps_2 = bootstrap_metrics(preds, 100, seed=1, n_workers=2)
+        >>> metrics.MAX_BATCH_CELLS = 2**22
+        >>> all(np.array_equal(reps_1[name], reps_2[name], equal_nan=True) for name in reps_1)
+        True
+        >>> bool(abs(reps_2["roc_auc_score"].mean() - point) < 0.02)
+        True
+        >>> bool(np.array_equal(reps["roc_auc_score"], reps_2["roc_auc_score"]))  # A different batch layout.
+        False
+    """
+    batch_size = max(1, MAX_BATCH_CELLS // max(len(predictions), 1))
+    batch_sizes = [min(batch_size, n_replicates - start) for start in range(0, n_replicates, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+
+    if n_workers > 1 and len(batch_sizes) > 1:
+        # Workers are spawned rather than forked, as forking a process that has used polars can deadlock.
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(predictions,),
+        ) as pool:
+            batches = list(pool.map(_bootstrap_batch, seeds, batch_sizes))
+    else:
+        _init_worker(predictions)
+        batches = [_bootstrap_batch(s, n) for s, n in zip(seeds, batch_sizes, strict=True)]
+
+    return {name: np.concatenate([batch[name] for batch in batches]) for name in batches[0]}
+
+
+def percentile_interval(
+    values: np.ndarray, confidence_level: float, decimals: int = INTERVAL_DECIMALS
+) -> list[float | None]:
+    """Returns the percentile bootstrap confidence interval of a metric, ignoring undefined replicates.
+
+    The bounds are rounded to `decimals` places, well below the resolution of a bootstrap interval, to keep
+    packaged results small.
+
+    Examples:
+        >>> percentile_interval(np.arange(101.0), 0.9)
+        [5.0, 95.0]
+        >>> percentile_interval(np.array([np.nan, 0.123456, 0.2, 0.3]), 1.0)
+        [0.1235, 0.3]
+        >>> percentile_interval(np.array([np.nan]), 0.95)
+        [None, None]
+    """
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return [None, None]
+    alpha = (1 - confidence_level) / 2
+    low, high = np.quantile(values, [alpha, 1 - alpha]).round(decimals)
+    return [float(low), float(high)]
+
+
+def resample_subjects(subject_ids: np.ndarray, samples_per_subject: int, seed: int = 0) -> np.ndarray:
+    """Returns the row indices of a resample with the same number of rows for every subject.
+
+    Each subject's rows are sampled with replacement, so every subject is equally weighted. The resample is
+    exactly the one `meds-evaluation` draws for its per-subject metrics with the same seed (subjects in
+    ascending order, each drawing its rows from numpy's legacy `RandomState` in turn), so the subject-weighted
+    metrics match it, but the rows are drawn in one vectorized pass rather than per subject, and without
+    seeding numpy's global random state.
+
+    Examples:
+        >>> idx = resample_subjects(np.array([3, 1, 3, 2, 3]), 2)
+        >>> np.array([3, 1, 3, 2, 3])[idx]
+        array([1, 1, 2, 2, 3, 3])
+        >>> sorted(set(idx[-2:]) - {0, 2, 4})
+        []
+        >>> import polars as pl
+        >>> from meds_evaluation.utils import _resample
+        >>> subject_ids = np.random.default_rng(0).integers(0, 50, 300)
+        >>> df = pl.DataFrame({"subject_id": subject_ids, "row": np.arange(300)})
+        >>> reference = _resample(df, n_samples=4, random_seed=3)["row"].to_numpy()
+        >>> bool((reference == resample_subjects(subject_ids, 4, seed=3)).all())
+        True
+    """
+    order = np.argsort(subject_ids, kind="stable")
+    _, starts, counts = np.unique(subject_ids[order], return_index=True, return_counts=True)
+    offsets = np.random.RandomState(seed).randint(0, np.repeat(counts, samples_per_subject))
+    return order[np.repeat(starts, samples_per_subject) + offsets]
+
+
+__all__ = [
+    "BinaryPredictions",
+    "bootstrap_metrics",
+    "bootstrap_weights",
+    "percentile_interval",
+    "resample_subjects",
+]
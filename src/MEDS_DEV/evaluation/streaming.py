@@ -0,0 +1,428 @@
+"""Bounded-memory evaluation of prediction files too large to load at once.
+
+Predictions are read one parquet record batch at a time and accumulated into fixed-size sufficient statistics:
+per-bin counts of positive and negative labels over a fine, uniform histogram of predicted probabilities, and
+exact per-calibration-bin sums. Peak memory thus depends on the number of histogram bins and the batch size,
+not on the number of predictions.
+
+Accuracy, F1, the calibration error, and the Brier score computed this way are exact. AUROC and average
+precision are computed treating all probabilities in the same histogram bin as tied, which is exact if no bin
+holds both a positive and a negative label (or, for average precision, more than one distinct probability
+among its positives), and otherwise is within a computable bound of the exact value:
+
+  - AUROC: Only pairs of a positive and a negative in the same bin can be misordered, and they are counted as
+    half-concordant, so the error is at most half the fraction of positive-negative pairs sharing a bin.
+  - Average precision: The precision at each positive in a bin lies between the precision it would have if
+    it were ranked first among the bin's rows and if it were ranked after all of the bin's negatives, so the
+    error is at most the recall-weighted sum of the widths of these ranges.
+
+Both bounds are reported along with the metrics, and shrink as the number of bins grows.
+"""
+
+import dataclasses
+import glob
+import logging
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+from meds_evaluation.schema import (
+    BOOLEAN_VALUE_FIELD,
+    PREDICTED_BOOLEAN_PROBABILITY_FIELD,
+    PREDICTED_BOOLEAN_VALUE_FIELD,
+    validate_binary_classification_schema,
+)
+
+from .metrics import CALIBRATION_BINS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_N_BINS = 2**16
+DEFAULT_BATCH_SIZE = 2**20
+
+
+@dataclasses.dataclass
+class ScoreHistogram:
+    """Sufficient statistics of binary classification predictions for approximate, streaming evaluation.
+
+    Build an empty histogram with `ScoreHistogram.empty`, add batches of predictions with `update`, then get
+    the metrics with `metrics` and the error bounds of the approximate ones with `error_bounds`.
+
+    Attributes:
+        n_bins: The number of uniform probability bins for AUROC and average precision.
+        n_rows: The number of predictions seen.
+        n_pos: The number of positive labels seen.
+        confusion: The counts of (true positives, false positives) of the predicted values, if there are any.
+        bin_pos: The number of positive labels in each probability bin.
+        bin_neg: The number of negative labels in each probability bin.
+        calibration_total: The number of predictions in each calibration bin.
+        calibration_true: The number of positive labels in each calibration bin.
+        calibration_prob: The sum of the predicted probabilities in each calibration bin.
+        squared_error: The sum of the squared errors of the predicted probabilities.
+    """
+
+    n_bins: int
+    n_rows: int = 0
+    n_pos: int = 0
+    confusion: np.ndarray | None = None
+    bin_pos: np.ndarray | None = None
+    bin_neg: np.ndarray | None = None
+    calibration_total: np.ndarray | None = None
+    calibration_true: np.ndarray | None = None
+    calibration_prob: np.ndarray | None = None
+    squared_error: float = 0.0
+
+    @classmethod
+    def empty(cls, n_bins: int = DEFAULT_N_BINS) -> "ScoreHistogram":
+        """Returns a histogram with no predictions.
+
+        Examples:
+            >>> ScoreHistogram.empty(1000).metrics()
+            {}
+            >>> ScoreHistogram.empty(0)
+            Traceback (most recent call last):
+                ...
+            ValueError: The number of bins must be positive; got 0.
+        """
+        if n_bins < 1:
+            raise ValueError(f"The number of bins must be positive; got {n_bins}.")
+        return cls(n_bins=n_bins)
+
+    def update(self, y_true: np.ndarray, y_pred: np.ndarray | None = None, y_prob: np.ndarray | None = None):
+        """Adds a batch of predictions to the histogram.
+
+        Raises:
+            ValueError: If the predicted probabilities are not in [0, 1], or if a batch has predicted values
+                or probabilities when previous batches did not (or vice versa).
+
+        Examples:
+            >>> hist = ScoreHistogram.empty(4)
+            >>> hist.update(np.array([True, False]), y_prob=np.array([0.1, 0.3]))
+            >>> hist.update(np.array([True]), y_prob=np.array([1.0]))
+            >>> hist.n_rows, hist.n_pos, hist.bin_pos, hist.bin_neg
+            (3, 2, array([1, 0, 0, 1]), array([0, 1, 0, 0]))
+            >>> hist.update(np.array([True]), y_prob=np.array([-0.1]))
+            Traceback (most recent call last):
+                ...
+            ValueError: Predicted probabilities must be in [0, 1]; got values in [-0.1, -0.1].
+            >>> hist.update(np.array([True]), y_pred=np.array([True]), y_prob=np.array([0.5]))
+            Traceback (most recent call last):
+                ...
+            ValueError: All batches must have the same prediction fields; this batch has predicted values...
+        """
+        y_true = np.asarray(y_true, dtype=bool)
+
+        if self.n_rows > 0 and ((y_pred is None) != (self.confusion is None)):
+            raise ValueError(
+                "All batches must have the same prediction fields; this batch has predicted values "
+                f"{'but' if y_pred is not None else 'and'} previous batches did not."
+            )
+        if self.n_rows > 0 and ((y_prob is None) != (self.bin_pos is None)):
+            raise ValueError(
+                "All batches must have the same prediction fields; this batch has predicted probabilities "
+                f"{'but' if y_prob is not None else 'and'} previous batches did not."
+            )
+
+        if y_prob is not None:
+            y_prob = np.asarray(y_prob, dtype=np.float64)
+            if len(y_prob) and (y_prob.min() < 0 or y_prob.max() > 1):
+                raise ValueError(
+                    "Predicted probabilities must be in [0, 1]; got values in "
+                    f"[{y_prob.min()}, {y_prob.max()}]."
+                )
+            if self.bin_pos is None:
+                self.bin_pos = np.zeros(self.n_bins, dtype=np.int64)
+                self.bin_neg = np.zeros(self.n_bins, dtype=np.int64)
+                self.calibration_total = np.zeros(CALIBRATION_BINS, dtype=np.int64)
+                self.calibration_true = np.zeros(CALIBRATION_BINS, dtype=np.int64)
+                self.calibration_prob = np.zeros(CALIBRATION_BINS)
+
+            bins = np.minimum((y_prob * self.n_bins).astype(np.int64), self.n_bins - 1)
+            self.bin_pos += np.bincount(bins[y_true], minlength=self.n_bins)
+            self.bin_neg += np.bincount(bins[~y_true], minlength=self.n_bins)
+
+            # The same calibration bins as `BinaryPredictions`, so that the calibration error is exact.
+            calibration_edges = np.linspace(0.0, 1.0, CALIBRATION_BINS + 1)[1:-1]
+            calibration_bins = np.searchsorted(calibration_edges, y_prob)
+            self.calibration_total += np.bincount(calibration_bins, minlength=CALIBRATION_BINS)
+            self.calibration_true += np.bincount(calibration_bins[y_true], minlength=CALIBRATION_BINS)
+            self.calibration_prob += np.bincount(calibration_bins, weights=y_prob, minlength=CALIBRATION_BINS)
+
+            self.squared_error += float(((y_prob - y_true) ** 2).sum())
+
+        if y_pred is not None:
+            y_pred = np.asarray(y_pred, dtype=bool)
+            if self.confusion is None:
+                self.confusion = np.zeros(2, dtype=np.int64)
+            self.confusion += [(y_true & y_pred).sum(), (~y_true & y_pred).sum()]
+
+        self.n_rows += len(y_true)
+        self.n_pos += int(y_true.sum())
+
+    def metrics(self) -> dict[str, float]:
+        """Computes the metrics, as in `BinaryPredictions.metrics`, with undefined metrics as NaN.
+
+        Examples:
+            >>> hist = ScoreHistogram.empty(10)
+            >>> hist.update(
+            ...     y_true=np.array([True, False, True, False, True]),
+            ...     y_pred=np.array([True, True, False, False, True]),
+            ...     y_prob=np.array([0.9, 0.6, 0.4, 0.1, 0.6]),
+            ... )
+            >>> for name, value in hist.metrics().items():
+            ...     print(f"{name}: {value:.4f}")
+            binary_accuracy: 0.6000
+            f1_score: 0.6667
+            roc_auc_score: 0.7500
+            average_precision_score: 0.8056
+            calibration_error: 0.2250
+            brier_score: 0.1800
+            >>> hist.error_bounds()
+            {'roc_auc_score': 0.0833..., 'average_precision_score': 0.1111...}
+
+        With one bin per distinct probability, the metrics are exact and match `BinaryPredictions`:
+            >>> from MEDS_DEV.evaluation.metrics import BinaryPredictions
+            >>> rng = np.random.default_rng(0)
+            >>> y_true = rng.random(1000) < 0.3
+            >>> y_prob = (rng.integers(0, 70, 1000) + 30 * y_true + 0.5) / 100  # At the centers of 100 bins.
+            >>> hist = ScoreHistogram.empty(100)
+            >>> for batch in np.array_split(np.arange(1000), 7):
+            ...     hist.update(y_true[batch], y_pred=y_prob[batch] > 0.5, y_prob=y_prob[batch])
+            >>> exact = BinaryPredictions.from_arrays(y_true, y_pred=y_prob > 0.5, y_prob=y_prob)
+            >>> all(np.isclose(hist.metrics()[k], v[0]) for k, v in exact.metrics().items())
+            True
+
+        With continuous probabilities, the errors shrink with the number of bins and are within their bounds:
+            >>> y_prob = np.clip(0.3 * y_true + rng.random(1000) * 0.7, 0, 1)
+            >>> exact = BinaryPredictions.from_arrays(y_true, y_prob=y_prob).metrics()
+            >>> for n_bins in [10, 100, 1000]:
+            ...     hist = ScoreHistogram.empty(n_bins)
+            ...     hist.update(y_true, y_prob=y_prob)
+            ...     for name, bound in hist.error_bounds().items():
+            ...         error = abs(hist.metrics()[name] - exact[name][0])
+            ...         print(f"{n_bins} {name}: error {error:.4f} <= {bound:.4f}")
+            10 roc_auc_score: error 0.0000 <= 0.0388
+            10 average_precision_score: error 0.0281 <= 0.1256
+            100 roc_auc_score: error 0.0002 <= 0.0039
+            100 average_precision_score: error 0.0035 <= 0.0126
+            1000 roc_auc_score: error 0.0001 <= 0.0004
+            1000 average_precision_score: error 0.0002 <= 0.0012
+        """
+        out = {}
+        if self.n_rows == 0:
+            return out
+
+        n_neg = self.n_rows - self.n_pos
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if self.confusion is not None:
+                tp, fp = self.confusion
+                out["binary_accuracy"] = (self.n_rows - fp - (self.n_pos - tp)) / self.n_rows
+                f1_denominator = tp + fp + self.n_pos
+                out["f1_score"] = 2 * tp / f1_denominator if f1_denominator > 0 else 0.0
+
+            if self.bin_pos is not None:
+                neg_below = np.cumsum(self.bin_neg) - self.bin_neg
+                concordant = (self.bin_pos * (neg_below + 0.5 * self.bin_neg)).sum()
+                out["roc_auc_score"] = concordant / (self.n_pos * n_neg)
+
+                tp_at = np.cumsum(self.bin_pos[::-1])
+                fp_at = np.cumsum(self.bin_neg[::-1])
+                precision = np.where(tp_at > 0, tp_at / (tp_at + fp_at), 0.0)
+                out["average_precision_score"] = (self.bin_pos[::-1] * precision).sum() / self.n_pos
+
+                nonzero = self.calibration_total > 0
+                bin_errors = np.abs(self.calibration_true - self.calibration_prob)[nonzero]
+                out["calibration_error"] = (bin_errors / self.calibration_total[nonzero]).mean()
+
+                out["brier_score"] = self.squared_error / self.n_rows
+
+        return {name: float(value) for name, value in out.items()}
+
+    def error_bounds(self) -> dict[str, float]:
+        """Bounds the absolute errors of the approximate metrics (AUROC and average precision).
+
+        Examples:
+            >>> hist = ScoreHistogram.empty(2)
+            >>> hist.update(np.array([True, False, True, False]), y_prob=np.array([0.1, 0.2, 0.7, 0.9]))
+            >>> hist.error_bounds()
+            {'roc_auc_score': 0.25, 'average_precision_score': 0.333...}
+            >>> hist = ScoreHistogram.empty(2)
+            >>> hist.update(np.array([True, False]), y_pred=np.array([True, False]))
+            >>> hist.error_bounds()
+            {}
+        """
+        if self.bin_pos is None or self.n_rows == 0:
+            return {}
+
+        n_neg = self.n_rows - self.n_pos
+        with np.errstate(divide="ignore", invalid="ignore"):
+            auroc_bound = 0.5 * (self.bin_pos * self.bin_neg).sum() / (self.n_pos * n_neg)
+
+            # The true positives and predictions above each bin, from the highest probability down.
+            pos, neg = self.bin_pos[::-1], self.bin_neg[::-1]
+            tp_above = np.cumsum(pos) - pos
+            predicted_above = np.cumsum(pos + neg) - pos - neg
+            highest = (tp_above + pos) / (predicted_above + pos)
+            lowest = (tp_above + 1) / (predicted_above + 1 + neg)
+            ap_widths = np.where(pos > 0, pos * (highest - lowest), 0.0)
+            ap_bound = ap_widths.sum() / self.n_pos
+
+        return {"roc_auc_score": float(auroc_bound), "average_precision_score": float(ap_bound)}
+
+
+def prediction_files(predictions_path: Path | str) -> list[Path]:
+    """Returns the sorted parquet files at a path or glob.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     for fp in ["a/1.parquet", "a/0.parquet", "b.parquet", "c.txt"]:
+        ...         (Path(d) / fp).parent.mkdir(exist_ok=True)
+        ...         (Path(d) / fp).touch()
+        ...     [fp.relative_to(d).as_posix() for fp in prediction_files(f"{d}/**/*.parquet")]
+        ['a/0.parquet', 'a/1.parquet', 'b.parquet']
+    """
+    return sorted(Path(fp) for fp in glob.glob(str(predictions_path), recursive=True))
+
+
+def count_predictions(predictions_path: Path | str) -> int:
+    """Counts the predictions at a path or glob from the parquet file metadata, without reading any rows.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     pl.DataFrame({"a": range(10)}).write_parquet(Path(d) / "0.parquet")
+        ...     pl.DataFrame({"a": range(5)}).write_parquet(Path(d) / "1.parquet")
+        ...     count_predictions(f"{d}/*.parquet")
+        15
+    """
+    return sum(pq.ParquetFile(fp).metadata.num_rows for fp in prediction_files(predictions_path))
+
+
+def stream_histogram(
+    predictions_path: Path | str, n_bins: int = DEFAULT_N_BINS, batch_size: int = DEFAULT_BATCH_SIZE
+) -> ScoreHistogram:
+    """Accumulates the score histogram of the predictions at a path or glob, one record batch at a time.
+
+    Args:
+        predictions_path: The path or glob of the prediction parquet files.
+        n_bins: The number of uniform probability bins.
+        batch_size: The maximum number of rows to read at once.
+
+    Returns:
+        The histogram of all predictions.
+
+    Raises:
+        FileNotFoundError: If there are no prediction files.
+        ValueError: If the predictions do not follow the schema.
+
+    Examples:
+        >>> import tempfile
+        >>> from MEDS_DEV.evaluation import evaluate_predictions, read_predictions
+        >>> rng = np.random.default_rng(0)
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     for i in range(3):
+        ...         pl.DataFrame({
+        ...             "subject_id": range(100),
+        ...             "prediction_time": None,
+        ...             "boolean_value": rng.random(100) < 0.5,
+        ...             "predicted_boolean_probability": rng.random(100),
+        ...         }).cast({"prediction_time": pl.Datetime("us")}).write_parquet(Path(d) / f"{i}.parquet")
+        ...     hist = stream_histogram(f"{d}/*.parquet", n_bins=100, batch_size=32)
+        ...     exact = read_predictions(f"{d}/*.parquet")
+        >>> hist.n_rows, int(hist.bin_pos.sum() + hist.bin_neg.sum()), hist.confusion
+        (300, 300, None)
+        >>> exact = evaluate_predictions(exact, n_bootstrap=0)["samples_equally_weighted"]
+        >>> errors = {k: round(abs(v - exact[k]), 4) for k, v in hist.metrics().items()}
+        >>> for name, error in errors.items():
+        ...     print(f"{name}: {error}")
+        roc_auc_score: 0.0013
+        average_precision_score: 0.0062
+        calibration_error: 0.0
+        brier_score: 0.0
+        >>> all(errors[k] <= bound for k, bound in hist.error_bounds().items())
+        True
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     stream_histogram(f"{d}/*.parquet")
+        Traceback (most recent call last):
+            ...
+        FileNotFoundError: No prediction files found at /tmp/.../*.parquet
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     pl.DataFrame({"subject_id": [1]}).write_parquet(Path(d) / "0.parquet")
+        ...     stream_histogram(f"{d}/*.parquet")
+        Traceback (most recent call last):
+            ...
+        ValueError: Missing required fields: ...
+    """
+    fps = prediction_files(predictions_path)
+    if not fps:
+        raise FileNotFoundError(f"No prediction files found at {predictions_path}")
+
+    hist = ScoreHistogram.empty(n_bins)
+    for fp in fps:
+        parquet_file = pq.ParquetFile(fp)
+        for i, batch in enumerate(parquet_file.iter_batches(batch_size=batch_size)):
+            df = pl.from_arrow(batch)
+            if i == 0:
+                validate_binary_classification_schema(df)
+            hist.update(
+                df[BOOLEAN_VALUE_FIELD].to_numpy(),
+                **{
+                    arg: df[field].to_numpy()
+                    for field, arg in [
+                        (PREDICTED_BOOLEAN_VALUE_FIELD, "y_pred"),
+                        (PREDICTED_BOOLEAN_PROBABILITY_FIELD, "y_prob"),
+                    ]
+                    if field in df.columns
+                },
+            )
+        logger.debug(f"Streamed {parquet_file.metadata.num_rows} predictions from {fp}.")
+    return hist
+
+
+def evaluate_streaming(
+    predictions_path: Path | str, n_bins: int = DEFAULT_N_BINS, batch_size: int = DEFAULT_BATCH_SIZE
+) -> dict:
+    """Evaluates the predictions at a path or glob in bounded memory, from their score histogram.
+
+    Only sample-weighted metrics are computed, as weighting subjects equally needs every subject's rows. The
+    output follows that of `evaluate_predictions`, with the bounds on the absolute errors of the approximate
+    metrics under the `"approximation_error_bounds"` key, and undefined metrics as `None`.
+
+    Examples:
+        >>> import json, tempfile
+        >>> rng = np.random.default_rng(0)
+        >>> labels = rng.random(1000) < 0.3
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     pl.DataFrame({
+        ...         "subject_id": range(1000), "prediction_time": None, "boolean_value": labels,
+        ...         "predicted_boolean_probability": np.clip(0.3 * labels + rng.random(1000) * 0.7, 0, 1),
+        ...     }).cast({"prediction_time": pl.Datetime("us")}).write_parquet(Path(d) / "0.parquet")
+        ...     out = evaluate_streaming(f"{d}/*.parquet", n_bins=1000)
+        >>> print(json.dumps(out, indent=2))
+        {
+          "samples_equally_weighted": {
+            "roc_auc_score": 0.8362...,
+            "average_precision_score": 0.7266...,
+            "calibration_error": 0.1697...,
+            "brier_score": 0.1600...
+          },
+          "approximation_error_bounds": {
+            "n_bins": 1000,
+            "samples_equally_weighted": {
+              "roc_auc_score": 0.0004...,
+              "average_precision_score": 0.0014...
+            }
+          }
+        }
+    """
+    hist = stream_histogram(predictions_path, n_bins=n_bins, batch_size=batch_size)
+    metrics = {name: None if np.isnan(value) else value for name, value in hist.metrics().items()}
+    return {
+        "samples_equally_weighted": metrics,
+        "approximation_error_bounds": {"n_bins": n_bins, "samples_equally_weighted": hist.error_bounds()},
+    }
+
+
+__all__ = ["ScoreHistogram", "count_predictions", "evaluate_streaming", "stream_histogram"]
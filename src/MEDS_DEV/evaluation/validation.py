@@ -0,0 +1,372 @@
+"""Bounded-memory validation of binary classification prediction files.
+
+`meds_evaluation.schema.validate_binary_classification_schema` checks a fully materialized predictions frame.
+This module checks the same schema, and more, without loading the predictions:
+
+  - The column names and dtypes are checked from the parquet schema, and the numbers of rows and of nulls
+    from the parquet metadata (row group statistics, where they were written).
+  - Only the columns that the metadata cannot vouch for are read, one record batch at a time: the predicted
+    probabilities (which must be in `[0, 1]`, and not NaN), and, when checking against the labels, the label
+    keys and values.
+  - Alignment with the labels is checked by comparing the number of rows and an order-independent hash of the
+    `(subject_id, prediction_time, boolean_value)` rows of the predictions and of the labels, so neither needs
+    to be sorted or held in memory.
+"""
+
+import logging
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+from meds_evaluation.schema import (
+    BINARY_CLASSIFICATION_SCHEMA_DICT,
+    BOOLEAN_VALUE_FIELD,
+    PREDICTED_BOOLEAN_PROBABILITY_FIELD,
+    PREDICTION_TIME_FIELD,
+    REQUIRED_FIELDS,
+    SUBJECT_ID_FIELD,
+)
+
+from . import PREDICTED_COLUMNS
+from .streaming import DEFAULT_BATCH_SIZE, prediction_files
+
+logger = logging.getLogger(__name__)
+
+LABEL_COLUMNS = (SUBJECT_ID_FIELD, PREDICTION_TIME_FIELD, BOOLEAN_VALUE_FIELD)
+NON_NULL_COLUMNS = (SUBJECT_ID_FIELD, BOOLEAN_VALUE_FIELD)
+HASH_SEED = 0
+
+
+def check_prediction_schema(schema: pl.Schema) -> list[str]:
+    """Checks a predictions schema, returning the predicted columns it has.
+
+    Raises:
+        ValueError: If a required column is missing or has the wrong dtype, or no predicted column is present.
+
+    Examples:
+        >>> schema = pl.Schema({
+        ...     "subject_id": pl.Int64, "prediction_time": pl.Datetime("ns"), "boolean_value": pl.Boolean,
+        ...     "predicted_boolean_probability": pl.Float64, "extra": pl.String,
+        ... })
+        >>> check_prediction_schema(schema)
+        ['predicted_boolean_probability']
+        >>> check_prediction_schema(pl.Schema({**schema, "subject_id": pl.UInt32}))
+        Traceback (most recent call last):
+            ...
+        ValueError: Mismatched type for subject_id: expected Int64, got UInt32
+        >>> check_prediction_schema(pl.Schema({"subject_id": pl.Int64}))
+        Traceback (most recent call last):
+            ...
+        ValueError: Missing required fields: boolean_value, prediction_time
+        >>> check_prediction_schema(pl.Schema({k: schema[k] for k in list(schema)[:3]}))
+        Traceback (most recent call last):
+            ...
+        ValueError: Missing all prediction fields: predicted_boolean_value, predicted_boolean_probability
+    """
+    if missing := sorted(REQUIRED_FIELDS - set(schema)):
+        raise ValueError(f"Missing required fields: {', '.join(missing)}")
+
+    predicted = [c for c in PREDICTED_COLUMNS if c in schema]
+    if not predicted:
+        raise ValueError(f"Missing all prediction fields: {', '.join(PREDICTED_COLUMNS)}")
+
+    for field in [*sorted(REQUIRED_FIELDS), *predicted]:
+        expected = BINARY_CLASSIFICATION_SCHEMA_DICT[field]
+        if schema[field] != expected:
+            raise ValueError(f"Mismatched type for {field}: expected {expected}, got {schema[field]}")
+    return predicted
+
+
+def metadata_null_counts(metadata: pq.FileMetaData, columns: list[str]) -> dict[str, int | None]:
+    """Returns the number of nulls in each column from the row group statistics of a parquet file.
+
+    A column's count is None if any of its row groups has no null count statistics.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     df = pl.DataFrame({"a": [1, None, 3], "b": [None, None, "x"]})
+        ...     df.write_parquet(Path(d) / "0.parquet", row_group_size=2)
+        ...     df.write_parquet(Path(d) / "1.parquet", statistics=False)
+        ...     print(metadata_null_counts(pq.ParquetFile(Path(d) / "0.parquet").metadata, ["a", "b", "c"]))
+        ...     print(metadata_null_counts(pq.ParquetFile(Path(d) / "1.parquet").metadata, ["a", "b"]))
+        {'a': 1, 'b': 2, 'c': None}
+        {'a': None, 'b': None}
+    """
+    paths = [metadata.schema.column(i).path for i in range(metadata.num_columns)]
+    counts = {}
+    for column in columns:
+        if column not in paths:
+            counts[column] = None
+            continue
+        i = paths.index(column)
+        count = 0
+        for rg in range(metadata.num_row_groups):
+            stats = metadata.row_group(rg).column(i).statistics
+            if stats is None or not stats.has_null_count:
+                count = None
+                break
+            count += stats.null_count
+        counts[column] = count
+    return counts
+
+
+def label_hash(df: pl.DataFrame) -> int:
+    """Returns an order-independent hash of the `(subject_id, prediction_time, boolean_value)` rows of a df.
+
+    The hash of a set of rows is the sum (modulo 2^64) of the hashes of its rows, so the hash of many batches
+    is the sum of the hashes of each batch, whatever their order. Dtypes are normalized first, so that labels
+    and predictions written with different integer or timestamp types hash alike.
+
+    Examples:
+        >>> from datetime import datetime
+        >>> df = pl.DataFrame({
+        ...     "subject_id": [1, 2, 3],
+        ...     "prediction_time": [datetime(2021, 1, d) for d in (1, 2, 3)],
+        ...     "boolean_value": [True, False, True],
+        ... })
+        >>> label_hash(df) == (label_hash(df[:1]) + label_hash(df[1:])) % 2**64 == label_hash(df.reverse())
+        True
+        >>> recast = df.cast({"subject_id": pl.UInt32, "prediction_time": pl.Datetime("ns")})
+        >>> label_hash(df) == label_hash(recast)
+        True
+        >>> label_hash(df) == label_hash(df.with_columns(pl.col("boolean_value").not_()))
+        False
+    """
+    row_hashes = df.select(
+        pl.struct(
+            pl.col(SUBJECT_ID_FIELD).cast(pl.Int64),
+            pl.col(PREDICTION_TIME_FIELD).cast(pl.Datetime("us")),
+            pl.col(BOOLEAN_VALUE_FIELD),
+        ).hash(HASH_SEED)
+    ).to_series()
+    return int(row_hashes.to_numpy().sum(dtype=np.uint64))
+
+
+def label_digest(labels_path: Path | str, batch_size: int = DEFAULT_BATCH_SIZE) -> tuple[int, int]:
+    """Returns the number of rows and the `label_hash` of the label parquet files at a path or glob.
+
+    The labels are read one record batch at a time. Compute this once to check several prediction sets
+    against the same labels with `validate_predictions`, rather than re-reading the labels for each.
+
+    Raises:
+        FileNotFoundError: If there are no label files.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> labels = pl.DataFrame({
+        ...     "subject_id": [1, 2, 3],
+        ...     "prediction_time": [datetime(2021, 1, d) for d in (1, 2, 3)],
+        ...     "boolean_value": [True, False, True],
+        ... })
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     labels[:1].write_parquet(Path(d) / "0.parquet")
+        ...     labels[1:].write_parquet(Path(d) / "1.parquet")
+        ...     label_digest(f"{d}/*.parquet", batch_size=1) == (3, label_hash(labels))
+        True
+        >>> label_digest("/nonexistent/*.parquet")
+        Traceback (most recent call last):
+            ...
+        FileNotFoundError: No label files found at /nonexistent/*.parquet
+    """
+    fps = prediction_files(labels_path)
+    if not fps:
+        raise FileNotFoundError(f"No label files found at {labels_path}")
+
+    n_rows, hash_sum = 0, 0
+    for fp in fps:
+        parquet_file = pq.ParquetFile(fp)
+        n_rows += parquet_file.metadata.num_rows
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=list(LABEL_COLUMNS)):
+            hash_sum = (hash_sum + label_hash(pl.from_arrow(batch))) % 2**64
+    return n_rows, hash_sum
+
+
+def validate_predictions(
+    predictions_path: Path | str,
+    labels_path: Path | str | None = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    labels_digest: tuple[int, int] | None = None,
+) -> int:
+    """Validates the prediction parquet files at a path or glob, in bounded memory.
+
+    The predictions must follow the MEDS binary classification prediction schema, with no null subject IDs or
+    labels, at least one predicted column with values, no nulls in the predicted columns that have values,
+    and predicted probabilities in `[0, 1]`. If `labels_path` is given, the predictions must also have exactly
+    the `(subject_id, prediction_time, boolean_value)` rows of the labels there, in any order.
+
+    Args:
+        predictions_path: The path or glob of the prediction parquet files.
+        labels_path: The path or glob of the label parquet files the predictions were made for, if they should
+            be checked against them.
+        batch_size: The maximum number of rows to read at once.
+        labels_digest: The `label_digest` of the labels at `labels_path`, if it was already computed (e.g., to
+            validate several prediction sets against the same labels). If not given, it is computed.
+
+    Returns:
+        The number of predictions.
+
+    Raises:
+        FileNotFoundError: If there are no prediction (or label) files.
+        ValueError: If the predictions are invalid, listing every problem found.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> labels = pl.DataFrame({
+        ...     "subject_id": [1, 1, 2, 3],
+        ...     "prediction_time": [datetime(2021, 1, d) for d in (1, 2, 1, 1)],
+        ...     "boolean_value": [True, False, False, True],
+        ... })
+        >>> predictions = labels.with_columns(
+        ...     predicted_boolean_probability=pl.Series([0.9, 0.2, 0.4, 0.7]), predicted_boolean_value=None,
+        ... ).cast({"predicted_boolean_value": pl.Boolean})
+        >>> def validate(predictions, **kwargs):
+        ...     with tempfile.TemporaryDirectory() as d:
+        ...         labels.write_parquet(Path(d) / "labels.parquet")
+        ...         predictions[:2].write_parquet(Path(d) / "0.parquet")
+        ...         predictions[2:].reverse().write_parquet(Path(d) / "1.parquet", statistics=False)
+        ...         return validate_predictions(f"{d}/[0-9].parquet", batch_size=1, **kwargs)
+        >>> validate(predictions)
+        4
+        >>> validate(predictions, labels_path="/nonexistent/*.parquet")
+        Traceback (most recent call last):
+            ...
+        FileNotFoundError: No label files found at /nonexistent/*.parquet
+
+    Every problem found is reported:
+
+        >>> validate(predictions.with_columns(
+        ...     subject_id=pl.Series([1, None, 2, 3]),
+        ...     predicted_boolean_probability=pl.Series([0.9, None, 1.5, float("nan")]),
+        ... ))
+        Traceback (most recent call last):
+            ...
+        ValueError: Invalid predictions at .../[0-9].parquet:
+          - 1 of 4 predictions have a null subject_id
+          - 1 of 4 predictions have a null predicted_boolean_probability
+          - 2 of 4 predicted probabilities are NaN or outside of [0, 1]
+        >>> validate(predictions.with_columns(predicted_boolean_probability=pl.lit(None, pl.Float64)))
+        Traceback (most recent call last):
+            ...
+        ValueError: Invalid predictions at .../[0-9].parquet:
+          - No predicted column has any values: predicted_boolean_value, predicted_boolean_probability
+
+    Predictions are checked against the labels with `labels_path`:
+
+        >>> def validate_against_labels(predictions):
+        ...     with tempfile.TemporaryDirectory() as d:
+        ...         labels.write_parquet(Path(d) / "labels.parquet")
+        ...         predictions.write_parquet(Path(d) / "predictions.parquet")
+        ...         return validate_predictions(Path(d) / "predictions.parquet", Path(d) / "labels.parquet")
+        >>> validate_against_labels(predictions.sample(fraction=1, shuffle=True, seed=0))
+        4
+        >>> validate_against_labels(predictions[:3])
+        Traceback (most recent call last):
+            ...
+        ValueError: Invalid predictions at .../predictions.parquet:
+          - There are 3 predictions for 4 labels at .../labels.parquet
+        >>> validate_against_labels(predictions.with_columns(pl.col("boolean_value").not_()))
+        Traceback (most recent call last):
+            ...
+        ValueError: Invalid predictions at .../predictions.parquet:
+          - The (subject_id, prediction_time, boolean_value) of the predictions do not match the labels at ...
+
+    A precomputed `label_digest` is used instead of reading the labels again:
+
+        >>> digest = (len(labels), label_hash(labels))
+        >>> validate(predictions, labels_path="labels", labels_digest=digest)
+        4
+        >>> validate(predictions[1:], labels_path="labels", labels_digest=digest)
+        Traceback (most recent call last):
+            ...
+        ValueError: Invalid predictions at .../[0-9].parquet:
+          - There are 3 predictions for 4 labels at labels
+    """
+    fps = prediction_files(predictions_path)
+    if not fps:
+        raise FileNotFoundError(f"No prediction files found at {predictions_path}")
+    if labels_path is None:
+        labels_digest = None
+    elif labels_digest is None:
+        labels_digest = label_digest(labels_path, batch_size)
+
+    n_rows, hash_sum, n_bad_probabilities = 0, 0, 0
+    null_counts = Counter()
+    for fp in fps:
+        parquet_file = pq.ParquetFile(fp)
+        schema = pl.from_arrow(parquet_file.schema_arrow.empty_table()).schema
+        try:
+            predicted = check_prediction_schema(schema)
+        except ValueError as e:
+            raise ValueError(f"Invalid predictions schema in {fp}: {e}") from e
+
+        n_file_rows = parquet_file.metadata.num_rows
+        n_rows += n_file_rows
+        for column in PREDICTED_COLUMNS:
+            if column not in predicted:
+                null_counts[column] += n_file_rows
+
+        # Only read the columns whose null counts are not in the metadata, the probabilities, and the labels.
+        metadata_counts = metadata_null_counts(parquet_file.metadata, [*NON_NULL_COLUMNS, *predicted])
+        count_in_batches = {column for column, count in metadata_counts.items() if count is None}
+        null_counts.update({column: count for column, count in metadata_counts.items() if count is not None})
+        to_read = set(count_in_batches)
+        if PREDICTED_BOOLEAN_PROBABILITY_FIELD in predicted:
+            to_read.add(PREDICTED_BOOLEAN_PROBABILITY_FIELD)
+        if labels_digest is not None:
+            to_read.update(LABEL_COLUMNS)
+        if not to_read:
+            continue
+
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=sorted(to_read)):
+            df = pl.from_arrow(batch)
+            for column in count_in_batches:
+                null_counts[column] += df[column].null_count()
+            if PREDICTED_BOOLEAN_PROBABILITY_FIELD in to_read:
+                probs = df[PREDICTED_BOOLEAN_PROBABILITY_FIELD]
+                n_bad_probabilities += int((probs.is_nan() | (probs < 0) | (probs > 1)).sum())
+            if labels_digest is not None:
+                hash_sum = (hash_sum + label_hash(df)) % 2**64
+
+    issues = []
+    for column in NON_NULL_COLUMNS:
+        if null_counts[column]:
+            issues.append(f"{null_counts[column]} of {n_rows} predictions have a null {column}")
+    with_values = [column for column in PREDICTED_COLUMNS if null_counts[column] < n_rows]
+    if not with_values:
+        issues.append(f"No predicted column has any values: {', '.join(PREDICTED_COLUMNS)}")
+    for column in with_values:
+        if null_counts[column]:
+            issues.append(f"{null_counts[column]} of {n_rows} predictions have a null {column}")
+    if n_bad_probabilities:
+        issues.append(
+            f"{n_bad_probabilities} of {n_rows} predicted probabilities are NaN or outside of [0, 1]"
+        )
+
+    if labels_digest is not None:
+        n_labels, labels_hash_sum = labels_digest
+        if n_labels != n_rows:
+            issues.append(f"There are {n_rows} predictions for {n_labels} labels at {labels_path}")
+        elif labels_hash_sum != hash_sum:
+            columns = ", ".join(LABEL_COLUMNS)
+            issues.append(f"The ({columns}) of the predictions do not match the labels at {labels_path}")
+
+    if issues:
+        raise ValueError(
+            f"Invalid predictions at {predictions_path}:\n" + "\n".join(f"  - {issue}" for issue in issues)
+        )
+    logger.info(f"Validated {n_rows} predictions in {len(fps)} files at {predictions_path}.")
+    return n_rows
+
+
+__all__ = [
+    "check_prediction_schema",
+    "label_digest",
+    "label_hash",
+    "metadata_null_counts",
+    "validate_predictions",
+]
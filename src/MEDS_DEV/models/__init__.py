@@ -3,24 +3,36 @@ from collections.abc import Generator
 from enum import StrEnum, auto
 from importlib.resources import files
 from pathlib import Path
+from typing import Any
 
 import meds
 from omegaconf import DictConfig, OmegaConf
 
+from ..registry import LazyRegistry
 from ..utils import Metadata
 
-model_files = files("MEDS_DEV.models")
 CFG_YAML = files("MEDS_DEV.configs") / "_run_model.yaml"
 
-MODELS = {}
 
-for path in model_files.rglob("*/model.yaml"):
-    model_name = path.relative_to(model_files).parent.with_suffix("").as_posix()
-    MODELS[model_name] = OmegaConf.to_object(OmegaConf.load(path))
-    MODELS[model_name]["metadata"] = Metadata(**MODELS[model_name]["metadata"])
+def load_model(path: Path) -> dict[str, Any]:
+    """Loads and validates the specification of the model whose `model.yaml` is at `path`.
+
+    Examples:
+        >>> spec = load_model(MODELS.root / "models" / "random_predictor" / "model.yaml")
+        >>> sorted(spec)
+        ['commands', 'metadata', 'model_dir', 'requirements']
+        >>> spec["model_dir"].name, spec["requirements"]
+        ('random_predictor', None)
+    """
+    spec = OmegaConf.to_object(OmegaConf.load(path))
+    spec["metadata"] = Metadata(**spec["metadata"])
     requirements_path = path.parent / "requirements.txt"
-    MODELS[model_name]["requirements"] = requirements_path if requirements_path.exists() else None
-    MODELS[model_name]["model_dir"] = path.parent
+    spec["requirements"] = requirements_path if requirements_path.exists() else None
+    spec["model_dir"] = path.parent
+    return spec
+
+
+MODELS = LazyRegistry("models", load_model)
 
 
 class RunMode(StrEnum):
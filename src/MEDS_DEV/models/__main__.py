@@ -27,12 +27,30 @@ def main(cfg: DictConfig):
 
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    cache_inputs = {
+        "dataset_dir": cfg.dataset_dir,
+        "labels_dir": cfg.get("labels_dir", None),
+        "model_initialization_dir": cfg.get("model_initialization_dir", None),
+        "model_dir": model_dir,
+        "requirements": requirements,
+    }
+
     with temp_env(cfg, requirements) as (temp_dir, env):
-        for cmd, out_dir in model_commands(cfg, commands, model_dir):
+        for i, (cmd, out_dir) in enumerate(model_commands(cfg, commands, model_dir)):
             logger.info(f"Considering running model command: {cmd}")
             try:
-                run_in_env(cmd, out_dir, env=env, do_overwrite=cfg.do_overwrite)
+                run_in_env(
+                    cmd,
+                    out_dir,
+                    env=env,
+                    do_overwrite=cfg.do_overwrite,
+                    cache_dir=cfg.get("stage_cache_dir", None),
+                    live_tail=cfg.get("live_tail", False),
+                    cache_inputs=cache_inputs,
+                )
             except Exception as e:  # pragma: no cover
                 raise ValueError(f"Failed to run {cfg.model} command {cmd}") from e
+            # Later commands (e.g., prediction) may depend on the outputs of earlier ones (e.g., training).
+            cache_inputs = {**cache_inputs, f"step_{i}_output_dir": out_dir}
 
     logger.info(f"Model {cfg.model} finished successfully.")
@@ -6,22 +6,85 @@ import hydra
 import meds
 import numpy as np
 import polars as pl
-from meds_evaluation.schema import (
-    PREDICTED_BOOLEAN_PROBABILITY_FIELD,
-    PREDICTED_BOOLEAN_VALUE_FIELD,
-    validate_binary_classification_schema,
-)
+from meds_evaluation.schema import PREDICTED_BOOLEAN_PROBABILITY_FIELD, PREDICTED_BOOLEAN_VALUE_FIELD
 from omegaconf import DictConfig
 
+from MEDS_DEV.evaluation.validation import validate_predictions
+
 logger = logging.getLogger(__name__)
 
 CONFIG = files("MEDS_DEV") / "models" / "random_predictor" / "_config.yaml"
 
 
+def _splitmix64(x: np.ndarray) -> np.ndarray:
+    """The splitmix64 finalizer, a bijective mix of 64-bit unsigned integers (with wrapping arithmetic)."""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _label_probabilities(labels: pl.Series, seed: int) -> pl.Series:
+    subject_ids = labels.struct.field(meds.subject_id_field).cast(pl.Int64).to_numpy()
+    times = labels.struct.field(meds.prediction_time_field).cast(pl.Datetime("us")).to_physical().fill_null(0)
+    h = _splitmix64(np.full(len(labels), seed, dtype=np.int64).view(np.uint64))
+    h = _splitmix64(h ^ subject_ids.view(np.uint64))
+    h = _splitmix64(h ^ times.to_numpy().view(np.uint64))
+    # Keep the top 53 bits, the precision of a double, so every draw is exactly representable and below 1.
+    return pl.Series((h >> np.uint64(11)).astype(np.float64) / float(2**53))
+
+
+def random_probability(seed: int) -> pl.Expr:
+    """Returns an expression drawing a uniform random probability in [0, 1) for each label.
+
+    The draw is a seeded splitmix64 hash of the label's subject ID (as an int64) and prediction time (as
+    microseconds since the epoch), computed with numpy on each batch. So, unlike drawing from a random number
+    generator in row order, it can be computed on each batch of a streamed query independently, a label gets
+    the same probability however the labels are sharded or ordered, and, unlike polars' own hashes, it is the
+    same across polars versions.
+
+    Args:
+        seed: The random seed.
+
+    Returns:
+        A float expression over the `subject_id` and `prediction_time` columns.
+
+    Examples:
+        >>> from datetime import datetime
+        >>> labels = pl.DataFrame({
+        ...     "subject_id": [1, 2, 1],
+        ...     "prediction_time": [datetime(2021, 1, 1), datetime(2021, 1, 2), datetime(2021, 1, 1)],
+        ... })
+        >>> probs = labels.select(random_probability(42))["subject_id"]
+        >>> bool(probs.is_between(0, 1, closed="left").all())
+        True
+        >>> probs[0] == probs[2], probs[0] == probs[1]
+        (True, False)
+        >>> labels.select(random_probability(0))["subject_id"][0] == probs[0]
+        False
+
+    The draws do not depend on the polars version, so they can be pinned:
+        >>> probs.to_list()
+        [0.008285720923652318, 0.6855555128734911, 0.008285720923652318]
+
+    The draws are uniformly distributed:
+        >>> many = pl.DataFrame({"subject_id": range(100_000), "prediction_time": datetime(2021, 1, 1)})
+        >>> probs = many.select(random_probability(1))["subject_id"]
+        >>> round(probs.mean(), 2), round(float((probs < 0.1).mean()), 2)
+        (0.5, 0.1)
+    """
+    return pl.struct(meds.subject_id_field, meds.prediction_time_field).map_batches(
+        lambda labels: _label_probabilities(labels, seed), return_dtype=pl.Float64, is_elementwise=True
+    )
+
+
 @hydra.main(version_base=None, config_path=str(CONFIG.parent.resolve()), config_name=CONFIG.stem)
 def main(cfg: DictConfig) -> None:
     """Generates random predictions for the specified split (must be held-out) of a dataset.
 
+    The labels are streamed from disk, restricted to the split's subjects, and written out in batches, so
+    memory use does not grow with the number of labels. Predictions are written in no particular order.
+
     Args:
         cfg: The configuration object, controlled through Hydra command line arguments. Takes:
           - dataset_dir: The directory containing the dataset.
@@ -132,7 +195,7 @@ def main(cfg: DictConfig) -> None:
     ...         "seed": 42,
     ...     })
     ...     main(cfg)
-    ...     predictions = pl.read_parquet(predictions_fp)
+    ...     predictions = pl.read_parquet(predictions_fp).sort("subject_id")
     ...     predictions
     shape: (2, 5)
     ┌────────────┬─────────────────────┬───────────────┬───────────────────────────────┬─────────────────────────┐
@@ -140,8 +203,8 @@ def main(cfg: DictConfig) -> None:
     │ ---        ┆ ---                 ┆ ---           ┆ ---                           ┆ ---                     │
     │ i64        ┆ datetime[μs]        ┆ bool          ┆ f64                           ┆ bool                    │
     ╞════════════╪═════════════════════╪═══════════════╪═══════════════════════════════╪═════════════════════════╡
-    │ 1          ┆ 2021-01-01 00:00:00 ┆ false         ┆ 0.773956                      ┆ true                    │
-    │ 2          ┆ 2021-01-02 00:00:00 ┆ true          ┆ 0.438878                      ┆ false                   │
+    │ 1          ┆ 2021-01-01 00:00:00 ┆ false         ┆ 0.008286                      ┆ false                   │
+    │ 2          ┆ 2021-01-02 00:00:00 ┆ true          ┆ 0.685556                      ┆ true                    │
     └────────────┴─────────────────────┴───────────────┴───────────────────────────────┴─────────────────────────┘
     """  # noqa: E501
 
@@ -163,42 +226,48 @@ def main(cfg: DictConfig) -> None:
             f"Could not find splits file {splits_file.relative_to(dataset_dir)} for dataset {dataset_dir}."
         )
 
-    splits = pl.read_parquet(splits_file, use_pyarrow=True)
-    subjects = set(splits.filter(pl.col("split") == cfg.split)[meds.subject_id_field])
+    # Only the held-out subject IDs are held in memory; the labels are streamed through the join in batches.
+    # An inner join against the unique subject IDs is a semi-join, but unlike `how="semi"` it is supported by
+    # polars' streaming engine.
+    split_subjects = (
+        pl.scan_parquet(splits_file)
+        .filter(pl.col("split") == cfg.split)
+        .select(meds.subject_id_field)
+        .unique()
+    )
 
     # Labels can live in any parquet file within the labels directory:
-    labels_files = list(labels_dir.rglob("*.parquet"))
+    labels_files = sorted(labels_dir.rglob("*.parquet"))
     if not labels_files:
         logger.warning(f"No labels found in {labels_dir}. Exiting without writing.")
         return
 
-    def read_split(fp: Path) -> pl.DataFrame:
-        return pl.read_parquet(fp, use_pyarrow=True).filter(pl.col(meds.subject_id_field).is_in(subjects))
-
     try:
-        labels = pl.concat([read_split(f) for f in labels_files], how="vertical_relaxed")
+        labels = pl.concat([pl.scan_parquet(fp) for fp in labels_files], how="vertical_relaxed")
+        subject_id_dtype = labels.collect_schema()[meds.subject_id_field]
+        predictions = labels.join(
+            split_subjects.with_columns(pl.col(meds.subject_id_field).cast(subject_id_dtype)),
+            on=meds.subject_id_field,
+            how="inner",
+        ).with_columns(random_probability(seed).alias(PREDICTED_BOOLEAN_PROBABILITY_FIELD))
+        predictions = predictions.with_columns(
+            (pl.col(PREDICTED_BOOLEAN_PROBABILITY_FIELD) > 0.5).alias(PREDICTED_BOOLEAN_VALUE_FIELD),
+        )
+        predictions.sink_parquet(predictions_fp)
     except Exception as e:
         err_lines = [f"Error reading labels: {e}", "Labels dir contents:"]
-        for file in labels_dir.rglob("*.parquet"):
+        for file in labels_files:
             err_lines.append(f"  - {file.relative_to(labels_dir)}")
         err_str = "\n".join(err_lines)
         logger.error(err_str)
         raise ValueError(err_str) from e
 
-    rng = np.random.default_rng(seed)
-    probabilities = rng.uniform(0, 1, len(labels))
-
-    predictions = labels.with_columns(
-        pl.Series(probabilities).alias(PREDICTED_BOOLEAN_PROBABILITY_FIELD),
-    )
-    predictions = predictions.with_columns(
-        (pl.col(PREDICTED_BOOLEAN_PROBABILITY_FIELD) > 0.5).alias(PREDICTED_BOOLEAN_VALUE_FIELD),
-    )
-
-    # Check the schema output:
-    validate_binary_classification_schema(predictions)
-
-    predictions.write_parquet(predictions_fp, use_pyarrow=True)
+    # Check the output in bounded memory, so the predictions are not read back in full:
+    try:
+        validate_predictions(predictions_fp)
+    except ValueError:
+        predictions_fp.unlink()
+        raise
 
 
 if __name__ == "__main__":
@@ -0,0 +1,259 @@
+"""Lazily loaded registries of the MEDS-DEV datasets, tasks, and models.
+
+The `DATASETS`, `TASKS`, and `MODELS` registries are read-only mappings from entry names to their loaded
+specifications. Names are listed from a prebuilt index file shipped with the package (`registry_index.json`),
+so importing `MEDS_DEV`, listing names, and checking membership never read the entries' YAML files. An entry
+is only loaded (and its metadata validated) when it is first accessed, and is then cached.
+
+Each entry's specification file is found from its name alone (e.g., task `mortality/in_icu/first_24h` is
+`tasks/mortality/in_icu/first_24h.yaml`), so an entry that is on disk but missing from a stale index can
+still be accessed by name; it just won't be listed. After adding, removing, or renaming a dataset, task, or
+model, regenerate the index with `python -m MEDS_DEV.registry` (a pre-commit hook does this automatically).
+"""
+
+import json
+import logging
+from collections.abc import Callable, Iterator, KeysView, Mapping
+from importlib.resources import files
+from pathlib import Path, PurePosixPath
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+package_files = files("MEDS_DEV")
+INDEX_FP = package_files / "registry_index.json"
+
+# The specification file of each kind of entry, relative to the package root, as a function of its name.
+ENTRY_PATHS = {
+    "datasets": "datasets/{name}/dataset.yaml",
+    "tasks": "tasks/{name}.yaml",
+    "models": "models/{name}/model.yaml",
+}
+
+
+def entry_path(kind: str, name: str, root: Path | None = None) -> Path | None:
+    """Returns the path of the specification file of the named entry, or None if the name is invalid.
+
+    Args:
+        kind: The kind of entry; one of `"datasets"`, `"tasks"`, or `"models"`.
+        name: The entry's name.
+        root: The package root to resolve the path in. Defaults to the installed `MEDS_DEV` package.
+
+    Returns:
+        The path, which need not exist, or None if the name is not a normalized relative path (so that names
+        like `"../datasets/MIMIC-IV/dataset"` or `"abnormal_lab/**"` never resolve to a file).
+
+    Examples:
+        >>> entry_path("tasks", "mortality/in_icu/first_24h", root=Path("pkg"))
+        PosixPath('pkg/tasks/mortality/in_icu/first_24h.yaml')
+        >>> entry_path("models", "meds_tab/tiny", root=Path("pkg"))
+        PosixPath('pkg/models/meds_tab/tiny/model.yaml')
+        >>> print(entry_path("tasks", "../datasets/MIMIC-IV/dataset"))
+        None
+        >>> print(entry_path("tasks", "/etc/passwd"))
+        None
+        >>> print(entry_path("tasks", "mortality//in_icu/first_24h"))
+        None
+        >>> print(entry_path("tasks", ""))
+        None
+        >>> entry_path("foo", "bar")
+        Traceback (most recent call last):
+            ...
+        ValueError: Unknown registry kind foo. Must be one of datasets, tasks, models
+    """
+    if kind not in ENTRY_PATHS:
+        raise ValueError(f"Unknown registry kind {kind}. Must be one of {', '.join(ENTRY_PATHS)}")
+
+    pure_name = PurePosixPath(name)
+    if (
+        not name
+        or pure_name.is_absolute()
+        or pure_name.as_posix() != name
+        or any(part in (".", "..") for part in pure_name.parts)
+    ):
+        return None
+
+    root = Path(package_files) if root is None else root
+    return root / ENTRY_PATHS[kind].format(name=name)
+
+
+def scan_entries(kind: str, root: Path | None = None) -> list[str]:
+    """Lists the names of all entries of a kind by scanning the package directory.
+
+    Args:
+        kind: The kind of entry; one of `"datasets"`, `"tasks"`, or `"models"`.
+        root: The package root to scan. Defaults to the installed `MEDS_DEV` package.
+
+    Returns:
+        The sorted entry names.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     root = Path(d)
+        ...     for fp in ["tasks/a/b.yaml", "tasks/c.yaml", "models/m/model.yaml", "models/m/cfg.yaml"]:
+        ...         (root / fp).parent.mkdir(parents=True, exist_ok=True)
+        ...         (root / fp).touch()
+        ...     print(scan_entries("tasks", root), scan_entries("models", root))
+        ...     print(scan_entries("datasets", root))
+        ['a/b', 'c'] ['m']
+        []
+    """
+    root = Path(package_files) if root is None else root
+    kind_dir, file_pattern = ENTRY_PATHS[kind].split("/{name}")
+    base = root / kind_dir
+
+    names = []
+    for fp in base.glob(f"**/*{file_pattern}"):
+        rel = fp.relative_to(base).as_posix()
+        names.append(rel.removesuffix(file_pattern))
+    return sorted(names)
+
+
+def build_index(root: Path | None = None) -> dict[str, list[str]]:
+    """Builds the registry index, listing the names of all datasets, tasks, and models in the package.
+
+    Examples:
+        >>> index = build_index()
+        >>> list(index)
+        ['datasets', 'tasks', 'models']
+        >>> index["models"]
+        ['cehrbert', 'genhpf', 'meds_tab/tiny', 'random_predictor']
+
+    The index shipped with the package must be up to date with the package's contents; if this fails, run
+    `python -m MEDS_DEV.registry` to regenerate it:
+        >>> index == json.loads(INDEX_FP.read_text())
+        True
+    """
+    return {kind: scan_entries(kind, root) for kind in ENTRY_PATHS}
+
+
+def read_index(kind: str) -> list[str]:
+    """Reads the names of all entries of a kind from the index, scanning the package if there is no index.
+
+    Examples:
+        >>> read_index("datasets")
+        ['MIMIC-IV', 'synthetic']
+    """
+    try:
+        index = json.loads(INDEX_FP.read_text())
+    except FileNotFoundError:
+        logger.warning(f"Registry index {INDEX_FP} not found; scanning the package for {kind} instead.")
+        return scan_entries(kind)
+    return index[kind]
+
+
+class LazyRegistry(Mapping):
+    """A read-only mapping from entry names to specifications that loads each entry on first access.
+
+    Listing names, iterating, and checking membership only use the registry index. Accessing an entry loads it
+    from its specification file with the given loader, which validates it, and caches the result.
+
+    Args:
+        kind: The kind of entry; one of `"datasets"`, `"tasks"`, or `"models"`.
+        loader: A function mapping an entry's specification file path to its loaded specification.
+        names: The entry names. Defaults to those in the registry index.
+        root: The package root to load entries from. Defaults to the installed `MEDS_DEV` package.
+
+    Examples:
+        >>> import tempfile
+        >>> loads = []
+        >>> def loader(path):
+        ...     loads.append(path.stem)
+        ...     return {"text": path.read_text()}
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     for name in ["a", "b/c", "d"]:
+        ...         (Path(d) / "tasks" / name).parent.mkdir(parents=True, exist_ok=True)
+        ...         _ = (Path(d) / "tasks" / f"{name}.yaml").write_text(name)
+        ...     registry = LazyRegistry("tasks", loader, names=["a", "b/c"], root=Path(d))
+        ...     print(list(registry), len(registry), "a" in registry, "x" in registry, loads)
+        ...     print(registry["b/c"], registry["b/c"], loads)
+        ...     print(registry)
+        ...     print(registry.keys())
+        ['a', 'b/c'] 2 True False []
+        {'text': 'b/c'} {'text': 'b/c'} ['c']
+        LazyRegistry(tasks, 1/2 loaded)
+        dict_keys(['a', 'b/c'])
+        >>> registry["x"]
+        Traceback (most recent call last):
+            ...
+        KeyError: 'x'
+
+    Entries that are on disk but missing from the index (e.g., if it is stale) can still be accessed by name,
+    with a warning, though they are not listed until the index is regenerated:
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     (Path(d) / "tasks").mkdir()
+        ...     _ = (Path(d) / "tasks" / "new.yaml").write_text("new")
+        ...     registry = LazyRegistry("tasks", loader, names=[], root=Path(d))
+        ...     print("new" in registry, registry["new"], list(registry))
+        True {'text': 'new'} []
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        loader: Callable[[Path], dict[str, Any]],
+        names: list[str] | None = None,
+        root: Path | None = None,
+    ):
+        self.kind = kind
+        self.loader = loader
+        self.root = Path(package_files) if root is None else root
+        self._names = dict.fromkeys(read_index(kind) if names is None else names)
+        self._loaded = {}
+
+    def _unindexed_path(self, name: str) -> Path | None:
+        if not isinstance(name, str):
+            return None
+        fp = entry_path(self.kind, name, root=self.root)
+        if fp is None or not fp.is_file():
+            return None
+        logger.warning(
+            f"{self.kind} entry {name} is not in the registry index; "
+            "run `python -m MEDS_DEV.registry` to regenerate it."
+        )
+        return fp
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._names or self._unindexed_path(name) is not None
+
+    def __getitem__(self, name: str) -> dict[str, Any]:
+        if name not in self._loaded:
+            if name in self._names:
+                fp = entry_path(self.kind, name, root=self.root)
+            elif (fp := self._unindexed_path(name)) is None:
+                raise KeyError(name)
+            self._loaded[name] = self.loader(fp)
+        return self._loaded[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._names)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def keys(self) -> KeysView[str]:
+        return self._names.keys()
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.kind}, {len(self._loaded)}/{len(self)} loaded)"
+
+
+def write_index(fp: Path | None = None) -> dict[str, list[str]]:
+    """Rebuilds the registry index from the package's contents and writes it to disk.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     index = write_index(Path(d) / "index.json")
+        ...     json.loads((Path(d) / "index.json").read_text()) == index == build_index()
+        True
+    """
+    fp = Path(INDEX_FP) if fp is None else fp
+    index = build_index()
+    fp.write_text(json.dumps(index, indent=2) + "\n")
+    return index
+
+
+if __name__ == "__main__":  # pragma: no cover
+    write_index()
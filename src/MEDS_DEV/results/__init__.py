@@ -300,8 +300,12 @@ class Result:
         return cls(**as_dict)
 
 
+# The maximum size of a packaged result file, in KB.
+MAX_SIZE_KB = 1.5
+
 PACK_YAML = files("MEDS_DEV.configs") / "_package_result.yaml"
 VALIDATE_YAML = files("MEDS_DEV.configs") / "_validate_result.yaml"
+WAREHOUSE_YAML = files("MEDS_DEV.configs") / "_results_warehouse.yaml"
 
 
-__all__ = ["PACK_YAML", "VALIDATE_YAML", "Result"]
+__all__ = ["MAX_SIZE_KB", "PACK_YAML", "VALIDATE_YAML", "WAREHOUSE_YAML", "Result"]
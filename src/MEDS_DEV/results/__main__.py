@@ -4,14 +4,15 @@ from datetime import UTC, datetime
 from pathlib import Path
 
 import hydra
+import polars as pl
 from omegaconf import DictConfig
 
-from . import PACK_YAML, VALIDATE_YAML, Result
+from . import MAX_SIZE_KB, PACK_YAML, VALIDATE_YAML, WAREHOUSE_YAML, Result
+from .validation import expand_result_paths, validate_result_files
+from .warehouse import ResultsWarehouse
 
 logger = logging.getLogger(__name__)
 
-MAX_SIZE_KB = 1.5
-
 
 @hydra.main(version_base=None, config_path=str(PACK_YAML.parent), config_name=PACK_YAML.stem)
 def pack_result(cfg: DictConfig):
@@ -40,7 +41,15 @@ def pack_result(cfg: DictConfig):
     config_name=VALIDATE_YAML.stem,
 )
 def validate_result(cfg: DictConfig):
-    """Package the result of a MEDS-DEV experiment."""
+    """Validate one packaged MEDS-DEV result, or all of those in a directory or matching a glob."""
+
+    if cfg.get("results") is not None:
+        if cfg.get("result_fp") is not None:
+            raise ValueError("Set only one of result_fp and results.")
+        validate_results(cfg)
+        return
+    if cfg.get("result_fp") is None:
+        raise ValueError("Set either result_fp (to validate one result) or results (to validate many).")
 
     result_fp = Path(cfg.result_fp)
 
@@ -56,3 +65,51 @@ def validate_result(cfg: DictConfig):
         Result.from_json(result_fp)
     except Exception as e:
         raise ValueError("Result should be packaged and decodable") from e
+
+
+def validate_results(cfg: DictConfig):
+    """Validates every result file in `cfg.results` in one pass and reports on all of them.
+
+    The JSON report is written to `cfg.report_fp`, or printed if that is not set. An error is raised after the
+    report is written if any file is invalid.
+    """
+
+    report = validate_result_files(expand_result_paths(cfg.results), n_workers=cfg.n_workers)
+    report_json = json.dumps(report.to_dict(), indent=2)
+    if cfg.get("report_fp") is None:
+        print(report_json)
+    else:
+        report_fp = Path(cfg.report_fp)
+        report_fp.parent.mkdir(parents=True, exist_ok=True)
+        report_fp.write_text(report_json)
+
+    if report.invalid:
+        raise ValueError(str(report))
+    logger.info(str(report))
+
+
+@hydra.main(version_base=None, config_path=str(WAREHOUSE_YAML.parent), config_name=WAREHOUSE_YAML.stem)
+def results_warehouse(cfg: DictConfig):
+    """Ingest results into the results warehouse and query their leaderboards."""
+
+    with ResultsWarehouse(cfg.warehouse_dir) as warehouse:
+        if cfg.results_dir is not None:
+            report = warehouse.ingest(cfg.results_dir, n_workers=cfg.n_workers, prune=cfg.prune)
+            logger.info(str(report))
+
+        if cfg.leaderboard.task is not None:
+            leaderboard = warehouse.leaderboard(
+                cfg.leaderboard.task,
+                metric=cfg.leaderboard.metric,
+                dataset=cfg.leaderboard.dataset,
+                version=cfg.leaderboard.version,
+                descending=cfg.leaderboard.descending,
+            )
+            if cfg.leaderboard.output_fp is None:
+                with pl.Config(tbl_rows=-1, tbl_width_chars=250, fmt_str_lengths=100):
+                    print(leaderboard)
+            else:
+                output_fp = Path(cfg.leaderboard.output_fp)
+                output_fp.parent.mkdir(parents=True, exist_ok=True)
+                leaderboard.write_json(output_fp)
+                logger.info(f"Wrote the leaderboard of {len(leaderboard)} results to {output_fp}")
@@ -0,0 +1,150 @@
+"""Validation of many packaged MEDS-DEV results at once.
+
+`meds-dev-validate-result` checks one result file per invocation, which is dominated by interpreter and
+registry start-up when checking a directory of thousands of results. This module validates a whole directory
+(or glob) in one process, or in a pool of processes, each of which loads the dataset, task, and model
+registries only once, and collects a single machine-readable report.
+"""
+
+import dataclasses
+import glob
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+from .warehouse import read_result_record
+
+logger = logging.getLogger(__name__)
+
+
+def expand_result_paths(results: Path | str) -> list[Path]:
+    """Returns the result JSON files under a directory (recursively), or matching a glob pattern, sorted.
+
+    Hidden files (whose names start with `.`) under a directory are skipped.
+
+    Raises:
+        FileNotFoundError: If no files match.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     for name in ("a.json", "b/c.json", "b/.hidden.json", "b/d.txt"):
+        ...         (Path(d) / name).parent.mkdir(parents=True, exist_ok=True)
+        ...         (Path(d) / name).touch()
+        ...     print([str(fp.relative_to(d)) for fp in expand_result_paths(d)])
+        ...     print([str(fp.relative_to(d)) for fp in expand_result_paths(f"{d}/b/*")])
+        ['a.json', 'b/c.json']
+        ['b/c.json', 'b/d.txt']
+        >>> expand_result_paths("/nonexistent/*.json")
+        Traceback (most recent call last):
+            ...
+        FileNotFoundError: No result files found matching /nonexistent/*.json
+    """
+    results = Path(results)
+    if results.is_dir():
+        fps = (fp for fp in results.rglob("*.json") if not fp.name.startswith("."))
+    else:
+        fps = (Path(fp) for fp in glob.glob(str(results), recursive=True))
+    fps = sorted(fp for fp in fps if fp.is_file())
+    if not fps:
+        raise FileNotFoundError(f"No result files found matching {results}")
+    return fps
+
+
+@dataclasses.dataclass
+class ValidationReport:
+    """The outcome of validating a batch of result files.
+
+    Attributes:
+        files: One entry per file, in input order, with its `path`, whether it is `valid`, and its validation
+            `error` if it is not, or the result's `dataset`, `task`, `model`, and `version` if it is.
+
+    Examples:
+        >>> report = ValidationReport([
+        ...     {"path": "a.json", "valid": True, "error": None},
+        ...     {"path": "b.json", "valid": False, "error": "Could not read result: KeyError('task')"},
+        ... ])
+        >>> print(report)
+        1 of 2 result files are invalid:
+          b.json: Could not read result: KeyError('task')
+        >>> report.to_dict()["n_valid"]
+        1
+    """
+
+    files: list[dict[str, Any]]
+
+    @property
+    def invalid(self) -> list[dict[str, Any]]:
+        return [f for f in self.files if not f["valid"]]
+
+    def to_dict(self) -> dict[str, Any]:
+        n_invalid = len(self.invalid)
+        return {
+            "n_files": len(self.files),
+            "n_valid": len(self.files) - n_invalid,
+            "n_invalid": n_invalid,
+            "files": self.files,
+        }
+
+    def __str__(self) -> str:
+        if not self.invalid:
+            return f"All {len(self.files)} result files are valid."
+        lines = [f"{len(self.invalid)} of {len(self.files)} result files are invalid:"]
+        lines.extend(f"  {f['path']}: {f['error']}" for f in self.invalid)
+        return "\n".join(lines)
+
+
+def _report_entry(fp: str, record: dict[str, Any] | None, error: str | None) -> dict[str, Any]:
+    entry = {"path": fp, "valid": error is None, "error": error}
+    if record is not None:
+        entry.update({k: record[k] for k in ("dataset", "task", "model", "version")})
+    return entry
+
+
+def validate_result_files(fps: list[Path | str], n_workers: int = 1) -> ValidationReport:
+    """Validates result files, in parallel across `n_workers` processes if more than one.
+
+    Each file is checked against the size limit, decoded, and validated as a `Result` (which, for results of
+    the current MEDS-DEV version, checks the dataset, task, and model names against the registries).
+
+    Examples:
+        >>> import datetime, json, tempfile
+        >>> from MEDS_DEV.results import Result
+        >>> result = Result(
+        ...     dataset="MIMIC-IV", task="mortality/in_icu/first_24h", model="random_predictor",
+        ...     timestamp=datetime.datetime(2021, 9, 1, 12), result={"auc": 0.5},
+        ... )
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     result.to_json(Path(d) / "good.json")
+        ...     unknown_model = {**dataclasses.asdict(result), "model": "not_a_model"}
+        ...     _ = (Path(d) / "unknown_model.json").write_text(json.dumps(unknown_model, default=str))
+        ...     _ = (Path(d) / "empty.json").write_text("")
+        ...     _ = (Path(d) / "large.json").write_text(" " * 2048)
+        ...     report = validate_result_files(expand_result_paths(d))
+        >>> for entry in report.files:
+        ...     print(Path(entry["path"]).name, entry["valid"], entry.get("model"))
+        empty.json False None
+        good.json True random_predictor
+        large.json False None
+        unknown_model.json False None
+        >>> for entry in report.invalid:
+        ...     print(entry["error"].split(". ")[0])
+        Could not read result: JSONDecodeError('Expecting value: line 1 column 1 (char 0)')
+        Result file is too large (2.00 KB > 1.5 KB)
+        Could not read result: ValueError("Unknown model: not_a_model
+    """
+    fps = [str(fp) for fp in fps]
+    logger.info(f"Validating {len(fps)} result files with {n_workers} workers.")
+    if n_workers > 1 and len(fps) > 1:
+        # Spawn rather than fork, as forking a process that has used polars' thread pool can deadlock.
+        with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            records = list(pool.map(read_result_record, fps, chunksize=64))
+    else:
+        records = [read_result_record(fp) for fp in fps]
+
+    return ValidationReport([_report_entry(fp, record, error) for fp, _, record, error in records])
+
+
+__all__ = ["ValidationReport", "expand_result_paths", "validate_result_files"]
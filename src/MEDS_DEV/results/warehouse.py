@@ -0,0 +1,387 @@
+"""A queryable warehouse of packaged MEDS-DEV results.
+
+Packaged result JSONs (from `meds-dev-pack-result`) are ingested into a SQLite database with two tables:
+
+  - `results`: One row per result file, with its path, content hash, and the result's dataset, task, model,
+    version, and timestamp. It is indexed on `(task, dataset, model, version)`.
+  - `metrics`: One row per (result file, metric), with the evaluation output flattened into `/`-separated
+    metric names (e.g., `samples_equally_weighted/roc_auc_score`, or
+    `confidence_intervals/samples_equally_weighted/roc_auc_score/0` for the lower bound of its interval). It
+    is indexed on `(metric, value)`.
+
+Files that fail validation are recorded in an `invalid` table with their errors. Ingestion is incremental:
+every file is hashed, and only files that are new or whose hash changed since they were last ingested are
+parsed and validated, in parallel across processes if requested.
+"""
+
+import dataclasses
+import hashlib
+import logging
+import multiprocessing
+import sqlite3
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any
+
+import polars as pl
+
+from . import MAX_SIZE_KB, Result
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DB = "results.db"
+DEFAULT_METRIC = "samples_equally_weighted/roc_auc_score"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    path TEXT PRIMARY KEY,
+    file_hash TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    task TEXT NOT NULL,
+    model TEXT NOT NULL,
+    version TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_by_entry ON results (task, dataset, model, version);
+CREATE TABLE IF NOT EXISTS metrics (
+    path TEXT NOT NULL REFERENCES results (path) ON DELETE CASCADE,
+    metric TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (path, metric)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS metrics_by_name ON metrics (metric, value);
+CREATE TABLE IF NOT EXISTS invalid (
+    path TEXT PRIMARY KEY,
+    file_hash TEXT NOT NULL,
+    error TEXT NOT NULL
+);
+"""
+
+
+def flatten_metrics(result: dict[str, Any], prefix: str = "") -> dict[str, float | None]:
+    """Flattens a nested evaluation output into `/`-separated metric names and numeric (or null) values.
+
+    Lists are flattened by index, and non-numeric leaves (e.g., strings) are dropped.
+
+    Examples:
+        >>> flat = flatten_metrics({
+        ...     "samples_equally_weighted": {"roc_auc_score": 0.7, "f1_score": None},
+        ...     "confidence_intervals": {
+        ...         "n_bootstrap": 1000, "samples_equally_weighted": {"roc_auc_score": [0.6, 0.8]}
+        ...     },
+        ...     "note": "dropped",
+        ... })
+        >>> for name, value in flat.items():
+        ...     print(name, value)
+        samples_equally_weighted/roc_auc_score 0.7
+        samples_equally_weighted/f1_score None
+        confidence_intervals/n_bootstrap 1000.0
+        confidence_intervals/samples_equally_weighted/roc_auc_score/0 0.6
+        confidence_intervals/samples_equally_weighted/roc_auc_score/1 0.8
+    """
+    out = {}
+    items = result.items() if isinstance(result, dict) else enumerate(result)
+    for key, value in items:
+        name = f"{prefix}{key}"
+        if isinstance(value, dict | list):
+            out.update(flatten_metrics(value, prefix=f"{name}/"))
+        elif value is None:
+            out[name] = None
+        elif isinstance(value, int | float) and not isinstance(value, bool):
+            out[name] = float(value)
+    return out
+
+
+@contextmanager
+def _quiet(logger_name: str) -> Iterator[None]:
+    result_logger = logging.getLogger(logger_name)
+    level = result_logger.level
+    result_logger.setLevel(logging.ERROR)
+    try:
+        yield
+    finally:
+        result_logger.setLevel(level)
+
+
+def read_result_record(
+    fp: str, known_hash: str | None = None
+) -> tuple[str, str, dict[str, Any] | None, str | None]:
+    """Hashes a result file and, unless its hash is `known_hash`, parses and validates it.
+
+    Version mismatch warnings are not logged, as the warehouse is expected to hold historical results.
+
+    Args:
+        fp: The path of the result JSON file.
+        known_hash: The file's hash when it was last ingested, if it was.
+
+    Returns:
+        A tuple of the path, the file's hash, the result record (or None if the file is unchanged or
+        invalid), and the validation error (or None if the file is unchanged or valid).
+
+    Examples:
+        >>> import datetime, tempfile
+        >>> result = Result(
+        ...     dataset="MIMIC-IV", task="mortality/in_icu/first_24h", model="random_predictor",
+        ...     timestamp=datetime.datetime(2021, 9, 1, 12), result={"auc": 0.5}, version="0.0.1",
+        ... )
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     result.to_json(Path(d) / "result.json")
+        ...     _ = (Path(d) / "bad.json").write_text("{}")
+        ...     fp, file_hash, record, error = read_result_record(str(Path(d) / "result.json"))
+        ...     print(record["dataset"], record["timestamp"], record["metrics"], error)
+        ...     print(read_result_record(str(Path(d) / "result.json"), known_hash=file_hash)[2:])
+        ...     print(read_result_record(str(Path(d) / "bad.json"))[2:])
+        MIMIC-IV 2021-09-01T12:00:00 {'auc': 0.5} None
+        (None, None)
+        (None, "Could not read result: KeyError('timestamp')")
+    """
+    content = Path(fp).read_bytes()
+    file_hash = hashlib.sha256(content).hexdigest()
+    if file_hash == known_hash:
+        return fp, file_hash, None, None
+
+    size_kb = len(content) / 1024
+    if size_kb > MAX_SIZE_KB:
+        return fp, file_hash, None, f"Result file is too large ({size_kb:.2f} KB > {MAX_SIZE_KB} KB)"
+
+    try:
+        with _quiet("MEDS_DEV.results"):
+            result = Result.from_json(fp)
+    except Exception as e:
+        # `Result.from_json` wraps JSON decoding errors, so report the underlying error where there is one.
+        return fp, file_hash, None, f"Could not read result: {e.__cause__ or e!r}"
+
+    record = {
+        "dataset": result.dataset,
+        "task": result.task,
+        "model": result.model,
+        "version": result.version,
+        "timestamp": result.timestamp.isoformat(),
+        "metrics": flatten_metrics(result.result),
+    }
+    return fp, file_hash, record, None
+
+
+@dataclasses.dataclass
+class IngestionReport:
+    """A summary of one ingestion into the warehouse.
+
+    Examples:
+        >>> print(IngestionReport(added=3, updated=1, unchanged=10, invalid=["a.json"], removed=2))
+        Ingested 15 result files (3 added, 1 updated, 10 unchanged, 1 invalid); removed 2 stale results.
+    """
+
+    added: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    invalid: list[str] = dataclasses.field(default_factory=list)
+    removed: int = 0
+
+    def __str__(self) -> str:
+        n_files = self.added + self.updated + self.unchanged + len(self.invalid)
+        return (
+            f"Ingested {n_files} result files ({self.added} added, {self.updated} updated, "
+            f"{self.unchanged} unchanged, {len(self.invalid)} invalid); removed {self.removed} stale results."
+        )
+
+
+class ResultsWarehouse:
+    """A SQLite warehouse of MEDS-DEV results, supporting incremental ingestion and leaderboard queries.
+
+    Args:
+        warehouse_dir: The directory of the warehouse; the database is `warehouse_dir/results.db`.
+
+    Examples:
+        >>> import datetime, tempfile
+        >>> def write(root, name, dataset, model, auc, day=1):
+        ...     Result(
+        ...         dataset=dataset, task="mortality/in_icu/first_24h", model=model,
+        ...         timestamp=datetime.datetime(2024, 1, day), version="0.0.1",
+        ...         result={"samples_equally_weighted": {"roc_auc_score": auc, "brier_score": 1 - auc}},
+        ...     ).to_json(root / f"{name}.json", do_overwrite=True)
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     root = Path(d) / "results"
+        ...     write(root, "a", "MIMIC-IV", "random_predictor", 0.5)
+        ...     write(root, "b", "MIMIC-IV", "meds_tab/tiny", 0.75)
+        ...     write(root, "c", "eICU", "meds_tab/tiny", 0.7)
+        ...     _ = (root / "bad.json").write_text("not JSON")
+        ...     with ResultsWarehouse(Path(d) / "warehouse") as warehouse:
+        ...         print(warehouse.ingest(root))
+        ...         print(warehouse.ingest(root))
+        ...         write(root, "a", "MIMIC-IV", "random_predictor", 0.55)
+        ...         write(root, "d", "MIMIC-IV", "random_predictor", 0.6, day=2)
+        ...         (root / "c.json").unlink()
+        ...         print(warehouse.ingest(root, n_workers=2, prune=True))
+        ...         leaderboard = warehouse.leaderboard("mortality/in_icu/first_24h")
+        ...         brier = warehouse.leaderboard(
+        ...             "mortality/in_icu/first_24h", metric="samples_equally_weighted/brier_score",
+        ...             descending=False,
+        ...         )
+        ...         invalid = warehouse.query("SELECT path, error FROM invalid")
+        Ingested 4 result files (3 added, 0 updated, 0 unchanged, 1 invalid); removed 0 stale results.
+        Ingested 4 result files (0 added, 0 updated, 4 unchanged, 0 invalid); removed 0 stale results.
+        Ingested 4 result files (1 added, 1 updated, 2 unchanged, 0 invalid); removed 1 stale results.
+
+    Leaderboards hold the latest result of each model on each dataset, best first:
+        >>> leaderboard.drop("timestamp")
+        shape: (2, 5)
+        ┌──────────┬────────────────────────────┬──────────────────┬─────────┬───────┐
+        │ dataset  ┆ task                       ┆ model            ┆ version ┆ value │
+        │ ---      ┆ ---                        ┆ ---              ┆ ---     ┆ ---   │
+        │ str      ┆ str                        ┆ str              ┆ str     ┆ f64   │
+        ╞══════════╪════════════════════════════╪══════════════════╪═════════╪═══════╡
+        │ MIMIC-IV ┆ mortality/in_icu/first_24h ┆ meds_tab/tiny    ┆ 0.0.1   ┆ 0.75  │
+        │ MIMIC-IV ┆ mortality/in_icu/first_24h ┆ random_predictor ┆ 0.0.1   ┆ 0.6   │
+        └──────────┴────────────────────────────┴──────────────────┴─────────┴───────┘
+        >>> brier["model"].to_list(), brier["value"].round(2).to_list()
+        (['meds_tab/tiny', 'random_predictor'], [0.25, 0.4])
+
+    Invalid files are recorded with their errors (and are not re-validated until they change):
+        >>> for path, error in invalid.iter_rows():
+        ...     print(Path(path).name, error.split("(")[0])
+        bad.json Could not read result: JSONDecodeError
+    """
+
+    def __init__(self, warehouse_dir: Path | str):
+        self.warehouse_dir = Path(warehouse_dir)
+        self.warehouse_dir.mkdir(parents=True, exist_ok=True)
+        self.db_fp = self.warehouse_dir / RESULTS_DB
+        self.conn = sqlite3.connect(self.db_fp)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self) -> "ResultsWarehouse":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def ingest(self, results_dir: Path | str, n_workers: int = 1, prune: bool = False) -> IngestionReport:
+        """Ingests all result JSON files under a directory, recursively, skipping unchanged files.
+
+        Args:
+            results_dir: The directory to ingest results from.
+            n_workers: The number of processes to hash, parse, and validate files in.
+            prune: Whether to remove results that were ingested from `results_dir` but no longer exist.
+
+        Returns:
+            A summary of the ingestion.
+        """
+        results_dir = Path(results_dir).resolve()
+        fps = sorted(str(fp) for fp in results_dir.rglob("*.json") if not fp.name.startswith("."))
+
+        known = dict(self.conn.execute("SELECT path, file_hash FROM results"))
+        known_invalid = dict(self.conn.execute("SELECT path, file_hash FROM invalid"))
+        tasks = [(fp, known.get(fp, known_invalid.get(fp))) for fp in fps]
+
+        logger.info(f"Ingesting {len(fps)} result files from {results_dir} with {n_workers} workers.")
+        if n_workers > 1 and len(tasks) > 1:
+            # Spawn rather than fork, as forking a process that has used polars' thread pool can deadlock.
+            with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                records = list(pool.map(read_result_record, *zip(*tasks, strict=True), chunksize=64))
+        else:
+            records = [read_result_record(fp, known_hash) for fp, known_hash in tasks]
+
+        report = IngestionReport()
+        with self.conn:
+            for fp, file_hash, record, error in records:
+                if record is None and error is None:
+                    report.unchanged += 1
+                    continue
+
+                self.conn.execute("DELETE FROM results WHERE path = ?", (fp,))
+                self.conn.execute("DELETE FROM invalid WHERE path = ?", (fp,))
+                if error is not None:
+                    logger.warning(f"Skipping invalid result {fp}: {error}")
+                    self.conn.execute("INSERT INTO invalid VALUES (?, ?, ?)", (fp, file_hash, error))
+                    report.invalid.append(fp)
+                    continue
+
+                if fp in known:
+                    report.updated += 1
+                else:
+                    report.added += 1
+                self.conn.execute(
+                    "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        fp,
+                        file_hash,
+                        *(record[k] for k in ("dataset", "task", "model", "version", "timestamp")),
+                    ),
+                )
+                self.conn.executemany(
+                    "INSERT INTO metrics VALUES (?, ?, ?)",
+                    ((fp, metric, value) for metric, value in record["metrics"].items()),
+                )
+
+            if prune:
+                seen = set(fps)
+                prefix = f"{results_dir}/"
+                for table in ("results", "invalid"):
+                    stale = [
+                        (fp,)
+                        for (fp,) in self.conn.execute(f"SELECT path FROM {table}")
+                        if fp.startswith(prefix) and fp not in seen
+                    ]
+                    self.conn.executemany(f"DELETE FROM {table} WHERE path = ?", stale)
+                    if table == "results":
+                        report.removed = len(stale)
+
+        return report
+
+    def query(self, sql: str, params: tuple | dict = ()) -> pl.DataFrame:
+        """Runs a SQL query against the warehouse, returning the result as a DataFrame."""
+        cursor = self.conn.execute(sql, params)
+        columns = [c[0] for c in cursor.description]
+        return pl.DataFrame(cursor.fetchall(), schema=columns, orient="row")
+
+    def leaderboard(
+        self,
+        task: str,
+        metric: str = DEFAULT_METRIC,
+        dataset: str | None = None,
+        version: str | None = None,
+        descending: bool = True,
+    ) -> pl.DataFrame:
+        """Returns the latest result of each model on each dataset for a task, ranked by a metric.
+
+        Args:
+            task: The task.
+            metric: The flattened name of the metric to rank by.
+            dataset: If set, only results on this dataset are included.
+            version: If set, only results from this MEDS-DEV version are included.
+            descending: Whether higher values of the metric are better.
+
+        Returns:
+            The dataset, task, model, version, timestamp, and metric value of the latest result of each model
+            on each dataset, sorted by dataset and then from the best to the worst value.
+        """
+        filters = ["task = :task"]
+        if dataset is not None:
+            filters.append("dataset = :dataset")
+        if version is not None:
+            filters.append("version = :version")
+
+        sql = f"""
+            WITH latest AS (
+                SELECT *, ROW_NUMBER() OVER (
+                    PARTITION BY dataset, model ORDER BY timestamp DESC
+                ) AS recency
+                FROM results
+                WHERE {" AND ".join(filters)}
+            )
+            SELECT latest.dataset, latest.task, latest.model, latest.version, latest.timestamp, metrics.value
+            FROM latest JOIN metrics ON metrics.path = latest.path AND metrics.metric = :metric
+            WHERE latest.recency = 1
+            ORDER BY latest.dataset, metrics.value {"DESC" if descending else "ASC"}
+        """
+        params = {"task": task, "metric": metric, "dataset": dataset, "version": version}
+        return self.query(sql, params)
+
+
+__all__ = ["DEFAULT_METRIC", "IngestionReport", "ResultsWarehouse", "flatten_metrics"]
@@ -0,0 +1,298 @@
+"""A content-addressed cache for the outputs of MEDS-DEV pipeline stages.
+
+Each stage (building a dataset, extracting a task, running a model command, evaluating predictions) is keyed
+by a hash of its command, fingerprints of its inputs (dataset files, task and predicates configs, labels,
+requirements, ...), and the versions of the packages that run it. Paths in the command are replaced by named
+placeholders before hashing, so the same stage run into a different output directory, or over a copy of the
+same inputs elsewhere on disk, has the same key.
+
+After a stage runs, its outputs are stored in the cache under that key; a later run with the same key
+materializes them into its output directory by hard-linking (or, across file systems, symlinking) the cached
+files, instead of re-running the stage. Stage output directories record the key they were produced with in a
+`.cache_key` file, so a stage whose inputs changed is re-run even if its output directory is marked done.
+
+Hidden files and directories (e.g., `.logs`, `.venv`, `.done`) are never fingerprinted, stored, or removed,
+and `cmd.sh` scripts are not stored, as they contain the original paths. Because cached files are shared by
+hard link, stages must write new files rather than modify existing outputs in place.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from collections.abc import Callable, Iterator
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY_FILE = ".cache_key"
+RESOURCES_FILE = ".resources.json"
+PACKAGES = ("MEDS_DEV", "meds", "es-aces", "meds-evaluation")
+UNCACHED_FILES = {"cmd.sh"}
+
+
+def _is_hidden(rel_path: Path) -> bool:
+    return any(part.startswith(".") for part in rel_path.parts)
+
+
+def _output_files(root: Path) -> Iterator[Path]:
+    """Yields the (relative) paths of the non-hidden files under `root`, in sorted order.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     root = Path(d)
+        ...     for fp in ["a.parquet", "train/0.parquet", ".done", ".logs/x.log", "cmd.sh"]:
+        ...         (root / fp).parent.mkdir(parents=True, exist_ok=True)
+        ...         (root / fp).touch()
+        ...     [str(fp) for fp in _output_files(root)]
+        ['a.parquet', 'cmd.sh', 'train/0.parquet']
+    """
+    for fp in sorted(root.rglob("*")):
+        rel = fp.relative_to(root)
+        if fp.is_file() and not _is_hidden(rel):
+            yield rel
+
+
+def fingerprint(path: Path | str) -> str:
+    """Returns a fingerprint of a file or directory, for use in stage cache keys.
+
+    Files are fingerprinted by the hash of their contents. Directories, which may be very large (e.g., MEDS
+    datasets), are fingerprinted by the relative path, size, and modification time of each non-hidden file
+    within them. Materializing a directory from the cache preserves these (hard links share them with the
+    cached copy), so a stage that consumes cached outputs of another stage keeps a stable key.
+
+    Args:
+        path: The file or directory to fingerprint.
+
+    Returns:
+        A hex digest fingerprinting the path.
+
+    Raises:
+        FileNotFoundError: If the path does not exist.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     fp = Path(d) / "task.yaml"
+        ...     _ = fp.write_text("foo")
+        ...     print(fingerprint(fp) == hashlib.sha256(b"foo").hexdigest())
+        ...     dir_fingerprint = fingerprint(d)
+        ...     (Path(d) / ".done").touch()
+        ...     print(fingerprint(d) == dir_fingerprint)
+        ...     _ = fp.write_text("foobar")
+        ...     print(fingerprint(d) == dir_fingerprint)
+        True
+        True
+        False
+        >>> fingerprint("/not/a/real/path")
+        Traceback (most recent call last):
+            ...
+        FileNotFoundError: Cannot fingerprint missing path /not/a/real/path
+    """
+    path = Path(path)
+    if path.is_file():
+        with open(path, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+    if not path.is_dir():
+        raise FileNotFoundError(f"Cannot fingerprint missing path {path}")
+
+    hash_func = hashlib.sha256()
+    for rel in _output_files(path):
+        stat = (path / rel).stat()
+        hash_func.update(f"{rel.as_posix()}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+    return hash_func.hexdigest()
+
+
+def package_versions() -> dict[str, str | None]:
+    """Returns the installed versions of the packages that stage outputs depend on."""
+    out = {}
+    for package in PACKAGES:
+        try:
+            out[package] = version(package)
+        except PackageNotFoundError:  # pragma: no cover
+            out[package] = None
+    return out
+
+
+def mask_paths(cmd: str, paths: dict[str, Path | str]) -> str:
+    """Replaces the given paths (as written and as resolved) in a command with named placeholders.
+
+    Longer paths are replaced first, so nested paths are masked by their most specific name.
+
+    Examples:
+        >>> mask_paths(
+        ...     "train data=/data/MIMIC labels=/data/MIMIC/labels out=/out",
+        ...     {"dataset_dir": "/data/MIMIC", "labels_dir": "/data/MIMIC/labels", "output_dir": "/out"},
+        ... )
+        'train data={dataset_dir} labels={labels_dir} out={output_dir}'
+    """
+    forms = {}
+    for name, path in paths.items():
+        for form in (str(path), str(Path(path).resolve())):
+            forms.setdefault(form, name)
+    for form in sorted(forms, key=len, reverse=True):
+        cmd = cmd.replace(form, f"{{{forms[form]}}}")
+    return cmd
+
+
+def stage_key(
+    cmd: str,
+    output_dir: Path | str,
+    inputs: dict[str, Path | str | None] | None = None,
+    masks: dict[str, Path | str | None] | None = None,
+) -> str:
+    """Computes the cache key of a stage.
+
+    Args:
+        cmd: The command the stage runs.
+        output_dir: The stage's output directory. It is masked in the command, so it does not affect the key.
+        inputs: Named input files or directories of the stage. They are masked in the command and their
+            fingerprints are part of the key. `None` values are ignored.
+        masks: Other named paths (e.g., temporary directories) to mask in the command without fingerprinting.
+            `None` values are ignored.
+
+    Returns:
+        The hex digest cache key.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     labels_dir = Path(d) / "labels"
+        ...     labels_dir.mkdir()
+        ...     _ = (labels_dir / "0.parquet").write_text("labels")
+        ...     out_1, out_2 = Path(d) / "out_1", Path(d) / "out_2"
+        ...     def key(out_dir):
+        ...         cmd = f"predict labels={labels_dir} out={out_dir}"
+        ...         return stage_key(cmd, out_dir, inputs={"labels": labels_dir})
+        ...     key_1 = key(out_1)
+        ...     print(key_1 == key(out_2))
+        ...     _ = (labels_dir / "1.parquet").write_text("more labels")
+        ...     print(key_1 == key(out_2))
+        True
+        False
+    """
+    inputs = {k: v for k, v in (inputs or {}).items() if v is not None}
+    masks = {k: v for k, v in (masks or {}).items() if v is not None}
+
+    payload = {
+        "cmd": mask_paths(cmd, {"output_dir": output_dir, **masks, **inputs}),
+        "inputs": {name: fingerprint(path) for name, path in inputs.items()},
+        "packages": package_versions(),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _link_tree(src: Path, dst: Path, fallback: Callable[[Path, Path], Any]):
+    for rel in _output_files(src):
+        if rel.name in UNCACHED_FILES:
+            continue
+        dst_fp = dst / rel
+        dst_fp.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(src / rel, dst_fp)
+        except OSError:
+            fallback(src / rel, dst_fp)
+
+
+def _symlink(src: Path, dst: Path):
+    dst.symlink_to(src.resolve())
+
+
+def _clear_outputs(output_dir: Path):
+    """Removes the (non-hidden) outputs and the completion and run records of a stage output directory."""
+    for child in output_dir.iterdir():
+        if child.name in {".done", CACHE_KEY_FILE, RESOURCES_FILE}:
+            child.unlink()
+        elif child.name.startswith("."):
+            continue
+        elif child.is_dir() and not child.is_symlink():
+            shutil.rmtree(child)
+        else:
+            child.unlink()
+
+
+def run_cached(
+    run_fn: Callable[[], Any], output_dir: Path | str, key: str, cache_dir: Path | str
+) -> Any | None:
+    """Runs a stage through the stage cache.
+
+    If `output_dir` is already marked done with the same cache key, nothing happens. Otherwise, any stale
+    outputs are removed and the stage's outputs are either materialized from the cache (if present) or
+    produced by `run_fn` and then stored in the cache.
+
+    Args:
+        run_fn: A function that runs the stage, writing its outputs to `output_dir` and marking it done.
+        output_dir: The stage's output directory.
+        key: The stage's cache key, from `stage_key`.
+        cache_dir: The root directory of the stage cache.
+
+    Returns:
+        The return value of `run_fn`, or `None` if the stage was not run.
+
+    Examples:
+        >>> import tempfile
+        >>> def make_run_fn(output_dir, content):
+        ...     def run_fn():
+        ...         print("Running!")
+        ...         _ = (output_dir / "out.txt").write_text(content)
+        ...         (output_dir / ".done").touch()
+        ...     return run_fn
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     cache_dir, out_1, out_2 = Path(d) / "cache", Path(d) / "out_1", Path(d) / "out_2"
+        ...     out_1.mkdir()
+        ...     out_2.mkdir()
+        ...     run_cached(make_run_fn(out_1, "foo"), out_1, "key_1", cache_dir)
+        ...     run_cached(make_run_fn(out_1, "foo"), out_1, "key_1", cache_dir)  # Already done.
+        ...     run_cached(make_run_fn(out_2, "foo"), out_2, "key_1", cache_dir)  # Materialized.
+        ...     print((out_2 / "out.txt").read_text(), (out_2 / ".done").is_file())
+        ...     run_cached(make_run_fn(out_2, "bar"), out_2, "key_2", cache_dir)  # Inputs changed.
+        ...     print((out_2 / "out.txt").read_text(), (out_1 / "out.txt").read_text())
+        Running!
+        foo True
+        Running!
+        bar foo
+    """
+    output_dir = Path(output_dir)
+    cache_dir = Path(cache_dir)
+    entry_dir = cache_dir / key[:2] / key
+
+    done_fp = output_dir / ".done"
+    key_fp = output_dir / CACHE_KEY_FILE
+
+    if done_fp.is_file() and key_fp.is_file() and key_fp.read_text() == key:
+        logger.info(f"Skipping stage in {output_dir}: outputs are up to date (cache key {key[:12]}).")
+        return None
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if done_fp.is_file() or key_fp.is_file():
+        logger.info(f"Outputs in {output_dir} are stale; re-running stage.")
+    _clear_outputs(output_dir)
+
+    if entry_dir.is_dir():
+        logger.info(f"Materializing stage outputs in {output_dir} from cache entry {entry_dir}.")
+        _link_tree(entry_dir, output_dir, _symlink)
+        done_fp.touch()
+        key_fp.write_text(key)
+        return None
+
+    out = run_fn()
+
+    tmp_dir = cache_dir / f".tmp.{key}.{os.getpid()}"
+    if tmp_dir.exists():  # pragma: no cover
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+    _link_tree(output_dir, tmp_dir, shutil.copy2)
+    entry_dir.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        tmp_dir.rename(entry_dir)
+        logger.info(f"Stored stage outputs from {output_dir} in cache entry {entry_dir}.")
+    except OSError:  # pragma: no cover
+        # Another process stored the same stage concurrently; its entry is equivalent.
+        shutil.rmtree(tmp_dir)
+
+    key_fp.write_text(key)
+    return out
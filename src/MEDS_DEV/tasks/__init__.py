@@ -1,9 +1,13 @@
 import dataclasses
+from fnmatch import fnmatchcase
 from importlib.resources import files
+from pathlib import Path
+from typing import Any
 
 from omegaconf import ListConfig, OmegaConf
 
 from ..datasets import DATASETS
+from ..registry import LazyRegistry
 from ..utils import Metadata
 
 
@@ -67,20 +71,78 @@ class TaskMetadata(Metadata):
                 )
 
 
-task_files = files("MEDS_DEV.tasks")
 CFG_YAML = files("MEDS_DEV.configs") / "_extract_task.yaml"
+PREDICATES_CFG_YAML = files("MEDS_DEV.configs") / "_cache_predicates.yaml"
 ACES_CFG_YAML = files("MEDS_DEV.configs") / "_ACES_MD.yaml"
+CHECK_LABELS_CFG_YAML = files("MEDS_DEV.configs") / "_check_labels.yaml"
 
-TASKS = {}
-for path in task_files.glob("**/*.yaml"):
-    task = path.relative_to(task_files).with_suffix("").as_posix()
 
+def load_task(path: Path) -> dict[str, Any]:
+    """Loads the task whose ACES criteria file is at `path`, validating its metadata.
+
+    Examples:
+        >>> spec = load_task(TASKS.root / "tasks" / "mortality" / "in_icu" / "first_24h.yaml")
+        >>> spec["criteria_fp"].name
+        'first_24h.yaml'
+        >>> "MIMIC-IV" in spec["metadata"].supported_datasets
+        True
+    """
     cfg = OmegaConf.load(path)
     metadata = TaskMetadata(**cfg.get("metadata")) if cfg.get("metadata", None) else None
+    return {"criteria_fp": path, "metadata": metadata}
+
+
+TASKS = LazyRegistry("tasks", load_task)
+
+
+def resolve_tasks(task_spec: str | list[str]) -> list[str]:
+    """Resolves a task name, glob pattern, or list thereof into the list of matching MEDS-DEV task names.
+
+    Args:
+        task_spec: A task name (e.g., `"mortality/in_icu/first_24h"`), a glob pattern over task names (e.g.,
+            `"abnormal_lab/**"`), or a list of either.
+
+    Returns:
+        The matching task names, deduplicated, in the order they were specified (with the matches of a single
+        pattern sorted).
+
+    Raises:
+        ValueError: If a name or pattern matches no configured task.
+
+    Examples:
+        >>> resolve_tasks("mortality/in_icu/first_24h")
+        ['mortality/in_icu/first_24h']
+        >>> resolve_tasks("abnormal_lab/cbc/**") # doctest: +NORMALIZE_WHITESPACE
+        ['abnormal_lab/cbc/anemia/first_24h',
+         'abnormal_lab/cbc/leukocytosis/first_24h',
+         'abnormal_lab/cbc/thrombocytopenia/first_24h']
+        >>> resolve_tasks(["mortality/in_icu/first_24h", "*/vital/**", "mortality/**"])
+        ['mortality/in_icu/first_24h', 'abnormal_lab/vital/hypotension/first_24h']
+        >>> resolve_tasks(["mortality/in_icu/first_24h", "not_a_task"])
+        Traceback (most recent call last):
+            ...
+        ValueError: Task not_a_task not currently configured. Configured tasks: ...
+    """
+
+    if isinstance(task_spec, str):
+        task_spec = [task_spec]
+
+    tasks = {}
+    for pattern in task_spec:
+        matches = sorted(t for t in TASKS if fnmatchcase(t, pattern))
+        if not matches:
+            raise ValueError(
+                f"Task {pattern} not currently configured. Configured tasks: {', '.join(sorted(TASKS))}"
+            )
+        tasks.update(dict.fromkeys(matches))
+    return list(tasks)
 
-    TASKS[task] = {
-        "criteria_fp": path,
-        "metadata": metadata,
-    }
 
-__all__ = ["ACES_CFG_YAML", "CFG_YAML", "TASKS"]
+__all__ = [
+    "ACES_CFG_YAML",
+    "CFG_YAML",
+    "CHECK_LABELS_CFG_YAML",
+    "PREDICATES_CFG_YAML",
+    "TASKS",
+    "resolve_tasks",
+]
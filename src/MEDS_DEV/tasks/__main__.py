@@ -1,22 +1,234 @@
+import json
 import logging
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
 import hydra
-from omegaconf import DictConfig
+from aces.config import TaskExtractorConfig
+from omegaconf import DictConfig, ListConfig
 
 from .. import DATASETS
-from ..utils import run_in_env
-from . import CFG_YAML, TASKS
+from ..stage_cache import run_cached, stage_key
+from ..utils import list_shards, run_in_env
+from . import CFG_YAML, CHECK_LABELS_CFG_YAML, PREDICATES_CFG_YAML, TASKS, resolve_tasks
+from .code_index import CODE_INDEX_SUBDIR
+from .extraction import (
+    PREDICATES_CACHE_DEFS,
+    cache_shard_predicates,
+    check_cached_predicates,
+    dump_plain_predicates,
+    extract_tasks_from_shard,
+    load_dataset_plain_predicates,
+    plain_predicates_union,
+)
+from .label_checks import check_labels as check_label_set
+from .label_checks import label_issues
 
 logger = logging.getLogger(__name__)
 
 
+def extract_shards_in_parallel(aces_overrides: list[str], data_dir: Path, output_dir: Path, n_workers: int):
+    """Runs ACES over each shard of the dataset as its own process, with up to `n_workers` at once.
+
+    Shards are scheduled largest first, so that the longest-running shards do not end up at the tail of the
+    run. Each shard writes its labels to `output_dir/$SHARD.parquet` (the same layout as the sequential,
+    `--multirun` path) and keeps its logs and completion marker in `output_dir/.shards/$SHARD`, so that an
+    interrupted extraction only re-runs the shards that did not finish.
+
+    Args:
+        aces_overrides: The `aces-cli` overrides shared across all shards.
+        data_dir: The MEDS data directory to extract from.
+        output_dir: The root output directory for the labels.
+        n_workers: The maximum number of shards to extract concurrently.
+
+    Raises:
+        FileNotFoundError: If no shards are found in `data_dir`.
+        RuntimeError: If any shard fails to extract.
+    """
+    shards = list_shards(data_dir)
+    if not shards:
+        raise FileNotFoundError(f"No shards found in {data_dir}")
+
+    logger.info(f"Extracting {len(shards)} shards with {n_workers} workers.")
+
+    def extract_shard(shard: str):
+        shard_dir = output_dir / ".shards" / shard
+        cmd = " ".join(
+            [
+                "aces-cli",
+                *aces_overrides,
+                f"data.shard={shard}",
+                f"output_filepath={output_dir / shard}.parquet",
+                f"log_dir={shard_dir}/.logs",
+            ]
+        )
+        run_in_env(cmd=cmd, output_dir=shard_dir, run_as_script=False)
+        return shard
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = {shard: pool.submit(extract_shard, shard) for shard in shards}
+        for shard, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Shard {shard} failed: {e}")
+                failed.append(shard)
+
+    if failed:
+        raise RuntimeError(f"Failed to extract {len(failed)}/{len(shards)} shards: {', '.join(failed)}")
+
+
+def extract_tasks_in_one_pass(
+    task_dirs: dict[str, Path],
+    data_dir: Path,
+    dataset_predicates_path: Path | None,
+    output_dir: Path,
+    n_workers: int,
+    predicates_cache_dir: Path | None = None,
+    code_index_dir: Path | None = None,
+):
+    """Extracts several tasks at once, reading each shard of the dataset only once.
+
+    Each shard is read a single time to compute the union of the plain predicates of all tasks; each task's
+    labels are then derived from those predicates and written to `task_dirs[$TASK]/$SHARD.parquet`. If a
+    predicates cache is given, the plain predicates are read from it instead and the raw data is not read at
+    all. Shards are processed largest first in up to `n_workers` processes, and each keeps its completion
+    marker (and, while it runs, its computed predicates) in `output_dir/.shards/$SHARD`, so an interrupted
+    extraction only re-runs unfinished shards.
+
+    Args:
+        task_dirs: A dictionary mapping the names of the tasks to extract to their label directories.
+        data_dir: The MEDS data directory to extract from.
+        dataset_predicates_path: The dataset predicates file used to resolve the tasks' predicates.
+        output_dir: The root output directory, used for the per-shard completion markers.
+        n_workers: The maximum number of shards to process concurrently.
+        predicates_cache_dir: A predicates cache built by `meds-dev-predicates` for this dataset, if any.
+        code_index_dir: If set, the directory of the dataset's code index (see `MEDS_DEV.tasks.code_index`),
+            used to skip the row groups of each shard that cannot match the tasks' plain predicates.
+
+    Raises:
+        FileNotFoundError: If no shards are found in `data_dir` or the predicates cache is incomplete.
+        ValueError: If a task needs plain predicates that are not in the predicates cache.
+        RuntimeError: If any shard fails to extract.
+    """
+    task_config_fps = {task: str(TASKS[task]["criteria_fp"]) for task in task_dirs}
+    predicates_path = str(dataset_predicates_path) if dataset_predicates_path else None
+
+    if predicates_cache_dir is not None:
+        if not (predicates_cache_dir / ".done").is_file():
+            raise FileNotFoundError(f"Predicates cache {predicates_cache_dir} is missing or incomplete.")
+        logger.info(f"Reading plain predicates from cache {predicates_cache_dir}")
+        cached = load_dataset_plain_predicates(predicates_cache_dir / PREDICATES_CACHE_DEFS)
+        task_cfgs = {
+            task: TaskExtractorConfig.load(config_path=Path(fp), predicates_path=predicates_path)
+            for task, fp in task_config_fps.items()
+        }
+        check_cached_predicates(task_cfgs, cached)
+        data_dir = predicates_cache_dir
+
+    shards = list_shards(data_dir)
+    if not shards:
+        raise FileNotFoundError(f"No shards found in {data_dir}")
+
+    todo = [s for s in shards if not (output_dir / ".shards" / s / ".done").is_file()]
+    logger.info(
+        f"Extracting {len(task_dirs)} tasks from {len(todo)}/{len(shards)} shards ({n_workers} workers)."
+    )
+
+    def shard_kwargs(shard: str) -> dict:
+        code_index_fp = None
+        if predicates_cache_dir is None:
+            shard_fp = str(data_dir / f"{shard}.parquet")
+            shard_predicates_fp = str(output_dir / ".shards" / shard / "predicates.parquet")
+            if code_index_dir is not None:
+                code_index_fp = str(code_index_dir / f"{shard}.parquet")
+        else:
+            shard_fp = None
+            shard_predicates_fp = str(predicates_cache_dir / f"{shard}.parquet")
+        return {
+            "shard_fp": shard_fp,
+            "task_config_fps": task_config_fps,
+            "predicates_path": predicates_path,
+            "output_fps": {task: str(task_dir / f"{shard}.parquet") for task, task_dir in task_dirs.items()},
+            "shard_predicates_fp": shard_predicates_fp,
+            "code_index_fp": code_index_fp,
+        }
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {shard: pool.submit(extract_tasks_from_shard, **shard_kwargs(shard)) for shard in todo}
+        for shard, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Shard {shard} failed: {e}")
+                failed.append(shard)
+            else:
+                shard_dir = output_dir / ".shards" / shard
+                shard_dir.mkdir(parents=True, exist_ok=True)
+                (shard_dir / ".done").touch()
+                # The shard's predicates are only needed to derive its labels; with a single task, they would
+                # otherwise sit among the labels themselves.
+                (shard_dir / "predicates.parquet").unlink(missing_ok=True)
+
+    if failed:
+        raise RuntimeError(f"Failed to extract {len(failed)}/{len(todo)} shards: {', '.join(failed)}")
+
+    for task_dir in task_dirs.values():
+        task_dir.mkdir(parents=True, exist_ok=True)
+        (task_dir / ".done").touch()
+
+
+def extract_task(
+    aces_overrides: list[str], dataset_dir: Path, output_dir: Path, n_workers: int, do_overwrite: bool = False
+):
+    """Extracts a single task with `aces-cli`, either sequentially or with shards in parallel.
+
+    Args:
+        aces_overrides: The `aces-cli` overrides specifying the task, dataset, and predicates.
+        dataset_dir: The root directory of the MEDS dataset.
+        output_dir: The directory to write the labels to.
+        n_workers: If greater than 1, shards are extracted in parallel with this many workers.
+        do_overwrite: Whether to remove any existing outputs first.
+    """
+    if n_workers > 1:
+        if do_overwrite and output_dir.exists():
+            logger.info(f"Removing existing output directory: {output_dir}")
+            shutil.rmtree(output_dir)
+
+        done_fp = output_dir / ".done"
+        if done_fp.is_file():
+            logger.info(f"Skipping extraction because {done_fp} exists.")
+            return
+
+        extract_shards_in_parallel(aces_overrides, dataset_dir / "data", output_dir, n_workers)
+        done_fp.touch()
+        return
+
+    cmd = " ".join(
+        [
+            "aces-cli",
+            "--multirun",
+            *aces_overrides,
+            f"data.shard=$(expand_shards {dataset_dir}/data)",
+            f"output_filepath={output_dir}" + r"/\$\{data._prefix\}.parquet",
+            f"log_dir={output_dir}/.logs",
+        ]
+    )
+
+    logger.info(f"Running ACES: {cmd}")
+    run_in_env(cmd=cmd, output_dir=output_dir, do_overwrite=do_overwrite, run_as_script=False)
+
+
 @hydra.main(version_base=None, config_path=str(CFG_YAML.parent), config_name=CFG_YAML.stem)
 def main(cfg: DictConfig):
-    if cfg.task not in TASKS:
-        raise ValueError(f"Task {cfg.task} not currently configured. Configured tasks: {TASKS.keys()}")
+    if isinstance(cfg.task, ListConfig) or cfg.task not in TASKS:
+        tasks = resolve_tasks(list(cfg.task) if isinstance(cfg.task, ListConfig) else cfg.task)
+    else:
+        tasks = [cfg.task]
 
-    task_config_path = TASKS[cfg.task]["criteria_fp"]
     if cfg.get("dataset_predicates_path", None):
         logger.info(f"Using provided (local) predicates path: {cfg.dataset_predicates_path}")
         dataset_predicates_path = Path(cfg.dataset_predicates_path)
@@ -27,29 +239,200 @@ def main(cfg: DictConfig):
             )
         dataset_predicates_path = DATASETS[cfg.dataset]["predicates"]
 
+    n_workers = cfg.get("n_workers", 1)
+    output_dir = Path(cfg.output_dir)
+    predicates_cache_dir = cfg.get("predicates_cache_dir", None)
+    code_index = cfg.get("code_index", False)
+
+    if tasks != [cfg.task] or predicates_cache_dir or code_index:
+        if cfg.do_overwrite and output_dir.exists():
+            logger.info(f"Removing existing output directory: {output_dir}")
+            shutil.rmtree(output_dir)
+
+        if tasks == [cfg.task]:
+            task_dirs = {cfg.task: output_dir}
+        else:
+            task_dirs = {task: output_dir / task for task in tasks}
+
+        logger.info(f"Running tasks {', '.join(tasks)} on dataset {cfg.dataset}")
+        extract_tasks_in_one_pass(
+            task_dirs,
+            Path(cfg.dataset_dir) / "data",
+            dataset_predicates_path,
+            output_dir,
+            n_workers,
+            predicates_cache_dir=Path(predicates_cache_dir) if predicates_cache_dir else None,
+            code_index_dir=Path(cfg.dataset_dir) / CODE_INDEX_SUBDIR if code_index else None,
+        )
+        logger.info(f"Extract {len(tasks)} tasks for {cfg.dataset} finished successfully.")
+        return
+
+    task_config_path = TASKS[cfg.task]["criteria_fp"]
     logger.info(f"Running task {cfg.task} on dataset {cfg.dataset}")
 
-    cmd = " ".join(
-        [
-            "aces-cli",
-            "--multirun",
-            f"cohort_name={cfg.task}",
-            "data=sharded",
-            "data.standard=meds",
-            f"data.root={cfg.dataset_dir}/data",
-            f"data.shard=$(expand_shards {cfg.dataset_dir}/data)",
-            f"config_path={task_config_path}",
-            f"predicates_path={dataset_predicates_path}",
-            f"output_filepath={cfg.output_dir}" + r"/\$\{data._prefix\}.parquet",
-            f"log_dir={cfg.output_dir}/.logs",
-        ]
-    )
+    aces_overrides = [
+        f"cohort_name={cfg.task}",
+        "data=sharded",
+        "data.standard=meds",
+        f"data.root={cfg.dataset_dir}/data",
+        f"config_path={task_config_path}",
+        f"predicates_path={dataset_predicates_path}",
+    ]
 
-    logger.info(f"Running ACES: {cmd}")
-    run_in_env(
-        cmd=cmd,
-        output_dir=cfg.output_dir,
-        do_overwrite=cfg.do_overwrite,
-        run_as_script=False,
+    stage_cache_dir = cfg.get("stage_cache_dir", None)
+    if not stage_cache_dir:
+        extract_task(aces_overrides, Path(cfg.dataset_dir), output_dir, n_workers, cfg.do_overwrite)
+        logger.info(f"Extract {cfg.task} for {cfg.dataset} finished successfully.")
+        return
+
+    if cfg.do_overwrite and output_dir.exists():
+        logger.info(f"Removing existing output directory: {output_dir}")
+        shutil.rmtree(output_dir)
+
+    # The labels don't depend on how many shards are extracted at once, so `n_workers` isn't part of the key.
+    key = stage_key(
+        " ".join(["aces-cli", *aces_overrides]),
+        output_dir,
+        inputs={
+            "dataset_dir": cfg.dataset_dir,
+            "task": task_config_path,
+            "predicates": dataset_predicates_path,
+        },
     )
-    logger.info(f"Extract {cfg.task} for {cfg.dataset} command {cmd} finished successfully.")
+    run_cached(
+        lambda: extract_task(aces_overrides, Path(cfg.dataset_dir), output_dir, n_workers),
+        output_dir,
+        key,
+        stage_cache_dir,
+    )
+    logger.info(f"Extract {cfg.task} for {cfg.dataset} finished successfully.")
+
+
+@hydra.main(
+    version_base=None,
+    config_path=str(PREDICATES_CFG_YAML.parent),
+    config_name=PREDICATES_CFG_YAML.stem,
+)
+def cache_predicates(cfg: DictConfig):
+    """Evaluates every plain predicate of a dataset once per shard and caches the counts on disk.
+
+    The cached predicates are those of the dataset predicates file plus the plain predicates that the
+    dataset's tasks (or the tasks given by `tasks`) define themselves. The cache holds one parquet file of
+    predicate counts per shard, in the same layout as the MEDS data directory, alongside a `predicates.yaml`
+    recording the definitions of all cached predicates. Pass it to `meds-dev-task` via `predicates_cache_dir`
+    to extract tasks without re-reading the raw data.
+    """
+
+    if cfg.get("dataset_predicates_path", None):
+        logger.info(f"Using provided (local) predicates path: {cfg.dataset_predicates_path}")
+        dataset_predicates_path = Path(cfg.dataset_predicates_path)
+    else:
+        if cfg.dataset not in DATASETS:
+            raise ValueError(
+                f"Dataset {cfg.dataset} not currently configured! Available datasets: {DATASETS.keys()}"
+            )
+        dataset_predicates_path = DATASETS[cfg.dataset]["predicates"]
+        if dataset_predicates_path is None:
+            raise FileNotFoundError(f"Dataset {cfg.dataset} has no predicates file.")
+
+    output_dir = Path(cfg.output_dir)
+    if cfg.do_overwrite and output_dir.exists():
+        logger.info(f"Removing existing output directory: {output_dir}")
+        shutil.rmtree(output_dir)
+
+    if cfg.get("tasks", None):
+        tasks = resolve_tasks(list(cfg.tasks) if isinstance(cfg.tasks, ListConfig) else cfg.tasks)
+    else:
+        tasks = [
+            task
+            for task, task_info in TASKS.items()
+            if task_info["metadata"] and cfg.dataset in (task_info["metadata"].supported_datasets or [])
+        ]
+    task_cfgs = {
+        task: TaskExtractorConfig.load(
+            config_path=Path(TASKS[task]["criteria_fp"]), predicates_path=dataset_predicates_path
+        )
+        for task in tasks
+    }
+    plain_predicates = {
+        **load_dataset_plain_predicates(dataset_predicates_path),
+        **plain_predicates_union(task_cfgs),
+    }
+    logger.info(f"Caching {len(plain_predicates)} plain predicates, covering {len(tasks)} tasks.")
+
+    defs_fp = output_dir / PREDICATES_CACHE_DEFS
+    predicates_text = dump_plain_predicates(plain_predicates)
+    if defs_fp.is_file() and defs_fp.read_text() != predicates_text:
+        raise ValueError(
+            f"Predicates cache {output_dir} was built from different predicates. Set do_overwrite=True to "
+            "rebuild it."
+        )
+
+    done_fp = output_dir / ".done"
+    if done_fp.is_file():
+        logger.info(f"Skipping predicates caching because {done_fp} exists.")
+        return
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    defs_fp.write_text(predicates_text)
+
+    data_dir = Path(cfg.dataset_dir) / "data"
+    shards = list_shards(data_dir)
+    if not shards:
+        raise FileNotFoundError(f"No shards found in {data_dir}")
+
+    todo = [s for s in shards if not (output_dir / f"{s}.parquet").is_file()]
+    n_workers = cfg.get("n_workers", 1)
+    logger.info(f"Caching predicates for {len(todo)}/{len(shards)} shards ({n_workers} workers).")
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {
+            shard: pool.submit(
+                cache_shard_predicates,
+                shard_fp=str(data_dir / f"{shard}.parquet"),
+                predicates_path=str(defs_fp),
+                out_fp=str(output_dir / f"{shard}.parquet"),
+            )
+            for shard in todo
+        }
+        for shard, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Shard {shard} failed: {e}")
+                failed.append(shard)
+
+    if failed:
+        raise RuntimeError(
+            f"Failed to cache predicates for {len(failed)}/{len(todo)} shards: {', '.join(failed)}"
+        )
+
+    done_fp.touch()
+    logger.info(f"Cached predicates for {cfg.dataset} in {output_dir}.")
+
+
+@hydra.main(
+    version_base=None,
+    config_path=str(CHECK_LABELS_CFG_YAML.parent),
+    config_name=CHECK_LABELS_CFG_YAML.stem,
+)
+def check_labels(cfg: DictConfig):
+    """Checks a task's labels for split coverage, duplicates, unknown subjects, and missing values."""
+
+    report = check_label_set(cfg.labels_dir, cfg.dataset_dir)
+    issues = label_issues(report)
+    report["issues"] = issues
+
+    report_json = json.dumps(report, indent=2)
+    if cfg.output_fp is None:
+        print(report_json)
+    else:
+        output_fp = Path(cfg.output_fp)
+        output_fp.parent.mkdir(parents=True, exist_ok=True)
+        output_fp.write_text(report_json)
+
+    if issues and cfg.strict:
+        raise ValueError("Found issues with the labels:\n" + "\n".join(f"  - {issue}" for issue in issues))
+    for issue in issues:
+        logger.warning(issue)
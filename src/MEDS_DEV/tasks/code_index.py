@@ -0,0 +1,166 @@
+"""A code-to-row-group index of MEDS shards, to skip data that cannot match a task's predicates.
+
+Every ACES plain predicate requires an event to have a given code (or a code in a list, or matching a regex),
+so a row group of a shard that contains none of the codes a task's plain predicates can match contributes
+nothing to their counts. This index records, for each shard, the distinct codes in each of its row groups, so
+that predicate evaluation can read the (wide) code and value columns of only the row groups that matter.
+Predicates on code prefixes (e.g., `{"regex": "^LAB//509"}`) are resolved against the indexed codes, so the
+index needs no separate prefix entries.
+
+The index of each shard is stored in its own file, `$DATASET_DIR/.code_index/$SHARD.parquet`, next to a
+`$SHARD.json` file with the size and modification time of the shard it was built from. An index whose shard
+has since changed is treated as missing, so a stale index can never be used, and each shard's index is built
+(by whichever process first needs it) independently of the others.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+
+import polars as pl
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from aces.config import PlainPredicateConfig
+from meds import code_field
+
+logger = logging.getLogger(__name__)
+
+CODE_INDEX_SUBDIR = ".code_index"
+ROW_GROUP = "row_group"
+
+
+def _shard_stat(shard_fp: Path) -> dict[str, int]:
+    stat = shard_fp.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def build_shard_code_index(shard_fp: Path | str, index_fp: Path | str) -> pl.DataFrame:
+    """Builds and writes the code index of a shard, reading only its code column, one row group at a time.
+
+    Returns:
+        The index: a dataframe with one row per `row_group` and distinct `code` in it.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     shard_fp = Path(d) / "0.parquet"
+        ...     shard = pl.DataFrame({"code": ["A", "B", "A", "C", "C"]})
+        ...     pq.write_table(shard.to_arrow(), shard_fp, row_group_size=2)
+        ...     index = build_shard_code_index(shard_fp, Path(d) / "index" / "0.parquet")
+        ...     stat = json.loads((Path(d) / "index" / "0.json").read_text())
+        ...     print(stat["num_row_groups"], stat["size"] == shard_fp.stat().st_size)
+        3 True
+        >>> index
+        shape: (5, 2)
+        ┌───────────┬──────┐
+        │ row_group ┆ code │
+        │ ---       ┆ ---  │
+        │ u32       ┆ str  │
+        ╞═══════════╪══════╡
+        │ 0         ┆ A    │
+        │ 0         ┆ B    │
+        │ 1         ┆ A    │
+        │ 1         ┆ C    │
+        │ 2         ┆ C    │
+        └───────────┴──────┘
+    """
+    shard_fp, index_fp = Path(shard_fp), Path(index_fp)
+    stat = _shard_stat(shard_fp)
+
+    parquet_file = pq.ParquetFile(shard_fp)
+    row_groups, codes = [], []
+    for row_group in range(parquet_file.num_row_groups):
+        column = parquet_file.read_row_group(row_group, columns=[code_field]).column(code_field)
+        unique = pc.unique(column.combine_chunks()).cast("string").drop_null().to_pylist()
+        row_groups.extend([row_group] * len(unique))
+        codes.extend(sorted(unique))
+    index = pl.DataFrame(
+        {ROW_GROUP: row_groups, code_field: codes}, schema={ROW_GROUP: pl.UInt32, code_field: pl.String}
+    )
+
+    # Write to temporary paths and rename into place, so concurrent readers never see a partial index, and
+    # write the shard's stat last, as it is what marks the index as valid.
+    index_fp.parent.mkdir(parents=True, exist_ok=True)
+    stat_fp = index_fp.with_suffix(".json")
+    tmp_index_fp = index_fp.with_suffix(f".parquet.tmp.{os.getpid()}")
+    tmp_stat_fp = index_fp.with_suffix(f".json.tmp.{os.getpid()}")
+    index.write_parquet(tmp_index_fp)
+    tmp_index_fp.rename(index_fp)
+    tmp_stat_fp.write_text(json.dumps({**stat, "num_row_groups": parquet_file.num_row_groups}))
+    tmp_stat_fp.rename(stat_fp)
+    return index
+
+
+def load_shard_code_index(shard_fp: Path | str, index_fp: Path | str) -> pl.DataFrame | None:
+    """Returns the code index of a shard, or `None` if it is missing or the shard has changed since.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     shard_fp, index_fp = Path(d) / "0.parquet", Path(d) / "index" / "0.parquet"
+        ...     pl.DataFrame({"code": ["A", "B"]}).write_parquet(shard_fp)
+        ...     print(load_shard_code_index(shard_fp, index_fp))
+        ...     _ = build_shard_code_index(shard_fp, index_fp)
+        ...     print(load_shard_code_index(shard_fp, index_fp)["code"].to_list())
+        ...     pl.DataFrame({"code": ["A", "B", "C"]}).write_parquet(shard_fp)
+        ...     print(load_shard_code_index(shard_fp, index_fp))
+        None
+        ['A', 'B']
+        None
+    """
+    shard_fp, index_fp = Path(shard_fp), Path(index_fp)
+    stat_fp = index_fp.with_suffix(".json")
+    if not (stat_fp.is_file() and index_fp.is_file()):
+        return None
+    stat = json.loads(stat_fp.read_text())
+    if {k: stat[k] for k in ("size", "mtime_ns")} != _shard_stat(shard_fp):
+        logger.info(f"Code index {index_fp} is stale; {shard_fp} has changed since it was built.")
+        return None
+    return pl.read_parquet(index_fp)
+
+
+def matching_row_groups(index: pl.DataFrame, plain_predicates: dict[str, PlainPredicateConfig]) -> list[int]:
+    """Returns the row groups of a shard's code index that contain a code any of the predicates can match.
+
+    Only the code criteria of the predicates are used, as value and other column criteria cannot make an
+    event match a predicate whose code it does not have.
+
+    Examples:
+        >>> index = pl.DataFrame({
+        ...     "row_group": [0, 0, 1, 2, 2, 3],
+        ...     "code": ["ADM", "LAB//1", "LAB//2", "ADM", "DX//A", "DX//B"],
+        ... })
+        >>> preds = {
+        ...     "high_lab": PlainPredicateConfig("LAB//2", value_min=2.0),
+        ...     "dx": PlainPredicateConfig({"regex": "^DX//B"}),
+        ... }
+        >>> matching_row_groups(index, preds)
+        [1, 3]
+        >>> matching_row_groups(index, {"any": PlainPredicateConfig({"any": ["LAB//1", "DX//A"]})})
+        [0, 2]
+        >>> matching_row_groups(index, {"none": PlainPredicateConfig("LAB//3")})
+        []
+    """
+    code_exprs = [PlainPredicateConfig(code=p.code).MEDS_eval_expr() for p in plain_predicates.values()]
+    return index.filter(pl.any_horizontal(code_exprs))[ROW_GROUP].unique().sort().to_list()
+
+
+def shard_row_groups(
+    shard_fp: Path | str, index_fp: Path | str, plain_predicates: dict[str, PlainPredicateConfig]
+) -> list[int]:
+    """Returns the row groups of a shard that can match the predicates, building its code index if needed."""
+    index = load_shard_code_index(shard_fp, index_fp)
+    if index is None:
+        logger.info(f"Building the code index of {shard_fp} in {index_fp}.")
+        index = build_shard_code_index(shard_fp, index_fp)
+    return matching_row_groups(index, plain_predicates)
+
+
+__all__ = [
+    "CODE_INDEX_SUBDIR",
+    "build_shard_code_index",
+    "load_shard_code_index",
+    "matching_row_groups",
+    "shard_row_groups",
+]
@@ -0,0 +1,461 @@
+"""Helpers to extract many tasks from a MEDS dataset while reading each shard only once.
+
+ACES evaluates a task in two steps: it first computes the task's "plain" predicates (those defined directly in
+terms of codes and values) over the raw event stream, then builds the derived predicates and windows from
+those predicate counts. Only the first step touches the raw data. So, to extract several tasks at once, we
+read each shard once, compute the union of the plain predicates of all tasks into a compact, per-shard
+predicates file, and then run the remainder of ACES for each task off of that file via its `direct` data
+standard.
+
+The same per-shard predicates files can also be computed once for *all* plain predicates of a dataset and kept
+as a predicates cache, in which case tasks whose plain predicates are all in the cache are extracted without
+reading the raw data at all.
+"""
+
+import dataclasses
+import io
+import logging
+from pathlib import Path
+
+import polars as pl
+import pyarrow.parquet as pq
+import ruamel.yaml
+from aces import predicates, query
+from aces.config import PlainPredicateConfig, TaskExtractorConfig
+from aces.types import PRED_CNT_TYPE
+from meds import label_schema, prediction_time_field, subject_id_field
+from omegaconf import DictConfig
+
+from .code_index import shard_row_groups
+
+logger = logging.getLogger(__name__)
+
+PREDICATES_CACHE_DEFS = "predicates.yaml"
+
+
+def plain_predicates_union(task_cfgs: dict[str, TaskExtractorConfig]) -> dict[str, PlainPredicateConfig]:
+    """Collects the plain predicates needed by any of the given tasks.
+
+    Args:
+        task_cfgs: A dictionary mapping task names to their loaded ACES configurations.
+
+    Returns:
+        A dictionary mapping each plain predicate name to its configuration.
+
+    Raises:
+        ValueError: If two tasks define a plain predicate with the same name but different definitions, as
+            these can't share a single predicates column.
+
+    Examples:
+        >>> cfg_1 = TaskExtractorConfig.__new__(TaskExtractorConfig)
+        >>> cfg_1.predicates = {"adm": PlainPredicateConfig("ADM"), "dth": PlainPredicateConfig("DTH")}
+        >>> cfg_2 = TaskExtractorConfig.__new__(TaskExtractorConfig)
+        >>> cfg_2.predicates = {"adm": PlainPredicateConfig("ADM"), "lab": PlainPredicateConfig("LAB", 1)}
+        >>> sorted(plain_predicates_union({"t1": cfg_1, "t2": cfg_2}))
+        ['adm', 'dth', 'lab']
+        >>> cfg_2.predicates["dth"] = PlainPredicateConfig("DEATH")
+        >>> plain_predicates_union({"t1": cfg_1, "t2": cfg_2})
+        Traceback (most recent call last):
+            ...
+        ValueError: Plain predicate 'dth' is defined differently in tasks t1 and t2; extract them separately.
+    """
+
+    union = {}
+    defined_by = {}
+    for task, cfg in task_cfgs.items():
+        for name, predicate in cfg.plain_predicates.items():
+            if name in union and union[name] != predicate:
+                raise ValueError(
+                    f"Plain predicate '{name}' is defined differently in tasks {defined_by[name]} and "
+                    f"{task}; extract them separately."
+                )
+            union[name] = predicate
+            defined_by.setdefault(name, task)
+    return union
+
+
+def load_dataset_plain_predicates(predicates_path: Path | str) -> dict[str, PlainPredicateConfig]:
+    """Loads all plain predicates (including patient demographics) defined in a dataset predicates file.
+
+    Predicates are parsed exactly as ACES parses them when resolving a task against the predicates file, so
+    the returned configurations compare equal to those in any task configuration loaded against it.
+
+    Args:
+        predicates_path: The dataset predicates file.
+
+    Returns:
+        A dictionary mapping each plain predicate name to its configuration. Derived (`expr`) predicates are
+        omitted, as they are computed per task from the plain predicates.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile(mode="w", suffix=".yaml") as f:
+        ...     _ = f.write('''
+        ... predicates:
+        ...   adm: {code: {regex: '^ADM//.*'}}
+        ...   lab: {code: LAB, value_min: 1.3, value_min_inclusive: False}
+        ...   adm_or_lab: {expr: 'or(adm, lab)'}
+        ... patient_demographics:
+        ...   female: {code: SEX//F}
+        ... ''')
+        ...     f.flush()
+        ...     preds = load_dataset_plain_predicates(f.name)
+        >>> list(preds)
+        ['adm', 'lab', 'female']
+        >>> preds["lab"] == PlainPredicateConfig("LAB", value_min=1.3, value_min_inclusive=False)
+        True
+        >>> preds["female"].static
+        True
+    """
+
+    yaml = ruamel.yaml.YAML(typ="safe", pure=True)
+    predicates_dict = yaml.load(Path(predicates_path).read_text()) or {}
+
+    out = {}
+    for name, p in predicates_dict.get("predicates", {}).items():
+        if "expr" in p:
+            continue
+        config_data = {k: v for k, v in p.items() if k in PlainPredicateConfig.__dataclass_fields__}
+        other_cols = {k: v for k, v in p.items() if k not in config_data}
+        out[name] = PlainPredicateConfig(**config_data, other_cols=other_cols)
+    for name, p in predicates_dict.get("patient_demographics", {}).items():
+        out[name] = PlainPredicateConfig(**p, static=True)
+    return out
+
+
+def dump_plain_predicates(plain_predicates: dict[str, PlainPredicateConfig]) -> str:
+    """Serializes plain predicates in the format of a dataset predicates file.
+
+    This is the inverse of `load_dataset_plain_predicates`, and is used to record exactly which predicates a
+    predicates cache holds.
+
+    Examples:
+        >>> preds = {
+        ...     "adm": PlainPredicateConfig({"regex": "^ADM//.*"}),
+        ...     "lab": PlainPredicateConfig("LAB", value_min=1.3, value_min_inclusive=False),
+        ...     "female": PlainPredicateConfig("SEX//F", static=True),
+        ... }
+        >>> print(dump_plain_predicates(preds))
+        patient_demographics:
+          female:
+            code: SEX//F
+        predicates:
+          adm:
+            code:
+              regex: ^ADM//.*
+          lab:
+            code: LAB
+            value_min: 1.3
+            value_min_inclusive: false
+        <BLANKLINE>
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile(mode="w", suffix=".yaml") as f:
+        ...     _ = f.write(dump_plain_predicates(preds))
+        ...     f.flush()
+        ...     load_dataset_plain_predicates(f.name) == preds
+        True
+    """
+
+    out = {"patient_demographics": {}, "predicates": {}}
+    for name, predicate in plain_predicates.items():
+        as_dict = {k: v for k, v in dataclasses.asdict(predicate).items() if v is not None}
+        as_dict.update(as_dict.pop("other_cols"))
+        section = "patient_demographics" if as_dict.pop("static") else "predicates"
+        out[section][name] = as_dict
+
+    stream = io.StringIO()
+    yaml = ruamel.yaml.YAML(typ="safe", pure=True)
+    yaml.default_flow_style = False
+    yaml.dump({k: v for k, v in out.items() if v}, stream)
+    return stream.getvalue()
+
+
+def check_cached_predicates(
+    task_cfgs: dict[str, TaskExtractorConfig], cached: dict[str, PlainPredicateConfig]
+):
+    """Checks that every plain predicate the given tasks need is in a predicates cache, with the same definition.
+
+    Args:
+        task_cfgs: A dictionary mapping task names to their loaded ACES configurations.
+        cached: The plain predicates stored in the cache.
+
+    Raises:
+        ValueError: If any task needs a plain predicate that is not cached or is cached with a different
+            definition. Such tasks must be extracted from the raw data.
+
+    Examples:
+        >>> cfg = TaskExtractorConfig.__new__(TaskExtractorConfig)
+        >>> cfg.predicates = {"adm": PlainPredicateConfig("ADM"), "dth": PlainPredicateConfig("DTH")}
+        >>> check_cached_predicates({"t": cfg}, {"adm": PlainPredicateConfig("ADM"), "dth": PlainPredicateConfig("DTH")})
+        >>> check_cached_predicates({"t": cfg}, {"adm": PlainPredicateConfig("ADM")})
+        Traceback (most recent call last):
+            ...
+        ValueError: Task t needs plain predicates not in the predicates cache: dth
+        >>> check_cached_predicates({"t": cfg}, {"adm": PlainPredicateConfig("ADM//.*"), "dth": PlainPredicateConfig("DTH")})
+        Traceback (most recent call last):
+            ...
+        ValueError: Task t defines plain predicates differently than the predicates cache: adm
+    """  # noqa: E501
+
+    for task, cfg in task_cfgs.items():
+        missing = [n for n in cfg.plain_predicates if n not in cached]
+        if missing:
+            raise ValueError(
+                f"Task {task} needs plain predicates not in the predicates cache: {', '.join(missing)}"
+            )
+        differ = [n for n, p in cfg.plain_predicates.items() if cached[n] != p]
+        if differ:
+            raise ValueError(
+                f"Task {task} defines plain predicates differently than the predicates cache: "
+                f"{', '.join(differ)}"
+            )
+
+
+def compute_plain_predicates(
+    shard_fp: Path | str,
+    plain_predicates: dict[str, PlainPredicateConfig],
+    row_groups: list[int] | None = None,
+) -> pl.DataFrame:
+    """Reads a MEDS shard once and computes the counts of all given plain predicates per subject and time.
+
+    This mirrors the MEDS branch of ACES' plain predicate generation, but evaluates all predicates in a single
+    lazy pass that only reads the columns the predicates need.
+
+    If `row_groups` is given (e.g., from a code index; see `MEDS_DEV.tasks.code_index`), the predicates are
+    only evaluated over those row groups of the shard, which must include every row group containing an event
+    that matches any predicate. The subject IDs and times of all rows are still read, as ACES needs a row for
+    every (subject, time) in the data, so the output is the same as without `row_groups`.
+
+    Args:
+        shard_fp: The path to the MEDS data shard.
+        plain_predicates: The plain predicates to compute.
+        row_groups: The only row groups of the shard whose events can match any predicate, if known.
+
+    Returns:
+        A dataframe with the `subject_id` and `timestamp` columns and one count column per predicate, in the
+        format ACES expects for its `direct` data standard.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> shard = pl.DataFrame({
+        ...     "subject_id": [1, 1, 1, 1, 2],
+        ...     "time": [None, datetime(2020, 1, 1), datetime(2020, 1, 2), datetime(2020, 1, 2), None],
+        ...     "code": ["SEX//F", "ADM", "LAB", "LAB", "SEX//M"],
+        ...     "numeric_value": [None, None, 1.0, 3.0, None],
+        ... })
+        >>> preds = {
+        ...     "female": PlainPredicateConfig("SEX//F", static=True),
+        ...     "adm": PlainPredicateConfig("ADM"),
+        ...     "high_lab": PlainPredicateConfig("LAB", value_min=2.0, value_min_inclusive=False),
+        ... }
+        >>> with tempfile.NamedTemporaryFile(suffix=".parquet") as f:
+        ...     shard.write_parquet(f.name)
+        ...     compute_plain_predicates(f.name, preds)
+        shape: (4, 5)
+        ┌────────────┬─────────────────────┬────────┬─────┬──────────┐
+        │ subject_id ┆ timestamp           ┆ female ┆ adm ┆ high_lab │
+        │ ---        ┆ ---                 ┆ ---    ┆ --- ┆ ---      │
+        │ i64        ┆ datetime[μs]        ┆ i64    ┆ i64 ┆ i64      │
+        ╞════════════╪═════════════════════╪════════╪═════╪══════════╡
+        │ 1          ┆ null                ┆ 1      ┆ 0   ┆ 0        │
+        │ 1          ┆ 2020-01-01 00:00:00 ┆ 0      ┆ 1   ┆ 0        │
+        │ 1          ┆ 2020-01-02 00:00:00 ┆ 0      ┆ 0   ┆ 1        │
+        │ 2          ┆ null                ┆ 0      ┆ 0   ┆ 0        │
+        └────────────┴─────────────────────┴────────┴─────┴──────────┘
+
+    With `row_groups`, the other row groups are skipped, but the output is the same:
+
+        >>> with tempfile.NamedTemporaryFile(suffix=".parquet") as f:
+        ...     pq.write_table(shard.to_arrow(), f.name, row_group_size=2)
+        ...     full = compute_plain_predicates(f.name, preds)
+        ...     print(full.equals(compute_plain_predicates(f.name, preds, row_groups=[0, 1])))
+        ...     print(compute_plain_predicates(f.name, {"adm": preds["adm"]}, row_groups=[]))
+        True
+        shape: (4, 3)
+        ┌────────────┬─────────────────────┬─────┐
+        │ subject_id ┆ timestamp           ┆ adm │
+        │ ---        ┆ ---                 ┆ --- │
+        │ i64        ┆ datetime[μs]        ┆ i64 │
+        ╞════════════╪═════════════════════╪═════╡
+        │ 1          ┆ null                ┆ 0   │
+        │ 1          ┆ 2020-01-01 00:00:00 ┆ 0   │
+        │ 1          ┆ 2020-01-02 00:00:00 ┆ 0   │
+        │ 2          ┆ null                ┆ 0   │
+        └────────────┴─────────────────────┴─────┘
+    """
+
+    needed_cols = {subject_id_field, "time", "code"}
+    for predicate in plain_predicates.values():
+        if predicate.value_min is not None or predicate.value_max is not None:
+            needed_cols.add("numeric_value")
+        needed_cols.update(predicate.other_cols)
+
+    lf = pl.scan_parquet(shard_fp)
+    columns = [c for c in lf.collect_schema().names() if c in needed_cols]
+    predicate_cols = list(plain_predicates.keys())
+    predicate_exprs = [p.MEDS_eval_expr().cast(PRED_CNT_TYPE).alias(n) for n, p in plain_predicates.items()]
+
+    def select_predicates(lf: pl.LazyFrame) -> pl.LazyFrame:
+        lf = lf.select(columns).rename({"time": "timestamp"}).with_columns(pl.col("code").cast(pl.Utf8))
+        return lf.select(subject_id_field, "timestamp", *predicate_exprs)
+
+    parquet_file = pq.ParquetFile(shard_fp) if row_groups is not None else None
+    if parquet_file is None or set(row_groups) >= set(range(parquet_file.num_row_groups)):
+        lf = select_predicates(lf)
+    else:
+        # Polars can't read selected row groups, so the shard is read with pyarrow, one row group at a time
+        # (to keep the rows in order), and only the subject IDs and times of the skipped row groups are read.
+        selected = set(row_groups)
+        parts = []
+        for row_group in range(parquet_file.num_row_groups):
+            if row_group in selected:
+                table = parquet_file.read_row_group(row_group, columns=columns)
+                parts.append(select_predicates(pl.from_arrow(table).lazy()))
+            else:
+                table = parquet_file.read_row_group(row_group, columns=[subject_id_field, "time"])
+                parts.append(
+                    pl.from_arrow(table)
+                    .lazy()
+                    .select(
+                        subject_id_field,
+                        pl.col("time").alias("timestamp"),
+                        *(pl.lit(0, dtype=PRED_CNT_TYPE).alias(c) for c in predicate_cols),
+                    )
+                )
+        lf = pl.concat(parts)
+
+    return (
+        lf.group_by([subject_id_field, "timestamp"], maintain_order=True)
+        .agg(*(pl.col(c).sum().cast(PRED_CNT_TYPE) for c in predicate_cols))
+        .collect()
+    )
+
+
+def cache_shard_predicates(shard_fp: Path | str, predicates_path: Path | str, out_fp: Path | str):
+    """Computes all plain predicates of a dataset predicates file over a shard and writes them to `out_fp`.
+
+    The file is written to a temporary path and then moved into place, so a partially written cache file is
+    never mistaken for a complete one.
+
+    Args:
+        shard_fp: The MEDS data shard to read.
+        predicates_path: The dataset predicates file.
+        out_fp: The parquet file to write the predicate counts to.
+    """
+    out_fp = Path(out_fp)
+    out_fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fp = out_fp.with_suffix(".tmp")
+    compute_plain_predicates(shard_fp, load_dataset_plain_predicates(predicates_path)).write_parquet(tmp_fp)
+    tmp_fp.rename(out_fp)
+
+
+def to_meds_labels(result: pl.DataFrame) -> pl.DataFrame:
+    """Converts the output of an ACES query to the MEDS label schema, as `aces-cli` does for MEDS data.
+
+    Examples:
+        >>> from datetime import datetime
+        >>> result = pl.DataFrame({
+        ...     "subject_id": [1, 2],
+        ...     "index_timestamp": [datetime(2020, 1, 1), datetime(2020, 1, 2)],
+        ...     "label": [1, 0],
+        ...     "trigger": [datetime(2019, 12, 31), datetime(2020, 1, 1)],
+        ... })
+        >>> labels = to_meds_labels(result)
+        >>> labels.columns # doctest: +NORMALIZE_WHITESPACE
+        ['subject_id', 'prediction_time', 'boolean_value',
+         'integer_value', 'float_value', 'categorical_value']
+        >>> labels["boolean_value"].to_list()
+        [True, False]
+        >>> to_meds_labels(pl.DataFrame()).shape
+        (0, 6)
+    """
+
+    if len(result) == 0:
+        return pl.from_arrow(label_schema.empty_table())
+
+    for in_col, out_col in [
+        ("subject_id", subject_id_field),
+        ("index_timestamp", prediction_time_field),
+        ("label", "boolean_value"),
+    ]:
+        if in_col in result.columns and in_col != out_col:
+            result = result.rename({in_col: out_col})
+
+    if subject_id_field not in result.columns:
+        raise ValueError("Output dataframe is missing a 'subject_id' column.")
+
+    out_cols = []
+    for field in label_schema:
+        dtype = pl.from_arrow(label_schema.empty_table().select([field.name])).schema[field.name]
+        if field.name in result.columns:
+            out_cols.append(pl.col(field.name).cast(dtype, strict=False))
+        else:
+            out_cols.append(pl.lit(None, dtype=dtype).alias(field.name))
+    return result.select(out_cols)
+
+
+def labels_from_predicates(task_cfg: TaskExtractorConfig, predicates_fp: Path | str) -> pl.DataFrame:
+    """Runs the remainder of ACES for a task off of a precomputed plain predicates file.
+
+    Args:
+        task_cfg: The loaded ACES configuration for the task.
+        predicates_fp: A parquet file in the format of `compute_plain_predicates` that contains (at least) all
+            of the task's plain predicates.
+
+    Returns:
+        The task labels, in the MEDS label schema.
+    """
+    data_config = DictConfig({"standard": "direct", "path": str(predicates_fp), "ts_format": None})
+    predicates_df = predicates.get_predicates_df(task_cfg, data_config)
+    return to_meds_labels(query.query(task_cfg, predicates_df))
+
+
+def extract_tasks_from_shard(
+    shard_fp: Path | str | None,
+    task_config_fps: dict[str, Path | str],
+    predicates_path: Path | str | None,
+    output_fps: dict[str, Path | str],
+    shard_predicates_fp: Path | str,
+    code_index_fp: Path | str | None = None,
+):
+    """Extracts the labels for several tasks from a single shard, reading the shard only once.
+
+    Task configurations are loaded within this function (rather than passed in) so that it can be run in a
+    separate worker process.
+
+    Args:
+        shard_fp: The MEDS data shard to read. If `None`, the plain predicates are instead read from an
+            existing `shard_predicates_fp` (e.g., from a predicates cache), and the raw data is not read.
+        task_config_fps: A dictionary mapping task names to their ACES task configuration files.
+        predicates_path: The dataset predicates file used to resolve the tasks' predicates, if any.
+        output_fps: A dictionary mapping task names to the parquet file the task's labels should be
+            written to.
+        shard_predicates_fp: Where to write the union of all plain predicates for this shard, or where to read
+            them from if `shard_fp` is `None`.
+        code_index_fp: If set, the shard's code index file (see `MEDS_DEV.tasks.code_index`), which is built
+            if it is missing or stale and used to read only the row groups of the shard that can match the
+            tasks' plain predicates.
+    """
+
+    task_cfgs = {
+        task: TaskExtractorConfig.load(config_path=Path(fp), predicates_path=predicates_path)
+        for task, fp in task_config_fps.items()
+    }
+
+    shard_predicates_fp = Path(shard_predicates_fp)
+    if shard_fp is not None:
+        plain_predicates = plain_predicates_union(task_cfgs)
+        row_groups = None
+        if code_index_fp is not None:
+            row_groups = shard_row_groups(shard_fp, code_index_fp, plain_predicates)
+            logger.info(f"Reading {len(row_groups)} matching row groups of {shard_fp}")
+        shard_predicates_fp.parent.mkdir(parents=True, exist_ok=True)
+        compute_plain_predicates(shard_fp, plain_predicates, row_groups).write_parquet(shard_predicates_fp)
+
+    for task, task_cfg in task_cfgs.items():
+        logger.info(f"Extracting {task} from {shard_fp or shard_predicates_fp}")
+        labels = labels_from_predicates(task_cfg, shard_predicates_fp)
+        out_fp = Path(output_fps[task])
+        out_fp.parent.mkdir(parents=True, exist_ok=True)
+        pq.write_table(labels.to_arrow().cast(label_schema), out_fp)
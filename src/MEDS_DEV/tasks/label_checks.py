@@ -0,0 +1,339 @@
+"""Quality checks of extracted task labels.
+
+The checks read each label file in record batches of at most `batch_size` rows, so memory use is bounded by
+the batch size (plus a per-subject table), not by the size of any label file or the total number of labels.
+Only unsorted labels need more: their duplicates are counted with a table of their distinct
+`(subject_id, prediction_time)` pairs.
+"""
+
+import logging
+from pathlib import Path
+from typing import Any
+
+import polars as pl
+import pyarrow.parquet as pq
+from meds import subject_splits_filepath
+
+logger = logging.getLogger(__name__)
+
+SUBJECT_ID = "subject_id"
+PREDICTION_TIME = "prediction_time"
+VALUE_COLUMNS = ("boolean_value", "integer_value", "float_value", "categorical_value")
+DEFAULT_BATCH_SIZE = 2**20
+
+
+def label_files(labels_dir: Path | str) -> list[Path]:
+    """Returns the label parquet files under a directory, recursively, skipping hidden files and directories.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     for name in ("train/0.parquet", "held_out/0.parquet", ".shards/train/0.parquet", "a.json"):
+        ...         (Path(d) / name).parent.mkdir(parents=True, exist_ok=True)
+        ...         (Path(d) / name).touch()
+        ...     print([str(fp.relative_to(d)) for fp in label_files(d)])
+        ['held_out/0.parquet', 'train/0.parquet']
+    """
+    labels_dir = Path(labels_dir)
+    return sorted(
+        fp
+        for fp in labels_dir.rglob("*.parquet")
+        if not any(part.startswith(".") for part in fp.relative_to(labels_dir).parts)
+    )
+
+
+def _adjacent_duplicates() -> list[pl.Expr]:
+    """Aggregations of how many rows repeat the previous row's keys, and of whether the keys are sorted."""
+    sid, time = pl.col(SUBJECT_ID), pl.col(PREDICTION_TIME)
+    prev_sid, prev_time = sid.shift(1), time.shift(1)
+    in_order = (sid > prev_sid) | ((sid == prev_sid) & (time >= prev_time))
+    return [
+        ((sid == prev_sid) & (time == prev_time)).sum().alias("n_adjacent"),
+        in_order.fill_null(True).all().alias("is_sorted"),
+    ]
+
+
+def _n_duplicates(keys: pl.LazyFrame, adjacent: tuple[int, bool] | None = None) -> int:
+    """Returns the number of rows that repeat an earlier row's `(subject_id, prediction_time)`.
+
+    Labels are normally sorted by subject and prediction time, in which case duplicates are adjacent and are
+    counted without hashing; otherwise, they are counted by grouping.
+
+    Args:
+        keys: The rows to check.
+        adjacent: The `_adjacent_duplicates` aggregations of `keys`, if they were already computed.
+
+    Examples:
+        >>> from datetime import datetime
+        >>> keys = pl.LazyFrame({
+        ...     "subject_id": [1, 1, 1, 2, 2],
+        ...     "prediction_time": [datetime(2020, 1, d) for d in (1, 2, 2, 1, 1)],
+        ... })
+        >>> _n_duplicates(keys), _n_duplicates(keys.reverse()), _n_duplicates(keys.unique())
+        (2, 2, 0)
+        >>> _n_duplicates(keys.unique().sort("prediction_time"))
+        0
+    """
+    if adjacent is None:
+        adjacent = keys.select(_adjacent_duplicates()).collect().row(0)
+    n_adjacent, is_sorted = adjacent
+    if is_sorted:
+        return n_adjacent
+    counts = keys.group_by(SUBJECT_ID, PREDICTION_TIME).agg(n=pl.len())
+    return counts.select((pl.col("n") - 1).sum()).collect(streaming=True).item() or 0
+
+
+def check_labels(
+    labels_dir: Path | str, dataset_dir: Path | str, batch_size: int = DEFAULT_BATCH_SIZE
+) -> dict[str, Any]:
+    """Checks a task's labels against the subject splits of the dataset they were extracted from.
+
+    Args:
+        labels_dir: The directory of label parquet files.
+        dataset_dir: The MEDS dataset directory, with its `metadata/subject_splits.parquet` file.
+        batch_size: The maximum number of label rows to read at once.
+
+    Returns:
+        A JSON-serializable report with:
+          - `n_files`, `n_labels`, and `n_subjects`: The number of label files, labels, and labeled subjects.
+          - `splits`: Per split in the dataset, its number of subjects, how many of them have labels, its
+            number of labels, and (for boolean labels) the prevalence of positive labels.
+          - `missing_splits`: The splits without any labels.
+          - `n_duplicate_labels`: The number of labels that repeat the `(subject_id, prediction_time)` of an
+            earlier label, or None if either column is missing.
+          - `n_labels_without_split` and `n_subjects_without_split`: How many labels, and the subjects they
+            are for, belong to subjects that are not in the dataset's subject splits.
+          - `null_counts` and `nan_counts`: The number of nulls in each column, and of NaNs in each floating
+            point column.
+
+    Raises:
+        FileNotFoundError: If there are no label files or the dataset has no subject splits file.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> splits = pl.DataFrame({
+        ...     "subject_id": [1, 2, 3, 4, 5], "split": ["train", "train", "tuning", "held_out", "held_out"],
+        ... })
+        >>> labels = pl.DataFrame({
+        ...     "subject_id": [1, 1, 1, 2, 4, 6],
+        ...     "prediction_time": [datetime(2020, 1, d) for d in (1, 2, 2, 1, 1, 1)],
+        ...     "boolean_value": [True, False, False, True, None, False],
+        ...     "float_value": [None, None, None, None, None, float("nan")],
+        ... })
+        >>> more_labels = pl.DataFrame({
+        ...     "subject_id": [1, 5], "prediction_time": [datetime(2020, 1, 1), datetime(2020, 1, 3)],
+        ...     "boolean_value": [True, True], "float_value": [None, None],
+        ... })
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     (Path(d) / "dataset" / "metadata").mkdir(parents=True)
+        ...     splits.write_parquet(Path(d) / "dataset" / "metadata" / "subject_splits.parquet")
+        ...     (Path(d) / "labels" / "held_out").mkdir(parents=True)
+        ...     labels.write_parquet(Path(d) / "labels" / "0.parquet")
+        ...     more_labels.write_parquet(Path(d) / "labels" / "held_out" / "0.parquet")
+        ...     report = check_labels(Path(d) / "labels", Path(d) / "dataset")
+        >>> for split, stats in report["splits"].items():
+        ...     print(split, stats)
+        held_out {'n_subjects': 2, 'n_labeled_subjects': 2, 'n_labels': 2, 'prevalence': 1.0}
+        train {'n_subjects': 2, 'n_labeled_subjects': 2, 'n_labels': 5, 'prevalence': 0.6}
+        tuning {'n_subjects': 1, 'n_labeled_subjects': 0, 'n_labels': 0, 'prevalence': None}
+        >>> for key in ("n_files", "n_labels", "n_subjects", "missing_splits", "n_duplicate_labels"):
+        ...     print(key, report[key])
+        n_files 2
+        n_labels 8
+        n_subjects 5
+        missing_splits ['tuning']
+        n_duplicate_labels 2
+        >>> report["n_labels_without_split"], report["n_subjects_without_split"]
+        (1, 1)
+        >>> report["null_counts"]
+        {'subject_id': 0, 'prediction_time': 0, 'boolean_value': 1, 'float_value': 7}
+        >>> report["nan_counts"]
+        {'float_value': 1}
+
+    Reading the labels in smaller batches gives the same report, including duplicates across batches:
+
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     (Path(d) / "dataset" / "metadata").mkdir(parents=True)
+        ...     splits.write_parquet(Path(d) / "dataset" / "metadata" / "subject_splits.parquet")
+        ...     (Path(d) / "labels" / "held_out").mkdir(parents=True)
+        ...     labels.write_parquet(Path(d) / "labels" / "0.parquet")
+        ...     more_labels.write_parquet(Path(d) / "labels" / "held_out" / "0.parquet")
+        ...     check_labels(Path(d) / "labels", Path(d) / "dataset", batch_size=1) == report
+        True
+
+    Labels without prediction times (or with any other columns missing) are checked as far as possible:
+
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     (Path(d) / "dataset" / "metadata").mkdir(parents=True)
+        ...     splits.write_parquet(Path(d) / "dataset" / "metadata" / "subject_splits.parquet")
+        ...     (Path(d) / "labels").mkdir()
+        ...     pl.DataFrame({"subject_id": [1, 3]}).write_parquet(Path(d) / "labels" / "0.parquet")
+        ...     report = check_labels(Path(d) / "labels", Path(d) / "dataset")
+        ...     (Path(d) / "empty").mkdir()
+        ...     check_labels(Path(d) / "empty", Path(d) / "dataset")
+        Traceback (most recent call last):
+            ...
+        FileNotFoundError: No label files found in .../empty
+        >>> report["missing_splits"], report["n_duplicate_labels"], report["splits"]["train"]["prevalence"]
+        (['held_out'], None, None)
+    """
+    fps = label_files(labels_dir)
+    if not fps:
+        raise FileNotFoundError(f"No label files found in {labels_dir}")
+    splits_fp = Path(dataset_dir) / subject_splits_filepath
+    if not splits_fp.is_file():
+        raise FileNotFoundError(f"Subject splits file not found: {splits_fp}")
+
+    subject_splits = (
+        pl.read_parquet(splits_fp, columns=[SUBJECT_ID, "split"], use_pyarrow=True)
+        .with_columns(pl.col(SUBJECT_ID).cast(pl.Int64))
+        .unique(SUBJECT_ID)
+    )
+
+    def scan(fp: Path) -> pl.LazyFrame:
+        return pl.scan_parquet(fp).with_columns(pl.col(SUBJECT_ID).cast(pl.Int64))
+
+    subject_stats, column_stats, n_duplicates = [], [], 0
+    has_keys = True
+    for fp in fps:
+        schema = scan(fp).collect_schema()
+        has_keys = has_keys and PREDICTION_TIME in schema
+
+        subject_aggs = [pl.len().alias("n_labels")]
+        if "boolean_value" in schema:
+            subject_aggs.append(pl.col("boolean_value").sum().alias("n_positive"))
+            subject_aggs.append(pl.col("boolean_value").count().alias("n_boolean"))
+        column_aggs = [pl.col(c).null_count().alias(f"null/{c}") for c in schema]
+        column_aggs.extend(
+            pl.col(c).is_nan().sum().alias(f"nan/{c}") for c, t in schema.items() if t.is_float()
+        )
+
+        parquet_file = pq.ParquetFile(fp)
+        if parquet_file.metadata.num_rows:
+            batches = parquet_file.iter_batches(batch_size=batch_size)
+        else:
+            batches = [parquet_file.schema_arrow.empty_table()]
+
+        # The keys of each batch's last row are carried into the next, so that duplicates and unsorted keys
+        # across the batch boundary are found.
+        file_subjects, file_columns, n_adjacent, is_sorted, last_keys = [], [], 0, True, None
+        for batch in batches:
+            df = pl.from_arrow(batch).with_columns(pl.col(SUBJECT_ID).cast(pl.Int64))
+            file_subjects.append(df.group_by(SUBJECT_ID).agg(*subject_aggs))
+            file_columns.append(df.select(column_aggs))
+            if has_keys:
+                keys = df.select(SUBJECT_ID, PREDICTION_TIME)
+                if last_keys is not None:
+                    keys = pl.concat([last_keys, keys])
+                batch_adjacent, batch_sorted = keys.select(_adjacent_duplicates()).row(0)
+                n_adjacent, is_sorted = n_adjacent + batch_adjacent, is_sorted and batch_sorted
+                last_keys = keys.tail(1)
+
+        file_subjects = pl.concat(file_subjects).group_by(SUBJECT_ID).agg(pl.all().sum())
+        subject_stats.append(file_subjects.with_columns(file=pl.lit(str(fp))))
+        column_stats.append(pl.concat(file_columns).sum())
+        if has_keys:
+            keys = scan(fp).select(SUBJECT_ID, PREDICTION_TIME)
+            n_duplicates += _n_duplicates(keys, (n_adjacent, is_sorted))
+
+    subject_stats = pl.concat(subject_stats, how="diagonal_relaxed")
+
+    # Duplicates were only counted within each file; labels of subjects that span several files (which does
+    # not happen for labels extracted shard-by-shard) are re-checked across them.
+    spanning = subject_stats.filter(pl.col(SUBJECT_ID).is_duplicated())
+    if has_keys and len(spanning):
+        logger.warning(f"{spanning[SUBJECT_ID].n_unique()} subjects have labels in more than one label file.")
+        spanning_keys = []
+        for fp in spanning["file"].unique().sort():
+            keys = scan(Path(fp)).filter(pl.col(SUBJECT_ID).is_in(spanning[SUBJECT_ID]))
+            keys = keys.select(SUBJECT_ID, PREDICTION_TIME).collect()
+            n_duplicates -= _n_duplicates(keys.lazy())
+            spanning_keys.append(keys)
+        n_duplicates += _n_duplicates(pl.concat(spanning_keys).lazy())
+
+    subjects = (
+        subject_stats.drop("file")
+        .group_by(SUBJECT_ID)
+        .agg(pl.all().sum())
+        .join(subject_splits, on=SUBJECT_ID, how="left")
+    )
+    split_stats = subjects.drop(SUBJECT_ID).group_by("split").agg(pl.all().sum(), pl.len())
+    column_stats = pl.concat(column_stats, how="diagonal_relaxed").sum().row(0, named=True)
+
+    split_sizes = dict(subject_splits.group_by("split").len().iter_rows())
+    labeled = {row["split"]: row for row in split_stats.iter_rows(named=True)}
+    without_split = labeled.pop(None, {"n_labels": 0, "len": 0})
+
+    splits = {}
+    for split in sorted(split_sizes):
+        stats = labeled.get(split, {})
+        n_boolean = stats.get("n_boolean") or 0
+        splits[split] = {
+            "n_subjects": split_sizes[split],
+            "n_labeled_subjects": stats.get("len", 0),
+            "n_labels": stats.get("n_labels", 0),
+            "prevalence": stats["n_positive"] / n_boolean if n_boolean else None,
+        }
+
+    return {
+        "n_files": len(fps),
+        "n_labels": sum(s["n_labels"] for s in splits.values()) + without_split["n_labels"],
+        "n_subjects": len(subjects),
+        "splits": splits,
+        "missing_splits": [split for split, stats in splits.items() if stats["n_labels"] == 0],
+        "n_duplicate_labels": n_duplicates if has_keys else None,
+        "n_labels_without_split": without_split["n_labels"],
+        "n_subjects_without_split": without_split["len"],
+        "null_counts": {k.split("/", 1)[1]: v for k, v in column_stats.items() if k.startswith("null/")},
+        "nan_counts": {k.split("/", 1)[1]: v for k, v in column_stats.items() if k.startswith("nan/")},
+    }
+
+
+def label_issues(report: dict[str, Any]) -> list[str]:
+    """Returns the problems found in a `check_labels` report, as human-readable messages.
+
+    Splits without labels, duplicate labels, labels of subjects outside the splits, nulls in the key columns,
+    NaNs, and value columns that are only partially null (a value column is either the label, and should have
+    no nulls, or unused, and should be all null) are problems.
+
+    Examples:
+        >>> report = {
+        ...     "n_labels": 10, "missing_splits": ["tuning"], "n_duplicate_labels": 0,
+        ...     "n_labels_without_split": 2, "n_subjects_without_split": 1,
+        ...     "null_counts": {"subject_id": 0, "boolean_value": 3, "integer_value": 10},
+        ...     "nan_counts": {"float_value": 0},
+        ... }
+        >>> for issue in label_issues(report):
+        ...     print(issue)
+        No labels in split(s): tuning
+        2 labels are for 1 subjects that are not in the subject splits
+        3 of 10 labels have a null boolean_value
+        >>> label_issues({**report, "missing_splits": [], "n_labels_without_split": 0,
+        ...               "null_counts": {"boolean_value": 0}})
+        []
+    """
+    issues = []
+    if report["missing_splits"]:
+        issues.append(f"No labels in split(s): {', '.join(report['missing_splits'])}")
+    if report["n_duplicate_labels"]:
+        issues.append(
+            f"{report['n_duplicate_labels']} labels repeat an earlier (subject_id, prediction_time)"
+        )
+    if report["n_labels_without_split"]:
+        issues.append(
+            f"{report['n_labels_without_split']} labels are for {report['n_subjects_without_split']} "
+            "subjects that are not in the subject splits"
+        )
+    n_labels = report["n_labels"]
+    for col, n_null in report["null_counts"].items():
+        is_key = col in (SUBJECT_ID, PREDICTION_TIME)
+        if n_null and (is_key or (col in VALUE_COLUMNS and n_null < n_labels)):
+            issues.append(f"{n_null} of {n_labels} labels have a null {col}")
+    for col, n_nan in report["nan_counts"].items():
+        if n_nan:
+            issues.append(f"{n_nan} of {n_labels} labels have a NaN {col}")
+    return issues
+
+
+__all__ = ["check_labels", "label_files", "label_issues"]
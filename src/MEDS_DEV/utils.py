@@ -1,20 +1,34 @@
 import contextlib
 import dataclasses
+import fcntl
 import hashlib
+import json
 import logging
 import os
+import platform
 import shutil
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+from collections import deque
 from pathlib import Path
 from urllib.parse import urlparse
 
 import validators
 from omegaconf import DictConfig, ListConfig
 
+from .stage_cache import RESOURCES_FILE, run_cached, stage_key
+
 logger = logging.getLogger(__name__)
 
+LOG_MAX_BYTES = 100 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_TAIL_LINES = 100
+_LOG_READ_SIZE = 64 * 1024
+
 
 def is_valid_email(email: str) -> bool:
     """A simple function to check if an email address is valid.
@@ -306,6 +320,35 @@ def install_venv(venv_dir: Path, requirements: str | Path, python: str | None =
     return venv_bin_path
 
 
+def list_shards(data_dir: Path | str) -> list[str]:
+    """Lists the shards of a MEDS data directory, largest first.
+
+    Shards are named as in `aces`' `expand_shards`: by their path relative to the data directory, without the
+    `.parquet` suffix. They are returned in decreasing order of file size (ties broken by name), so that
+    parallel consumers that schedule shards in order start the longest-running shards first.
+
+    Args:
+        data_dir: The MEDS data directory (typically `$DATASET_DIR/data`).
+
+    Returns:
+        The list of shard names.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     data_dir = Path(d)
+        ...     (data_dir / "train").mkdir()
+        ...     _ = (data_dir / "train" / "0.parquet").write_bytes(b"0" * 10)
+        ...     _ = (data_dir / "train" / "1.parquet").write_bytes(b"0" * 30)
+        ...     _ = (data_dir / "held_out.parquet").write_bytes(b"0" * 20)
+        ...     _ = (data_dir / "notes.txt").write_bytes(b"0" * 40)
+        ...     list_shards(data_dir)
+        ['train/1', 'held_out', 'train/0']
+    """
+    data_dir = Path(data_dir)
+    shard_fps = sorted(data_dir.rglob("*.parquet"), key=lambda fp: (-fp.stat().st_size, fp.as_posix()))
+    return [fp.relative_to(data_dir).with_suffix("").as_posix() for fp in shard_fps]
+
+
 def file_hash(filepath, algorithm="sha256", chunk_size=4096):
     hash_func = hashlib.new(algorithm)
     with open(filepath, "rb") as file:
@@ -314,42 +357,385 @@ def file_hash(filepath, algorithm="sha256", chunk_size=4096):
     return hash_func.hexdigest()
 
 
+def venv_store_key(requirements: str | Path, python: str | None = None) -> str:
+    """Returns the key of a virtual environment in the shared venv store.
+
+    Environments are keyed by the contents of the requirements file and the identity of the interpreter they
+    are built with (implementation, version, architecture, and resolved path), so the same requirements
+    installed for different interpreters never share an environment.
+
+    Args:
+        requirements: Path to the requirements file.
+        python: The interpreter the environment is built with. Defaults to the current interpreter.
+
+    Returns:
+        A hex digest key.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     req_1, req_2 = Path(d) / "req_1.txt", Path(d) / "req_2.txt"
+        ...     _ = req_1.write_text("polars")
+        ...     _ = req_2.write_text("polars")
+        ...     print(venv_store_key(req_1) == venv_store_key(req_2))
+        ...     print(venv_store_key(req_1) == venv_store_key(req_1, python="/usr/bin/python3.10"))
+        ...     _ = req_2.write_text("torch")
+        ...     print(venv_store_key(req_1) == venv_store_key(req_2))
+        True
+        False
+        False
+    """
+    interpreter = os.path.realpath(python or sys.executable)
+    identity = f"{sys.implementation.name}-{platform.python_version()}-{platform.machine()}-{interpreter}"
+
+    hash_func = hashlib.sha256(Path(requirements).read_bytes())
+    hash_func.update(b"\0" + identity.encode())
+    return hash_func.hexdigest()
+
+
+def _make_read_only(root: Path):
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in [*dirnames, *filenames]:
+            fp = Path(dirpath) / name
+            if not fp.is_symlink():
+                fp.chmod(fp.stat().st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+    root.chmod(root.stat().st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+def _make_writable(root: Path):
+    root.chmod(root.stat().st_mode | stat.S_IWUSR)
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in [*dirnames, *filenames]:
+            fp = Path(dirpath) / name
+            if not fp.is_symlink():
+                fp.chmod(fp.stat().st_mode | stat.S_IWUSR)
+
+
+@contextlib.contextmanager
+def venv_from_store(store_dir: str | Path, requirements: str | Path) -> Path:
+    """Provides a shared, read-only virtual environment for the given requirements from a venv store.
+
+    The environment lives in `store_dir/$KEY`, where `$KEY` is given by `venv_store_key`, and is installed at
+    most once: if it is not yet installed, the first caller installs it while holding an exclusive file lock
+    on `store_dir/$KEY.install.lock`, and all other callers (including concurrent ones, in other processes)
+    wait for that lock and then reuse the installed environment. Environments are built in place (virtual
+    environments are not relocatable), marked complete with an `.installed` file only once installation
+    succeeds, and then made read-only. A partially installed environment (e.g., from a crashed run) is removed
+    and rebuilt.
+
+    While the context is active, a shared lock is held on `store_dir/$KEY.lock`, so any number of runs can use
+    the environment at once, and tooling that wants to remove environments from the store can take the
+    exclusive lock to ensure that no run is using them. The install lock is only held while installing, never
+    while the environment is in use.
+
+    Args:
+        store_dir: The root directory of the venv store.
+        requirements: Path to the requirements file.
+
+    Yields:
+        The root directory of the virtual environment.
+
+    Examples:
+        >>> from concurrent.futures import ThreadPoolExecutor
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     req = Path(d) / "requirements.txt"
+        ...     _ = req.write_text("")
+        ...     def use_venv(_):
+        ...         with venv_from_store(Path(d) / "store", req) as venv_dir:
+        ...             return venv_dir
+        ...     with ThreadPoolExecutor(max_workers=3) as pool:
+        ...         venv_dirs = list(pool.map(use_venv, range(3)))
+        ...     print(len(set(venv_dirs)), (venv_dirs[0] / ".installed").is_file())
+        ...     print(bool(get_venv_bin_path(venv_dirs[0]).stat().st_mode & stat.S_IWUSR))
+        ...     _make_writable(venv_dirs[0])
+        1 True
+        False
+
+    Runs using the same environment overlap, rather than each waiting for the previous one to finish:
+
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     req = Path(d) / "requirements.txt"
+        ...     _ = req.write_text("")
+        ...     both_inside = threading.Barrier(2, timeout=30)
+        ...     def hold_venv(_):
+        ...         with venv_from_store(Path(d) / "store", req) as venv_dir:
+        ...             both_inside.wait()  # Raises BrokenBarrierError if the other run cannot enter.
+        ...             return venv_dir
+        ...     with ThreadPoolExecutor(max_workers=2) as pool:
+        ...         venv_dirs = list(pool.map(hold_venv, range(2)))
+        ...     print(venv_dirs[0] == venv_dirs[1])
+        ...     _make_writable(venv_dirs[0])
+        True
+    """
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+
+    key = venv_store_key(requirements)
+    venv_dir = store_dir / key
+    installed_fp = venv_dir / ".installed"
+
+    with open(store_dir / f"{key}.lock", "a") as lock_file:
+        # Taken before installing, so the environment cannot be removed between installing and using it.
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        try:
+            if installed_fp.is_file():
+                logger.info(f"Reusing virtual environment {venv_dir} from the venv store.")
+            else:
+                with open(store_dir / f"{key}.install.lock", "a") as install_lock_file:
+                    fcntl.flock(install_lock_file, fcntl.LOCK_EX)
+                    try:
+                        if installed_fp.is_file():
+                            logger.info(f"Reusing virtual environment {venv_dir}, installed by another run.")
+                        else:
+                            if venv_dir.exists():
+                                logger.warning(
+                                    f"Removing partially installed virtual environment {venv_dir}."
+                                )
+                                _make_writable(venv_dir)
+                                shutil.rmtree(venv_dir)
+                            install_venv(venv_dir, requirements)
+                            (venv_dir / "requirements.txt").write_bytes(Path(requirements).read_bytes())
+                            installed_fp.touch()
+                            _make_read_only(venv_dir)
+                    finally:
+                        fcntl.flock(install_lock_file, fcntl.LOCK_UN)
+            yield venv_dir
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
 @contextlib.contextmanager
 def temp_env(cfg: DictConfig, requirements: str | Path | None) -> tuple[Path, dict]:
-    with tempdir_ctx(cfg) as build_temp_dir:
+    with tempdir_ctx(cfg) as build_temp_dir, contextlib.ExitStack() as stack:
         env = os.environ.copy()
         if requirements is not None:
-            if cfg.get("venv_dir", None) is not None:
-                venv_dir = Path(cfg.venv_dir)
+            if cfg.get("venv_store_dir", None) is not None:
+                venv_dir = stack.enter_context(venv_from_store(cfg.venv_store_dir, requirements))
             else:
-                venv_dir = build_temp_dir / ".venv"
-
-            check_fp = venv_dir / f".installed.{file_hash(requirements)}.txt"
-            venv_bin_path = get_venv_bin_path(venv_dir)
-
-            if check_fp.exists():
-                logger.info(f"Requirements already installed in {venv_dir}.")
-            elif venv_bin_path.exists():
-                any_check_fp = any(venv_dir.glob(".installed.*.txt"))
-                if any_check_fp:
-                    logger.warning(
-                        f"Virtual environment {venv_dir} exists, but requirements check files differ! "
-                        "Overwriting."
-                    )
+                if cfg.get("venv_dir", None) is not None:
+                    venv_dir = Path(cfg.venv_dir)
                 else:
-                    logger.warning(f"{venv_dir} exists but no requirements check files found. Overwriting.")
-                shutil.rmtree(venv_dir)
-
-            if not check_fp.exists():
-                install_venv(venv_dir, requirements)
-                check_fp.touch()
+                    venv_dir = build_temp_dir / ".venv"
+
+                check_fp = venv_dir / f".installed.{file_hash(requirements)}.txt"
+                venv_bin_path = get_venv_bin_path(venv_dir)
+
+                if check_fp.exists():
+                    logger.info(f"Requirements already installed in {venv_dir}.")
+                elif venv_bin_path.exists():
+                    any_check_fp = any(venv_dir.glob(".installed.*.txt"))
+                    if any_check_fp:
+                        logger.warning(
+                            f"Virtual environment {venv_dir} exists, but requirements check files differ! "
+                            "Overwriting."
+                        )
+                    else:
+                        logger.warning(
+                            f"{venv_dir} exists but no requirements check files found. Overwriting."
+                        )
+                    shutil.rmtree(venv_dir)
+
+                if not check_fp.exists():
+                    install_venv(venv_dir, requirements)
+                    check_fp.touch()
 
+            venv_bin_path = get_venv_bin_path(venv_dir)
             env["VIRTUAL_ENV"] = str(venv_dir.resolve())
             env["PATH"] = f"{venv_bin_path.resolve()!s}{os.pathsep}{env['PATH']}"
 
         yield build_temp_dir, env
 
 
+@dataclasses.dataclass
+class ResourceUsage:
+    """The resources used by a (completed) command, as recorded in a stage's `.resources.json`.
+
+    CPU times, peak memory, and I/O are taken from the `rusage` of the command's process as returned by
+    `os.wait4`, which includes all of its descendants that it waited on. Peak RSS is thus that of the largest
+    single process in the tree, and I/O counts only the blocks actually read from or written to storage.
+
+    Attributes:
+        wall_time_s: The wall-clock run time, in seconds.
+        user_time_s: The user-mode CPU time, in seconds.
+        system_time_s: The kernel-mode CPU time, in seconds.
+        max_rss_bytes: The peak resident set size, in bytes.
+        read_bytes: The bytes read from storage.
+        written_bytes: The bytes written to storage.
+
+    Examples:
+        >>> import resource
+        >>> rusage = resource.struct_rusage((1.5, 0.25, 2048, 0, 0, 0, 0, 0, 0, 8, 16, 0, 0, 0, 0, 0))
+        >>> ResourceUsage.from_rusage(rusage, wall_time_s=3.0)  # doctest: +NORMALIZE_WHITESPACE
+        ResourceUsage(wall_time_s=3.0, user_time_s=1.5, system_time_s=0.25, max_rss_bytes=2097152,
+                      read_bytes=4096, written_bytes=8192)
+    """
+
+    wall_time_s: float
+    user_time_s: float
+    system_time_s: float
+    max_rss_bytes: int
+    read_bytes: int
+    written_bytes: int
+
+    @classmethod
+    def from_rusage(cls, rusage, wall_time_s: float) -> "ResourceUsage":
+        # `ru_maxrss` is in kibibytes on Linux but in bytes on macOS; block counts are in 512-byte units.
+        rss_unit = 1 if sys.platform == "darwin" else 1024
+        return cls(
+            wall_time_s=wall_time_s,
+            user_time_s=rusage.ru_utime,
+            system_time_s=rusage.ru_stime,
+            max_rss_bytes=rusage.ru_maxrss * rss_unit,
+            read_bytes=rusage.ru_inblock * 512,
+            written_bytes=rusage.ru_oublock * 512,
+        )
+
+
+class _RotatingLog:
+    """A binary log file that is rotated (to `$NAME.1`, `$NAME.2`, ...) once it exceeds `max_bytes`.
+
+    A pre-existing log (e.g., from a prior, failed run) is rotated away on open rather than appended to.
+    """
+
+    def __init__(self, fp: Path, max_bytes: int, backup_count: int):
+        self.fp = fp
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.fp.parent.mkdir(parents=True, exist_ok=True)
+        if self.fp.is_file() and self.fp.stat().st_size > 0:
+            self._rotate_files()
+        self._file = open(self.fp, "wb")  # noqa: SIM115
+        self._size = 0
+
+    def _rotate_files(self):
+        if self.backup_count <= 0:
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            src = self.fp.with_name(f"{self.fp.name}.{i}")
+            if src.is_file():
+                src.replace(self.fp.with_name(f"{self.fp.name}.{i + 1}"))
+        self.fp.replace(self.fp.with_name(f"{self.fp.name}.1"))
+
+    def write(self, data: bytes):
+        if self._size > 0 and self._size + len(data) > self.max_bytes:
+            self._file.close()
+            self._rotate_files()
+            self._file = open(self.fp, "wb")  # noqa: SIM115
+            self._size = 0
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+
+    def close(self):
+        self._file.close()
+
+
+def stream_subprocess(
+    cmd: str | list[str],
+    log_dir: Path | str,
+    live_tail: bool = False,
+    max_bytes: int = LOG_MAX_BYTES,
+    backup_count: int = LOG_BACKUP_COUNT,
+    tail_lines: int = LOG_TAIL_LINES,
+    resources_fp: Path | str | None = None,
+    **popen_kwargs,
+) -> subprocess.CompletedProcess:
+    """Runs a command, streaming its output line by line to rotating `stdout.log` and `stderr.log` files.
+
+    Unlike `subprocess.run(..., capture_output=True)`, the output is never held in memory in full: each line
+    is written to the log files in `log_dir` as soon as it is produced, and only the last `tail_lines` lines
+    of each stream are kept, to report on failure. Very long lines (e.g., progress bars that only use carriage
+    returns) are read in bounded chunks.
+
+    Args:
+        cmd: The command to run, as for `subprocess.Popen`.
+        log_dir: The directory in which to write `stdout.log` and `stderr.log`.
+        live_tail: If true, also echo the output to this process's stdout and stderr as it is produced.
+        max_bytes: The size at which a log file is rotated.
+        backup_count: How many rotated log files (`stdout.log.1`, ...) to keep.
+        tail_lines: How many of the last lines of each stream to keep in memory and return.
+        resources_fp: If given, the `ResourceUsage` of the command is written to this JSON file.
+        popen_kwargs: Further keyword arguments for `subprocess.Popen` (e.g., `env`, `cwd`, `shell`).
+
+    Returns:
+        A `CompletedProcess` whose `stdout` and `stderr` hold only the tails of the output streams.
+
+    Examples:
+        >>> import tempfile
+        >>> code = "import sys; [print(f'line {i}') for i in range(5)]; print('oops', file=sys.stderr)"
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     out = stream_subprocess(["python", "-c", code], d, tail_lines=2)
+        ...     print(out.returncode, out.stdout, out.stderr)
+        ...     print((Path(d) / "stdout.log").read_text().splitlines())
+        0 b'line 3\\nline 4\\n' b'oops\\n'
+        ['line 0', 'line 1', 'line 2', 'line 3', 'line 4']
+
+    The resources the command used can be recorded, too:
+
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     resources_fp = Path(d) / "resources.json"
+        ...     _ = stream_subprocess(["python", "-c", "x = bytearray(2**26)"], d, resources_fp=resources_fp)
+        ...     resources = json.loads(resources_fp.read_text())
+        >>> sorted(resources)
+        ['max_rss_bytes', 'read_bytes', 'system_time_s', 'user_time_s', 'wall_time_s', 'written_bytes']
+        >>> resources["max_rss_bytes"] > 2**26, resources["wall_time_s"] > 0
+        (True, True)
+
+    Logs are rotated once they grow too large, and a prior run's logs are rotated away, not appended to:
+
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     _ = stream_subprocess(["python", "-c", code], d, max_bytes=14, backup_count=2)
+        ...     print(sorted(fp.name for fp in Path(d).iterdir()))
+        ...     print((Path(d) / "stdout.log").read_text().splitlines())
+        ...     _ = stream_subprocess(["python", "-c", "print('again')"], d, max_bytes=14, backup_count=2)
+        ...     print((Path(d) / "stdout.log").read_text() + (Path(d) / "stdout.log.1").read_text(), end="")
+        ['stderr.log', 'stdout.log', 'stdout.log.1', 'stdout.log.2']
+        ['line 4']
+        again
+        line 4
+    """
+    log_dir = Path(log_dir)
+    popen_kwargs = {**popen_kwargs, "stdout": subprocess.PIPE, "stderr": subprocess.PIPE}
+
+    tails = {"stdout": deque(maxlen=tail_lines), "stderr": deque(maxlen=tail_lines)}
+    consoles = {"stdout": sys.stdout, "stderr": sys.stderr}
+
+    def pump(name: str, pipe):
+        log = _RotatingLog(log_dir / f"{name}.log", max_bytes, backup_count)
+        try:
+            for chunk in iter(lambda: pipe.readline(_LOG_READ_SIZE), b""):
+                log.write(chunk)
+                tails[name].append(chunk)
+                if live_tail:
+                    consoles[name].write(chunk.decode(errors="replace"))
+                    consoles[name].flush()
+        finally:
+            log.close()
+            pipe.close()
+
+    start = time.perf_counter()
+    with subprocess.Popen(cmd, **popen_kwargs) as proc:
+        threads = [
+            threading.Thread(target=pump, args=("stdout", proc.stdout), daemon=True),
+            threading.Thread(target=pump, args=("stderr", proc.stderr), daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # `wait4` (unlike `Popen.wait`) also returns the resources used by the process tree.
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = returncode = os.waitstatus_to_exitcode(status)
+    wall_time_s = time.perf_counter() - start
+
+    if resources_fp is not None:
+        resources = ResourceUsage.from_rusage(rusage, wall_time_s=wall_time_s)
+        Path(resources_fp).write_text(json.dumps(dataclasses.asdict(resources), indent=2))
+
+    return subprocess.CompletedProcess(
+        cmd, returncode, stdout=b"".join(tails["stdout"]), stderr=b"".join(tails["stderr"])
+    )
+
+
 def run_in_env(
     cmd: str,
     output_dir: Path | str,
@@ -357,6 +743,10 @@ def run_in_env(
     do_overwrite: bool = False,
     cwd: Path | str | None = None,
     run_as_script: bool = True,
+    cache_dir: Path | str | None = None,
+    cache_inputs: dict[str, Path | str | None] | None = None,
+    live_tail: bool = False,
+    cache_masks: dict[str, Path | str | None] | None = None,
 ) -> subprocess.CompletedProcess:
     if type(output_dir) is str:
         output_dir = Path(output_dir)
@@ -367,6 +757,20 @@ def run_in_env(
 
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    if cache_dir is not None:
+        # The stage cache replaces the `.done` and `cmd.sh` checks below: the stage is re-run if and only if
+        # its command, inputs, or package versions changed, and is materialized from the cache if it has
+        # already been run elsewhere.
+        key = stage_key(cmd, output_dir, inputs=cache_inputs, masks={"cwd": cwd, **(cache_masks or {})})
+        return run_cached(
+            lambda: run_in_env(
+                cmd, output_dir, env=env, cwd=cwd, run_as_script=run_as_script, live_tail=live_tail
+            ),
+            output_dir,
+            key,
+            cache_dir,
+        )
+
     done_file = output_dir / ".done"
     if done_file.is_file():
         logger.info(f"Skipping {cmd} because {done_file} exists.")
@@ -375,7 +779,7 @@ def run_in_env(
     if env is None:
         env = os.environ.copy()
 
-    runner_kwargs = {"env": env, "capture_output": True}
+    runner_kwargs = {"env": env}
 
     if run_as_script:
         script_file = output_dir / "cmd.sh"
@@ -415,7 +819,12 @@ def run_in_env(
     if cwd is not None:
         runner_kwargs["cwd"] = cwd
 
-    command_out = subprocess.run(cmd, **runner_kwargs)
+    # Output is streamed to (hidden, so never cached or fingerprinted) log files rather than captured, as
+    # long-running stages (e.g., model training) can produce far more of it than should be held in memory.
+    log_dir = output_dir / ".logs"
+    command_out = stream_subprocess(
+        cmd, log_dir, live_tail=live_tail, resources_fp=output_dir / RESOURCES_FILE, **runner_kwargs
+    )
 
     command_errored = command_out.returncode != 0
     if command_errored:
@@ -423,8 +832,10 @@ def run_in_env(
             f"Command failed with exit code "
             f"{command_out.returncode}:\n"
             f"SCRIPT:\n{cmd_contents_error}\n"
-            f"STDERR:\n{command_out.stderr.decode()}\n"
-            f"STDOUT:\n{command_out.stdout.decode()}"
+            f"STDERR (last {LOG_TAIL_LINES} lines; full output in {log_dir / 'stderr.log'}):\n"
+            f"{command_out.stderr.decode(errors='replace')}\n"
+            f"STDOUT (last {LOG_TAIL_LINES} lines; full output in {log_dir / 'stdout.log'}):\n"
+            f"{command_out.stdout.decode(errors='replace')}"
         )
     else:
         done_file.touch()
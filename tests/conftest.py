@@ -2,13 +2,14 @@ import contextlib
 import itertools
 import logging
 import shutil
+from collections.abc import Mapping
 from pathlib import Path
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 
-import polars as pl
 import pytest
 
 from MEDS_DEV import DATASETS, MODELS, TASKS
+from MEDS_DEV.tasks.label_checks import check_labels
 from tests.utils import NAME_AND_DIR, run_command
 
 logger = logging.getLogger(__name__)
@@ -309,7 +310,7 @@ def get_opts(config, opt: str) -> list[str]:
 
     out = (allowed[opt] if "all" in arg else arg) if arg else allowed[opt]
 
-    if isinstance(out, dict):
+    if isinstance(out, Mapping):
         out = list(out.keys())
 
     return out
@@ -372,9 +373,11 @@ def demo_dataset(request, venv_cache: Path) -> NAME_AND_DIR:
                 },
             )
 
-            # Dataset venvs should never be used again, so we delete it here for simplicity.
-            logger.info(f"Deleting venv for {dataset_name} at {venv_dir}")
-            shutil.rmtree(venv_dir)
+            # Dataset venvs should never be used again, so we delete it here for simplicity. Datasets without
+            # requirements (e.g., the synthetic dataset) run in the current environment and have no venv.
+            if venv_dir.exists():
+                logger.info(f"Deleting venv for {dataset_name} at {venv_dir}")
+                shutil.rmtree(venv_dir)
 
             check_fp.parent.mkdir(parents=True, exist_ok=True)
             check_fp.touch()
@@ -429,6 +432,7 @@ def missing_labels_in_splits(labels_dir: Path, dataset_dir: Path) -> set[str]:
         A set of split names that are missing labels.
 
     Examples:
+        >>> import polars as pl
         >>> splits = pl.DataFrame({"subject_id": [1, 2, 3], "split": ["train", "tuning", "held_out"]})
         >>> labels = pl.DataFrame({"subject_id": [1, 3]}) # This is not a true label schema
         >>> with TemporaryDirectory() as temp_dir:
@@ -476,19 +480,7 @@ def missing_labels_in_splits(labels_dir: Path, dataset_dir: Path) -> set[str]:
         set()
     """
 
-    labels = pl.concat(
-        [pl.read_parquet(f, use_pyarrow=True, columns=["subject_id"]) for f in labels_dir.rglob("*.parquet")],
-        how="vertical_relaxed",
-    )
-    label_subjects = set(labels["subject_id"].unique())
-
-    subject_splits = pl.read_parquet(dataset_dir / "metadata" / "subject_splits.parquet", use_pyarrow=True)
-    all_splits = set(subject_splits["split"].unique())
-
-    subj_splits_with_label = subject_splits.filter(pl.col("subject_id").is_in(label_subjects))
-    splits_with_labels = set(subj_splits_with_label["split"].unique())
-
-    return all_splits - splits_with_labels
+    return set(check_labels(labels_dir, dataset_dir)["missing_splits"])
 
 
 @pytest.fixture(scope="session")
@@ -1,9 +1,13 @@
+import json
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
+import polars as pl
 from meds_testing_helpers.dataset import MEDSDataset
 
 from MEDS_DEV import DATASETS
+from MEDS_DEV.datasets.materialize import load_materialized, read_shard, read_shard_table
+from MEDS_DEV.datasets.profiling import load_profile
 from tests.utils import NAME_AND_DIR, run_command
 
 
@@ -34,3 +38,120 @@ def test_datasets_configured(demo_dataset: NAME_AND_DIR):
         MEDSDataset(root_dir=demo_dataset_dir)
     except Exception as e:
         raise AssertionError(f"Failed to validate dataset {dataset_name} from {demo_dataset_dir}") from e
+
+
+def test_reshard(demo_dataset: NAME_AND_DIR):
+    dataset_name, demo_dataset_dir = demo_dataset
+
+    def split_events(data_dir: Path) -> pl.DataFrame:
+        return (
+            pl.read_parquet(data_dir / "**/*.parquet", include_file_paths="path")
+            .with_columns(pl.col("path").str.strip_prefix(f"{data_dir}/").str.split("/").list.first())
+            .group_by("path", "subject_id")
+            .agg(pl.len())
+            .sort("path", "subject_id")
+        )
+
+    with TemporaryDirectory() as root_dir:
+        output_dir = Path(root_dir) / "resharded"
+        hydra_kwargs = {
+            "input_dir": str(demo_dataset_dir.resolve()),
+            "output_dir": str(output_dir.resolve()),
+            "n_shards": 4,
+            "n_workers": 2,
+        }
+        run_command("meds-dev-reshard", f"Reshard {dataset_name}", hydra_kwargs)
+        assert (output_dir / ".done").is_file()
+
+        mtimes = {fp: fp.stat().st_mtime_ns for fp in (output_dir / "data").rglob("*.parquet")}
+        run_command("meds-dev-reshard", f"Re-run reshard {dataset_name}", hydra_kwargs)
+        assert mtimes == {fp: fp.stat().st_mtime_ns for fp in (output_dir / "data").rglob("*.parquet")}
+
+        run_command(
+            "meds-dev-reshard", f"Overwrite reshard {dataset_name}", {**hydra_kwargs, "do_overwrite": True}
+        )
+        assert (output_dir / ".done").is_file()
+
+        try:
+            MEDSDataset(root_dir=output_dir)
+        except Exception as e:
+            raise AssertionError(f"Failed to validate resharded {dataset_name} at {output_dir}") from e
+
+        assert len(list((output_dir / "data").rglob("*.parquet"))) == 4
+        assert split_events(output_dir / "data").equals(split_events(demo_dataset_dir / "data"))
+        for fp in (demo_dataset_dir / "metadata").rglob("*"):
+            if fp.is_file():
+                assert fp.read_bytes() == (output_dir / fp.relative_to(demo_dataset_dir)).read_bytes()
+
+
+def test_profile(demo_dataset: NAME_AND_DIR):
+    dataset_name, demo_dataset_dir = demo_dataset
+
+    with TemporaryDirectory() as root_dir:
+        hydra_kwargs = {
+            "dataset_dir": str(demo_dataset_dir.resolve()),
+            "profile_dir": str(Path(root_dir).resolve()),
+            "n_workers": 2,
+        }
+        _, stdout = run_command("meds-dev-profile", f"Profile {dataset_name}", hydra_kwargs)
+        summary = json.loads(stdout)
+
+        profile = load_profile(demo_dataset_dir, root_dir)
+        assert str(profile.profile_dir) == summary["profile_dir"]
+
+        _, stdout = run_command("meds-dev-profile", f"Re-profile {dataset_name}", hydra_kwargs)
+        assert json.loads(stdout) == summary
+        assert len(list(Path(root_dir).iterdir())) == 1
+
+        codes, subjects, splits = profile.codes, profile.subjects, profile.splits
+
+    data = pl.read_parquet(demo_dataset_dir / "data" / "**/*.parquet")
+    code_counts = data.group_by("code").len().sort("code")
+    assert (
+        codes.select("code", pl.col("n_events").alias("len"))
+        .sort("code")
+        .equals(code_counts, null_equal=True)
+    )
+    assert summary["n_events"] == len(data) == subjects["n_events"].sum() == splits["n_events"].sum()
+    assert summary["n_subjects"] == data["subject_id"].n_unique() == len(subjects)
+
+    values = data.filter(pl.col("numeric_value").is_not_null() & pl.col("numeric_value").is_not_nan())
+    top_code = codes.filter(pl.col("n_values") > 0).row(0, named=True)
+    code_values = values.filter(pl.col("code") == top_code["code"])["numeric_value"].cast(pl.Float64)
+    assert top_code["n_values"] == len(code_values)
+    assert top_code["min"] == code_values.min() and top_code["max"] == code_values.max()
+    assert abs(top_code["mean"] - code_values.mean()) < 1e-6 * max(1, abs(code_values.mean()))
+    assert code_values.quantile(0.4) <= top_code["q50"] <= code_values.quantile(0.6)
+
+
+def test_materialize(demo_dataset: NAME_AND_DIR):
+    dataset_name, demo_dataset_dir = demo_dataset
+
+    with TemporaryDirectory() as root_dir:
+        hydra_kwargs = {
+            "dataset_dir": str(demo_dataset_dir.resolve()),
+            "materialized_dir": str(Path(root_dir).resolve()),
+            "n_workers": 2,
+        }
+        _, stdout = run_command("meds-dev-materialize", f"Materialize {dataset_name}", hydra_kwargs)
+        shards = {shard: Path(fp) for shard, fp in json.loads(stdout)["shards"].items()}
+        assert shards == load_materialized(demo_dataset_dir, root_dir)
+
+        assert all(fp == Path(root_dir).resolve() / f"{shard}.arrow" for shard, fp in shards.items())
+        mtimes = {shard: fp.stat().st_mtime_ns for shard, fp in shards.items()}
+
+        _, stdout = run_command("meds-dev-materialize", f"Re-materialize {dataset_name}", hydra_kwargs)
+        assert json.loads(stdout)["shards"] == {shard: str(fp) for shard, fp in shards.items()}
+        assert mtimes == {shard: fp.stat().st_mtime_ns for shard, fp in shards.items()}, "Shards reconverted"
+
+        want_shards = sorted(
+            fp.relative_to(demo_dataset_dir / "data").with_suffix("").as_posix()
+            for fp in (demo_dataset_dir / "data").glob("**/*.parquet")
+        )
+        assert sorted(shards) == want_shards
+
+        for shard, fp in shards.items():
+            want = pl.read_parquet(demo_dataset_dir / "data" / f"{shard}.parquet")
+            assert read_shard_table(fp).schema.field("code").type.value_type in ("string", "large_string")
+            got = read_shard(fp).with_columns(pl.col("code").cast(pl.String))
+            assert got.equals(want, null_equal=True), f"Materialized shard {shard} differs from the original"
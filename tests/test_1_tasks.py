@@ -1,6 +1,9 @@
+import json
+import shutil
 import tempfile
 from pathlib import Path
 
+import polars as pl
 import pytest
 
 from MEDS_DEV import DATASETS, TASKS
@@ -60,6 +63,82 @@ def test_tasks_configured(demo_dataset: NAME_AND_DIR, task_labels: NAME_AND_DIR)
     assert files, f"No files found for task {task_name} in dataset {dataset_name}"
 
 
+def test_check_labels(demo_dataset: NAME_AND_DIR, task_labels: NAME_AND_DIR):
+    dataset_name, dataset_dir = demo_dataset
+    task_name, task_labels_dir = task_labels
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        report_fp = Path(tmpdir) / "report.json"
+        run_command(
+            "meds-dev-check-labels",
+            test_name=f"Labels of {task_name} on {dataset_name} should be checked",
+            hydra_kwargs={
+                "labels_dir": str(task_labels_dir.resolve()),
+                "dataset_dir": str(dataset_dir.resolve()),
+                "output_fp": str(report_fp),
+                "strict": False,
+            },
+        )
+        report = json.loads(report_fp.read_text())
+
+    labels = pl.read_parquet(task_labels_dir / "**/*.parquet")
+    assert report["n_labels"] == len(labels)
+    assert report["n_subjects"] == labels["subject_id"].n_unique()
+    assert sum(split["n_labels"] for split in report["splits"].values()) == len(labels)
+    assert report["n_duplicate_labels"] == 0
+    assert report["n_labels_without_split"] == 0
+    assert report["null_counts"]["subject_id"] == 0
+
+
+def test_subsample_stratified_by_labels(demo_dataset: NAME_AND_DIR, task_labels: NAME_AND_DIR):
+    dataset_name, dataset_dir = demo_dataset
+    task_name, task_labels_dir = task_labels
+
+    splits = pl.read_parquet(dataset_dir / "metadata" / "subject_splits.parquet")
+    positive = (
+        pl.read_parquet(task_labels_dir / "**/*.parquet")
+        .group_by("subject_id")
+        .agg(pl.col("boolean_value").any())
+        .filter("boolean_value")["subject_id"]
+    )
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        subset_dir = Path(tmpdir) / "subset"
+        hydra_kwargs = {
+            "input_dir": str(dataset_dir.resolve()),
+            "output_dir": str(subset_dir.resolve()),
+            "fraction": 0.1,
+            "labels_dir": str(task_labels_dir.resolve()),
+            "n_workers": 2,
+        }
+        run_command("meds-dev-subsample", f"Subsample {dataset_name} stratified by {task_name}", hydra_kwargs)
+        assert (subset_dir / ".done").is_file()
+
+        mtimes = {fp: fp.stat().st_mtime_ns for fp in (subset_dir / "data").rglob("*.parquet")}
+        run_command("meds-dev-subsample", f"Re-run subsample {dataset_name}", hydra_kwargs)
+        assert mtimes == {fp: fp.stat().st_mtime_ns for fp in (subset_dir / "data").rglob("*.parquet")}
+
+        hydra_kwargs["do_overwrite"] = True
+        run_command("meds-dev-subsample", f"Overwrite subsample {dataset_name}", hydra_kwargs)
+        assert (subset_dir / ".done").is_file()
+
+        subset_splits = pl.read_parquet(subset_dir / "metadata" / "subject_splits.parquet")
+        subset_data = pl.read_parquet(subset_dir / "data" / "**/*.parquet")
+        full_data = pl.read_parquet(dataset_dir / "data" / "**/*.parquet")
+
+    assert 0 < len(subset_splits) < len(splits)
+    assert (
+        subset_splits.join(splits, on="subject_id", suffix="_full")
+        .filter(pl.col("split") != pl.col("split_full"))
+        .is_empty()
+    )
+    assert set(subset_splits["split"]) == set(splits["split"])
+    assert subset_splits["subject_id"].is_in(positive).any()
+
+    subset_events = full_data.filter(pl.col("subject_id").is_in(subset_splits["subject_id"]))
+    assert subset_data.sort(subset_data.columns).equals(subset_events.sort(subset_events.columns))
+
+
 def test_task_consistent_when_using_manual_predicates(demo_dataset: NAME_AND_DIR, task_labels: NAME_AND_DIR):
     dataset_name, dataset_dir = demo_dataset
     task_name, task_labels_dir = task_labels
@@ -87,3 +166,193 @@ def test_task_consistent_when_using_manual_predicates(demo_dataset: NAME_AND_DIR
             assert file.read_bytes() == original_file.read_bytes(), (
                 f"File {relative_file} differs from original"
             )
+
+
+def test_task_consistent_when_extracting_shards_in_parallel(
+    demo_dataset: NAME_AND_DIR, task_labels: NAME_AND_DIR
+):
+    dataset_name, dataset_dir = demo_dataset
+    task_name, task_labels_dir = task_labels
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        alt_task_labels_dir = Path(tmpdir) / "task_labels"
+        run_command(
+            "meds-dev-task",
+            test_name=f"Task {task_name} should run for {dataset_name} with parallel shard extraction",
+            hydra_kwargs={
+                "task": task_name,
+                "dataset": dataset_name,
+                "dataset_dir": str(dataset_dir.resolve()),
+                "output_dir": str(alt_task_labels_dir.resolve()),
+                "n_workers": 2,
+            },
+        )
+
+        alt_files = sorted(
+            f.relative_to(alt_task_labels_dir) for f in alt_task_labels_dir.glob("**/*.parquet")
+        )
+        want_files = sorted(f.relative_to(task_labels_dir) for f in task_labels_dir.glob("**/*.parquet"))
+        assert alt_files == want_files, f"Parallel extraction wrote {alt_files}, want {want_files}"
+
+        for relative_file in alt_files:
+            assert (alt_task_labels_dir / relative_file).read_bytes() == (
+                task_labels_dir / relative_file
+            ).read_bytes(), f"File {relative_file} differs from original"
+
+
+def test_task_consistent_when_extracting_multiple_tasks(
+    demo_dataset: NAME_AND_DIR, task_labels: NAME_AND_DIR
+):
+    dataset_name, dataset_dir = demo_dataset
+    task_name, task_labels_dir = task_labels
+
+    other_tasks = [
+        t
+        for t, task_info in TASKS.items()
+        if t != task_name and dataset_name in (task_info["metadata"].supported_datasets or [])
+    ]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        alt_task_labels_dir = Path(tmpdir) / "task_labels"
+        run_command(
+            "meds-dev-task",
+            test_name=f"Task {task_name} should run for {dataset_name} alongside other tasks",
+            hydra_kwargs={
+                "task": [task_name, *other_tasks[:1]],
+                "dataset": dataset_name,
+                "dataset_dir": str(dataset_dir.resolve()),
+                "output_dir": str(alt_task_labels_dir.resolve()),
+            },
+        )
+
+        alt_task_labels_dir = alt_task_labels_dir / task_name
+        alt_files = sorted(
+            f.relative_to(alt_task_labels_dir) for f in alt_task_labels_dir.glob("**/*.parquet")
+        )
+        want_files = sorted(f.relative_to(task_labels_dir) for f in task_labels_dir.glob("**/*.parquet"))
+        assert alt_files == want_files, f"Multi-task extraction wrote {alt_files}, want {want_files}"
+
+        for relative_file in alt_files:
+            got = pl.read_parquet(alt_task_labels_dir / relative_file)
+            want = pl.read_parquet(task_labels_dir / relative_file)
+            assert got.equals(want), f"File {relative_file} differs from original"
+
+
+def test_task_consistent_when_using_predicates_cache(demo_dataset: NAME_AND_DIR, task_labels: NAME_AND_DIR):
+    dataset_name, dataset_dir = demo_dataset
+    task_name, task_labels_dir = task_labels
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        predicates_cache_dir = Path(tmpdir) / "predicates"
+        run_command(
+            "meds-dev-predicates",
+            test_name=f"Predicates should be cached for {dataset_name}",
+            hydra_kwargs={
+                "dataset": dataset_name,
+                "dataset_dir": str(dataset_dir.resolve()),
+                "output_dir": str(predicates_cache_dir.resolve()),
+                "tasks": [task_name],
+            },
+        )
+
+        alt_task_labels_dir = Path(tmpdir) / "task_labels"
+        run_command(
+            "meds-dev-task",
+            test_name=f"Task {task_name} should run for {dataset_name} from the predicates cache",
+            hydra_kwargs={
+                "task": task_name,
+                "dataset": dataset_name,
+                "dataset_dir": str(dataset_dir.resolve()),
+                "output_dir": str(alt_task_labels_dir.resolve()),
+                "predicates_cache_dir": str(predicates_cache_dir.resolve()),
+            },
+        )
+
+        alt_files = sorted(
+            f.relative_to(alt_task_labels_dir) for f in alt_task_labels_dir.glob("**/*.parquet")
+        )
+        want_files = sorted(f.relative_to(task_labels_dir) for f in task_labels_dir.glob("**/*.parquet"))
+        assert alt_files == want_files, f"Cached extraction wrote {alt_files}, want {want_files}"
+
+        for relative_file in alt_files:
+            got = pl.read_parquet(alt_task_labels_dir / relative_file)
+            want = pl.read_parquet(task_labels_dir / relative_file)
+            assert got.equals(want), f"File {relative_file} differs from original"
+
+
+def test_task_consistent_when_using_code_index(demo_dataset: NAME_AND_DIR, task_labels: NAME_AND_DIR):
+    dataset_name, dataset_dir = demo_dataset
+    task_name, task_labels_dir = task_labels
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # The code index is written into the dataset directory, so index a copy of it.
+        indexed_dataset_dir = Path(tmpdir) / "dataset"
+        shutil.copytree(dataset_dir, indexed_dataset_dir)
+
+        alt_task_labels_dir = Path(tmpdir) / "task_labels"
+        run_command(
+            "meds-dev-task",
+            test_name=f"Task {task_name} should run for {dataset_name} with a code index",
+            hydra_kwargs={
+                "task": task_name,
+                "dataset": dataset_name,
+                "dataset_dir": str(indexed_dataset_dir.resolve()),
+                "output_dir": str(alt_task_labels_dir.resolve()),
+                "code_index": True,
+            },
+        )
+
+        shards = sorted(
+            f.relative_to(indexed_dataset_dir / "data").with_suffix("")
+            for f in (indexed_dataset_dir / "data").glob("**/*.parquet")
+        )
+        indexed = sorted(
+            f.relative_to(indexed_dataset_dir / ".code_index").with_suffix("")
+            for f in (indexed_dataset_dir / ".code_index").glob("**/*.parquet")
+        )
+        assert indexed == shards, f"Code index covers {indexed}, want {shards}"
+
+        alt_files = sorted(
+            f.relative_to(alt_task_labels_dir) for f in alt_task_labels_dir.glob("**/*.parquet")
+        )
+        want_files = sorted(f.relative_to(task_labels_dir) for f in task_labels_dir.glob("**/*.parquet"))
+        assert alt_files == want_files, f"Indexed extraction wrote {alt_files}, want {want_files}"
+
+        for relative_file in alt_files:
+            got = pl.read_parquet(alt_task_labels_dir / relative_file)
+            want = pl.read_parquet(task_labels_dir / relative_file)
+            assert got.equals(want), f"File {relative_file} differs from original"
+
+
+def test_task_reused_from_stage_cache(demo_dataset: NAME_AND_DIR, task_labels: NAME_AND_DIR):
+    dataset_name, dataset_dir = demo_dataset
+    task_name, task_labels_dir = task_labels
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        stage_cache_dir = Path(tmpdir) / "stage_cache"
+        labels_dirs = [Path(tmpdir) / "task_labels_1", Path(tmpdir) / "task_labels_2"]
+        for labels_dir in labels_dirs:
+            run_command(
+                "meds-dev-task",
+                test_name=f"Task {task_name} should run for {dataset_name} through the stage cache",
+                hydra_kwargs={
+                    "task": task_name,
+                    "dataset": dataset_name,
+                    "dataset_dir": str(dataset_dir.resolve()),
+                    "output_dir": str(labels_dir.resolve()),
+                    "stage_cache_dir": str(stage_cache_dir.resolve()),
+                },
+            )
+
+        want_files = sorted(f.relative_to(task_labels_dir) for f in task_labels_dir.glob("**/*.parquet"))
+        for labels_dir in labels_dirs:
+            got_files = sorted(f.relative_to(labels_dir) for f in labels_dir.glob("**/*.parquet"))
+            assert got_files == want_files, f"Cached extraction wrote {got_files}, want {want_files}"
+
+        # The second extraction should be materialized from the first via hard links.
+        for relative_file in want_files:
+            first, second = labels_dirs[0] / relative_file, labels_dirs[1] / relative_file
+            assert first.read_bytes() == (task_labels_dir / relative_file).read_bytes()
+            assert second.stat().st_ino == first.stat().st_ino or second.is_symlink(), (
+                f"File {relative_file} was not materialized from the stage cache"
+            )
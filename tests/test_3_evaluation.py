@@ -1,5 +1,11 @@
 import json
 from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import polars as pl
+
+from tests.utils import run_command
 
 
 def test_evaluates(evaluated_model: Path):
@@ -7,7 +13,8 @@ def test_evaluates(evaluated_model: Path):
 
     try:
         assert evaluation_dir.exists(), "Evaluation dir should exist"
-        assert len(list(evaluation_dir.rglob("*.json"))) == 1, "There should only be one result file."
+        result_fps = [fp for fp in evaluation_dir.rglob("*.json") if not fp.name.startswith(".")]
+        assert len(result_fps) == 1, "There should only be one result file."
         eval_fp = evaluation_dir / "results.json"
         assert eval_fp.is_file(), "The result file should exist"
         try:
@@ -27,3 +34,255 @@ def test_evaluates(evaluated_model: Path):
         error_lines.append(f"Directory {d} exists. Contents:")
         error_lines.append(str(list(d.rglob("*"))))
         raise AssertionError("\n".join(error_lines)) from e
+
+
+METRICS = {
+    "binary_accuracy",
+    "f1_score",
+    "roc_auc_score",
+    "average_precision_score",
+    "calibration_error",
+    "brier_score",
+}
+
+
+def make_predictions(seed: int, n: int = 300) -> pl.DataFrame:
+    rng = np.random.default_rng(seed)
+    labels = rng.random(n) < 0.3
+    probs = np.clip(0.4 * labels + 0.6 * rng.random(n), 0, 1)
+    return pl.DataFrame(
+        {
+            "subject_id": np.arange(n) // 6,
+            "boolean_value": labels,
+            "predicted_boolean_value": probs > 0.5,
+            "predicted_boolean_probability": probs,
+        }
+    ).with_columns(prediction_time=pl.datetime(2020, 1, 1) + pl.duration(days=pl.int_range(pl.len())))
+
+
+def test_evaluates_in_process():
+    predictions = make_predictions(1)
+
+    with TemporaryDirectory() as root_dir:
+        root_dir = Path(root_dir)
+        predictions_dir = root_dir / "predictions"
+        predictions_dir.mkdir()
+        predictions.write_parquet(predictions_dir / "held_out.parquet")
+        output_dir = root_dir / "evaluation"
+
+        run_command(
+            "meds-dev-evaluation",
+            test_name="In-process evaluation should succeed",
+            hydra_kwargs={
+                "predictions_dir": str(predictions_dir),
+                "output_dir": str(output_dir),
+                "in_process": True,
+                "n_bootstrap": 50,
+            },
+        )
+
+        assert (output_dir / ".done").is_file(), "The evaluation should be marked as done."
+        results = json.loads((output_dir / "results.json").read_text())
+
+    for weighting in ("samples_equally_weighted", "subjects_equally_weighted"):
+        assert set(results[weighting]) == METRICS
+        intervals = results["confidence_intervals"][weighting]
+        assert set(intervals) == METRICS
+        for name, (low, high) in intervals.items():
+            assert low <= high, f"The {weighting} {name} interval should not be empty."
+    assert results["confidence_intervals"]["n_bootstrap"] == 50
+
+
+def test_evaluates_prediction_sets():
+    # Two "models" predicting the same rows, in different orders, and with different labels in the second set
+    # to check that the labels are only read from the first.
+    sets = {
+        "model_a": make_predictions(1),
+        "model_b": make_predictions(2).with_columns(boolean_value=False).reverse(),
+    }
+
+    with TemporaryDirectory() as root_dir:
+        root_dir = Path(root_dir)
+        output_dir = root_dir / "evaluation"
+        prediction_sets = {}
+        for name, predictions in sets.items():
+            predictions_dir = root_dir / name
+            predictions_dir.mkdir()
+            predictions.write_parquet(predictions_dir / "held_out.parquet")
+            prediction_sets[f"+prediction_sets.{name}"] = str(predictions_dir)
+
+        run_command(
+            "meds-dev-evaluation",
+            test_name="Batch evaluation should succeed",
+            hydra_kwargs={"output_dir": str(output_dir), "n_bootstrap": 20, **prediction_sets},
+        )
+
+        results = {}
+        for name in sets:
+            assert (output_dir / name / ".done").is_file(), f"The evaluation of {name} should be marked done."
+            results[name] = json.loads((output_dir / name / "results.json").read_text())
+
+        labels_b = sets["model_a"].select("subject_id", "prediction_time", "boolean_value")
+        predictions_b = labels_b.join(
+            sets["model_b"].drop("boolean_value"), on=["subject_id", "prediction_time"], how="left"
+        )
+        predictions_b.write_parquet(root_dir / "model_b" / "held_out.parquet")
+        run_command(
+            "meds-dev-evaluation",
+            test_name="In-process evaluation of one prediction set should succeed",
+            hydra_kwargs={
+                "predictions_dir": str(root_dir / "model_b"),
+                "output_dir": str(root_dir / "model_b_evaluation"),
+                "in_process": True,
+                "n_bootstrap": 20,
+            },
+        )
+        single_b = json.loads((root_dir / "model_b_evaluation" / "results.json").read_text())
+
+    assert results["model_b"] == single_b, "Batch results should match evaluating the set on its own."
+    assert results["model_a"] != results["model_b"]
+    for name, set_results in results.items():
+        assert set(set_results["samples_equally_weighted"]) == METRICS, name
+
+
+def test_evaluates_predictions_path():
+    with TemporaryDirectory() as root_dir:
+        root_dir = Path(root_dir)
+        for name in ("a", "b"):
+            predictions_dir = root_dir / name / "predictions"
+            predictions_dir.mkdir(parents=True)
+            make_predictions(5).write_parquet(predictions_dir / "held_out.parquet")
+
+        def evaluate(name: str, output_name: str, **kwargs) -> Path:
+            run_command(
+                "meds-dev-evaluation",
+                test_name=f"Evaluation of {name} with only predictions_path should succeed",
+                hydra_kwargs={
+                    "predictions_path": str(root_dir / name / "predictions" / "*.parquet"),
+                    "output_dir": str(root_dir / output_name),
+                    **kwargs,
+                },
+            )
+            results_fp = root_dir / output_name / "results.json"
+            assert results_fp.is_file()
+            return results_fp
+
+        evaluate("a", "evaluation")
+
+        # With a stage cache, the same predictions stored elsewhere are materialized from the cache entry (via
+        # hard links), and changed predictions are evaluated anew.
+        cache_kwargs = {"stage_cache_dir": str(root_dir / "stage_cache")}
+        cached_a = evaluate("a", "cached_a", **cache_kwargs)
+        cached_b = evaluate("b", "cached_b", **cache_kwargs)
+        assert cached_b.stat().st_ino == cached_a.stat().st_ino or cached_b.is_symlink()
+
+        make_predictions(6).write_parquet(root_dir / "b" / "predictions" / "held_out.parquet")
+        cached_b = evaluate("b", "cached_b", **cache_kwargs)
+        assert cached_b.read_text() != cached_a.read_text()
+
+
+def test_evaluates_streaming():
+    with TemporaryDirectory() as root_dir:
+        root_dir = Path(root_dir)
+        predictions_dir = root_dir / "predictions"
+        predictions_dir.mkdir()
+        for i in range(3):
+            make_predictions(i).write_parquet(predictions_dir / f"{i}.parquet")
+
+        results = {}
+        for max_rows_in_memory in (0, 1000):
+            output_dir = root_dir / f"evaluation_{max_rows_in_memory}"
+            run_command(
+                "meds-dev-evaluation",
+                test_name="Streaming evaluation should succeed",
+                hydra_kwargs={
+                    "predictions_dir": str(predictions_dir),
+                    "output_dir": str(output_dir),
+                    "streaming": True,
+                    "max_rows_in_memory": max_rows_in_memory,
+                    "n_bootstrap": 0,
+                },
+            )
+            results[max_rows_in_memory] = json.loads((output_dir / "results.json").read_text())
+
+    streamed, exact = results[0], results[1000]
+    assert list(streamed) == ["samples_equally_weighted", "approximation_error_bounds"]
+    assert "subjects_equally_weighted" in exact, "Predictions that fit in memory should be evaluated exactly."
+    assert set(streamed["samples_equally_weighted"]) == METRICS
+
+    bounds = streamed["approximation_error_bounds"]["samples_equally_weighted"]
+    for name, value in streamed["samples_equally_weighted"].items():
+        error = abs(value - exact["samples_equally_weighted"][name])
+        assert error <= bounds.get(name, 1e-12), f"The streamed {name} should be within its error bound."
+
+
+def test_validates_predictions_before_evaluating():
+    predictions = make_predictions(4)
+    labels = predictions.select("subject_id", "prediction_time", "boolean_value")
+
+    with TemporaryDirectory() as root_dir:
+        root_dir = Path(root_dir)
+        labels_fp = root_dir / "labels" / "held_out" / "0.parquet"
+        labels_fp.parent.mkdir(parents=True)
+        labels.write_parquet(labels_fp)
+
+        def evaluate(predictions: pl.DataFrame, name: str, **kwargs):
+            predictions_dir = root_dir / name / "predictions"
+            predictions_dir.mkdir(parents=True)
+            predictions.write_parquet(predictions_dir / "held_out.parquet")
+            return run_command(
+                "meds-dev-evaluation",
+                test_name=f"Evaluation of {name} predictions",
+                hydra_kwargs={
+                    "predictions_dir": str(predictions_dir),
+                    "output_dir": str(root_dir / name / "evaluation"),
+                    "labels_path": str(labels_fp),
+                    "in_process": True,
+                    "n_bootstrap": 0,
+                },
+                **kwargs,
+            )
+
+        evaluate(predictions.sample(fraction=1, shuffle=True, seed=0), "valid")
+        assert (root_dir / "valid" / "evaluation" / "results.json").is_file()
+
+        evaluate(
+            predictions.with_columns(pl.col("predicted_boolean_probability") * 2),
+            "out_of_range",
+            should_error=True,
+            want_err_msg="predicted probabilities are NaN or outside of [0, 1]",
+        )
+        evaluate(
+            predictions[1:],
+            "misaligned",
+            should_error=True,
+            want_err_msg=f"There are {len(predictions) - 1} predictions for {len(predictions)} labels",
+        )
+        assert not (root_dir / "misaligned" / "evaluation" / "results.json").exists()
+
+        # Prediction sets are each checked against the same labels.
+        prediction_sets = {}
+        for name, set_predictions in {
+            "set_a": predictions.sample(fraction=1, shuffle=True, seed=1),
+            "set_b": predictions.reverse(),
+        }.items():
+            predictions_dir = root_dir / "sets" / name
+            predictions_dir.mkdir(parents=True)
+            set_predictions.write_parquet(predictions_dir / "held_out.parquet")
+            prediction_sets[f"+prediction_sets.{name}"] = str(predictions_dir)
+        sets_kwargs = {"labels_path": str(labels_fp), "n_bootstrap": 0, **prediction_sets}
+        run_command(
+            "meds-dev-evaluation",
+            test_name="Validated evaluation of prediction sets",
+            hydra_kwargs={"output_dir": str(root_dir / "sets" / "evaluation"), **sets_kwargs},
+        )
+        assert (root_dir / "sets" / "evaluation" / "set_b" / "results.json").is_file()
+
+        predictions[1:].write_parquet(root_dir / "sets" / "set_b" / "held_out.parquet")
+        run_command(
+            "meds-dev-evaluation",
+            test_name="Validated evaluation of a misaligned prediction set",
+            hydra_kwargs={"output_dir": str(root_dir / "sets" / "evaluation_2"), **sets_kwargs},
+            should_error=True,
+            want_err_msg=f"There are {len(predictions) - 1} predictions for {len(predictions)} labels",
+        )
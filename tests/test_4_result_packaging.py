@@ -1,3 +1,4 @@
+import json
 import random
 import subprocess
 import tempfile
@@ -84,3 +85,82 @@ def test_packages_result(packaged_result: Path):
         subprocess.run(["meds-dev-validate-result", f"result_fp={results_fp}"], check=True)
     except subprocess.CalledProcessError as e:
         raise AssertionError("Result should be valid according to MEDS-DEV validator") from e
+
+
+def test_results_warehouse(packaged_result: Path):
+    def run(*args: str):
+        cmd = ["meds-dev-results", *args]
+        out = subprocess.run(cmd, check=False, capture_output=True)
+        assert out.returncode == 0, f"meds-dev-results failed:\n{out.stderr.decode()}"
+        return out
+
+    packaged = Result.from_json(packaged_result)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        results_dir = Path(tempdir) / "results"
+        warehouse_dir = Path(tempdir) / "warehouse"
+        leaderboard_fp = Path(tempdir) / "leaderboard.json"
+
+        (results_dir / "nested").mkdir(parents=True)
+        (results_dir / "nested" / "packaged.json").write_text(packaged_result.read_text())
+        for i, (model, auroc) in enumerate([("genhpf", 0.9), ("genhpf", 0.6), ("cehrbert", 0.7)]):
+            Result(
+                dataset=packaged.dataset,
+                task=packaged.task,
+                model=model,
+                version=packaged.version,
+                timestamp=packaged.timestamp - timedelta(days=3 - i),
+                result={"samples_equally_weighted": {"roc_auc_score": auroc}},
+            ).to_json(results_dir / f"{i}.json")
+        (results_dir / "broken.json").write_text("{")
+
+        run(f"warehouse_dir={warehouse_dir}", f"results_dir={results_dir}", "n_workers=2")
+        assert (warehouse_dir / "results.db").is_file()
+
+        run(
+            f"warehouse_dir={warehouse_dir}",
+            f"leaderboard.task={packaged.task}",
+            f"leaderboard.output_fp={leaderboard_fp}",
+        )
+        leaderboard = json.loads(leaderboard_fp.read_text())
+        values = {row["model"]: row["value"] for row in leaderboard}
+        assert set(values) == {"genhpf", "cehrbert", packaged.model}, f"Unexpected leaderboard {leaderboard}"
+        assert values["genhpf"] == 0.6, "Only the latest result of each model should be ranked"
+        assert [row["value"] for row in leaderboard] == sorted(values.values(), reverse=True)
+
+        # Re-ingesting is incremental, and removed files are pruned.
+        (results_dir / "0.json").unlink()
+        out = run(f"warehouse_dir={warehouse_dir}", f"results_dir={results_dir}", "prune=True")
+        assert "removed 1 stale results" in out.stdout.decode() + out.stderr.decode()
+
+
+def test_validate_results_batch(packaged_result: Path):
+    with tempfile.TemporaryDirectory() as tempdir:
+        results_dir = Path(tempdir) / "results"
+        report_fp = Path(tempdir) / "report.json"
+        (results_dir / "nested").mkdir(parents=True)
+        for i in range(3):
+            (results_dir / "nested" / f"{i}.json").write_text(packaged_result.read_text())
+
+        def run(results: str, *args: str):
+            cmd = ["meds-dev-validate-result", f"results={results}", f"report_fp={report_fp}", *args]
+            return subprocess.run(cmd, check=False, capture_output=True)
+
+        out = run(str(results_dir), "n_workers=2")
+        assert out.returncode == 0, f"Batch validation should pass:\n{out.stderr.decode()}"
+        report = json.loads(report_fp.read_text())
+        assert (report["n_files"], report["n_valid"], report["n_invalid"]) == (3, 3, 0)
+
+        (results_dir / "empty.json").write_text("")
+        (results_dir / "large.json").write_text(" " * 2048)
+        out = run(str(results_dir))
+        assert out.returncode != 0, "Batch validation should fail if any file is invalid"
+        assert "2 of 5 result files are invalid" in out.stderr.decode()
+        report = json.loads(report_fp.read_text())
+        errors = {Path(f["path"]).name: f["error"] for f in report["files"] if not f["valid"]}
+        assert errors["large.json"] == "Result file is too large (2.00 KB > 1.5 KB)"
+        assert errors["empty.json"].startswith("Could not read result: JSONDecodeError")
+
+        out = run(f"{results_dir}/nested/*.json")
+        assert out.returncode == 0, f"Batch validation of a glob should pass:\n{out.stderr.decode()}"
+        assert json.loads(report_fp.read_text())["n_files"] == 3
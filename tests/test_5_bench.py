@@ -0,0 +1,95 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from MEDS_DEV import MODELS
+from MEDS_DEV.bench import Stage
+from MEDS_DEV.bench.job_queue import queue_status, run_queue_worker, submit_graph
+from tests.utils import run_command
+
+
+def test_bench_non_model_breaks():
+    non_model = "_not_supported"
+    while non_model in MODELS:
+        non_model = f"_{non_model}"
+
+    with TemporaryDirectory() as root_dir:
+        output_dir = Path(root_dir) / "output"
+        run_command(
+            "meds-dev-bench",
+            test_name="Benchmark with a non-model should error",
+            hydra_kwargs={"models": [non_model], "output_dir": str(output_dir.resolve())},
+            should_error=True,
+            want_err_msg=f"Model {non_model} not currently configured",
+        )
+
+
+def _start_worker(queue_dir: Path, **kwargs) -> subprocess.Popen:
+    code = (
+        "import json, sys\n"
+        "from MEDS_DEV.bench.job_queue import run_queue_worker\n"
+        f"print(json.dumps(run_queue_worker({str(queue_dir)!r}, **{kwargs!r})))\n"
+    )
+    # Each worker gets its own session, so that it can be killed along with the job it is running.
+    return subprocess.Popen(
+        [sys.executable, "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True
+    )
+
+
+def test_job_queue_workers_share_jobs():
+    with TemporaryDirectory() as root_dir:
+        queue_dir, runs_dir = Path(root_dir) / "queue", Path(root_dir) / "runs"
+        runs_dir.mkdir()
+
+        # Each job records every time it runs, then takes long enough for all workers to find work.
+        record = "import sys, time; open(sys.argv[1], 'a').write('x'); time.sleep(1)"
+        graph = {
+            f"job/{i}": Stage(f"job/{i}", ["python", "-c", record, str(runs_dir / str(i))]) for i in range(6)
+        }
+        graph["all"] = Stage("all", ["python", "-c", "pass"], depends_on=tuple(graph))
+        submit_graph(queue_dir, graph)
+
+        workers = [_start_worker(queue_dir, poll_s=0.2) for _ in range(3)]
+        ran = []
+        for worker in workers:
+            stdout, stderr = worker.communicate(timeout=120)
+            assert worker.returncode == 0, f"Worker failed:\n{stderr.decode()}"
+            ran.append(json.loads(stdout))
+
+        assert queue_status(queue_dir) == dict.fromkeys(graph, "done")
+        assert sorted(name for worker_ran in ran for name in worker_ran) == sorted(graph)
+        assert sum(1 for worker_ran in ran if worker_ran) >= 2, f"Jobs were not shared across workers: {ran}"
+        for i in range(6):
+            assert (runs_dir / str(i)).read_text() == "x", f"Job {i} did not run exactly once"
+
+
+def test_job_queue_reclaims_jobs_of_dead_workers():
+    with TemporaryDirectory() as root_dir:
+        queue_dir, started_fp = Path(root_dir) / "queue", Path(root_dir) / "started"
+
+        # The job hangs the first time it runs, and finishes immediately when run again.
+        hang_once = (
+            "import os, sys, time; os.path.exists(sys.argv[1]) or (open(sys.argv[1], 'w'), time.sleep(300))"
+        )
+        submit_graph(
+            queue_dir, {"hang_once": Stage("hang_once", ["python", "-c", hang_once, str(started_fp)])}
+        )
+
+        worker = _start_worker(queue_dir, stale_after_s=2.0, poll_s=0.2)
+        deadline = time.time() + 60
+        while not started_fp.exists():
+            assert time.time() < deadline and worker.poll() is None, "The first worker never started the job"
+            time.sleep(0.1)
+        os.killpg(worker.pid, signal.SIGKILL)
+        worker.wait()
+
+        assert queue_status(queue_dir) == {"hang_once": "running"}
+        ran = run_queue_worker(queue_dir, stale_after_s=2.0, poll_s=0.2)
+        assert ran == {"hang_once": "done"}
+        assert queue_status(queue_dir) == {"hang_once": "done"}
+        assert not list((queue_dir / "running").iterdir())
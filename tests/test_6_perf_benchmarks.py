@@ -0,0 +1,55 @@
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from MEDS_DEV.benchmarks import STAGES
+from tests.utils import run_command
+
+
+def test_perf_benchmarks_missing_baseline_breaks():
+    with TemporaryDirectory() as root_dir:
+        run_command(
+            "meds-dev-perf",
+            test_name="Benchmarking against a missing baseline should error",
+            hydra_kwargs={
+                "n_subjects": 200,
+                "output_dir": str(Path(root_dir) / "output"),
+                "baseline_fp": str(Path(root_dir) / "baseline.json"),
+            },
+            should_error=True,
+            want_err_msg="Baseline report",
+        )
+
+
+def test_perf_benchmarks_flag_regressions():
+    with TemporaryDirectory() as root_dir:
+        root_dir = Path(root_dir)
+        output_dir = root_dir / "output"
+
+        # A baseline in which every stage was (implausibly) instantaneous, so every stage regresses.
+        baseline_fp = root_dir / "baseline.json"
+        baseline = {"scales": {"200_subjects": {stage: {"wall_time_s": 0.01} for stage in STAGES}}}
+        baseline_fp.write_text(json.dumps(baseline))
+
+        run_command(
+            "meds-dev-perf",
+            test_name="Benchmarks should flag regressions against the baseline",
+            hydra_kwargs={
+                "n_subjects": 200,
+                "output_dir": str(output_dir),
+                "baseline_fp": str(baseline_fp),
+                "min_delta_s": 0.0,
+            },
+            should_error=True,
+            want_err_msg="regressed by more than 20%",
+        )
+
+        report = json.loads((output_dir / "report.json").read_text())
+        assert list(report["scales"]) == ["200_subjects"]
+        timings = report["scales"]["200_subjects"]
+        assert list(timings) == list(STAGES)
+        for stage, timing in timings.items():
+            assert timing["wall_time_s"] > 0, f"Stage {stage} should have been timed."
+            assert len(timing["runs"]) == 1
+        assert sorted(r["stage"] for r in report["regressions"]) == sorted(STAGES)
+        assert not (output_dir / "200_subjects" / "run_0").exists(), "Outputs should have been removed."